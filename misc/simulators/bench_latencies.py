@@ -0,0 +1,70 @@
+"""
+Measure what keeping latency statistics costs a storage server.
+
+Every storage RPC ends with a call to StorageServer.add_latency(), and every
+stats poll calls get_latencies(). This compares the streaming histograms in
+allmydata.util.latency with the list of the last 1000 samples that the
+storage server used to keep. Run it like this:
+
+python bench_latencies.py
+"""
+
+import random
+
+from pyutil import benchutil
+
+from allmydata.util.latency import WindowedLatencyHistogram
+
+class SampleList(object):
+    # the old approach: keep the last 1000 samples, sort them when asked
+    def init(self, N):
+        self.samples = []
+        self.values = [random.expovariate(100) for i in range(N)]
+
+    def add(self, N):
+        for value in self.values:
+            self.samples.append(value)
+            if len(self.samples) > 1000:
+                self.samples = self.samples[-1000:]
+
+    def report(self, N):
+        for i in xrange(N):
+            samples = self.samples[:]
+            samples.sort()
+            for p in (0.01, 0.1, 0.5, 0.9, 0.95, 0.99, 0.999):
+                samples[int(p*len(samples))]
+
+class Histogram(object):
+    def init(self, N):
+        self.h = WindowedLatencyHistogram()
+        self.values = [random.expovariate(100) for i in range(N)]
+
+    def add(self, N):
+        for value in self.values:
+            self.h.add(value)
+
+    def report(self, N):
+        for i in xrange(N):
+            for window in (60, 5*60, 60*60):
+                h = self.h.get_histogram(window)
+                h.get_percentiles((0.01, 0.1, 0.5, 0.9, 0.95, 0.99, 0.999))
+
+def bench(klass):
+    b = klass()
+    print "%s.add, per sample:" % klass.__name__
+    for N in [1000, 10000, 100000]:
+        print "%7d" % N,
+        benchutil.rep_bench(b.add, N, initfunc=b.init, runreps=3,
+                            UNITS_PER_SECOND=1000000)
+    print "%s.report, per stats poll (after 10000 samples):" % klass.__name__
+    b.init(10000)
+    b.add(10000)
+    for N in [10, 100]:
+        print "%7d" % N,
+        benchutil.rep_bench(b.report, N, runreps=3, UNITS_PER_SECOND=1000000)
+
+benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
+print "(microseconds)"
+
+bench(SampleList)
+bench(Histogram)
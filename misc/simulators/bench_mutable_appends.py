@@ -0,0 +1,86 @@
+"""
+Measure what appending to a mutable share costs the storage server.
+
+An MDMF file that is extended a little at a time makes its shares grow by a
+small amount on each write. Each time a share outgrows its container, the
+extra leases stored after the data have to be moved. This compares
+MutableShareFile's container growth factors, and shows how long it takes
+compact() to give the spare room back afterwards. Run it like this:
+
+python bench_mutable_appends.py
+"""
+
+import os, shutil, tempfile
+
+from pyutil import benchutil
+
+from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.mutable import MutableShareFile
+
+BLOCK = 4096 # bytes appended to the share by each write
+EXTRA_LEASES = 4 # leases beyond the four that live in the header
+
+class Appender(object):
+    def __init__(self, growth_factor):
+        self.growth_factor = growth_factor
+        self.tmpdir = tempfile.mkdtemp()
+
+    def init(self, N):
+        fn = os.path.join(self.tmpdir, "share")
+        if os.path.exists(fn):
+            os.unlink(fn)
+        MutableShareFile(fn).create("\x00"*20, "\x00"*32)
+        self.msf = MutableShareFile(fn, growth_factor=self.growth_factor)
+        for i in range(4 + EXTRA_LEASES):
+            self.msf.add_lease(LeaseInfo(1, "r%031d" % i, "c%031d" % i,
+                                         0, "\x00"*20))
+        self.data = "a" * BLOCK
+
+    def append(self, N):
+        for i in xrange(N):
+            self.msf.writev([(i*BLOCK, self.data)], None)
+
+    def append_and_compact(self, N):
+        self.append(N)
+        self.msf.compact()
+
+    def cleanup(self):
+        shutil.rmtree(self.tmpdir)
+
+def count_moves(growth_factor, N):
+    a = Appender(growth_factor)
+    a.init(N)
+    offsets = set()
+    for i in xrange(N):
+        a.msf.writev([(i*BLOCK, a.data)], None)
+        f = open(a.msf.home, "rb")
+        offsets.add(a.msf._read_extra_lease_offset(f))
+        f.close()
+    size = os.path.getsize(a.msf.home)
+    a.cleanup()
+    return len(offsets), size
+
+def bench(growth_factor):
+    print "growth factor %.1f, per %d-byte append:" % (growth_factor, BLOCK)
+    a = Appender(growth_factor)
+    for N in [100, 1000, 10000]:
+        print "%7d" % N,
+        benchutil.rep_bench(a.append, N, initfunc=a.init, runreps=3,
+                            UNITS_PER_SECOND=1000000)
+    print "growth factor %.1f, per append, including a compact() at the end:" \
+          % growth_factor
+    for N in [100, 1000, 10000]:
+        print "%7d" % N,
+        benchutil.rep_bench(a.append_and_compact, N, initfunc=a.init,
+                            runreps=3, UNITS_PER_SECOND=1000000)
+    a.cleanup()
+    for N in [100, 1000, 10000]:
+        moves, size = count_moves(growth_factor, N)
+        print "%7d appends: leases moved %d times, file is %d bytes" % \
+              (N, moves, size)
+
+benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
+print "(microseconds)"
+
+for growth_factor in (1.0, 1.5, 2.0):
+    bench(growth_factor)
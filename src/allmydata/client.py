@@ -2,7 +2,7 @@ import os, stat, time, weakref
 from allmydata import node
 
 from zope.interface import implements
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
 from twisted.application import service
 from twisted.application.internet import TimerService
 from pycryptopp.publickey import rsa
@@ -16,6 +16,7 @@ from allmydata.control import ControlServer
 from allmydata.introducer.client import IntroducerClient
 from allmydata.util import hashutil, base32, pollmixin, log, keyutil
 from allmydata.util.encodingutil import get_filesystem_encoding
+from allmydata.util.fileutil import abspath_expanduser_unicode
 from allmydata.util.abbreviate import parse_abbreviated_size
 from allmydata.util.time_format import parse_duration, parse_date
 from allmydata.stats import StatsProvider
@@ -23,6 +24,7 @@ from allmydata.history import History
 from allmydata.interfaces import IStatsProducer, SDMF_VERSION, MDMF_VERSION
 from allmydata.nodemaker import NodeMaker
 from allmydata.blacklist import Blacklist
+from allmydata.keypool import KeyPool
 from allmydata.node import OldConfigOptionError
 
 
@@ -49,17 +51,29 @@ class SecretHolder:
     def get_convergence_secret(self):
         return self._convergence_secret
 
+    def get_key_pool_secret(self):
+        return hashutil.my_key_pool_secret_hash(self._lease_secret)
+
 class KeyGenerator:
     """I create RSA keys for mutable files. Each call to generate() returns a
     single keypair. The keysize is specified first by the keysize= argument
     to generate(), then with a default set by set_default_keysize(), then
-    with a built-in default of 2048 bits."""
+    with a built-in default of 2048 bits.
+
+    If I am given a KeyPool, keys of the default size are taken from it when
+    it has any. When it is empty I wait for its worker to make the next one,
+    and if there is no worker to wait for, the key is generated in a thread:
+    either way the reactor is not held up."""
     def __init__(self):
         self._remote = None
+        self._pool = None
         self.default_keysize = 2048
 
     def set_remote_generator(self, keygen):
         self._remote = keygen
+    def set_key_pool(self, pool):
+        self._pool = pool
+        pool.set_keysize(self.default_keysize)
     def set_default_keysize(self, keysize):
         """Call this to override the size of the RSA keys created for new
         mutable files which don't otherwise specify a size. This will affect
@@ -68,6 +82,8 @@ class KeyGenerator:
         during setup, to cause me to create smaller keys, so the unit tests
         run faster."""
         self.default_keysize = keysize
+        if self._pool:
+            self._pool.set_keysize(keysize)
 
     def generate(self, keysize=None):
         """I return a Deferred that fires with a (verifyingkey, signingkey)
@@ -85,12 +101,29 @@ class KeyGenerator:
                 return v, s
             d.addCallback(make_key_objs)
             return d
-        else:
-            # RSA key generation for a 2048 bit key takes between 0.8 and 3.2
-            # secs
-            signer = rsa.generate(keysize)
-            verifier = signer.get_verifying_key()
-            return defer.succeed( (verifier, signer) )
+        if self._pool:
+            signing_key = self._pool.get_key(keysize)
+            if signing_key:
+                return defer.succeed(self._make_keypair(signing_key))
+            d = self._pool.wait_for_key(keysize)
+            def _got_key(signing_key):
+                if signing_key:
+                    return self._make_keypair(signing_key)
+                d2 = threads.deferToThread(rsa.generate, keysize)
+                d2.addCallback(lambda signer:
+                               (signer.get_verifying_key(), signer))
+                return d2
+            d.addCallback(_got_key)
+            return d
+        # RSA key generation for a 2048 bit key takes between 0.8 and 3.2
+        # secs
+        signer = rsa.generate(keysize)
+        verifier = signer.get_verifying_key()
+        return defer.succeed( (verifier, signer) )
+
+    def _make_keypair(self, signing_key):
+        s = rsa.create_signing_key_from_string(signing_key)
+        return (s.get_verifying_key(), s)
 
 class Terminator(service.Service):
     def __init__(self):
@@ -143,6 +176,8 @@ class Client(node.Node, pollmixin.PollMixin):
         key_gen_furl = self.get_config("client", "key_generator.furl", None)
         if key_gen_furl:
             self.init_key_gen(key_gen_furl)
+        if self.get_config("client", "mutable.key_pool", False, boolean=True):
+            self.init_key_pool()
         self.init_client()
         # ControlServer and Helper are attached after Tub startup
         self.init_ftp_server()
@@ -244,6 +279,10 @@ class Client(node.Node, pollmixin.PollMixin):
         self._maybe_create_node_key()
 
         storedir = os.path.join(self.basedir, self.STOREDIR)
+        extra_dirs = self.get_config("storage", "extra_dirs", "").decode('utf-8')
+        extra_storedirs = [abspath_expanduser_unicode(os.path.join(self.basedir,
+                                                                   d.strip()))
+                           for d in extra_dirs.split(",") if d.strip()]
 
         data = self.get_config("storage", "reserved_space", None)
         reserved = None
@@ -279,6 +318,21 @@ class Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        durability = self.get_config("storage", "durability", "none")
+        io_threads = int(self.get_config("storage", "io_threads", "0"))
+        crawler_io_threads = int(self.get_config("storage",
+                                                 "crawler_io_threads", "0"))
+        combined_crawler = self.get_config("storage", "combined_crawler",
+                                           False, boolean=True)
+        mutable_growth_factor = float(self.get_config("storage",
+                                                      "mutable_growth_factor",
+                                                      "1.0"))
+        compact_mutable_shares = self.get_config("storage",
+                                                 "compact_mutable_shares",
+                                                 False, boolean=True)
+        readv_cache_size = parse_abbreviated_size(
+            self.get_config("storage", "readv_cache_size", "0"))
+
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
                            discard_storage=discard,
@@ -288,7 +342,15 @@ class Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           durability=durability,
+                           io_threads=io_threads,
+                           extra_storedirs=extra_storedirs,
+                           crawler_io_threads=crawler_io_threads,
+                           combined_crawler=combined_crawler,
+                           mutable_growth_factor=mutable_growth_factor,
+                           compact_mutable_shares=compact_mutable_shares,
+                           readv_cache_size=readv_cache_size)
         self.add_service(ss)
 
         d = self.when_tub_ready()
@@ -419,6 +481,12 @@ class Client(node.Node, pollmixin.PollMixin):
         d.addErrback(log.err, facility="tahoe.init",
                      level=log.BAD, umid="z9DMzw")
 
+    def init_key_pool(self):
+        poolfile = os.path.join(self.basedir, "private", "key_pool")
+        pool = KeyPool(poolfile, self._secret_holder.get_key_pool_secret())
+        pool.setServiceParent(self)
+        self._key_generator.set_key_pool(pool)
+
     def _got_key_generator(self, key_generator):
         self._key_generator.set_remote_generator(key_generator)
         key_generator.notifyOnDisconnect(self._lost_key_generator)
@@ -436,7 +504,10 @@ class Client(node.Node, pollmixin.PollMixin):
         nodeurl_path = os.path.join(self.basedir, "node.url")
         staticdir = self.get_config("node", "web.static", "public_html")
         staticdir = os.path.expanduser(staticdir)
-        ws = WebishServer(self, webport, nodeurl_path, staticdir)
+        mutation_window = float(self.get_config("node", "web.mutation_window",
+                                                "0"))
+        ws = WebishServer(self, webport, nodeurl_path, staticdir,
+                          mutation_window=mutation_window)
         self.add_service(ws)
 
     def init_ftp_server(self):
@@ -533,9 +604,11 @@ class Client(node.Node, pollmixin.PollMixin):
     def create_immutable_dirnode(self, children, convergence=None):
         return self.nodemaker.create_immutable_directory(children, convergence)
 
-    def create_mutable_file(self, contents=None, keysize=None, version=None):
+    def create_mutable_file(self, contents=None, keysize=None, version=None,
+                            segment_size=None):
         return self.nodemaker.create_mutable_file(contents, keysize,
-                                                  version=version)
+                                                  version=version,
+                                                  segment_size=segment_size)
 
     def upload(self, uploadable):
         uploader = self.getServiceNamed("uploader")
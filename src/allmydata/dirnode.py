@@ -15,6 +15,7 @@ from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
+from allmydata.storage_client import LeaseBatcher
 from allmydata.util import hashutil, mathutil, base32, log
 from allmydata.util.encodingutil import quote_output
 from allmydata.util.assertutil import precondition
@@ -171,6 +172,119 @@ class Adder:
         new_contents = self.node._pack_contents(children)
         return new_contents
 
+class Batcher:
+    """I apply a list of operations to a directory in a single modify
+    cycle. Each operation is one of:
+
+     ("set", namex, child, metadata, overwrite)
+     ("delete", namex, must_exist)
+     ("rename", from_namex, to_namex, overwrite)
+     ("set-metadata", namex, metadata)
+
+    with the same meaning as the arguments of set_node(), delete(),
+    move_child_to() and set_metadata_for(). They are applied in order, and
+    each one succeeds or fails on its own: an operation that fails leaves
+    the directory as the ones before it left it, and the rest are still
+    applied. After modify() has run, self.results holds None for each
+    operation that succeeded and the exception for each one that failed.
+    """
+    def __init__(self, node, operations, create_readonly_node=None):
+        self.node = node
+        self.operations = operations
+        self.create_readonly_node = create_readonly_node
+        self.results = []
+
+    def modify(self, old_contents, servermap, first_time):
+        children = self.node._unpack_contents(old_contents)
+        now = time.time()
+        self.results = []
+        changed = False
+        for op in self.operations:
+            try:
+                applier = getattr(self, "_apply_" + op[0].replace("-", "_"))
+                changed = applier(children, now, first_time, *op[1:]) or changed
+            except Exception, e:
+                # appliers check everything before they change 'children'
+                self.results.append(e)
+            else:
+                self.results.append(None)
+        if not changed:
+            return None
+        return self.node._pack_contents(children)
+
+    def _apply_set(self, children, now, first_time,
+                   namex, child, new_metadata, overwrite):
+        name = normalize(namex)
+        precondition(IFilesystemNode.providedBy(child), child)
+        child.raise_error()
+        metadata = None
+        if name in children:
+            old_child = children[name][0]
+            if (not first_time and
+                old_child.get_uri() == child.get_uri()):
+                # we set it in an earlier attempt that we thought failed
+                pass
+            elif not overwrite:
+                raise ExistingChildError("child %s already exists"
+                                         % quote_output(name, encoding='utf-8'))
+            elif (overwrite == "only-files" and
+                  IDirectoryNode.providedBy(old_child)):
+                raise ExistingChildError("child %s already exists"
+                                         % quote_output(name, encoding='utf-8'))
+            metadata = children[name][1].copy()
+        metadata = update_metadata(metadata, new_metadata, now)
+        if self.create_readonly_node and metadata.get('no-write', False):
+            child = self.create_readonly_node(child, name)
+        children[name] = (child, metadata)
+        return True
+
+    def _apply_delete(self, children, now, first_time, namex, must_exist=True):
+        name = normalize(namex)
+        if name not in children:
+            if first_time and must_exist:
+                raise NoSuchChildError(name)
+            return False
+        del children[name]
+        return True
+
+    def _apply_rename(self, children, now, first_time,
+                      from_namex, to_namex, overwrite=True):
+        from_name = normalize(from_namex)
+        to_name = normalize(to_namex)
+        if from_name == to_name:
+            return False
+        if from_name not in children:
+            if not first_time and to_name in children:
+                # we renamed it in an earlier attempt
+                return False
+            raise NoSuchChildError(from_name)
+        child, metadata = children[from_name]
+        if to_name in children:
+            if not overwrite:
+                raise ExistingChildError("child %s already exists"
+                                         % quote_output(to_name, encoding='utf-8'))
+            if (overwrite == "only-files" and
+                IDirectoryNode.providedBy(children[to_name][0])):
+                raise ExistingChildError("child %s already exists"
+                                         % quote_output(to_name, encoding='utf-8'))
+        # the edge keeps its metadata, but has been modified
+        metadata = update_metadata(metadata.copy(), None, now)
+        del children[from_name]
+        children[to_name] = (child, metadata)
+        return True
+
+    def _apply_set_metadata(self, children, now, first_time,
+                            namex, new_metadata):
+        name = normalize(namex)
+        if name not in children:
+            raise NoSuchChildError(name)
+        child = children[name][0]
+        metadata = update_metadata(children[name][1].copy(), new_metadata, now)
+        if self.create_readonly_node and metadata.get('no-write', False):
+            child = self.create_readonly_node(child, name)
+        children[name] = (child, metadata)
+        return True
+
 def _encrypt_rw_uri(writekey, rw_uri):
     precondition(isinstance(rw_uri, str), rw_uri)
     precondition(isinstance(writekey, str), writekey)
@@ -281,10 +395,13 @@ class DirectoryNode:
         a Deferred that fires with the result."""
         return self._node.get_current_size()
 
-    def _read(self):
+    def _read(self, version=None):
         if self._node.is_mutable():
             # use the IMutableFileNode API.
-            d = self._node.download_best_version()
+            if version is not None:
+                d = version.download_to_data()
+            else:
+                d = self._node.download_best_version()
         else:
             d = download_to_data(self._node)
         d.addCallback(self._unpack_contents)
@@ -425,10 +542,13 @@ class DirectoryNode:
     def check_and_repair(self, monitor, verify=False, add_lease=False):
         return self._node.check_and_repair(monitor, verify, add_lease)
 
-    def list(self):
+    def list(self, version=None):
         """I return a Deferred that fires with a dictionary mapping child
         name to a tuple of (IFilesystemNode, metadata)."""
-        return self._read()
+        return self._read(version)
+
+    def get_best_readable_version(self):
+        return self._node.get_best_readable_version()
 
     def has_child(self, namex):
         """I return a Deferred that fires with a boolean, True if there
@@ -614,6 +734,19 @@ class DirectoryNode:
         d.addCallback(lambda res: deleter.old_child)
         return d
 
+    def apply_batch(self, operations):
+        """I apply a list of operations (see Batcher for their format) in a
+        single modify cycle. I return a Deferred that fires with a list that
+        has None for each operation that succeeded and the exception for
+        each one that failed."""
+        if self.is_readonly():
+            return defer.fail(NotWriteableError())
+        b = Batcher(self, operations,
+                    create_readonly_node=self._create_readonly_node)
+        d = self._node.modify(b.modify)
+        d.addCallback(lambda res: b.results)
+        return d
+
     # XXX: Too many arguments? Worthwhile to break into mutable/immutable?
     def create_subdirectory(self, namex, initial_children={}, overwrite=True,
                             mutable=True, mutable_version=None, metadata=None):
@@ -922,6 +1055,9 @@ class DeepChecker:
                            si=root_si_base32, verify=verify, repair=repair)
         self._verify = verify
         self._repair = repair
+        if add_lease:
+            # send the leases for many files in each message
+            add_lease = LeaseBatcher()
         self._add_lease = add_lease
         if repair:
             self._results = DeepCheckAndRepairResults(root_si)
@@ -947,9 +1083,15 @@ class DeepChecker:
         return self._stats.enter_directory(parent, children)
 
     def finish(self):
-        log.msg("deep-check done", parent=self._lp)
-        self._results.update_stats(self._stats.get_results())
-        return self._results
+        d = defer.succeed(None)
+        if self._add_lease:
+            d.addCallback(lambda ign: self._add_lease.flush())
+        def _done(ign):
+            log.msg("deep-check done", parent=self._lp)
+            self._results.update_stats(self._stats.get_results())
+            return self._results
+        d.addCallback(_done)
+        return d
 
 
 # use client.create_dirnode() to make one of these
@@ -14,6 +14,7 @@ from allmydata.util.hashutil import file_renewal_secret_hash, \
      block_hash
 
 from allmydata.immutable import layout
+from allmydata.storage_client import LeaseBatcher
 
 class IntegrityCheckReject(Exception):
     pass
@@ -472,7 +473,10 @@ class Checker(log.PrefixingLogMixin):
         self._monitor = monitor
         self._servers = servers
         self._verify = verify # bool: verify what the servers claim, or not?
-        self._add_lease = add_lease
+        if add_lease and not isinstance(add_lease, LeaseBatcher):
+            # checking a single file: send its leases right away
+            add_lease = LeaseBatcher(batch_size=1)
+        self._add_lease = add_lease # a LeaseBatcher, or False
 
         frs = file_renewal_secret_hash(secret_holder.get_renewal_secret(),
                                        self._verifycap.get_storage_index())
@@ -500,8 +504,8 @@ class Checker(log.PrefixingLogMixin):
         if self._add_lease:
             renew_secret = self._get_renewal_secret(lease_seed)
             cancel_secret = self._get_cancel_secret(lease_seed)
-            d2 = rref.callRemote("add_lease", storageindex,
-                                 renew_secret, cancel_secret)
+            d2 = self._add_lease.add_lease(s, storageindex,
+                                           renew_secret, cancel_secret)
             d2.addErrback(self._add_lease_failed, s.get_name(), storageindex)
 
         d = rref.callRemote("get_buckets", storageindex)
@@ -15,7 +15,7 @@ from allmydata.hashtree import IncompleteHashTree, BadHashError, \
 # local imports
 from finder import ShareFinder
 from fetcher import SegmentFetcher
-from segmentation import Segmentation
+from segmentation import Segmentation, select_pieces
 from common import BadCiphertextHashError
 
 class IDownloadStatusHandlingConsumer(Interface):
@@ -193,6 +193,10 @@ class DownloadNode:
         segment, so that you can call get_segment() before knowing the
         segment size, and still know which data you received.
 
+        The data is delivered as a list of strings (the buffers produced by
+        the decoder), which must be concatenated to obtain the segment. This
+        lets callers that stream the segment somewhere else avoid copying it.
+
         The Deferred can also errback with other fatal problems, such as
         NotEnoughSharesError, NoSharesError, or BadCiphertextHashError.
         """
@@ -419,7 +423,8 @@ class DownloadNode:
                     seg_ev.error(when)
                     eventually(self._deliver, d, c, result)
             else:
-                (offset, segment, decodetime) = result
+                (offset, pieces, decodetime) = result
+                segment_length = sum([len(piece) for piece in pieces])
                 for (d,c,seg_ev) in self._extract_requests(segnum):
                     # when we have two requests for the same segment, the
                     # second one will not be "activated" before the data is
@@ -429,7 +434,7 @@ class DownloadNode:
                     # Note that this will result in an inaccurate "receive
                     # speed" for the second request.
                     seg_ev.activate(when)
-                    seg_ev.deliver(when, offset, len(segment), decodetime)
+                    seg_ev.deliver(when, offset, segment_length, decodetime)
                     eventually(self._deliver, d, c, result)
             self._download_status.add_misc_event("process_block", start, now())
             self._active_segment = None
@@ -463,28 +468,33 @@ class DownloadNode:
         d = codec.decode(shares, shareids)   # segment
         del shares
         def _process(buffers):
+            # The segment is the concatenation of these buffers. We don't
+            # join them: for primary shares, zfec hands back the very
+            # strings we received from the servers, and everything
+            # downstream can work on the pieces without another copy.
             decodetime = now() - start
-            segment = "".join(buffers)
-            assert len(segment) == decoded_size
-            del buffers
+            assert sum([len(b) for b in buffers]) == decoded_size
             if tail:
-                segment = segment[:self.tail_segment_size]
+                buffers = select_pieces(buffers, 0, self.tail_segment_size)
             self._download_status.add_misc_event("decode", start, now())
-            return (segment, decodetime)
+            return (buffers, decodetime)
         d.addCallback(_process)
         return d
 
-    def _check_ciphertext_hash(self, (segment, decodetime), segnum):
+    def _check_ciphertext_hash(self, (pieces, decodetime), segnum):
         start = now()
         assert self._active_segment.segnum == segnum
         assert self.segment_size is not None
         offset = segnum * self.segment_size
 
-        h = hashutil.crypttext_segment_hash(segment)
+        hasher = hashutil.crypttext_segment_hasher()
+        for piece in pieces:
+            hasher.update(piece)
+        h = hasher.digest()
         try:
             self.ciphertext_hash_tree.set_hashes(leaves={segnum: h})
             self._download_status.add_misc_event("CThash", start, now())
-            return (offset, segment, decodetime)
+            return (offset, pieces, decodetime)
         except (BadHashError, NotEnoughHashesError):
             format = ("hash failure in ciphertext_hash_tree:"
                       " segnum=%(segnum)d, SI=%(si)s")
@@ -11,6 +11,24 @@ from allmydata.interfaces import DownloadStopped
 
 from common import BadSegmentNumberError, WrongSegmentError
 
+def select_pieces(pieces, start, length):
+    """Return a list of strings that make up
+    "".join(pieces)[start:start+length]. Pieces that lie entirely inside the
+    range are passed through without being copied: only the pieces that
+    straddle its edges are sliced."""
+    selected = []
+    end = start + length
+    piece_start = 0
+    for piece in pieces:
+        piece_end = piece_start + len(piece)
+        if max(piece_start, start) < min(piece_end, end):
+            if piece_start < start or piece_end > end:
+                piece = piece[max(start-piece_start, 0):
+                              min(end, piece_end)-piece_start]
+            selected.append(piece)
+        piece_start = piece_end
+    return selected
+
 class Segmentation:
     """I am responsible for a single offset+size read of the file. I handle
     segmentation: I figure out which segments are necessary, request them
@@ -90,19 +108,20 @@ class Segmentation:
         self._cancel_segment_request = None
         return res
 
-    def _got_segment(self, (segment_start,segment,decodetime), wanted_segnum):
+    def _got_segment(self, (segment_start,pieces,decodetime), wanted_segnum):
         self._cancel_segment_request = None
-        # we got file[segment_start:segment_start+len(segment)]
+        segment_length = sum([len(piece) for piece in pieces])
+        # we got file[segment_start:segment_start+segment_length]
         # we want file[self._offset:self._offset+self._size]
         log.msg(format="Segmentation got data:"
                 " want [%(wantstart)d-%(wantend)d),"
                 " given [%(segstart)d-%(segend)d), for segnum=%(segnum)d",
                 wantstart=self._offset, wantend=self._offset+self._size,
-                segstart=segment_start, segend=segment_start+len(segment),
+                segstart=segment_start, segend=segment_start+segment_length,
                 segnum=wanted_segnum,
                 level=log.OPERATIONAL, parent=self._lp, umid="32dHcg")
 
-        o = overlap(segment_start, len(segment),  self._offset, self._size)
+        o = overlap(segment_start, segment_length,  self._offset, self._size)
         # the overlap is file[o[0]:o[0]+o[1]]
         if not o or o[0] != self._offset:
             # we didn't get the first byte, so we can't use this segment
@@ -110,20 +129,24 @@ class Segmentation:
                     " want [%d-%d), given [%d-%d), for segnum=%d,"
                     " for si=%s"
                     % (self._offset, self._offset+self._size,
-                       segment_start, segment_start+len(segment),
+                       segment_start, segment_start+segment_length,
                        wanted_segnum, self._node._si_prefix),
                     level=log.UNUSUAL, parent=self._lp, umid="STlIiA")
             # we may retry if the segnum we asked was based on a guess
             raise WrongSegmentError("I was given the wrong data.")
-        offset_in_segment = self._offset - segment_start
-        desired_data = segment[offset_in_segment:offset_in_segment+o[1]]
-
-        self._offset += len(desired_data)
-        self._size -= len(desired_data)
-        self._consumer.write(desired_data)
-        # the consumer might call our .pauseProducing() inside that write()
-        # call, setting self._hungry=False
-        self._read_ev.update(len(desired_data), 0, 0)
+        desired_pieces = select_pieces(pieces, self._offset - segment_start,
+                                       o[1])
+
+        self._offset += o[1]
+        self._size -= o[1]
+        for piece in desired_pieces:
+            if not self._alive:
+                # the consumer called stopProducing() inside write()
+                return
+            self._consumer.write(piece)
+        # the consumer might call our .pauseProducing() inside those write()
+        # calls, setting self._hungry=False
+        self._read_ev.update(o[1], 0, 0)
         # note: filenode.DecryptingConsumer is responsible for calling
         # _read_ev.update with how much decrypt_time was consumed
         self._maybe_fetch_next()
@@ -147,6 +170,10 @@ class Segmentation:
     def stopProducing(self):
         log.msg("asked to stopProducing",
                 level=log.NOISY, parent=self._lp, umid="XIyL9w")
+        if not self._alive:
+            # we already finished, failed, or were stopped. A consumer which
+            # is written to several times per segment may ask more than once.
+            return
         self._hungry = False
         self._alive = False
         # cancel any outstanding segment request
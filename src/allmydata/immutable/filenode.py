@@ -69,13 +69,23 @@ class CiphertextFileNode:
         segment size, and still know which data you received.
         """
         self._maybe_create_download_node()
-        return self._node.get_segment(segnum)
+        (d,c) = self._node.get_segment(segnum)
+        def _join((offset, pieces, decodetime)):
+            return (offset, "".join(pieces), decodetime)
+        d.addCallback(_join)
+        return (d,c)
 
     def get_segment_size(self):
         # return a Deferred that fires with the file's real segment size
         self._maybe_create_download_node()
         return self._node.get_segsize()
 
+    def guess_segment_size(self):
+        # the real segment size if we know it, else the one the download
+        # node guessed, without fetching anything
+        self._maybe_create_download_node()
+        return self._node.segment_size or self._node.guessed_segment_size
+
     def get_storage_index(self):
         return self._verifycap.storage_index
     def get_verify_cap(self):
@@ -287,6 +297,8 @@ class ImmutableFileNode:
         return self.u.get_size()
     def get_current_size(self):
         return defer.succeed(self.get_size())
+    def get_segment_size(self):
+        return defer.succeed(self._cnode.guess_segment_size())
 
     def is_mutable(self):
         return False
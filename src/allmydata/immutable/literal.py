@@ -67,6 +67,9 @@ class LiteralFileNode(_ImmutableFileNodeBase):
         return len(self.u.data)
     def get_current_size(self):
         return defer.succeed(self.get_size())
+    def get_segment_size(self):
+        # the data is all in the URI, as a single segment
+        return defer.succeed(self.get_size())
 
     def get_cap(self):
         return self.u
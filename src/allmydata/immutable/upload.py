@@ -1495,6 +1495,118 @@ class Data(FileHandle):
         assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
         FileHandle.__init__(self, StringIO(data), convergence=convergence)
 
+class StreamingData(BaseUploadable):
+    implements(IUploadable)
+    # pause our producer when this much data is waiting to be read
+    max_buffered = 1*1024*1024
+
+    def __init__(self, size, producer=None):
+        """
+        Upload data that is delivered to me (with write()) while the upload
+        is already in progress, such as the body of an HTTP request that is
+        still arriving. The total size must be known in advance. Since the
+        plaintext is never available in its entirety, a random encryption
+        key is always used. If 'producer' is provided, it will be paused
+        while more than max_buffered bytes are waiting to be read, and
+        resumed when the uploader catches up.
+        """
+        assert isinstance(size, (int, long)), size
+        self._size = size
+        self._producer = producer
+        self._paused = False
+        self._key = None
+        self._buffer = []
+        self._buffered = 0
+        self._finished = False
+        self._discarding = False
+        self._failure = None
+        self._pending_read = None # (length, Deferred)
+
+    def get_encryption_key(self):
+        if self._key is None:
+            self._key = os.urandom(16)
+        return defer.succeed(self._key)
+
+    def get_size(self):
+        return defer.succeed(self._size)
+
+    def write(self, data):
+        if self._discarding:
+            return
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._satisfy_pending_read()
+        if (self._buffered > self.max_buffered and not self._pending_read
+            and self._producer and not self._paused):
+            self._paused = True
+            self._producer.pauseProducing()
+
+    def finish(self):
+        """All of the data has been written."""
+        self._finished = True
+        self._satisfy_pending_read()
+
+    def fail(self, why):
+        """The source of the data went away before delivering all of it."""
+        self._failure = why
+        self._buffer = []
+        self._buffered = 0
+        if self._pending_read:
+            length, d = self._pending_read
+            self._pending_read = None
+            d.errback(why)
+
+    def discard(self):
+        """Nobody is going to read the rest of the data, so drop it as it
+        arrives instead of buffering it."""
+        self._discarding = True
+        self._buffer = []
+        self._buffered = 0
+        self._resume()
+
+    def _resume(self):
+        if self._paused:
+            self._paused = False
+            self._producer.resumeProducing()
+
+    def read(self, length):
+        assert self._pending_read is None, "only one read() at a time"
+        if self._failure:
+            return defer.fail(self._failure)
+        d = defer.Deferred()
+        self._pending_read = (length, d)
+        self._satisfy_pending_read()
+        if self._pending_read:
+            # we need more data than is buffered, so don't hold it back
+            self._resume()
+        return d
+
+    def _satisfy_pending_read(self):
+        if not self._pending_read:
+            return
+        length, d = self._pending_read
+        if self._buffered < length and not self._finished:
+            return
+        self._pending_read = None
+        data = []
+        got = 0
+        while self._buffer and got < length:
+            chunk = self._buffer.pop(0)
+            if got + len(chunk) > length:
+                needed = length - got
+                self._buffer.insert(0, chunk[needed:])
+                chunk = chunk[:needed]
+            data.append(chunk)
+            got += len(chunk)
+        self._buffered -= got
+        if self._buffered <= self.max_buffered / 2:
+            self._resume()
+        d.callback(data)
+
+    def close(self):
+        self._buffer = []
+        self._buffered = 0
+
 class Uploader(service.MultiService, log.PrefixingLogMixin):
     """I am a service that allows file uploading. I am a service-child of the
     Client.
@@ -18,6 +18,7 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_LEASES_PER_BATCH = 1000 # storage indexes per add_leases() call
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -132,6 +133,22 @@ class RIStorageServer(RemoteInterface):
         """
         return Any() # returns None now, but future versions might change
 
+    def add_leases(leases=ListOf(TupleOf(StorageIndex, LeaseRenewSecret,
+                                         LeaseCancelSecret),
+                                 maxLength=MAX_LEASES_PER_BATCH)):
+        """
+        Add (or renew) a lease on each of several buckets, exactly as if
+        add_lease(storage_index, renew_secret, cancel_secret) had been called
+        for each tuple in 'leases'. This lets a client that is renewing the
+        leases on many files (deep-check --add-lease, for example) send one
+        message instead of one per file. The server processes the buckets in
+        the order in which they are stored on disk, not the order given.
+
+        Servers that accept this message say so by including
+        'maximum-add-leases-batch-size' in their version dictionary.
+        """
+        return Any()
+
     def renew_lease(storage_index=StorageIndex, renew_secret=LeaseRenewSecret):
         """
         Renew the lease on a given bucket, resetting the timer to 31 days.
@@ -654,6 +671,13 @@ class IReadable(Interface):
     def get_size():
         """Return the length (in bytes) of this readable object."""
 
+    def get_segment_size():
+        """Return a Deferred that fires with the size (in bytes) of this
+        object's segments, the units in which it is downloaded. The last
+        segment may be shorter. If the size cannot be learned without
+        downloading some of the file (as with an immutable file that has not
+        been read yet), this fires with the size the download expects."""
+
     def download_to_data():
         """Download all of the file contents. I return a Deferred that fires
         with the contents as a byte string."""
@@ -724,6 +748,10 @@ class IMutableFileVersion(IReadable):
     def get_sequence_number():
         """Return the sequence number of this version."""
 
+    def get_root_hash():
+        """Return the root hash of this version. Together with the sequence
+        number, this identifies the version's contents."""
+
     def get_servermap():
         """Return the IMutableFileServerMap instance that was used to create
         this object.
@@ -1162,11 +1190,20 @@ class IDirectoryNode(IFilesystemNode):
         protocol.
         """
 
-    def list():
+    def list(version=None):
         """I return a Deferred that fires with a dictionary mapping child
         name (a unicode string) to (node, metadata_dict) tuples, in which
         'node' is an IFilesystemNode and 'metadata_dict' is a dictionary of
-        metadata."""
+        metadata.
+
+        For a mutable directory, 'version' may be a version obtained from
+        get_best_readable_version(), in which case I list the contents of
+        that version rather than looking for the best one again."""
+
+    def get_best_readable_version():
+        """Return a Deferred that fires with the best readable version of
+        the file that holds my contents: an IMutableFileVersion for mutable
+        directories. This can be passed to list()."""
 
     def has_child(name):
         """I return a Deferred that fires with a boolean, True if there
@@ -1291,6 +1328,26 @@ class IDirectoryNode(IFilesystemNode):
         is a file, or if must_be_file is True and the child is a directory,
         I raise ChildOfWrongTypeError."""
 
+    def apply_batch(operations):
+        """I apply a list of changes to this directory, in order, with a
+        single read-modify-write cycle. Each operation is a tuple, one of:
+
+         ('set', name, child_node, metadata, overwrite)
+         ('delete', name, must_exist)
+         ('rename', from_name, to_name, overwrite)
+         ('set-metadata', name, metadata)
+
+        which behave like set_node(), delete(), move_child_to() (within this
+        directory, keeping the child's metadata) and set_metadata_for(). All
+        names must be unicode strings. Each operation succeeds or fails on
+        its own: one that fails (with ExistingChildError, NoSuchChildError,
+        and so on) is skipped, and the others are still applied.
+
+        I return a Deferred that fires with a list holding, for each
+        operation, None if it succeeded or the exception if it failed. If
+        this directory node is read-only, the Deferred will errback with a
+        NotWriteableError."""
+
     def create_subdirectory(name, initial_children={}, overwrite=True, metadata=None):
         """I create and attach a directory at the given name. The new
         directory can be empty, or it can be populated with children
@@ -2079,6 +2136,11 @@ class ICheckable(Interface):
         been implemented), there may be additional options here to define the
         kind of lease that is obtained (which account number to claim, etc).
 
+        add_lease may also be an allmydata.storage_client.LeaseBatcher, which
+        is shared by the checks of many files (deep-check does this) and
+        sends their leases to each server in batches. The leases are then
+        only certain to have been added once the LeaseBatcher is flushed.
+
         TODO: any problems seen during checking will be reported to the
         health-manager.furl, a centralized object that is responsible for
         figuring out why files are unhealthy so corrective action can be
@@ -2418,7 +2480,7 @@ class IClient(Interface):
                  To get the URI for this file, use results.uri .
         """
 
-    def create_mutable_file(contents=""):
+    def create_mutable_file(contents="", segment_size=None):
         """Create a new mutable file (with initial) contents, get back the
         new node instance.
 
@@ -2433,6 +2495,13 @@ class IClient(Interface):
         content_maker= is more efficient than creating a mutable file and
         setting its contents in two separate operations.
 
+        @param segment_size: (int or None): the segment size of a new MDMF
+        file. Small segments make small updates cheaper, large ones make
+        reads faster. If None, a segment size is chosen to suit the size of
+        the initial contents. The file keeps its segment size when it is
+        later overwritten or updated. SDMF files have a single segment, and
+        ignore this.
+
         @return: a Deferred that fires with an IMutableFileNode instance.
         """
 
@@ -2483,13 +2552,14 @@ class INodeMaker(Interface):
         only provide nodes for existing file/directory objects: use my other
         methods to create new objects. I return synchronously."""
 
-    def create_mutable_file(contents=None, keysize=None):
+    def create_mutable_file(contents=None, keysize=None, segment_size=None):
         """I create a new mutable file, and return a Deferred that will fire
         with the IMutableFileNode instance when it is ready. If contents= is
         provided (a bytestring), it will be used as the initial contents of
         the new file, otherwise the file will contain zero bytes. keysize= is
         for use by unit tests, to create mutable files that are smaller than
-        usual."""
+        usual. segment_size= is passed on as for
+        IClient.create_mutable_file()."""
 
     def create_new_mutable_directory(initial_children={}):
         """I create a new mutable directory, and return a Deferred that will
@@ -0,0 +1,238 @@
+
+import os, sys, time
+
+from twisted.internet import reactor, protocol, defer, error
+from twisted.application import service
+from foolscap.api import eventually
+from pycryptopp.cipher.aes import AES
+from allmydata.util import base32, fileutil, hashutil, log
+
+# The keys are made by a separate python process, so that generating them
+# does not hold up the reactor. It only needs pycryptopp, not the rest of
+# allmydata.
+WORKER_SCRIPT = """
+import os, sys
+from pycryptopp.publickey import rsa
+if hasattr(os, "nice"):
+    os.nice(10)
+keysize, count = int(sys.argv[1]), int(sys.argv[2])
+for i in range(count):
+    sys.stdout.write(rsa.generate(keysize).serialize().encode("hex") + "\\n")
+    sys.stdout.flush()
+"""
+
+MAGIC = "tahoe key pool v1\n"
+SALTLEN = 16
+
+class KeyPoolWorker(protocol.ProcessProtocol):
+    """I collect the keys that a worker process writes to its stdout, one
+    hex-encoded signing key per line, and hand them to my KeyPool."""
+    def __init__(self, pool, keysize):
+        self._pool = pool
+        self._keysize = keysize
+        self._buffer = ""
+        self.done = defer.Deferred()
+
+    def outReceived(self, data):
+        self._buffer += data
+        while "\n" in self._buffer:
+            (line, self._buffer) = self._buffer.split("\n", 1)
+            try:
+                key = line.strip().decode("hex")
+            except TypeError:
+                log.msg("key pool worker wrote garbage: %r" % (line,),
+                        level=log.WEIRD, umid="fXt3Ug")
+                continue
+            self._pool._add_key(self._keysize, key)
+
+    def errReceived(self, data):
+        log.msg("key pool worker: %s" % (data,),
+                level=log.UNUSUAL, umid="hY4R1w")
+
+    def processEnded(self, reason):
+        self.done.callback(reason)
+
+
+class KeyPool(service.Service):
+    """I keep a pool of RSA signing keys on hand for new mutable files and
+    directories, so that creating one does not have to wait a second or more
+    for a key to be generated.
+
+    I refill the pool in the background, in a worker process, whenever it
+    falls below my target size. The target is the number of keys that were
+    asked for in the last DEMAND_PERIOD seconds, but at least MIN_POOL_SIZE
+    and at most MAX_POOL_SIZE, so a node that makes many directories at once
+    keeps more keys in reserve than one that rarely makes any.
+
+    The pool is kept in a file (under private/), encrypted with a key derived
+    from the node's secret, so that it survives a restart. The file is
+    rewritten every time a key is handed out: a key must never be used for
+    two mutable files, which would give them the same storage index."""
+    name = "key_pool"
+
+    MIN_POOL_SIZE = 4
+    MAX_POOL_SIZE = 64
+    DEMAND_PERIOD = 10*60
+    RETRY_DELAY = 60 # seconds to wait before replacing a worker that failed
+
+    def __init__(self, poolfile, secret, keysize=2048):
+        self._poolfile = poolfile
+        self._secret = secret
+        self.keysize = keysize
+        self._keys = [] # serialized signing keys of self.keysize bits
+        self._demand = [] # when keys were asked for
+        self._waiters = [] # Deferreds waiting for the worker's next key
+        self._worker = None
+        self._process = None
+        self._last_worker_failure = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._load()
+        self._maybe_refill()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self._release_waiters()
+        if not self._worker:
+            return
+        d = self._worker.done
+        try:
+            self._process.signalProcess("KILL")
+        except error.ProcessExitedAlready:
+            pass
+        return d
+
+    def __repr__(self):
+        return "<KeyPool[%d]>" % (len(self._keys),)
+
+    def get_pool_size(self):
+        return len(self._keys)
+
+    def get_target_size(self):
+        cutoff = time.time() - self.DEMAND_PERIOD
+        self._demand = [when for when in self._demand if when > cutoff]
+        return max(self.MIN_POOL_SIZE,
+                   min(self.MAX_POOL_SIZE, len(self._demand)))
+
+    def set_keysize(self, keysize):
+        if keysize == self.keysize:
+            return
+        self.keysize = keysize
+        self._keys = []
+        self._save()
+        self._release_waiters()
+        self._maybe_refill()
+
+    def get_key(self, keysize):
+        """Return a serialized signing key of the given size, or None if the
+        pool has none of that size to offer."""
+        self._demand.append(time.time())
+        key = None
+        if keysize == self.keysize and self._keys:
+            key = self._keys.pop(0)
+            self._save()
+        self._maybe_refill()
+        return key
+
+    def wait_for_key(self, keysize):
+        """Return a Deferred that fires with the next serialized signing key
+        of the given size that my worker makes, for when get_key() came back
+        empty. It fires with None instead if no worker is going to make one:
+        the size is wrong, I am stopped, or the last worker failed."""
+        if keysize != self.keysize or not self.running:
+            return defer.succeed(None)
+        self._maybe_refill()
+        if not self._worker:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        return d
+
+    def _release_waiters(self):
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            eventually(d.callback, None)
+
+    def _add_key(self, keysize, key):
+        if keysize != self.keysize:
+            return # left over from before set_keysize()
+        if self._waiters:
+            # somebody is already waiting for this one, so it never needs to
+            # be written down
+            eventually(self._waiters.pop(0).callback, key)
+            return
+        self._keys.append(key)
+        self._save()
+
+    def _maybe_refill(self):
+        self._start_worker()
+        if not self._worker:
+            self._release_waiters()
+
+    def _start_worker(self):
+        if not self.running or self._worker:
+            return
+        if (self._last_worker_failure is not None and
+            time.time() < self._last_worker_failure + self.RETRY_DELAY):
+            return
+        wanted = self.get_target_size() - len(self._keys)
+        if wanted <= 0:
+            return
+        log.msg("%s: generating %d %d-bit keys" % (self, wanted, self.keysize),
+                level=log.NOISY, umid="0hQHwA")
+        self._worker = KeyPoolWorker(self, self.keysize)
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        args = [sys.executable, "-c", WORKER_SCRIPT,
+                str(self.keysize), str(wanted)]
+        self._process = reactor.spawnProcess(self._worker, sys.executable,
+                                             args, env)
+        self._worker.done.addBoth(self._worker_done)
+
+    def _worker_done(self, reason):
+        self._worker = None
+        self._process = None
+        if not self.running:
+            return
+        if not reason.check(error.ProcessDone):
+            log.msg("key pool worker failed: %s" % (reason.value,),
+                    level=log.UNUSUAL, umid="Vt9ajQ")
+            self._last_worker_failure = time.time()
+            self._release_waiters()
+            return
+        # more keys may have been asked for in the meantime
+        eventually(self._maybe_refill)
+
+    def _encrypt(self, salt, contents):
+        key = hashutil.key_pool_key_hash(self._secret, salt)
+        return (hashutil.key_pool_check_hash(key, contents) +
+                AES(key).process(contents))
+
+    def _save(self):
+        if not self._keys:
+            fileutil.remove_if_possible(self._poolfile)
+            return
+        contents = "%d\n" % self.keysize
+        contents += "".join([base32.b2a(key) + "\n" for key in self._keys])
+        salt = os.urandom(SALTLEN)
+        fileutil.write_atomically(self._poolfile,
+                                  MAGIC + salt + self._encrypt(salt, contents))
+
+    def _load(self):
+        if not os.path.exists(self._poolfile):
+            return
+        data = fileutil.read(self._poolfile)
+        salt = data[len(MAGIC):len(MAGIC)+SALTLEN]
+        crypttext = data[len(MAGIC)+SALTLEN+hashutil.CRYPTO_VAL_SIZE:]
+        key = hashutil.key_pool_key_hash(self._secret, salt)
+        contents = AES(key).process(crypttext)
+        if (not data.startswith(MAGIC) or
+            self._encrypt(salt, contents) != data[len(MAGIC)+SALTLEN:]):
+            log.msg("ignoring unreadable key pool in %s" % (self._poolfile,),
+                    level=log.WEIRD, umid="RK6yXg")
+            return
+        lines = contents.splitlines()
+        if int(lines[0]) != self.keysize:
+            return
+        self._keys = [base32.a2b(line) for line in lines[1:]]
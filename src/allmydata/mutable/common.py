@@ -1,4 +1,7 @@
 
+from collections import deque
+import itertools
+
 MODE_CHECK = "MODE_CHECK" # query all peers
 MODE_ANYTHING = "MODE_ANYTHING" # one recoverable version
 MODE_WRITE = "MODE_WRITE" # replace all shares, probably.. not for initial
@@ -57,3 +60,121 @@ class CorruptShareError(BadShareError):
 
 class UnknownVersionError(BadShareError):
     """The share we received was of a version we don't recognize."""
+
+class SignatureCache:
+    """I remember which signed prefixes have already been verified against
+    which public keys.
+
+    All N shares of a given version of a mutable file carry the same signed
+    prefix and signature, and each servermap update used to check that
+    signature again with RSA. When a large directory tree is traversed that
+    work dominates. Verification depends only on the key, the prefix and the
+    signature, so one of me is shared by every mutable operation in the
+    process. I only remember signatures that were good, and only the
+    MAX_ENTRIES most recently used of them."""
+
+    MAX_ENTRIES = 1000
+
+    def __init__(self):
+        self._verified = {} # (fingerprint, prefix, sig) -> last-use stamp
+        # (stamp, key), least recently used first. A key that is used again
+        # gets a new entry, and the old one is skipped when it comes up.
+        self._order = deque()
+        self._clock = itertools.count()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def _touch(self, key):
+        stamp = self._clock.next()
+        self._verified[key] = stamp
+        self._order.append((stamp, key))
+        if len(self._order) > 2*self.MAX_ENTRIES:
+            # too many stale entries: rebuild the queue from the live ones
+            live = [(s, k) for (k, s) in self._verified.items()]
+            live.sort()
+            self._order = deque(live)
+
+    def verify(self, pubkey, fingerprint, prefix, signature):
+        """Return True if 'signature' is a valid signature of 'prefix' by
+        'pubkey', whose fingerprint is 'fingerprint'."""
+        key = (fingerprint, prefix, signature)
+        if key in self._verified:
+            self._touch(key)
+            self._stats["hits"] += 1
+            return True
+        self._stats["misses"] += 1
+        if not pubkey.verify(prefix, signature):
+            return False
+        self._touch(key)
+        while len(self._verified) > self.MAX_ENTRIES:
+            (stamp, oldkey) = self._order.popleft()
+            if self._verified.get(oldkey) == stamp:
+                del self._verified[oldkey]
+        return True
+
+    def get_stats(self):
+        return self._stats.copy()
+
+signature_cache = SignatureCache()
+
+class ReadSizeEstimator:
+    """I learn how much of each share the ServermapUpdater should read in
+    its first query, so that it rarely has to go back to the server for the
+    signature, the verification key or the encrypted private key.
+
+    Where these live depends on the share format (the signature of an MDMF
+    share comes after its encrypted private key, and the encrypted private
+    key of an SDMF share is at the very end) and on the sizes of the keys
+    and hash chains, so rather than guess, I remember how many bytes the
+    last few shares of each kind actually needed. The StorageFarmBroker
+    keeps one of me, which is shared by all of the updates for its grid."""
+
+    HISTORY = 20
+    # never read more than this up front: past this point (the private key
+    # of a large SDMF file, say) a second round trip is cheaper.
+    MAX_READ_SIZE = 16000
+
+    def __init__(self):
+        self._needed = {} # key -> recent numbers of bytes needed
+        self._stats = {"shares": 0,
+                       "follow_up_reads": 0,
+                       "follow_up_reads_avoided": 0}
+
+    def get_read_size(self, key, default):
+        """Return how many bytes to read for a share of the given kind.
+        The key is (share format, need pubkey, need privkey). The format is
+        None when it is not known yet, and then the shares of every format
+        are taken into account."""
+        if key[0] is None:
+            keys = [k for k in self._needed if k[1:] == key[1:]]
+        else:
+            keys = [key]
+        # never read less than the default: the proxies we make keep what
+        # we read, and Retrieve uses it for the first segment.
+        fits = []
+        for k in keys:
+            fits.extend([needed for needed in self._needed.get(k, [])
+                         if needed <= self.MAX_READ_SIZE])
+        return max([default] + fits)
+
+    def record(self, key, needed, read_size, default):
+        """Record that a share of the given kind (whose format is known by
+        now) needed 'needed' bytes, when 'read_size' bytes were read instead
+        of the 'default'. Return 'follow-up' if another read was needed,
+        'avoided' if one would have been needed with the default read size,
+        and None otherwise. Only what was still needed when the share
+        arrived counts: once one share has given us the private key, we
+        don't need it from the others."""
+        recent = self._needed.setdefault(key, [])
+        recent.append(needed)
+        del recent[:-self.HISTORY]
+        self._stats["shares"] += 1
+        if needed > read_size:
+            self._stats["follow_up_reads"] += 1
+            return "follow-up"
+        if needed > default:
+            self._stats["follow_up_reads_avoided"] += 1
+            return "avoided"
+        return None
+
+    def get_stats(self):
+        return self._stats.copy()
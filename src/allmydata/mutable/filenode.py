@@ -66,6 +66,12 @@ class MutableFileNode:
         self._total_shares = default_encoding_parameters["n"]
         self._sharemap = {} # known shares, shnum-to-[nodeids]
         self._most_recent_size = None
+        # the MDMF segment size asked for when this file was created, if any
+        self._requested_segment_size = None
+        # what our last MDMF publish left behind, so that an update of the
+        # version it created need not read it back first. See
+        # _populate_update_cache.
+        self._update_cache = None
         # filled in after __init__ if we're being created for the first time;
         # filled in by the servermap updater before publishing, otherwise.
         # set to this default value in case neither of those things happen,
@@ -120,13 +126,17 @@ class MutableFileNode:
         return self
 
     def create_with_keys(self, (pubkey, privkey), contents,
-                         version=SDMF_VERSION):
+                         version=SDMF_VERSION, segment_size=None):
         """Call this to create a brand-new mutable file. It will create the
         shares, find homes for them, and upload the initial contents (created
         with the same rules as IClient.create_mutable_file() ). Returns a
         Deferred that fires (with the MutableFileNode instance you should
         use) when it completes.
+
+        segment_size= sets the segment size of an MDMF file; if it is None,
+        one is chosen to suit the size of the initial contents.
         """
+        self._requested_segment_size = segment_size
         self._pubkey, self._privkey = pubkey, privkey
         pubkey_s = self._pubkey.serialize()
         privkey_s = self._privkey.serialize()
@@ -180,6 +190,26 @@ class MutableFileNode:
     def _populate_encprivkey(self, encprivkey):
         self._encprivkey = encprivkey
 
+    def _populate_update_cache(self, verinfo, blockhashes, segments):
+        """
+        Publish calls me when it has placed a new MDMF version of this file.
+        I remember the block hash tree of each of its shares (shnum ->
+        list of hashes), and the plaintext of the first and last segments
+        that it wrote (segnum -> string): this is what an in-place update
+        of that version would otherwise have to fetch from the servers.
+        """
+        self._update_cache = (verinfo[:7], blockhashes, segments)
+    def _get_update_cache(self, verinfo):
+        """
+        I return (blockhashes, segments) for verinfo if it is the version
+        that our last publish created, or None if it isn't.
+        """
+        # the offsets table is left out of the comparison: the root hash
+        # already pins down the contents of every share
+        if self._update_cache and self._update_cache[0] == verinfo[:7]:
+            return self._update_cache[1:]
+        return None
+
     def get_write_enabler(self, server):
         seed = server.get_foolscap_write_enabler_seed()
         assert len(seed) == 20
@@ -212,6 +242,8 @@ class MutableFileNode:
     def get_pubkey(self):
         return self._pubkey
 
+    def get_requested_segment_size(self):
+        return self._requested_segment_size
     def get_required_shares(self):
         return self._required_shares
     def get_total_shares(self):
@@ -743,6 +775,13 @@ class MutableFileVersion:
         return self._version[0] # verinfo[0] == the sequence number
 
 
+    def get_root_hash(self):
+        """
+        Get the root hash of the mutable version that I represent.
+        """
+        return self._version[1] # verinfo[1] == the root hash
+
+
     # TODO: Terminology?
     def get_writekey(self):
         """
@@ -935,6 +974,14 @@ class MutableFileVersion:
         return self._servermap.size_of_version(self._version)
 
 
+    def get_segment_size(self):
+        """
+        I return a Deferred that fires with the segment size of the
+        version that I represent.
+        """
+        return defer.succeed(self._version[3])
+
+
     def download_to_data(self, fetch_privkey=False):
         """
         I return a Deferred that fires with the contents of this
@@ -1028,6 +1075,11 @@ class MutableFileVersion:
         O(data.get_size()) memory/bandwidth/CPU to perform the update.
         Otherwise, it must download, re-encode, and upload the entire
         file again, which will use O(filesize) resources.
+
+        An in-place update needs the block hash trees of the version being
+        updated, and the old contents of any segment that it only partly
+        replaces. If the version was published by this node, these are
+        remembered from that publish instead of being fetched again.
         """
         return self._do_serialized(self._update, data, offset)
 
@@ -1056,6 +1108,11 @@ class MutableFileVersion:
 
         # Otherwise, we can replace just the parts that are changing.
         log.msg("updating in place")
+        cached = self._get_cached_update_data(data, offset)
+        if cached:
+            log.msg("using the block hashes and segments from our last "
+                    "publish")
+            return self._build_uploadable_and_finish(cached, data, offset)
         d = self._do_update_update(data, offset)
         d.addCallback(self._decode_and_decrypt_segments, data, offset)
         d.addCallback(self._build_uploadable_and_finish, data, offset)
@@ -1078,6 +1135,44 @@ class MutableFileVersion:
         return self._modify(m, None)
 
 
+    def _get_cached_update_data(self, data, offset):
+        """
+        If our node published the version that I represent, and my
+        servermap says that every share still holds it, I return the (start
+        segment, end segment, block hashes) that an in-place update needs,
+        taken from what that publish left behind, so that we don't have to
+        update the servermap again to fetch them. If another writer has
+        changed the shares since my servermap was updated, the test vectors
+        sent along with the writes will catch it. Otherwise, or if the
+        update touches a partial segment that wasn't kept, I return None.
+        """
+        cached = self._node._get_update_cache(self._version)
+        if cached is None:
+            return None
+        blockhashes, segments = cached
+        shnums = set()
+        known_shares = self._servermap.get_known_shares()
+        for ((server, shnum), (verinfo, timestamp)) in known_shares.items():
+            if verinfo[:7] != self._version[:7]:
+                return None
+            shnums.add(shnum)
+        if shnums != set(blockhashes):
+            return None
+
+        segsize = self._version[3]
+        start = end = ""
+        if offset % segsize:
+            # we need the old data at the start of the first segment
+            start = segments.get(offset // segsize)
+        end_data = offset + data.get_size()
+        if end_data < self.get_size() and end_data % segsize:
+            # and the old data at the end of the last one
+            end = segments.get(end_data // segsize)
+        if start is None or end is None:
+            return None
+        return (start, end, blockhashes)
+
+
     def _do_update_update(self, data, offset):
         """
         I start the Servermap update that gets us the data we need to
@@ -8,6 +8,7 @@ from allmydata.util import mathutil
 from twisted.python import failure
 from twisted.internet import defer
 from zope.interface import implements
+from foolscap.api import eventually
 
 
 # These strings describe the format of the packed structs they help process.
@@ -1143,6 +1144,27 @@ class MDMFSlotWriteProxy:
         return self._write(self._writevs)
 
 
+    def flush(self):
+        """
+        I send the write vectors that have been queued so far to the remote
+        server now, instead of waiting for finish_publishing. This is only
+        safe for a share that is being newly created, since it leaves a
+        partially-written share on the server until finish_publishing is
+        called. I return a Deferred that fires with the answer from the
+        server.
+        """
+        datavs, self._writevs = self._writevs, []
+        d = self._write(datavs)
+        if not self._written:
+            # Writes to one server are delivered in order, so any write sent
+            # after this one can already expect to find the checkstring that
+            # this one is putting there.
+            checkstring = self.get_checkstring()
+            self._written = True
+            self._testvs = [(0, len(checkstring), "eq", checkstring)]
+        return d
+
+
     def _write(self, datavs, on_failure=None, on_success=None):
         """I write the data vectors in datavs to the remote slot."""
         tw_vectors = {}
@@ -1174,6 +1196,65 @@ class MDMFSlotWriteProxy:
         d.addCallback(_result)
         return d
 
+class SlotWriteCoalescer:
+    """
+    I stand in for the remote reference to a storage server, for the slot
+    write proxies of all the shares that one Publish puts on that server.
+
+    Calls to slot_testv_and_readv_and_writev that are made during the same
+    reactor turn are combined into as few remote calls as possible: one,
+    unless they use different secrets or read vectors, or write the same
+    share more than once. The writes to each share are still sent in the
+    order that they were made. Every caller gets the answer to the combined
+    call. The storage server applies a combined call atomically, so if the
+    test vector for any of its shares fails, none of them are written.
+
+    Any other remote method is passed straight through.
+    """
+    def __init__(self, rref):
+        self._rref = rref
+        self._pending = [] # (args, Deferred)
+
+    def callRemote(self, methname, *args, **kwargs):
+        if methname != "slot_testv_and_readv_and_writev" or kwargs:
+            return self._rref.callRemote(methname, *args, **kwargs)
+        d = defer.Deferred()
+        if not self._pending:
+            eventually(self._send)
+        self._pending.append((args, d))
+        return d
+
+    def _send(self):
+        pending, self._pending = self._pending, []
+        batches = [] # [storage_index, secrets, tw_vectors, readv, [d]]
+        for ((storage_index, secrets, tw_vectors, readv), d) in pending:
+            # a share's writes must not overtake one another, so this call
+            # can only join a batch after the last one that writes any of
+            # its shares
+            start = 0
+            for i, batch in enumerate(batches):
+                if set(batch[2]) & set(tw_vectors):
+                    start = i + 1
+            for batch in batches[start:]:
+                if (batch[0], batch[1], batch[3]) == (storage_index, secrets,
+                                                      readv):
+                    batch[2].update(tw_vectors)
+                    batch[4].append(d)
+                    break
+            else:
+                batches.append([storage_index, secrets, dict(tw_vectors),
+                                readv, [d]])
+        for (storage_index, secrets, tw_vectors, readv, ds) in batches:
+            d = self._rref.callRemote("slot_testv_and_readv_and_writev",
+                                      storage_index, secrets, tw_vectors,
+                                      readv)
+            d.addBoth(self._deliver, ds)
+
+    def _deliver(self, res, ds):
+        for d in ds:
+            d.callback(res)
+
+
 def _handle_bad_struct(f):
     # struct.unpack errors mean the server didn't give us enough data, so
     # this share is bad
@@ -1758,6 +1839,29 @@ class MDMFSlotReadProxy:
                                          readvs)
 
 
+    def get_prefix_length(self, need_pubkey, need_privkey):
+        """
+        I return the number of bytes from the start of my share that a
+        reader must have to check my signature without another remote
+        read, and also to get my verification key and encrypted private
+        key if asked for. My offsets must already have been fetched.
+        """
+        assert self._offsets
+        if self._version_number == SDMF_VERSION:
+            # the verification key comes before the signature, and the
+            # encrypted private key is at the very end of the share.
+            needed = self._offsets['share_hash_chain']
+            if need_privkey:
+                needed = self._offsets['EOF']
+        else:
+            # the encrypted private key comes before the signature, and
+            # the verification key right after it.
+            needed = self._offsets['verification_key']
+            if need_pubkey:
+                needed = self._offsets['verification_key_end']
+        return needed
+
+
     def is_sdmf(self):
         """I tell my caller whether or not my remote file is SDMF or MDMF
         """
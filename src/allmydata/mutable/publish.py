@@ -22,14 +22,43 @@ from allmydata.mutable.layout import get_version_from_checkstring,\
                                      unpack_mdmf_checkstring, \
                                      unpack_sdmf_checkstring, \
                                      MDMFSlotWriteProxy, \
-                                     SDMFSlotWriteProxy
+                                     SDMFSlotWriteProxy, \
+                                     SlotWriteCoalescer
 
 KiB = 1024
 DEFAULT_MAX_SEGMENT_SIZE = 128 * KiB
+# The segment size of an MDMF file can be chosen when it is created, up to
+# this limit. Otherwise choose_segment_size() picks one from the file size.
+MAX_SEGMENT_SIZE = 16 * 1024 * KiB
+ADAPTIVE_MAX_SEGMENT_SIZE = 1024 * KiB
+ADAPTIVE_SEGMENT_COUNT = 1024
+# When an MDMF publish is creating new shares, the blocks are sent to the
+# servers a window of this much plaintext at a time, rather than all being
+# held until the end. While one window is being sent the next is encoded, and
+# at most PUBLISH_WINDOWS_IN_FLIGHT windows may be unacknowledged at once,
+# which bounds the memory used by a large publish.
+PUBLISH_WINDOW_SIZE = 1024 * KiB
+PUBLISH_WINDOWS_IN_FLIGHT = 2
 PUSHING_BLOCKS_STATE = 0
 PUSHING_EVERYTHING_ELSE_STATE = 1
 DONE_STATE = 2
 
+def choose_segment_size(datalength):
+    """
+    Return the segment size to use for a new MDMF file of datalength bytes.
+    update() rewrites whole segments, so small segments keep small updates
+    cheap, while reads go faster with fewer, bigger segments. Files of up
+    to ADAPTIVE_SEGMENT_COUNT default-sized segments use the default size;
+    larger files use the smallest power-of-two multiple of it that keeps the
+    segment count within ADAPTIVE_SEGMENT_COUNT, up to
+    ADAPTIVE_MAX_SEGMENT_SIZE.
+    """
+    segment_size = DEFAULT_MAX_SEGMENT_SIZE
+    while (segment_size < ADAPTIVE_MAX_SEGMENT_SIZE and
+           datalength > segment_size * ADAPTIVE_SEGMENT_COUNT):
+        segment_size *= 2
+    return segment_size
+
 class PublishStatus:
     implements(IPublishStatus)
     statusid_counter = count(0)
@@ -38,6 +67,8 @@ class PublishStatus:
         self.timings["send_per_server"] = {}
         self.timings["encrypt"] = 0.0
         self.timings["encode"] = 0.0
+        self.timings["send_blocks"] = 0.0
+        self.timings["wait_for_blocks"] = 0.0
         self.servermap = None
         self._problems = {}
         self.active = True
@@ -58,6 +89,10 @@ class PublishStatus:
         self.timings["encode"] += elapsed
     def accumulate_encrypt_time(self, elapsed):
         self.timings["encrypt"] += elapsed
+    def accumulate_send_blocks_time(self, elapsed):
+        self.timings["send_blocks"] += elapsed
+    def accumulate_wait_for_blocks_time(self, elapsed):
+        self.timings["wait_for_blocks"] += elapsed
 
     def get_started(self):
         return self.started
@@ -130,6 +165,16 @@ class Publish:
         self._version = self._node.get_version()
         assert self._version in (SDMF_VERSION, MDMF_VERSION)
 
+        # writers for shares that do not exist yet, whose blocks we can send
+        # a window at a time without disturbing any existing version
+        self._window_writers = set()
+        self._windows_in_flight = [] # Deferreds
+        # server -> SlotWriteCoalescer, shared by its writers
+        self._write_rrefs = {}
+        # segnum -> plaintext of the first and last segments that we write,
+        # for the node to keep once we are done
+        self._boundary_segments = {}
+
 
     def get_status(self):
         return self._status
@@ -218,8 +263,10 @@ class Publish:
 
         # This will set self.segment_size, self.num_segments, and
         # self.fec. TODO: Does it know how to do the offset? Probably
-        # not. So do that part next.
-        self.setup_encoding_parameters(offset=offset)
+        # not. So do that part next. The new segments must line up with
+        # the ones we are not replacing.
+        self.setup_encoding_parameters(offset=offset,
+                                       segment_size=version[3])
 
         # if we experience any surprises (writes which were rejected because
         # our test vector did not match, or shares which we didn't expect to
@@ -271,7 +318,7 @@ class Publish:
             secrets = (write_enabler, renew_secret, cancel_secret)
 
             writer = writer_class(shnum,
-                                  server.get_rref(),
+                                  self._get_write_rref(server),
                                   self._storage_index,
                                   secrets,
                                   self._new_seqnum,
@@ -412,7 +459,7 @@ class Publish:
 
         # This will set self.segment_size, self.num_segments, and
         # self.fec.
-        self.setup_encoding_parameters()
+        self.setup_encoding_parameters(segment_size=self._get_segment_size())
 
         # if we experience any surprises (writes which were rejected because
         # our test vector did not match, or shares which we didn't expect to
@@ -473,7 +520,7 @@ class Publish:
             secrets = (write_enabler, renew_secret, cancel_secret)
 
             writer =  writer_class(shnum,
-                                   server.get_rref(),
+                                   self._get_write_rref(server),
                                    self._storage_index,
                                    secrets,
                                    self._new_seqnum,
@@ -495,6 +542,8 @@ class Publish:
             elif (server, shnum) in self.bad_share_checkstrings:
                 old_checkstring = self.bad_share_checkstrings[(server, shnum)]
                 writer.set_checkstring(old_checkstring)
+            elif self._version == MDMF_VERSION:
+                self._window_writers.add(writer)
 
         # Our remote shares will not have a complete checkstring until
         # after we are done writing share data and have started to write
@@ -526,6 +575,11 @@ class Publish:
 
         return self.done_deferred
 
+    def _get_write_rref(self, server):
+        if server not in self._write_rrefs:
+            self._write_rrefs[server] = SlotWriteCoalescer(server.get_rref())
+        return self._write_rrefs[server]
+
     def _get_some_writer(self):
         return list(self.writers.values()[0])[0]
 
@@ -538,9 +592,26 @@ class Publish:
         self._status.set_progress(1.0 * len(self.placed) / len(self.goal))
 
 
-    def setup_encoding_parameters(self, offset=0):
+    def _get_segment_size(self):
+        """
+        Decide on the segment size for a publish of the whole file. An MDMF
+        file keeps the segment size that it already has, or else uses the
+        one it was created with, or else one that suits its size.
+        """
+        if self._version != MDMF_VERSION:
+            return None
+        verinfo = self._servermap.best_recoverable_version()
+        if verinfo and verinfo[2] is None: # MDMF has no IV
+            return verinfo[3]
+        segment_size = self._node.get_requested_segment_size()
+        if segment_size:
+            return segment_size
+        return choose_segment_size(self.datalength)
+
+    def setup_encoding_parameters(self, offset=0, segment_size=None):
         if self._version == MDMF_VERSION:
-            segment_size = DEFAULT_MAX_SEGMENT_SIZE # 128 KiB by default
+            if segment_size is None:
+                segment_size = DEFAULT_MAX_SEGMENT_SIZE # 128 KiB by default
         else:
             segment_size = self.datalength # SDMF is only one segment
         # this must be a multiple of self.required_shares
@@ -594,6 +665,12 @@ class Publish:
         self.piece_size = fec.get_block_size()
         self.fec = fec
 
+        if self.segment_size:
+            self.window_segments = max(1, PUBLISH_WINDOW_SIZE //
+                                          self.segment_size)
+        else:
+            self.window_segments = 1
+
         if self.tail_segment_size == self.segment_size:
             self.tail_fec = self.fec
         else:
@@ -652,9 +729,16 @@ class Publish:
             self._add_dummy_salts()
 
         if segnum > self.end_segment:
-            # We don't have any more segments to push.
-            self._state = PUSHING_EVERYTHING_ELSE_STATE
-            return self._push()
+            # We don't have any more segments to push. Let any windows of
+            # blocks that are still in flight land before we go on.
+            d = defer.DeferredList(self._windows_in_flight)
+            self._windows_in_flight = []
+            def _change_state(ignored):
+                self._state = PUSHING_EVERYTHING_ELSE_STATE
+            d.addCallback(_change_state)
+            d.addCallback(self._push)
+            d.addErrback(self._failure)
+            return d
 
         d = self._encode_segment(segnum)
         d.addCallback(self._push_segment, segnum)
@@ -663,11 +747,66 @@ class Publish:
         # XXX: I don't think we need to do addBoth here -- any errBacks
         # should be handled within push_segment.
         d.addCallback(_increment_segnum)
+        d.addCallback(self._maybe_send_window, segnum)
         d.addCallback(self._turn_barrier)
         d.addCallback(self._push)
         d.addErrback(self._failure)
 
 
+    def _maybe_send_window(self, ignored, segnum):
+        """
+        If segnum completes a window, I send the blocks that have been
+        queued for new shares so far, one write per share. Writes to an
+        existing share are left for finish_publishing, so that the old
+        version stays intact until the new one replaces it all at once.
+
+        If that leaves too many windows unacknowledged, I return a
+        Deferred that fires when the oldest of them has been answered.
+        """
+        if not self._window_writers:
+            return
+        if (segnum + 1 - self.starting_segment) % self.window_segments:
+            return
+        if segnum == self.end_segment:
+            # finish_publishing will send the last window along with
+            # everything else
+            return
+
+        started = time.time()
+        self._status.set_status("Sending blocks")
+        ds = []
+        for (shnum, writers) in self.writers.copy().iteritems():
+            for writer in writers:
+                if writer not in self._window_writers:
+                    continue
+                self.num_outstanding += 1
+                def _no_longer_outstanding(res):
+                    self.num_outstanding -= 1
+                    return res
+
+                d = writer.flush()
+                d.addBoth(_no_longer_outstanding)
+                d.addErrback(self._connection_problem, writer)
+                d.addCallback(self._got_write_answer, writer, started)
+                ds.append(d)
+        d = defer.DeferredList(ds)
+        def _sent(res):
+            self._status.accumulate_send_blocks_time(time.time() - started)
+            return res
+        d.addCallback(_sent)
+        self._windows_in_flight.append(d)
+
+        if len(self._windows_in_flight) <= PUBLISH_WINDOWS_IN_FLIGHT:
+            return
+        waiting = time.time()
+        d = self._windows_in_flight.pop(0)
+        def _waited(res):
+            self._status.accumulate_wait_for_blocks_time(time.time() -
+                                                         waiting)
+        d.addCallback(_waited)
+        return d
+
+
     def _turn_barrier(self, result):
         """
         I help the publish process avoid the recursion limit issues
@@ -708,6 +847,11 @@ class Publish:
         data = "".join(data)
 
         assert len(data) == segsize, len(data)
+        if (self._version == MDMF_VERSION and
+            segnum in (self.starting_segment, self.end_segment)):
+            # leave out the padding of the tail segment
+            end = self.datalength - segnum * self.segment_size
+            self._boundary_segments[segnum] = data[:end]
 
         salt = os.urandom(16)
 
@@ -1176,6 +1320,11 @@ class Publish:
         hints['segsize'] = self.segment_size
         hints['k'] = self.required_shares
         self._node.set_downloader_hints(hints)
+        if self._version == MDMF_VERSION:
+            # a later update of this version can start from here
+            self._node._populate_update_cache(self.versioninfo,
+                                              self.blockhashes,
+                                              self._boundary_segments)
         eventually(self.done_deferred.callback, None)
 
     def _failure(self, f=None):
@@ -9,7 +9,7 @@ from foolscap.api import eventually, fireEventually, DeadReferenceError, \
      RemoteException
 from allmydata.interfaces import IRetrieveStatus, NotEnoughSharesError, \
      DownloadStopped, MDMF_VERSION, SDMF_VERSION
-from allmydata.util import hashutil, log, mathutil, deferredutil
+from allmydata.util import hashutil, log, mathutil, deferredutil, observer
 from allmydata.util.dictutil import DictOfSets
 from allmydata import hashtree, codec
 from allmydata.storage.server import si_b2a
@@ -20,6 +20,13 @@ from allmydata.mutable.common import CorruptShareError, BadShareError, \
      UncoordinatedWriteError
 from allmydata.mutable.layout import MDMFSlotReadProxy
 
+# Blocks are fetched for the segments after the one that is being delivered
+# to the consumer, up to this much ciphertext ahead (but always at least one
+# segment ahead), so that reading a large MDMF file does not take a round
+# trip per segment. Segments are still delivered in order, and no more are
+# requested while the consumer has paused us.
+RETRIEVE_WINDOW_SIZE = 1024 * 1024
+
 class RetrieveStatus:
     implements(IRetrieveStatus)
     statusid_counter = count(0)
@@ -154,6 +161,17 @@ class Retrieve:
         self._pause_deferred = None
         self._offset = None
         self._read_length = None
+        # segnum => Deferred for the blocks of a segment that we have asked
+        # for, but not yet delivered
+        self._segment_fetches = {}
+        # segnum => {shnum: (block, salt)} for the blocks that have been
+        # validated, when an attempt at that segment did not get enough of
+        # them. Only the missing blocks are asked for next time.
+        self._validated_blocks = {}
+        # reader => OneShotObserverList for a hash fetch that is in flight,
+        # so that the segments in the window can share it
+        self._block_hash_fetches = {}
+        self._share_hash_fetches = {}
         self.log("got seqnum %d" % self.verinfo[0])
 
 
@@ -259,6 +277,9 @@ class Retrieve:
     def loop(self):
         d = fireEventually(None) # avoid #237 recursion limit problem
         d.addCallback(lambda ign: self._activate_enough_servers())
+        # don't ask for any more blocks while we are paused
+        d.addCallback(self._check_for_paused)
+        d.addCallback(self._check_for_stopped)
         d.addCallback(lambda ign: self._download_current_segment())
         # when we're done, _download_current_segment will call _done. If we
         # aren't, it will call loop() again.
@@ -438,6 +459,9 @@ class Retrieve:
             self._last_segment = self._num_segments - 1
 
         self._current_segment = self._start_segment
+        self._next_fetch_segment = self._start_segment
+        self._window_segments = max(2, RETRIEVE_WINDOW_SIZE //
+                                       max(self._segment_size, 1))
 
     def _activate_enough_servers(self):
         """
@@ -607,19 +631,61 @@ class Retrieve:
             return self._done()
         self.log("on segment %d of %d" %
                  (self._current_segment + 1, self._num_segments))
+        self._fetch_segments()
         d = self._process_segment(self._current_segment)
         d.addCallback(lambda ign: self.loop())
         return d
 
+    def _fetch_segments(self):
+        """
+        I make sure that the blocks for the current segment, and for the
+        segments in the window after it, have been asked for.
+        """
+        segnum = self._current_segment
+        if segnum not in self._segment_fetches:
+            # either we are just starting, or our last attempt at this
+            # segment ran into a bad share, and we are trying again with
+            # the replacement servers.
+            self._segment_fetches[segnum] = self._fetch_segment(segnum)
+        self._next_fetch_segment = max(self._next_fetch_segment, segnum + 1)
+        while (self._next_fetch_segment <= self._last_segment and
+               self._next_fetch_segment < segnum + self._window_segments):
+            self._segment_fetches[self._next_fetch_segment] = \
+                self._fetch_segment(self._next_fetch_segment)
+            self._next_fetch_segment += 1
+
+    def _discard_segment_fetches(self):
+        for d in self._segment_fetches.values():
+            # we will never look at these results, or at their failures
+            d.addErrback(lambda f: None)
+        self._segment_fetches.clear()
+        self._validated_blocks.clear()
+
     def _process_segment(self, segnum):
         """
-        I download, validate, decode, and decrypt one segment of the
-        file that this Retrieve is retrieving. This means coordinating
-        the process of getting k blocks of that file, validating them,
-        assembling them into one segment with the decoder, and then
-        decrypting them.
+        I wait for the blocks of one segment of the file that this Retrieve
+        is retrieving to be fetched and validated, then decode and decrypt
+        them and hand the segment to the consumer.
         """
         self.log("processing segment %d" % segnum)
+        dl = self._segment_fetches.pop(segnum)
+        if self._verify:
+            dl.addCallback(lambda ignored: "")
+            dl.addCallback(self._set_segment)
+        else:
+            dl.addCallback(self._maybe_decode_and_decrypt_segment, segnum)
+        return dl
+
+    def _fetch_segment(self, segnum):
+        """
+        I ask each of the active readers for its block of one segment, and
+        validate the blocks as they arrive. Readers whose share already gave
+        us a valid block for this segment, on an earlier attempt at it, are
+        not asked again. I return a Deferred that fires with a list of
+        {shnum: (block, salt)} dicts, one per reader asked, with None in
+        place of any block that could not be fetched or validated.
+        """
+        self.log("fetching segment %d" % segnum)
 
         # TODO: The old code uses a marker. Should this code do that
         # too? What did the Marker do?
@@ -627,8 +693,11 @@ class Retrieve:
         # We need to ask each of our active readers for its block and
         # salt. We will then validate those. If validation is
         # successful, we will assemble the results into plaintext.
+        have = self._validated_blocks.get(segnum, {})
         ds = []
         for reader in self._active_readers:
+            if reader.shnum in have:
+                continue
             started = time.time()
             d1 = reader.get_block_and_salt(segnum)
             d2,d3 = self._get_needed_hashes(reader, segnum)
@@ -639,21 +708,17 @@ class Retrieve:
             # bugs) are passed through and cause the retrieve to fail.
             d.addErrback(self._handle_bad_share, [reader])
             ds.append(d)
-        dl = deferredutil.gatherResults(ds)
-        if self._verify:
-            dl.addCallback(lambda ignored: "")
-            dl.addCallback(self._set_segment)
-        else:
-            dl.addCallback(self._maybe_decode_and_decrypt_segment, segnum)
-        return dl
+        return deferredutil.gatherResults(ds)
 
 
     def _maybe_decode_and_decrypt_segment(self, results, segnum):
         """
         I take the results of fetching and validating the blocks from
-        _process_segment. If validation and fetching succeeded without
-        incident, I will proceed with decoding and decryption. Otherwise, I
-        will do nothing.
+        _process_segment. If, together with the blocks that were validated
+        by earlier attempts at this segment, there are enough of them, I
+        will proceed with decoding and decryption. Otherwise, I remember the
+        ones that are good and do nothing, so that loop() fetches only the
+        rest, from the replacement servers.
         """
         self.log("trying to decode and decrypt segment %d" % segnum)
 
@@ -664,11 +729,18 @@ class Retrieve:
         # exception and _validation_or_decoding_failed handled it (by
         # dropping that server).
 
-        if None in results:
-            self.log("some validation operations failed; not proceeding")
+        blocks = self._validated_blocks.setdefault(segnum, {})
+        for result in results:
+            if result is not None:
+                blocks.update(result)
+        if len(blocks) < self._required_shares:
+            self.log("some validation operations failed; have %d of %d "
+                     "blocks, not proceeding" % (len(blocks),
+                                                 self._required_shares))
             return defer.succeed(None)
+        del self._validated_blocks[segnum]
         self.log("everything looks ok, building segment %d" % segnum)
-        d = self._decode_blocks(results, segnum)
+        d = self._decode_blocks([blocks], segnum)
         d.addCallback(self._decrypt_segment)
         # check to see whether we've been paused before writing
         # anything.
@@ -740,6 +812,12 @@ class Retrieve:
         # perform integrity checks on the data.
 
         assert isinstance(readers, list)
+        # several segments may be in flight, so a bad share can let us down
+        # more than once. We only need to hear about it the first time.
+        readers = [reader for reader in readers
+                   if reader in self._active_readers]
+        if not readers:
+            return None
         bad_shnums = [reader.shnum for reader in readers]
 
         self.log("validation or decoding failed on share(s) %s, server(s) %s "
@@ -838,17 +916,41 @@ class Retrieve:
         self.log("getting blockhashes for segment %d, share %d: %s" % \
                  (segnum, reader.shnum, str(needed)))
         # TODO is force_remote necessary here?
-        d1 = reader.get_blockhashes(needed, force_remote=False)
+        if needed:
+            d1 = self._share_fetch(self._block_hash_fetches, reader,
+                                   reader.get_blockhashes, needed)
+        else:
+            d1 = defer.succeed([])
         if self.share_hash_tree.needed_hashes(reader.shnum):
             need = self.share_hash_tree.needed_hashes(reader.shnum)
             self.log("also need sharehashes for share %d: %s" % (reader.shnum,
                                                                  str(need)))
-            d2 = reader.get_sharehashes(need, force_remote=False)
+            d2 = self._share_fetch(self._share_hash_fetches, reader,
+                                   reader.get_sharehashes, need)
         else:
             d2 = defer.succeed({}) # the logic in the next method
                                    # expects a dict
         return d1,d2
 
+    def _share_fetch(self, fetches, reader, fetch, needed):
+        """
+        I fetch some hashes from the reader, unless a fetch of the same kind
+        from the same reader is already in flight for another segment, in
+        which case I wait for its answer instead. The readers always fetch
+        the whole block hash tree or share hash chain, so that answer will
+        include the hashes that we need. A reader that replaces a bad one
+        with the same shnum gets fetches of its own.
+        """
+        o = fetches.get(reader)
+        if o is None:
+            o = fetches[reader] = observer.OneShotObserverList()
+            d = fetch(needed, force_remote=False)
+            def _fetched(res):
+                del fetches[reader]
+                o.fire(res)
+            d.addBoth(_fetched)
+        return o.when_fired()
+
 
     def _decode_blocks(self, results, segnum):
         """
@@ -973,6 +1075,7 @@ class Retrieve:
         self._status.timings['fetch'] = now - self._started_fetching
         self._status.set_status("Finished")
         self._status.set_progress(1.0)
+        self._discard_segment_fetches()
 
         # remember the encoding parameters, use them again next time
         (seqnum, root_hash, IV, segsize, datalength, k, N, prefix,
@@ -1020,4 +1123,5 @@ class Retrieve:
         self._status.timings['total'] = now - self._started
         self._status.timings['fetch'] = now - self._started_fetching
         self._status.set_status("Failed")
+        self._discard_segment_fetches()
         eventually(self._done_deferred.errback, f)
@@ -10,10 +10,12 @@ from allmydata.util import base32, hashutil, log, deferredutil
 from allmydata.util.dictutil import DictOfSets
 from allmydata.storage.server import si_b2a
 from allmydata.interfaces import IServermapUpdaterStatus
+from allmydata.storage_client import LeaseBatcher
 from pycryptopp.publickey import rsa
 
+from allmydata.interfaces import SDMF_VERSION, MDMF_VERSION
 from allmydata.mutable.common import MODE_CHECK, MODE_ANYTHING, MODE_WRITE, \
-     MODE_READ, MODE_REPAIR, CorruptShareError
+     MODE_READ, MODE_REPAIR, CorruptShareError, signature_cache
 from allmydata.mutable.layout import SIGNED_PREFIX_LENGTH, MDMFSlotReadProxy
 
 class UpdateStatus:
@@ -33,6 +35,8 @@ class UpdateStatus:
         self.counter = self.statusid_counter.next()
         self.started = time.time()
         self.finished = None
+        self.follow_up_reads = 0
+        self.follow_up_reads_avoided = 0
 
     def add_per_server_time(self, server, op, sent, elapsed):
         assert op in ("query", "late", "privkey")
@@ -64,6 +68,8 @@ class UpdateStatus:
         return self.active
     def get_counter(self):
         return self.counter
+    def get_follow_up_reads(self):
+        return (self.follow_up_reads, self.follow_up_reads_avoided)
 
     def set_storage_index(self, si):
         self.storage_index = si
@@ -169,6 +175,14 @@ class ServerMap:
         self._bad_shares.pop(key, None)
         self._known_shares[key] = (verinfo, timestamp)
 
+    def get_share_format(self):
+        """Return the format (SDMF_VERSION or MDMF_VERSION) of the shares
+        I know about, or None if I don't know about any yet. It is the
+        first byte of their signed prefix."""
+        for (verinfo, timestamp) in self._known_shares.values():
+            return ord(verinfo[7][0])
+        return None
+
     def add_problem(self, f):
         self._problems.append(f)
     def get_problems(self):
@@ -390,7 +404,10 @@ class ServermapUpdater:
         self._monitor = monitor
         self._servermap = servermap
         self.mode = mode
-        self._add_lease = add_lease
+        if add_lease and not isinstance(add_lease, LeaseBatcher):
+            # checking a single file: send its leases right away
+            add_lease = LeaseBatcher(batch_size=1)
+        self._add_lease = add_lease # a LeaseBatcher, or False
         self._running = True
 
         self._storage_index = filenode.get_storage_index()
@@ -420,11 +437,16 @@ class ServermapUpdater:
         #    table as well.
         # At this point, we don't know which we are. Our filenode can
         # tell us, but it might be lying -- in some cases, we're
-        # responsible for telling it which kind of file it is.
+        # responsible for telling it which kind of file it is. So these
+        # are only the defaults: our ReadSizeEstimator learns from the
+        # shares we have seen how much we really need.
         self._read_size = 4000
         if mode == MODE_CHECK:
             # we use unpack_prefix_and_signature, so we need 1k
             self._read_size = 1000
+        self._read_size_estimator = storage_broker.read_size_estimator
+        # the format of this file's shares, once we have seen one
+        self._share_format = self._servermap.get_share_format()
         self._need_privkey = False
 
         if mode in (MODE_WRITE, MODE_REPAIR) and not self._node.get_privkey():
@@ -553,12 +575,39 @@ class ServermapUpdater:
 
         return initial_servers_to_query, must_query
 
+    def _get_read_size(self):
+        # until we have seen one of its shares, we don't know this file's
+        # format: the filenode may be wrong about it.
+        key = (self._share_format, not self._node.get_pubkey(),
+               self._need_privkey)
+        return self._read_size_estimator.get_read_size(key, self._read_size)
+
+    def _record_read_size(self, res, reader, readsize, need_pubkey,
+                          need_privkey):
+        d = reader.is_sdmf()
+        def _got_format(is_sdmf):
+            if is_sdmf:
+                self._share_format = SDMF_VERSION
+            else:
+                self._share_format = MDMF_VERSION
+            needed = reader.get_prefix_length(need_pubkey, need_privkey)
+            key = (self._share_format, need_pubkey, need_privkey)
+            outcome = self._read_size_estimator.record(key, needed, readsize,
+                                                       self._read_size)
+            if outcome == "follow-up":
+                self._status.follow_up_reads += 1
+            elif outcome == "avoided":
+                self._status.follow_up_reads_avoided += 1
+            return res
+        d.addCallback(_got_format)
+        return d
+
     def _send_initial_requests(self, serverlist):
         self._status.set_status("Sending %d initial queries" % len(serverlist))
         self._queries_outstanding = set()
         for server in serverlist:
             self._queries_outstanding.add(server)
-            self._do_query(server, self._storage_index, self._read_size)
+            self._do_query(server, self._storage_index, self._get_read_size())
 
         if not serverlist:
             # there is nobody to ask, so we need to short-circuit the state
@@ -593,14 +642,15 @@ class ServermapUpdater:
         ss = server.get_rref()
         if self._add_lease:
             # send an add-lease message in parallel. The results are handled
-            # separately. This is sent before the slot_readv() so that we can
-            # be sure the add_lease is retired by the time slot_readv comes
-            # back (this relies upon our knowledge that the server code for
-            # add_lease is synchronous).
+            # separately. When checking a single file, this is sent before
+            # the slot_readv() so that we can be sure the add_lease is
+            # retired by the time slot_readv comes back (this relies upon our
+            # knowledge that the server code for add_lease is synchronous).
+            # A deep-check batches its leases, and waits for them at the end.
             renew_secret = self._node.get_renewal_secret(server)
             cancel_secret = self._node.get_cancel_secret(server)
-            d2 = ss.callRemote("add_lease", storage_index,
-                               renew_secret, cancel_secret)
+            d2 = self._add_lease.add_lease(server, storage_index,
+                                           renew_secret, cancel_secret)
             # we ignore success
             d2.addErrback(self._add_lease_failed, server, storage_index)
         d = ss.callRemote("slot_readv", storage_index, shnums, readv)
@@ -672,7 +722,8 @@ class ServermapUpdater:
             # need to do the following:
             #   - If we don't already have the public key, fetch the
             #     public key. We use this to validate the signature.
-            if not self._node.get_pubkey():
+            need_pubkey = not self._node.get_pubkey()
+            if need_pubkey:
                 # fetch and set the public key.
                 d = reader.get_verification_key()
                 d.addCallback(lambda results, shnum=shnum:
@@ -693,6 +744,10 @@ class ServermapUpdater:
             #   bytes of the share on the storage server, so we
             #   shouldn't need to fetch anything at this step.
             d2 = reader.get_verinfo()
+            # by now we know where everything is in this share, so we can
+            # tell whether our read was big enough.
+            d2.addCallback(self._record_read_size, reader, readsize,
+                           need_pubkey, self._need_privkey)
             d2.addErrback(lambda error, shnum=shnum, data=data:
                           self._got_corrupt_share(error, shnum, server, data, lp))
             # - Next, we need the signature. For an SDMF share, it is
@@ -832,9 +887,12 @@ class ServermapUpdater:
 
         if verinfo not in self._valid_versions:
             # This is a new version tuple, and we need to validate it
-            # against the public key before keeping track of it.
+            # against the public key before keeping track of it. Some
+            # other operation may already have done so.
             assert self._node.get_pubkey()
-            valid = self._node.get_pubkey().verify(prefix, signature[1])
+            valid = signature_cache.verify(self._node.get_pubkey(),
+                                           self._node.get_fingerprint(),
+                                           prefix, signature[1])
             if not valid:
                 raise CorruptShareError(server, shnum,
                                         "signature is invalid")
@@ -1192,7 +1250,7 @@ class ServermapUpdater:
                  level=log.NOISY)
 
         for server in more_queries:
-            self._do_query(server, self._storage_index, self._read_size)
+            self._do_query(server, self._storage_index, self._get_read_size())
             # we'll retrigger when those queries come back
 
     def _done(self):
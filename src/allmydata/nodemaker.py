@@ -114,13 +114,15 @@ class NodeMaker:
             return self._create_dirnode(filenode)
         return None
 
-    def create_mutable_file(self, contents=None, keysize=None, version=None):
+    def create_mutable_file(self, contents=None, keysize=None, version=None,
+                            segment_size=None):
         if version is None:
             version = self.mutable_file_default
         n = MutableFileNode(self.storage_broker, self.secret_holder,
                             self.default_encoding_parameters, self.history)
         d = self.key_generator.generate(keysize)
-        d.addCallback(n.create_with_keys, contents, version=version)
+        d.addCallback(n.create_with_keys, contents, version=version,
+                      segment_size=segment_size)
         d.addCallback(lambda res: n)
         return d
 
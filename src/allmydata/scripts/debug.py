@@ -959,6 +959,99 @@ def corrupt_share(options):
 
 
 
+class MigrateSharesOptions(usage.Options):
+    def getSynopsis(self):
+        return "Usage: tahoe debug migrate-shares SOURCE_STOREDIR DEST_STOREDIR"
+
+    optFlags = [
+        ["dry-run", "n", "Report what would be moved, but don't move anything."],
+        ]
+
+    def parseArgs(self, source, dest):
+        from allmydata.util.encodingutil import argv_to_abspath
+        self.source = argv_to_abspath(source)
+        self.dest = argv_to_abspath(dest)
+
+    def getUsage(self, width=None):
+        t = usage.Options.getUsage(self, width)
+        t += """
+Move all of the shares held in one storage directory (usually the NODEDIR/storage
+of a node that is being retired) into another, which should be the
+NODEDIR/storage of a storage server or one of its [storage]extra_dirs. Both
+nodes must be stopped. Buckets are renamed into place when both directories
+are on the same filesystem, and copied otherwise. A bucket that already exists
+in DEST_STOREDIR is left where it is, and reported.
+
+ tahoe debug migrate-shares /disk3/node-3/storage /disk3/tahoe
+
+Shares keep the leases (and, for mutable shares, the write enablers) that were
+made for the node that used to hold them. Those leases can't be renewed
+through the new node, but new ones can be added (for example by 'tahoe
+deep-check --add-lease'), and the old ones will eventually expire. Mutable
+shares can't be modified through the new node.
+
+The counts of shares and bytes that the storage server keeps in
+DEST_STOREDIR/share_inventory.state are marked as stale for every prefix that
+shares were moved into. Until the server's bucket counter has counted those
+prefixes again, its share counts are reported as "Not computed yet". If
+DEST_STOREDIR is one of [storage]extra_dirs, delete the share_inventory.state
+file in the server's NODEDIR/storage instead, with the node stopped.
+"""
+        return t
+
+def migrate_shares(options):
+    import errno, shutil
+    from allmydata.util import fileutil
+    from allmydata.util.encodingutil import listdir_unicode, quote_output
+
+    out = options.stdout
+    err = options.stderr
+    source_sharedir = os.path.join(options.source, "shares")
+    dest_sharedir = os.path.join(options.dest, "shares")
+    moved = conflicts = 0
+    moved_prefixes = set()
+    for prefix in sorted(listdir_unicode(source_sharedir)):
+        if prefix == "incoming":
+            continue
+        prefixdir = os.path.join(source_sharedir, prefix)
+        for si_s in sorted(listdir_unicode(prefixdir)):
+            source = os.path.join(prefixdir, si_s)
+            dest = os.path.join(dest_sharedir, prefix, si_s)
+            if os.path.exists(dest):
+                print >>err, "%s already exists, leaving %s in place" % (
+                    quote_output(dest), quote_output(source))
+                conflicts += 1
+                continue
+            if not options["dry-run"]:
+                fileutil.make_dirs(os.path.dirname(dest))
+                try:
+                    os.rename(source, dest)
+                except OSError, e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    # on a different filesystem
+                    shutil.copytree(source, dest)
+                    shutil.rmtree(source)
+            moved += 1
+            moved_prefixes.add(str(prefix))
+    if options["dry-run"]:
+        print >>out, "would move %d buckets" % moved
+    else:
+        print >>out, "moved %d buckets" % moved
+        statefile = os.path.join(options.dest, "share_inventory.state")
+        if moved_prefixes and os.path.exists(statefile):
+            from allmydata.storage.inventory import ShareInventory
+            inventory = ShareInventory(statefile)
+            inventory.forget_prefixes(moved_prefixes)
+            inventory.save_state()
+            print >>out, ("share counts for %d prefixes will be recomputed"
+                          % len(moved_prefixes))
+    if conflicts:
+        print >>out, "%d buckets were already present and were not moved" % conflicts
+        return 1
+    return 0
+
+
 class ReplOptions(usage.Options):
     def getSynopsis(self):
         return "Usage: tahoe debug repl"
@@ -1050,6 +1143,7 @@ class DebugCommand(usage.Options):
         ["find-shares", None, FindSharesOptions, "Locate sharefiles in node dirs."],
         ["catalog-shares", None, CatalogSharesOptions, "Describe all shares in node dirs."],
         ["corrupt-share", None, CorruptShareOptions, "Corrupt a share by flipping a bit."],
+        ["migrate-shares", None, MigrateSharesOptions, "Move the shares of one storage directory into another."],
         ["repl", None, ReplOptions, "Open a Python interpreter."],
         ["trial", None, TrialOptions, "Run tests using Twisted Trial with the right imports."],
         ["flogtool", None, FlogtoolOptions, "Utilities to access log files."],
@@ -1068,6 +1162,7 @@ Subcommands:
     tahoe debug find-shares     Locate sharefiles in node directories.
     tahoe debug catalog-shares  Describe all shares in node dirs.
     tahoe debug corrupt-share   Corrupt a share by flipping a bit.
+    tahoe debug migrate-shares  Move shares from one storage directory to another.
     tahoe debug repl            Open a Python interpreter.
     tahoe debug trial           Run tests using Twisted Trial with the right imports.
     tahoe debug flogtool        Utilities to access log files.
@@ -1109,6 +1204,7 @@ subDispatch = {
     "find-shares": find_shares,
     "catalog-shares": catalog_shares,
     "corrupt-share": corrupt_share,
+    "migrate-shares": migrate_shares,
     "repl": repl,
     "trial": trial,
     "flogtool": flogtool,
@@ -1,14 +1,24 @@
 
-import os, time, struct
+import os, re, time, struct
 import cPickle as pickle
 from twisted.internet import reactor
 from twisted.application import service
-from allmydata.storage.common import si_b2a
-from allmydata.util import fileutil
+from allmydata.storage.common import si_b2a, si_a2b
+from allmydata.storage.mutable import MutableShareFile
+from allmydata.storage.inventory import empty_counts
+from allmydata.storage.executor import StorageIOExecutor
+from allmydata.util import fileutil, log
+
+# share files are named with their share number
+NUM_RE = re.compile("^[0-9]+$")
 
 class TimeSliceExceeded(Exception):
     pass
 
+class WaitingForPrefix(Exception):
+    # args[0] is a Deferred that fires when the prefix has been loaded
+    pass
+
 class ShareCrawler(service.MultiService):
     """A ShareCrawler subclass is attached to a StorageServer, and
     periodically walks all of its shares, processing each one in some
@@ -44,6 +54,13 @@ class ShareCrawler(service.MultiService):
     will use crawler.get_state() to retrieve this dictionary; they can
     present the contents as they see fit.
 
+    If the StorageServer keeps shares in more than one directory, each prefix
+    is visited in all of them at once: the bucket list holds the buckets of
+    every directory, and process_bucket() is given the prefixdir that holds
+    the bucket. Subclasses that override process_prefixdir() (which is given
+    the prefixdir of the first directory) should use bucket_prefixdir() to
+    find each bucket.
+
     Then create an instance, with a reference to a StorageServer and a
     filename where it can store persistent state. The statefile is used to
     keep track of how far around the ring the process has travelled, as well
@@ -57,6 +74,22 @@ class ShareCrawler(service.MultiService):
 
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
+
+    Setting 'io_threads' (before startService) to more than zero switches
+    the crawler to I/O scheduling, which suits large servers on spinning
+    disks, where the time goes into waiting for seeks rather than into
+    computation. A pool of that many threads loads the next
+    'prefetch_depth' prefixes ahead of the crawler: each prefix directory
+    and bucket directory is listed, and the beginning and end of every share
+    file (where the headers and leases live) are read, so that when the
+    subclass methods run (still in the reactor thread) everything they need
+    is already in the kernel's cache. Instead of allowed_cpu_percentage, the
+    pace is set by how long the disk takes to answer: while an operation
+    takes less than 'target_io_latency' seconds on average the crawler runs
+    flat out, and when the disk gets slower (usually because clients are
+    using it) the crawler sleeps long enough between prefixes to bring its
+    share of the disk's time down to match. In this mode the state is
+    saved after every prefix.
     """
 
     slow_start = 300 # don't start crawling for 5 minutes after startup
@@ -65,24 +98,40 @@ class ShareCrawler(service.MultiService):
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
 
+    # I/O scheduling (see above). These must be set before startService().
+    io_threads = 0
+    prefetch_depth = 4 # how many prefixes to load ahead
+    target_io_latency = 0.010 # seconds per disk operation
+    # bytes read from each end of each share file when loading a prefix
+    prefetch_bytes = 4096
+
+    # the CrawlerHost that drives me, if any (see CrawlerHost.add_consumer)
+    host = None
+
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
         if allowed_cpu_percentage is not None:
             self.allowed_cpu_percentage = allowed_cpu_percentage
         self.server = server
         self.sharedir = server.sharedir
+        self.sharedirs = [sd.sharedir for sd in server.sharedirs]
         self.statefile = statefile
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
                          for i in range(2**10)]
         self.prefixes.sort()
         self.timer = None
-        self.bucket_cache = (None, [])
+        self.bucket_cache = (None, [], {})
         self.current_sleep_time = None
         self.next_wake_time = None
         self.last_prefix_finished_time = None
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        self.io_latency = None # moving average, seconds per disk operation
+        self.last_prefix_io_time = None
+        self._io = None
+        self._prefetching = {} # prefix index -> Deferred
+        self._prefetched = {} # prefix index -> (buckets, homes)
         self.load_state()
 
     def minus_or_none(self, a, b):
@@ -147,6 +196,8 @@ class ShareCrawler(service.MultiService):
             # finished_prefix() function
             d["remaining-sleep-time"] = self.minus_or_none(self.next_wake_time,
                                                            time.time())
+        # only known when io_threads is set
+        d["io-latency"] = self.io_latency
         per_cycle = None
         if self.last_cycle_elapsed_time is not None:
             per_cycle = self.last_cycle_elapsed_time
@@ -236,6 +287,14 @@ class ShareCrawler(service.MultiService):
         fileutil.move_into_place(tmpfile, self.statefile)
 
     def startService(self):
+        if self.host:
+            # the CrawlerHost decides when I do any work
+            self.sleeping_between_cycles = True
+            service.MultiService.startService(self)
+            return
+        if self.io_threads and not self._io:
+            self._io = StorageIOExecutor(self.io_threads)
+            self._io.setServiceParent(self)
         # arrange things to look like we were just sleeping, so
         # status/progress values work correctly
         self.sleeping_between_cycles = True
@@ -262,6 +321,12 @@ class ShareCrawler(service.MultiService):
             finished_cycle = True
         except TimeSliceExceeded:
             finished_cycle = False
+        except WaitingForPrefix, e:
+            # come back when the disk-I/O threads have loaded it
+            self.save_state()
+            if self.running:
+                e.args[0].addCallback(self._prefix_loaded)
+            return
         self.save_state()
         if not self.running:
             # someone might have used stopService() to shut us down
@@ -277,6 +342,8 @@ class ShareCrawler(service.MultiService):
         # forever. Note that this means that, while a cycle is running, we
         # will process at least one bucket every 5 minutes, no matter how
         # long that bucket takes.
+        if self._io:
+            sleep_time = self.get_io_backoff()
         sleep_time = max(0.0, min(sleep_time, 299))
         if finished_cycle:
             # how long should we sleep between cycles? Don't run faster than
@@ -291,46 +358,148 @@ class ShareCrawler(service.MultiService):
         self.yielding(sleep_time)
         self.timer = reactor.callLater(sleep_time, self.start_slice)
 
+    def _prefix_loaded(self, ignored):
+        if self.running and not self.timer:
+            self.start_slice()
+
+    def get_io_backoff(self):
+        """Return how long to sleep after the last prefix to keep our share
+        of the disk's time in line with target_io_latency."""
+        if self.io_latency is None or self.io_latency <= self.target_io_latency:
+            return 0.0
+        return (self.last_prefix_io_time
+                * (self.io_latency / self.target_io_latency - 1))
+
+    def _list_buckets(self, prefix):
+        homes = {} # bucket -> prefixdir
+        for sharedir in self.sharedirs:
+            d = os.path.join(sharedir, prefix)
+            try:
+                for bucket in os.listdir(d):
+                    homes.setdefault(bucket, d)
+            except EnvironmentError:
+                pass
+        return sorted(homes.keys()), homes
+
+    def load_prefix(self, prefix):
+        """Run in a disk-I/O thread: list the prefix, and read the parts of
+        each share that crawlers look at, so that they will be cached when
+        the prefix is processed. Returns (buckets, homes, elapsed, ops)."""
+        start = time.time()
+        buckets, homes = self._list_buckets(prefix)
+        ops = len(self.sharedirs)
+        for bucket in buckets:
+            bucketdir = os.path.join(homes[bucket], bucket)
+            try:
+                sharefiles = os.listdir(bucketdir)
+            except EnvironmentError:
+                continue
+            ops += 1
+            for fn in sharefiles:
+                try:
+                    f = open(os.path.join(bucketdir, fn), "rb")
+                    try:
+                        f.read(self.prefetch_bytes)
+                        f.seek(0, 2)
+                        f.seek(max(0, f.tell() - self.prefetch_bytes))
+                        f.read(self.prefetch_bytes)
+                    finally:
+                        f.close()
+                except EnvironmentError:
+                    continue
+                ops += 2
+        return buckets, homes, time.time() - start, ops
+
+    def _start_prefetching(self, first):
+        # make sure the prefixes from 'first' on are being loaded
+        last = min(first + self.prefetch_depth, len(self.prefixes))
+        for i in range(first, last):
+            if i in self._prefetching or i in self._prefetched:
+                continue
+            d = self._io.run(None, self.load_prefix, self.prefixes[i])
+            def _loaded((buckets, homes, elapsed, ops), i=i):
+                del self._prefetching[i]
+                self._prefetched[i] = (buckets, homes)
+                self.last_prefix_io_time = elapsed
+                latency = elapsed / max(ops, 1)
+                if self.io_latency is None:
+                    self.io_latency = latency
+                else:
+                    self.io_latency = 0.8 * self.io_latency + 0.2 * latency
+            def _failed(f, i=i):
+                del self._prefetching[i]
+                log.err(f, "unable to load prefix %s" % self.prefixes[i],
+                        umid="3WiN2w")
+                # let the crawler list it for itself
+                self._prefetched[i] = self._list_buckets(self.prefixes[i])
+            d.addCallbacks(_loaded, _failed)
+            self._prefetching[i] = d
+
+    def _get_buckets(self, i):
+        if i == self.bucket_cache[0]:
+            return self.bucket_cache[1]
+        if self._io:
+            if i not in self._prefetched:
+                self._start_prefetching(i)
+                raise WaitingForPrefix(self._prefetching[i])
+            buckets, homes = self._prefetched.pop(i)
+            self._start_prefetching(i+1)
+        else:
+            buckets, homes = self._list_buckets(self.prefixes[i])
+        self.bucket_cache = (i, buckets, homes)
+        return buckets
+
     def start_current_prefix(self, start_slice):
         state = self.state
         if state["current-cycle"] is None:
-            self.last_cycle_started_time = time.time()
-            state["current-cycle-start-time"] = self.last_cycle_started_time
-            if state["last-cycle-finished"] is None:
-                state["current-cycle"] = 0
-            else:
-                state["current-cycle"] = state["last-cycle-finished"] + 1
-            self.started_cycle(state["current-cycle"])
+            self.begin_cycle()
         cycle = state["current-cycle"]
 
         for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
             # if we want to yield earlier, just raise TimeSliceExceeded()
             prefix = self.prefixes[i]
             prefixdir = os.path.join(self.sharedir, prefix)
-            if i == self.bucket_cache[0]:
-                buckets = self.bucket_cache[1]
-            else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
-                self.bucket_cache = (i, buckets)
+            buckets = self._get_buckets(i)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
-            self.last_complete_prefix_index = i
-
-            now = time.time()
-            if self.last_prefix_finished_time is not None:
-                elapsed = now - self.last_prefix_finished_time
-                self.last_prefix_elapsed_time = elapsed
-            self.last_prefix_finished_time = now
-
-            self.finished_prefix(cycle, prefix)
+            self.complete_prefix(i)
+            if self._io:
+                self.save_state()
+                if self.get_io_backoff() > 0:
+                    raise TimeSliceExceeded()
             if time.time() >= start_slice + self.cpu_slice:
                 raise TimeSliceExceeded()
 
         # yay! we finished the whole cycle
+        self.end_cycle()
+        self.save_state()
+
+    # begin_cycle(), complete_prefix() and end_cycle() do the bookkeeping
+    # for start_current_prefix(). A CrawlerHost calls them on the crawlers
+    # that it drives.
+
+    def begin_cycle(self):
+        state = self.state
+        self.last_cycle_started_time = time.time()
+        state["current-cycle-start-time"] = self.last_cycle_started_time
+        if state["last-cycle-finished"] is None:
+            state["current-cycle"] = 0
+        else:
+            state["current-cycle"] = state["last-cycle-finished"] + 1
+        self.started_cycle(state["current-cycle"])
+
+    def complete_prefix(self, i):
+        self.last_complete_prefix_index = i
+        now = time.time()
+        if self.last_prefix_finished_time is not None:
+            elapsed = now - self.last_prefix_finished_time
+            self.last_prefix_elapsed_time = elapsed
+        self.last_prefix_finished_time = now
+        self.finished_prefix(self.state["current-cycle"], self.prefixes[i])
+
+    def end_cycle(self):
+        state = self.state
+        cycle = state["current-cycle"]
         self.last_complete_prefix_index = -1
         self.last_prefix_finished_time = None # don't include the sleep
         now = time.time()
@@ -340,7 +509,14 @@ class ShareCrawler(service.MultiService):
         state["last-cycle-finished"] = cycle
         state["current-cycle"] = None
         self.finished_cycle(cycle)
-        self.save_state()
+
+    def get_next_cycle_time(self):
+        """Return the time (seconds-since-epoch) at which minimum_cycle_time
+        allows the next cycle to start, counted from the start of the last
+        one. This is 0 if no cycle has finished yet."""
+        if self.state["last-cycle-finished"] is None:
+            return 0
+        return self.state["current-cycle-start-time"] + self.minimum_cycle_time
 
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
@@ -357,11 +533,19 @@ class ShareCrawler(service.MultiService):
         for bucket in buckets:
             if bucket <= self.state["last-complete-bucket"]:
                 continue
-            self.process_bucket(cycle, prefix, prefixdir, bucket)
+            self.process_bucket(cycle, prefix,
+                                self.bucket_prefixdir(prefixdir, bucket),
+                                bucket)
             self.state["last-complete-bucket"] = bucket
             if time.time() >= start_slice + self.cpu_slice:
                 raise TimeSliceExceeded()
 
+    def bucket_prefixdir(self, prefixdir, storage_index_b32):
+        """Return the prefixdir that holds the given bucket of the prefix
+        being processed. 'prefixdir' (the one in the first share directory)
+        is returned for buckets that I don't know about."""
+        return self.bucket_cache[2].get(storage_index_b32, prefixdir)
+
     # the remaining methods are explictly for subclasses to implement.
 
     def started_cycle(self, cycle):
@@ -441,9 +625,16 @@ class BucketCountingCrawler(ShareCrawler):
     will have shares on other servers instead of me. Also note that the
     number of buckets will differ from the number of shares in small grids,
     when more than one share is placed on a single server.
+
+    The server's ShareInventory keeps these counts up to date as shares
+    arrive and leave, so my job is to count each prefix directory from disk
+    (buckets, and the number and size of the shares of each type) and hand
+    the result to the inventory, which uses it to fill in prefixes it has
+    never seen and to correct any that have drifted. Since this is only a
+    consistency check, I don't need to run very often.
     """
 
-    minimum_cycle_time = 60*60 # we don't need this more than once an hour
+    minimum_cycle_time = 24*60*60 # once a day is plenty for a check
 
     def __init__(self, server, statefile, num_sample_prefixes=1):
         ShareCrawler.__init__(self, server, statefile)
@@ -469,6 +660,41 @@ class BucketCountingCrawler(ShareCrawler):
         self.state["bucket-counts"][cycle][prefix] = len(buckets)
         if prefix in self.prefixes[:self.num_sample_prefixes]:
             self.state["storage-index-samples"][prefix] = (cycle, buckets)
+        self.server.inventory.set_prefix_counts(prefix,
+                                                self.count_shares(prefixdir,
+                                                                  buckets))
+
+    def count_shares(self, prefixdir, buckets):
+        counts = empty_counts()
+        counts["buckets"] = len(buckets)
+        for storage_index_b32 in buckets:
+            bucketdir = os.path.join(self.bucket_prefixdir(prefixdir,
+                                                           storage_index_b32),
+                                     storage_index_b32)
+            try:
+                sharefiles = os.listdir(bucketdir)
+            except EnvironmentError:
+                continue
+            for fn in sharefiles:
+                if not NUM_RE.match(fn):
+                    continue
+                sharefile = os.path.join(bucketdir, fn)
+                try:
+                    f = open(sharefile, "rb")
+                    header = f.read(32)
+                    f.close()
+                    size = os.stat(sharefile).st_size
+                except EnvironmentError:
+                    continue
+                # this matches get_share_file(): anything that isn't a
+                # mutable container is assumed to be immutable
+                if header == MutableShareFile.MAGIC:
+                    sharetype = "mutable"
+                else:
+                    sharetype = "immutable"
+                counts[sharetype+"-shares"] += 1
+                counts[sharetype+"-bytes"] += size
+        return counts
 
     def finished_cycle(self, cycle):
         last_counts = self.state["bucket-counts"].get(cycle, [])
@@ -486,3 +712,212 @@ class BucketCountingCrawler(ShareCrawler):
             if old_cycle != cycle:
                 del self.state["storage-index-samples"][prefix]
 
+
+class MutableCompactingCrawler(ShareCrawler):
+    """I give back the space that mutable share containers no longer need.
+    A container grows (by the server's mutable_growth_factor) when its data
+    outgrows it, but never shrinks by itself: shares that were truncated, or
+    that stopped growing after space was preallocated for them, keep the
+    room. I call MutableShareFile.compact() on each mutable share that has
+    more than 'min_slack' bytes to spare and has not been modified for
+    'idle_time' seconds (so that shares which are still being appended to
+    keep their room to grow), and tell the server's ShareInventory how much
+    was freed.
+
+    My state holds the number of shares compacted and bytes freed, in
+    ["cycle-to-date"] and (for the last complete cycle) ["last-cycle"].
+    """
+
+    minimum_cycle_time = 24*60*60
+    min_slack = 64*1024
+    idle_time = 24*60*60
+
+    def add_initial_state(self):
+        self.state.setdefault("cycle-to-date", self.create_empty_cycle_dict())
+        self.state.setdefault("last-cycle", None)
+
+    def create_empty_cycle_dict(self):
+        return {"compacted-shares": 0, "freed-bytes": 0}
+
+    def started_cycle(self, cycle):
+        self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        storage_index = si_a2b(str(storage_index_b32))
+        if self.server.is_io_busy(storage_index):
+            # a disk-I/O thread is writing to this bucket: leave it alone
+            # until next cycle
+            return
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        try:
+            sharefiles = os.listdir(bucketdir)
+        except EnvironmentError:
+            return
+        now = time.time()
+        for fn in sharefiles:
+            if not NUM_RE.match(fn):
+                continue
+            sharefile = os.path.join(bucketdir, fn)
+            try:
+                f = open(sharefile, "rb")
+                header = f.read(32)
+                f.close()
+                s = os.stat(sharefile)
+            except EnvironmentError:
+                continue
+            if header != MutableShareFile.MAGIC:
+                continue
+            if now - s.st_mtime < self.idle_time:
+                continue
+            freed = MutableShareFile(sharefile).compact(self.min_slack)
+            if freed:
+                self.server.inventory.share_resized(storage_index, "mutable",
+                                                    s.st_size,
+                                                    s.st_size - freed)
+                so_far = self.state["cycle-to-date"]
+                so_far["compacted-shares"] += 1
+                so_far["freed-bytes"] += freed
+
+    def finished_cycle(self, cycle):
+        self.state["last-cycle"] = self.state["cycle-to-date"]
+
+class CrawlerHost(ShareCrawler):
+    """I walk the shares once per cycle on behalf of several other crawlers
+    (my consumers), so that a server running N crawlers lists each prefix
+    and bucket directory once instead of N times. Each bucket is handed to
+    every consumer in turn while its directory is still in the kernel's
+    cache.
+
+    Consumers are ordinary ShareCrawler instances, registered with
+    add_consumer() instead of being attached to the StorageServer. Each one
+    keeps its own statefile, cycle count, and progress (so the status pages
+    that use get_state() and get_progress() keep working), but it no longer
+    has a timer of its own: I decide when work is done, and my own
+    allowed_cpu_percentage, cpu_slice, and io_threads settings apply to the
+    combined walk.
+
+    A consumer joins a cycle of mine when it starts, if its own
+    minimum_cycle_time has passed since the start of its last cycle, and
+    sits that cycle out otherwise. Between cycles I sleep until the next
+    consumer is due. A consumer that was part way through a cycle when it
+    was added (for example, one that used to run on its own) picks up where
+    it left off once my walk reaches that prefix, carrying on into my next
+    cycle if need be: a consumer is only ever given the prefix right after
+    the last one it completed, so it never skips any.
+
+    Consumers that leave process_prefixdir() alone get their process_bucket()
+    calls interleaved with those of the other consumers, one bucket at a
+    time. Consumers that override process_prefixdir() (like the
+    BucketCountingCrawler) are given each whole prefix, before the buckets
+    are dispatched.
+    """
+
+    def add_consumer(self, consumer, name):
+        consumer.host = self
+        consumer.setName(name)
+        consumer.setServiceParent(self)
+
+    def get_consumers(self):
+        return [s for s in self if isinstance(s, ShareCrawler)]
+
+    def get_consumer_progress(self):
+        """Return a dict that maps each consumer's name to its
+        get_progress()."""
+        return dict([(c.name, c.get_progress())
+                     for c in self.get_consumers()])
+
+    def _wants_buckets(self, consumer):
+        return (consumer.process_prefixdir.im_func
+                is ShareCrawler.process_prefixdir.im_func)
+
+    def _schedule_next_cycle(self):
+        due = [c.get_next_cycle_time() for c in self.get_consumers()]
+        if due:
+            self.minimum_cycle_time = max(0, min(due) - time.time())
+        else:
+            self.minimum_cycle_time = ShareCrawler.minimum_cycle_time
+
+    def _update_consumers(self):
+        # keep the consumers' status fields in step with mine
+        now = time.time()
+        for c in self.get_consumers():
+            c.next_wake_time = self.next_wake_time
+            if c.state["current-cycle"] is None:
+                c.sleeping_between_cycles = True
+                if self.next_wake_time is not None:
+                    c.next_wake_time = max(self.next_wake_time,
+                                           c.get_next_cycle_time())
+            else:
+                c.sleeping_between_cycles = False
+            c.current_sleep_time = self.minus_or_none(c.next_wake_time, now)
+
+    def startService(self):
+        ShareCrawler.startService(self)
+        self._update_consumers()
+
+    def start_slice(self):
+        ShareCrawler.start_slice(self)
+        self._update_consumers()
+
+    def save_state(self):
+        # the consumers go first, so that my statefile never claims more
+        # progress than theirs: after a crash, a prefix is at worst handed
+        # to a consumer twice, never skipped
+        for c in self.get_consumers():
+            c.save_state()
+        ShareCrawler.save_state(self)
+
+    def start_current_prefix(self, start_slice):
+        if self.state["current-cycle"] is None:
+            now = time.time()
+            if not [c for c in self.get_consumers()
+                    if c.state["current-cycle"] is not None
+                    or c.get_next_cycle_time() <= now]:
+                # nobody needs a walk yet, so don't start one
+                self._schedule_next_cycle()
+                return
+        ShareCrawler.start_current_prefix(self, start_slice)
+
+    def started_cycle(self, cycle):
+        now = time.time()
+        for c in self.get_consumers():
+            if (c.state["current-cycle"] is None
+                and c.get_next_cycle_time() <= now):
+                c.begin_cycle()
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        i = self.last_complete_prefix_index + 1
+        active = [c for c in self.get_consumers()
+                  if c.state["current-cycle"] is not None
+                  and c.last_complete_prefix_index == i - 1]
+        per_bucket = []
+        for c in active:
+            c.bucket_cache = self.bucket_cache
+            if self._wants_buckets(c):
+                per_bucket.append(c)
+                continue
+            c.process_prefixdir(c.state["current-cycle"], prefix, prefixdir,
+                                buckets, start_slice)
+            c.complete_prefix(i)
+        for bucket in buckets:
+            bucket_prefixdir = self.bucket_prefixdir(prefixdir, bucket)
+            for c in per_bucket:
+                if bucket <= c.state["last-complete-bucket"]:
+                    continue
+                c.process_bucket(c.state["current-cycle"], prefix,
+                                 bucket_prefixdir, bucket)
+                c.state["last-complete-bucket"] = bucket
+            if time.time() >= start_slice + self.cpu_slice:
+                raise TimeSliceExceeded()
+        for c in per_bucket:
+            c.complete_prefix(i)
+
+    def finished_cycle(self, cycle):
+        last = len(self.prefixes) - 1
+        for c in self.get_consumers():
+            # a consumer that joined part way through its own cycle still
+            # has the start of it to do, in my next cycle
+            if (c.state["current-cycle"] is not None
+                and c.last_complete_prefix_index == last):
+                c.end_cycle()
+        self._schedule_next_cycle()
@@ -0,0 +1,114 @@
+
+import time
+from collections import deque
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+from twisted.application import service
+
+def when_done(result, f):
+    """Apply f() to 'result', which is either a value returned by
+    StorageIOExecutor.run() in synchronous mode, or a Deferred."""
+    if isinstance(result, defer.Deferred):
+        return result.addCallback(f)
+    return f(result)
+
+def when_all_done(results, f):
+    """Apply f() to None once all of 'results' (each a value returned by
+    StorageIOExecutor.run()) are available. If any of them fails, f() is not
+    applied, and the first failure is passed on instead."""
+    ds = [r for r in results if isinstance(r, defer.Deferred)]
+    if not ds:
+        return f(None)
+    d = defer.gatherResults(ds, consumeErrors=True)
+    def _first_failure(failure):
+        failure.trap(defer.FirstError)
+        return failure.value.subFailure
+    d.addErrback(_first_failure)
+    d.addCallback(lambda ign: f(None))
+    return d
+
+class StorageIOExecutor(service.Service):
+    """I run the blocking disk I/O of storage server requests, so that a slow
+    disk does not hold up the reactor (and with it every other client of the
+    node).
+
+    With 'threads' set to zero, run() simply calls the function and returns
+    its result, exactly as if I were not there. Otherwise I hand the work to
+    a pool of at most 'threads' threads, and run() returns a Deferred that
+    fires (in the reactor thread) with the result.
+
+    Work submitted with the same (non-None) key is run one at a time, in the
+    order it was submitted: the storage server uses the storage index as the
+    key for everything that reads or modifies the share files of a bucket
+    (mutable writes and reads, and lease changes), so that no two threads
+    ever touch the same share at once.
+
+    'record_wait' is called (in the reactor thread) with the number of
+    seconds that each piece of work waited before a thread picked it up.
+    """
+
+    def __init__(self, threads=0, record_wait=None):
+        self.threads = threads
+        self._record_wait = record_wait
+        self._pool = None
+        if threads:
+            self._pool = threadpool.ThreadPool(0, threads,
+                                               "storage-io")
+        self._busy = {} # key -> deque of (func, args, kwargs, d, submitted)
+        self._outstanding = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        if self._pool:
+            self._pool.start()
+
+    def stopService(self):
+        if self._pool:
+            self._pool.stop()
+        return service.Service.stopService(self)
+
+    def is_busy(self, key):
+        """Is any work with this key waiting or running?"""
+        return key in self._busy
+
+    def get_stats(self):
+        # 'queue_depth' counts everything that has been submitted and has not
+        # yet finished, including work that is running right now
+        return {"threads": self.threads,
+                "queue_depth": self._outstanding,
+                }
+
+    def run(self, key, func, *args, **kwargs):
+        if not self._pool:
+            return func(*args, **kwargs)
+        d = defer.Deferred()
+        self._outstanding += 1
+        job = (func, args, kwargs, d, time.time())
+        if key is None:
+            self._submit(None, job)
+        elif key in self._busy:
+            self._busy[key].append(job)
+        else:
+            self._busy[key] = deque()
+            self._submit(key, job)
+        return d
+
+    def _submit(self, key, job):
+        (func, args, kwargs, d, submitted) = job
+        started = []
+        def _in_thread():
+            started.append(time.time())
+            return func(*args, **kwargs)
+        d2 = threads.deferToThreadPool(reactor, self._pool, _in_thread)
+        def _finished(res):
+            self._outstanding -= 1
+            if started and self._record_wait:
+                self._record_wait(started[0] - submitted)
+            if key is not None:
+                waiting = self._busy[key]
+                if waiting:
+                    self._submit(key, waiting.popleft())
+                else:
+                    del self._busy[key]
+            d.callback(res) # 'res' may be a Failure
+        d2.addBoth(_finished)
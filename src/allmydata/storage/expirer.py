@@ -2,7 +2,7 @@ import time, os, pickle, struct
 from allmydata.storage.crawler import ShareCrawler
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
+     UnknownImmutableContainerVersionError, si_a2b
 from twisted.python import log as twlog
 
 class LeaseCheckingCrawler(ShareCrawler):
@@ -113,6 +113,10 @@ class LeaseCheckingCrawler(ShareCrawler):
         return os.stat(fn)
 
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        if self.server.is_io_busy(si_a2b(str(storage_index_b32))):
+            # a disk-I/O thread is working on this bucket right now. It will
+            # be examined again next cycle.
+            return
         bucketdir = os.path.join(prefixdir, storage_index_b32)
         s = self.stat(bucketdir)
         would_keep_shares = []
@@ -208,6 +212,17 @@ class LeaseCheckingCrawler(ShareCrawler):
         if self.expiration_enabled:
             for li in expired_leases_configured:
                 sf.cancel_lease(li.cancel_secret)
+            si_s = str(os.path.basename(os.path.dirname(sharefilename)))
+            if not os.path.exists(sharefilename):
+                # the last lease was cancelled, taking the share with it
+                self.server.inventory.share_removed(si_a2b(si_s), sharetype,
+                                                    s.st_size)
+                self.server.readv_cache.invalidate(si_a2b(si_s))
+            elif expired_leases_configured:
+                # each cancelled lease shrank the share
+                self.server.note_share_resized(si_a2b(si_s), sharetype,
+                                               s.st_size,
+                                               os.path.getsize(sharefilename))
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
@@ -1,5 +1,6 @@
 import os, stat, struct, time
 
+from twisted.internet import defer
 from foolscap.api import Referenceable
 
 from zope.interface import implements
@@ -10,6 +11,8 @@ from allmydata.util.hashutil import constant_time_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownImmutableContainerVersionError, \
      DataTooLargeError
+from allmydata.storage.executor import StorageIOExecutor, when_done, \
+     when_all_done
 
 # each share file (in storage/shares/$SI/$SHNUM) contains lease information
 # and share data. The share data is accessed by RIBucketWriter.write and
@@ -92,17 +95,26 @@ class ShareFile:
         f.seek(seekpos)
         return f.read(actuallength)
 
-    def write_share_data(self, offset, data):
-        length = len(data)
+    def check_share_data(self, offset, length):
         precondition(offset >= 0, offset)
         if self._max_size is not None and offset+length > self._max_size:
             raise DataTooLargeError(self._max_size, offset, length)
-        f = open(self.home, 'rb+')
+
+    def write_share_data(self, offset, data, f=None):
+        """Write 'data' at 'offset' within the share data. If 'f' is
+        provided, it must be a file opened (in 'rb+' mode) on my home, and I
+        will use it instead of opening and closing the file myself."""
+        self.check_share_data(offset, len(data))
+        close = False
+        if f is None:
+            f = open(self.home, 'rb+')
+            close = True
         real_offset = self._data_offset+offset
         f.seek(real_offset)
         assert f.tell() == real_offset
         f.write(data)
-        f.close()
+        if close:
+            f.close()
 
     def _write_lease_record(self, f, lease_number, lease_info):
         offset = self._lease_offset + lease_number * self.LEASE_SIZE
@@ -194,11 +206,46 @@ class ShareFile:
         return space_freed
 
 
+DURABILITY_POLICIES = ("none", "fsync", "fdatasync")
+
+# not every platform has fdatasync(), but fsync() is always good enough
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+# used when BucketWriters and BucketReaders are not given an executor: it
+# does all of the disk I/O in the calling thread
+_synchronous_io = StorageIOExecutor()
+
 class BucketWriter(Referenceable):
+    """I receive one immutable share from an uploader, writing it into
+    'incominghome' and moving it to 'finalhome' when it is closed.
+
+    I keep the share file open for as long as I live, and I gather small
+    writes that follow on from each other (as the data blocks of a share
+    do) into a buffer of up to 'write_buffer_size' bytes, which is written
+    out when it fills, when a write arrives for some other part of the
+    share, or when I am closed.
+
+    'durability' says what I do to get the share onto the disk: 'none'
+    leaves it to the operating system, 'fsync' calls fsync() just before
+    the share is closed, and 'fdatasync' calls fdatasync() after every
+    'sync_batch_size' bytes and again at close, so that the work of
+    flushing a large share is spread across the upload.
+
+    Everything that touches the disk is done through 'executor' (a
+    StorageIOExecutor), using me as the key, so my writes reach the disk one
+    at a time and in order even when they are done by a pool of threads.
+    The buffer itself is only ever handled in the reactor thread.
+    """
     implements(RIBucketWriter)
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    write_buffer_size = 256*1024
+    sync_batch_size = 8*1024*1024
+
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary,
+                 durability="none", executor=None):
+        precondition(durability in DURABILITY_POLICIES, durability)
         self.ss = ss
+        self._io = executor or _synchronous_io
         self.incominghome = incominghome
         self.finalhome = finalhome
         self._max_size = max_size # don't allow the client to write more than this
@@ -210,6 +257,12 @@ class BucketWriter(Referenceable):
         # also, add our lease to the file now, so that other ones can be
         # added by simultaneous uploaders
         self._sharefile.add_lease(lease_info)
+        self._durability = durability
+        self._f = open(incominghome, 'rb+')
+        self._buffer = []
+        self._buffer_offset = 0
+        self._buffer_length = 0
+        self._unsynced = 0
 
     def allocated_size(self):
         return self._max_size
@@ -219,16 +272,108 @@ class BucketWriter(Referenceable):
         precondition(not self.closed)
         if self.throw_out_all_data:
             return
-        self._sharefile.write_share_data(offset, data)
-        self.ss.add_latency("write", time.time() - start)
-        self.ss.count("write")
+        self._sharefile.check_share_data(offset, len(data))
+        # both flushes are queued right away, so that they reach the disk
+        # before anything that is written or closed after them, and the
+        # client hears about a failure of either one
+        flushes = []
+        if (self._buffer_length
+            and offset != self._buffer_offset + self._buffer_length):
+            # not a continuation of what we have buffered
+            flushes.append(self._io.run(self, self._flush,
+                                        *self._take_buffer()))
+        if not self._buffer_length:
+            self._buffer_offset = offset
+        self._buffer.append(data)
+        self._buffer_length += len(data)
+        if self._buffer_length >= self.write_buffer_size:
+            flushes.append(self._io.run(self, self._flush,
+                                        *self._take_buffer()))
+        def _done(ign):
+            self.ss.add_latency("write", time.time() - start)
+            self.ss.count("write")
+        return when_all_done(flushes, _done)
+
+    def _take_buffer(self):
+        offset, data = self._buffer_offset, "".join(self._buffer)
+        self._buffer = []
+        self._buffer_length = 0
+        return offset, data
+
+    def _flush(self, offset, data):
+        if data:
+            self._sharefile.write_share_data(offset, data, self._f)
+            self._f.flush()
+            self._unsynced += len(data)
+        if (self._durability == "fdatasync"
+            and self._unsynced >= self.sync_batch_size):
+            self._sync()
+
+    def _sync(self):
+        if self._durability == "fsync":
+            os.fsync(self._f.fileno())
+        elif self._durability == "fdatasync":
+            _fdatasync(self._f.fileno())
+        self._unsynced = 0
 
     def remote_close(self):
         precondition(not self.closed)
         start = time.time()
+        self.closed = True
+        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
 
+        try:
+            d = self._io.run(self, self._close, *self._take_buffer())
+        except:
+            self._close_failed()
+            raise
+        if isinstance(d, defer.Deferred):
+            def _failed(f):
+                self._close_failed()
+                return f
+            d.addErrback(_failed)
+        def _closed(filelen):
+            self._remove_incoming_dirs()
+            self.ss.bucket_writer_closed(self, filelen)
+            self.ss.add_latency("close", time.time() - start)
+            self.ss.count("close")
+        return when_done(d, _closed)
+
+    def _close(self, offset, data):
+        self._flush(offset, data)
+        self._sync()
+        self._f.close()
+        self._f = None
         fileutil.make_dirs(os.path.dirname(self.finalhome))
         fileutil.rename(self.incominghome, self.finalhome)
+        self._sharefile = None
+        return os.stat(self.finalhome)[stat.ST_SIZE]
+
+    def _close_failed(self):
+        # The share could not be written out or moved into place. Give it up
+        # as _abort would, so that neither its file handle nor the space
+        # allocated to it is held forever. This runs in the reactor thread,
+        # once the I/O thread has finished with the file.
+        if self._f is not None:
+            try:
+                self._f.close()
+            except EnvironmentError:
+                pass
+            self._f = None
+        self._sharefile = None
+        try:
+            os.remove(self.incominghome)
+        except EnvironmentError:
+            pass
+        self._remove_incoming_dirs()
+        self.ss.bucket_writer_closed(self, 0)
+
+    def _remove_incoming_dirs(self):
+        # This runs in the reactor thread, after the share has been moved or
+        # removed by _close or _remove_share in the I/O thread. The storage
+        # server creates these directories for new BucketWriters in the
+        # reactor thread too, so it can never see one vanish between making
+        # it and opening the share file inside it.
         try:
             # self.incominghome is like storage/shares/incoming/ab/abcde/4 .
             # We try to delete the parent (.../ab/abcde) to avoid leaving
@@ -253,14 +398,6 @@ class BucketWriter(Referenceable):
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
-        self._sharefile = None
-        self.closed = True
-        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
-        self.ss.bucket_writer_closed(self, filelen)
-        self.ss.add_latency("close", time.time() - start)
-        self.ss.count("close")
 
     def _disconnected(self):
         if not self.closed:
@@ -271,33 +408,39 @@ class BucketWriter(Referenceable):
                 facility="tahoe.storage", level=log.UNUSUAL)
         if not self.closed:
             self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-        self._abort()
+        d = self._abort()
         self.ss.count("abort")
+        return d
 
     def _abort(self):
         if self.closed:
             return
 
+        # We are now considered closed for further writing.
+        self.closed = True
+        self._take_buffer()
+        d = self._io.run(self, self._remove_share)
+        def _removed(ign):
+            self._remove_incoming_dirs()
+            # We must tell the storage server about this so that it stops
+            # expecting us to use the space it allocated for us earlier.
+            self.ss.bucket_writer_closed(self, 0)
+        return when_done(d, _removed)
+
+    def _remove_share(self):
+        self._f.close()
+        self._f = None
         os.remove(self.incominghome)
-        # if we were the last share to be moved, remove the incoming/
-        # directory that was our parent
-        parentdir = os.path.split(self.incominghome)[0]
-        if not os.listdir(parentdir):
-            os.rmdir(parentdir)
         self._sharefile = None
 
-        # We are now considered closed for further writing. We must tell
-        # the storage server about this so that it stops expecting us to
-        # use the space it allocated for us earlier.
-        self.closed = True
-        self.ss.bucket_writer_closed(self, 0)
-
 
 class BucketReader(Referenceable):
     implements(RIBucketReader)
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 executor=None):
         self.ss = ss
+        self._io = executor or _synchronous_io
         self._share_file = ShareFile(sharefname)
         self.storage_index = storage_index
         self.shnum = shnum
@@ -309,10 +452,13 @@ class BucketReader(Referenceable):
 
     def remote_read(self, offset, length):
         start = time.time()
-        data = self._share_file.read_share_data(offset, length)
-        self.ss.add_latency("read", time.time() - start)
-        self.ss.count("read")
-        return data
+        d = self._io.run(None, self._share_file.read_share_data,
+                         offset, length)
+        def _done(data):
+            self.ss.add_latency("read", time.time() - start)
+            self.ss.count("read")
+            return data
+        return when_done(d, _done)
 
     def remote_advise_corrupt_share(self, reason):
         return self.ss.remote_advise_corrupt_share("immutable",
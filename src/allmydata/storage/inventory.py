@@ -0,0 +1,181 @@
+
+import threading
+import cPickle as pickle
+from twisted.internet import task
+from twisted.application import service
+from allmydata.storage.common import si_b2a
+from allmydata.util import fileutil, log
+
+COUNTERS = ("buckets",
+            "immutable-shares", "immutable-bytes",
+            "mutable-shares", "mutable-bytes")
+
+NUM_PREFIXES = 2**10 # see ShareCrawler.prefixes
+
+def empty_counts():
+    return dict([(name, 0) for name in COUNTERS])
+
+class ShareInventory(service.Service):
+    """I keep exact counts of the buckets and shares held by a storage
+    server, and of the bytes used by those shares, without walking the share
+    directories. The StorageServer tells me whenever it creates or deletes a
+    bucket directory, closes a new immutable share, creates or deletes a
+    mutable share, or resizes a share (by writing to it, or by adding or
+    cancelling a lease), and I adjust my counts for the prefix directory
+    that holds that bucket.
+
+    My counts are only trusted once every prefix directory has been counted
+    from disk by the BucketCountingCrawler: until then, get_counts() returns
+    None. After that, the crawler keeps visiting (much less often than it
+    used to) as a consistency check, replacing my counts for each prefix
+    with what it finds on disk, and logging any difference. Differences are
+    expected only if the node was killed before it could save my state, or
+    if shares were added or removed behind the server's back.
+
+    My state is kept in a pickle in 'statefile', which is written every
+    'save_interval' seconds (if anything has changed), and when the service
+    is stopped.
+
+    The StorageServer may call me from its disk-I/O threads, so my counts
+    are guarded by a lock.
+    """
+
+    save_interval = 60
+
+    def __init__(self, statefile):
+        self.statefile = statefile
+        self.timer = None
+        self.dirty = False
+        self._lock = threading.Lock()
+        self.load_state()
+
+    def load_state(self):
+        # ["version"]: int, always 1
+        # ["prefixes"][prefix]: dict mapping each name in COUNTERS to a count
+        # ["counted-prefixes"]: set of prefixes that the crawler has counted
+        #                       from disk at least once
+        # ["corrections"]: number of times the crawler has found a prefix
+        #                  that did not match our incremental counts
+        try:
+            f = open(self.statefile, "rb")
+            state = pickle.load(f)
+            f.close()
+        except Exception:
+            state = {"version": 1,
+                     "prefixes": {},
+                     "counted-prefixes": set(),
+                     "corrections": 0,
+                     }
+        self.state = state
+
+    def save_state(self):
+        tmpfile = self.statefile + ".tmp"
+        f = open(tmpfile, "wb")
+        self._lock.acquire()
+        try:
+            pickle.dump(self.state, f)
+            self.dirty = False
+        finally:
+            self._lock.release()
+        f.close()
+        fileutil.move_into_place(tmpfile, self.statefile)
+
+    def _save_if_dirty(self):
+        if self.dirty:
+            self.save_state()
+
+    def startService(self):
+        self.timer = task.LoopingCall(self._save_if_dirty)
+        self.timer.start(self.save_interval, now=False)
+        service.Service.startService(self)
+
+    def stopService(self):
+        if self.timer:
+            self.timer.stop()
+            self.timer = None
+        self._save_if_dirty()
+        return service.Service.stopService(self)
+
+    def _adjust(self, storage_index, deltas):
+        prefix = si_b2a(storage_index)[:2]
+        self._lock.acquire()
+        try:
+            counts = self.state["prefixes"].setdefault(prefix, empty_counts())
+            for name, delta in deltas.items():
+                counts[name] += delta
+            self.dirty = True
+        finally:
+            self._lock.release()
+
+    def bucket_added(self, storage_index):
+        self._adjust(storage_index, {"buckets": 1})
+
+    def bucket_removed(self, storage_index):
+        self._adjust(storage_index, {"buckets": -1})
+
+    def share_added(self, storage_index, sharetype, size):
+        # sharetype is "immutable" or "mutable"
+        self._adjust(storage_index, {sharetype+"-shares": 1,
+                                     sharetype+"-bytes": size})
+
+    def share_resized(self, storage_index, sharetype, old_size, new_size):
+        if new_size != old_size:
+            self._adjust(storage_index, {sharetype+"-bytes":
+                                         new_size - old_size})
+
+    def share_removed(self, storage_index, sharetype, size):
+        self._adjust(storage_index, {sharetype+"-shares": -1,
+                                     sharetype+"-bytes": -size})
+
+    def set_prefix_counts(self, prefix, counts):
+        """Replace my counts for one prefix directory with 'counts', which
+        the crawler has just measured from disk."""
+        self._lock.acquire()
+        try:
+            old = self.state["prefixes"].get(prefix, empty_counts())
+            corrected = (prefix in self.state["counted-prefixes"]
+                         and old != counts)
+            if corrected:
+                self.state["corrections"] += 1
+            self.state["prefixes"][prefix] = counts.copy()
+            self.state["counted-prefixes"].add(prefix)
+            self.dirty = True
+        finally:
+            self._lock.release()
+        if corrected:
+            log.msg(format="share inventory for prefix %(prefix)s was"
+                    " %(old)s, but disk says %(new)s",
+                    prefix=prefix, old=old, new=counts,
+                    facility="tahoe.storage", level=log.UNUSUAL,
+                    umid="Wm3xJg")
+
+    def forget_prefixes(self, prefixes):
+        """Shares have been added to these prefix directories behind the
+        server's back: stop trusting my counts for them until the crawler
+        has counted them from disk again."""
+        self._lock.acquire()
+        try:
+            for prefix in prefixes:
+                self.state["prefixes"].pop(prefix, None)
+                self.state["counted-prefixes"].discard(prefix)
+            self.dirty = True
+        finally:
+            self._lock.release()
+
+    def get_counts(self):
+        """Return a dict with the total of each counter in COUNTERS, or None
+        if some prefix directories have never been counted from disk."""
+        self._lock.acquire()
+        try:
+            if len(self.state["counted-prefixes"]) < NUM_PREFIXES:
+                return None
+            totals = empty_counts()
+            for counts in self.state["prefixes"].values():
+                for name in COUNTERS:
+                    totals[name] += counts[name]
+            return totals
+        finally:
+            self._lock.release()
+
+    def get_state(self):
+        return self.state
@@ -53,8 +53,13 @@ class MutableShareFile:
     MAX_SIZE = MAX_MUTABLE_SHARE_SIZE
     # TODO: decide upon a policy for max share size
 
-    def __init__(self, filename, parent=None):
+    def __init__(self, filename, parent=None, growth_factor=1.0):
         self.home = filename
+        # when the data outgrows the container, the new container is at
+        # least this many times the size of the old one, so that a share
+        # which grows by appending (as MDMF shares do) moves its extra leases
+        # a logarithmic number of times rather than on every write
+        self.growth_factor = growth_factor
         if os.path.exists(self.home):
             # we don't cache anything, just check the magic
             f = open(self.home, 'rb')
@@ -163,6 +168,46 @@ class MutableShareFile:
         f.write(extra_lease_data)
         self._write_extra_lease_offset(f, new_extra_lease_offset)
 
+    def _choose_container_size(self, f, needed):
+        old_container_size = (self._read_extra_lease_offset(f)
+                              - self.DATA_OFFSET)
+        grown = int(old_container_size * self.growth_factor)
+        return max(needed, min(grown, self.MAX_SIZE))
+
+    def compact(self, min_slack=0):
+        """Shrink the container to fit the share data, by moving the extra
+        leases down to the end of the data and truncating the file. This is
+        only done if it would free more than 'min_slack' bytes, and if the
+        new location of the extra leases does not overlap the old one (so
+        that an interrupt cannot corrupt them). Returns the number of bytes
+        freed."""
+        f = open(self.home, 'rb+')
+        try:
+            data_length = self._read_data_length(f)
+            old_extra_lease_offset = self._read_extra_lease_offset(f)
+            new_extra_lease_offset = self.DATA_OFFSET + data_length
+            slack = old_extra_lease_offset - new_extra_lease_offset
+            num_extra_leases = self._read_num_extra_leases(f)
+            leases_size = 4 + num_extra_leases * self.LEASE_SIZE
+            if slack <= min_slack or slack < leases_size:
+                return 0
+            old_size = os.fstat(f.fileno())[stat.ST_SIZE]
+            f.seek(old_extra_lease_offset)
+            extra_lease_data = f.read(leases_size)
+            f.seek(new_extra_lease_offset)
+            f.write(extra_lease_data)
+            f.flush()
+            # an interrupt before here is ok: the old leases are still
+            # where the header says they are
+            self._write_extra_lease_offset(f, new_extra_lease_offset)
+            f.flush()
+            # the old leases (and any data beyond the end of the share) are
+            # past the new end of the file, so they go away with it
+            f.truncate(new_extra_lease_offset + leases_size)
+            return old_size - (new_extra_lease_offset + leases_size)
+        finally:
+            f.close()
+
     def _write_share_data(self, f, offset, data):
         length = len(data)
         precondition(offset >= 0)
@@ -180,7 +225,8 @@ class MutableShareFile:
                 # have to move the leases. With luck, they're expanding it
                 # more than the size of the extra lease block, which will
                 # minimize the corrupt-the-share window
-                self._change_container_size(f, offset+length)
+                self._change_container_size(f,
+                    self._choose_container_size(f, offset+length))
                 extra_lease_offset = self._read_extra_lease_offset(f)
 
                 # an interrupt here is ok.. the container has been enlarged
@@ -422,9 +468,8 @@ class MutableShareFile:
             cur_length = self._read_data_length(f)
             if new_length < cur_length:
                 self._write_data_length(f, new_length)
-                # TODO: if we're going to shrink the share file when the
-                # share data has shrunk, then call
-                # self._change_container_size() here.
+                # the container keeps its size: compact() gives the space
+                # back later
         f.close()
 
 def testv_compare(a, op, b):
@@ -454,9 +499,10 @@ class EmptyShare:
                 break
         return test_good
 
-def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent):
+def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent,
+                             growth_factor=1.0):
     ms = MutableShareFile(filename, parent)
     ms.create(my_nodeid, write_enabler)
     del ms
-    return MutableShareFile(filename, parent)
+    return MutableShareFile(filename, parent, growth_factor)
 
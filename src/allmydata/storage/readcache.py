@@ -0,0 +1,129 @@
+
+import itertools, threading
+
+class ReadvCache:
+    """I remember the answers to recent slot_readv requests, so that the
+    mutable shares that everybody reads (a directory that is shared by many
+    users, for example) are served from memory instead of reopening and
+    rereading each share file every time.
+
+    For each storage index I keep the numbers of the shares that exist, and
+    the data that was read from each share, keyed by (shnum, offset, length).
+    A request is answered from the cache only if every range it asks for is
+    there; otherwise it is read from disk, and the answer is added to what I
+    know.
+
+    The StorageServer must call invalidate() whenever the shares of a
+    storage index change (writes, and shares being deleted). Reads and
+    writes of the same storage index never overlap, since the server runs
+    them one at a time (see StorageIOExecutor), so nothing stale can be
+    added after an invalidate().
+
+    I hold at most 'max_bytes' (share data plus an estimate of my overhead),
+    and a single storage index may use no more than an eighth of that. When
+    I am full, the least recently used storage indexes are dropped. With
+    max_bytes=0 I cache nothing.
+
+    I may be used from the StorageServer's disk-I/O threads.
+    """
+
+    # rough memory cost of each storage index and each range, beyond the
+    # share data itself, so that caching many empty answers still counts
+    ENTRY_OVERHEAD = 200
+    RANGE_OVERHEAD = 100
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self._entries = {} # storage index -> [last_used, size, shnums, ranges]
+        self._used = 0
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, storage_index, shares, readv):
+        """Return the datavs dict that slot_readv(storage_index, shares,
+        readv) would return, or None if I can't answer it."""
+        if not self.max_bytes:
+            return None
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(storage_index)
+            if entry is None:
+                self.misses += 1
+                return None
+            (last_used, size, shnums, ranges) = entry
+            datavs = {}
+            for shnum in shnums:
+                if shnum in shares or not shares:
+                    try:
+                        datavs[shnum] = [ranges[(shnum, offset, length)]
+                                         for (offset, length) in readv]
+                    except KeyError:
+                        self.misses += 1
+                        return None
+            entry[0] = self._clock.next()
+            self.hits += 1
+            return datavs
+        finally:
+            self._lock.release()
+
+    def add(self, storage_index, shnums, readv, datavs):
+        """Remember the answer to a slot_readv request. 'shnums' lists all
+        of the shares that exist for this storage index, whether or not the
+        request asked for them."""
+        if not self.max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(storage_index)
+            if entry is None or entry[2] != sorted(shnums):
+                if entry is not None:
+                    self._used -= entry[1]
+                entry = [None, self.ENTRY_OVERHEAD, sorted(shnums), {}]
+                self._entries[storage_index] = entry
+                self._used += self.ENTRY_OVERHEAD
+            ranges = entry[3]
+            for shnum, datav in datavs.items():
+                for (offset, length), data in zip(readv, datav):
+                    key = (shnum, offset, length)
+                    if key not in ranges:
+                        ranges[key] = data
+                        entry[1] += self.RANGE_OVERHEAD + len(data)
+                        self._used += self.RANGE_OVERHEAD + len(data)
+            entry[0] = self._clock.next()
+            if entry[1] > self.max_bytes // 8:
+                del self._entries[storage_index]
+                self._used -= entry[1]
+            if self._used > self.max_bytes:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        # drop the least recently used entries until I am three-quarters
+        # full, so that this isn't done on every add
+        by_age = sorted([(entry[0], si)
+                         for (si, entry) in self._entries.items()])
+        for (last_used, si) in by_age:
+            if self._used <= self.max_bytes * 3 // 4:
+                break
+            self._used -= self._entries.pop(si)[1]
+
+    def invalidate(self, storage_index):
+        if not self.max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(storage_index, None)
+            if entry is not None:
+                self._used -= entry[1]
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "bytes": self._used,
+                "entries": len(self._entries),
+                }
@@ -2,10 +2,14 @@ import os, re, weakref, struct, time
 
 from foolscap.api import Referenceable
 from twisted.application import service
+from twisted.internet import reactor, defer
+from twisted.python import threadable
 
 from zope.interface import implements
-from allmydata.interfaces import RIStorageServer, IStatsProducer
+from allmydata.interfaces import RIStorageServer, IStatsProducer, \
+     MAX_LEASES_PER_BATCH
 from allmydata.util import fileutil, idlib, log, time_format
+from allmydata.util.latency import WindowedLatencyHistogram
 import allmydata # for __full_version__
 
 from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
@@ -14,8 +18,14 @@ from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
      create_mutable_sharefile
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
-from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
-from allmydata.storage.crawler import BucketCountingCrawler
+from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader, \
+     DURABILITY_POLICIES
+from allmydata.storage.crawler import BucketCountingCrawler, CrawlerHost, \
+     MutableCompactingCrawler
+from allmydata.storage.inventory import ShareInventory
+from allmydata.storage.executor import StorageIOExecutor, when_done
+from allmydata.storage.readcache import ReadvCache
+from allmydata.storage.sharedirs import ShareDirectory, BucketIndex
 from allmydata.storage.expirer import LeaseCheckingCrawler
 
 # storage/
@@ -28,9 +38,16 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
 
+# Each of the extra_storedirs (usually one per additional disk) has the same
+# shares/ and shares/incoming/ layout. A bucket lives in exactly one of them.
+
 # $SHARENUM matches this regex:
 NUM_RE=re.compile("^[0-9]+$")
 
+# the windows of time over which latency percentiles are reported. The plain
+# storage_server.latencies.* stats cover the last five minutes.
+LATENCY_WINDOWS = {"1m": 60, "5m": 5*60, "1h": 60*60}
+
 
 
 class StorageServer(service.MultiService, Referenceable):
@@ -45,27 +62,55 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 durability="none",
+                 io_threads=0,
+                 extra_storedirs=(),
+                 crawler_io_threads=0,
+                 combined_crawler=False,
+                 mutable_growth_factor=1.0,
+                 compact_mutable_shares=False,
+                 readv_cache_size=0):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, str)
         assert len(nodeid) == 20
         self.my_nodeid = nodeid
         self.storedir = storedir
-        sharedir = os.path.join(storedir, "shares")
-        fileutil.make_dirs(sharedir)
-        self.sharedir = sharedir
+        self.reserved_space = int(reserved_space)
+        # each directory (usually a disk of its own) gets its own disk-I/O
+        # threads. With io_threads=0, all disk I/O is done in the reactor
+        # thread.
+        def _record_wait(wait):
+            self.add_latency("io-wait", wait)
+        self.sharedirs = []
+        for d in [storedir] + list(extra_storedirs):
+            sd = ShareDirectory(d, self.reserved_space,
+                                StorageIOExecutor(io_threads, _record_wait),
+                                self.log)
+            sd.io.setServiceParent(self)
+            fileutil.make_dirs(sd.sharedir)
+            self.sharedirs.append(sd)
+        self.sharedir = self.sharedirs[0].sharedir
+        self.buckets = BucketIndex(self.sharedirs, self.log)
         # we don't actually create the corruption-advisory dir until necessary
         self.corruption_advisory_dir = os.path.join(storedir,
                                                     "corruption-advisories")
-        self.reserved_space = int(reserved_space)
         self.no_storage = discard_storage
         self.readonly_storage = readonly_storage
         self.stats_provider = stats_provider
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError("durability '%s' must be one of %s"
+                             % (durability, ", ".join(DURABILITY_POLICIES)))
+        self.durability = durability
+        if mutable_growth_factor < 1.0:
+            raise ValueError("mutable_growth_factor must be at least 1.0")
+        self.mutable_growth_factor = mutable_growth_factor
         if self.stats_provider:
             self.stats_provider.register_producer(self)
-        self.incomingdir = os.path.join(sharedir, 'incoming')
+        self.incomingdir = self.sharedirs[0].incomingdir
         self._clean_incomplete()
-        fileutil.make_dirs(self.incomingdir)
+        for sd in self.sharedirs:
+            fileutil.make_dirs(sd.incomingdir)
         self._active_writers = weakref.WeakKeyDictionary()
         log.msg("StorageServer created", facility="tahoe.storage")
 
@@ -74,17 +119,29 @@ class StorageServer(service.MultiService, Referenceable):
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
+        categories = ["allocate", "write", "close", "read", "get", # immutable
+                      "writev", "readv", # mutable
+                      "add-lease", "add-leases", "renew", "cancel", # both
+                      # time spent waiting for a disk-I/O thread
+                      "io-wait",
+                      # immutable write and close latencies are also kept
+                      # separately for the durability policy in use, so
+                      # that policies can be compared
+                      "write-" + durability, "close-" + durability]
+        self.latencies = dict([(category, WindowedLatencyHistogram())
+                               for category in categories])
+        # answers to recent slot_readv requests, for popular mutable files
+        self.readv_cache = ReadvCache(readv_cache_size)
+        self.inventory = ShareInventory(os.path.join(self.storedir,
+                                                     "share_inventory.state"))
+        self.inventory.setServiceParent(self)
+        # with combined_crawler=True, one CrawlerHost walks the shares on
+        # behalf of all of the crawlers below
+        self.crawler_host = None
+        if combined_crawler:
+            statefile = os.path.join(self.storedir, "crawler_host.state")
+            self.crawler_host = CrawlerHost(self, statefile)
+            self.crawler_host.setServiceParent(self)
         self.add_bucket_counter()
 
         statefile = os.path.join(self.storedir, "lease_checker.state")
@@ -95,7 +152,21 @@ class StorageServer(service.MultiService, Referenceable):
                                    expiration_override_lease_duration,
                                    expiration_cutoff_date,
                                    expiration_sharetypes)
-        self.lease_checker.setServiceParent(self)
+        self.add_crawler("lease_checker", self.lease_checker)
+        self.mutable_compactor = None
+        if compact_mutable_shares:
+            statefile = os.path.join(self.storedir, "mutable_compactor.state")
+            self.mutable_compactor = MutableCompactingCrawler(self, statefile)
+            self.add_crawler("mutable_compactor", self.mutable_compactor)
+        if crawler_io_threads:
+            if self.crawler_host:
+                crawlers = [self.crawler_host]
+            else:
+                crawlers = [self.bucket_counter, self.lease_checker]
+                if self.mutable_compactor:
+                    crawlers.append(self.mutable_compactor)
+            for crawler in crawlers:
+                crawler.io_threads = crawler_io_threads
 
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
@@ -103,46 +174,78 @@ class StorageServer(service.MultiService, Referenceable):
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
-        return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
+        for sd in self.sharedirs:
+            if set(os.listdir(sd.sharedir)) - set(["incoming"]):
+                return True
+        return False
 
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
         self.bucket_counter = BucketCountingCrawler(self, statefile)
-        self.bucket_counter.setServiceParent(self)
+        self.add_crawler("bucket_counter", self.bucket_counter)
+
+    def add_crawler(self, name, crawler):
+        """Start running a ShareCrawler: as a consumer of my CrawlerHost if I
+        have one, otherwise on its own."""
+        if self.crawler_host:
+            self.crawler_host.add_consumer(crawler, name)
+        else:
+            crawler.setServiceParent(self)
+
+    def get_io(self, storage_index):
+        """Return the StorageIOExecutor that does the disk I/O for this
+        bucket: that of the directory which holds it, or of the first
+        directory for a bucket that does not exist yet. Work on a bucket
+        stays with whichever executor already has some queued, so that it is
+        still done in order when the bucket has just been created somewhere
+        else."""
+        for sd in self.sharedirs:
+            if sd.io.is_busy(storage_index):
+                return sd.io
+        sd = self.buckets.find(storage_index)
+        return (sd or self.sharedirs[0]).io
+
+    def is_io_busy(self, storage_index):
+        """Is any disk I/O for this bucket waiting or running?"""
+        for sd in self.sharedirs:
+            if sd.io.is_busy(storage_index):
+                return True
+        return False
 
     def count(self, name, delta=1):
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].add(latency)
+        if category in ("write", "close"):
+            self.add_latency("%s-%s" % (category, self.durability), latency)
 
-    def get_latencies(self):
+    def get_latencies(self, window=LATENCY_WINDOWS["1h"]):
         """Return a dict, indexed by category, that contains a dict of
-        latency numbers for each category. If there are sufficient samples
-        for unambiguous interpretation, each dict will contain the
-        following keys: mean, 01_0_percentile, 10_0_percentile,
-        50_0_percentile (median), 90_0_percentile, 95_0_percentile,
-        99_0_percentile, 99_9_percentile.  If there are insufficient
-        samples for a given percentile to be interpreted unambiguously
-        that percentile will be reported as None. If no samples have been
-        collected for the given category, then that category name will
-        not be present in the return value. """
+        latency numbers for each category, covering the operations of the
+        last 'window' seconds (at most, and by default, an hour). If there
+        are sufficient samples for unambiguous interpretation, each dict
+        will contain the following keys: mean, 01_0_percentile,
+        10_0_percentile, 50_0_percentile (median), 90_0_percentile,
+        95_0_percentile, 99_0_percentile, 99_9_percentile.  If there are
+        insufficient samples for a given percentile to be interpreted
+        unambiguously that percentile will be reported as None. If no
+        samples have been collected for the given category, then that
+        category name will not be present in the return value. Percentiles
+        are estimated, and may be off by a few percent. """
         # note that Amazon's Dynamo paper says they use 99.9% percentile.
         output = {}
+        now = time.time()
         for category in self.latencies:
-            if not self.latencies[category]:
+            h = self.latencies[category].get_histogram(window, now)
+            if not h.count:
                 continue
             stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
+            count = h.count
             stats["samplesize"] = count
-            samples.sort()
             if count > 1:
-                stats["mean"] = sum(samples) / count
+                stats["mean"] = h.total / count
             else:
                 stats["mean"] = None
 
@@ -151,9 +254,10 @@ class StorageServer(service.MultiService, Referenceable):
                              (0.95, "95_0_percentile", 20), (0.99, "99_0_percentile", 100),\
                              (0.999, "99_9_percentile", 1000)]
 
+            percentiles = h.get_percentiles([p for (p, ps, m) in orderstatlist])
             for percentile, percentilestring, minnumtoobserve in orderstatlist:
                 if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
+                    stats[percentilestring] = percentiles[percentile]
                 else:
                     stats[percentilestring] = None
 
@@ -163,30 +267,56 @@ class StorageServer(service.MultiService, Referenceable):
     def log(self, *args, **kwargs):
         if "facility" not in kwargs:
             kwargs["facility"] = "tahoe.storage"
+        if not threadable.isInIOThread():
+            # called from a disk-I/O thread: log.msg is not thread-safe
+            reactor.callFromThread(log.msg, *args, **kwargs)
+            return None
         return log.msg(*args, **kwargs)
 
     def _clean_incomplete(self):
-        fileutil.rm_dir(self.incomingdir)
+        for sd in self.sharedirs:
+            fileutil.rm_dir(sd.incomingdir)
 
     def get_stats(self):
         # remember: RIStatsProvider requires that our return dict
         # contains numeric values.
         stats = { 'storage_server.allocated': self.allocated_size(), }
         stats['storage_server.reserved_space'] = self.reserved_space
-        for category,ld in self.get_latencies().items():
-            for name,v in ld.items():
-                stats['storage_server.latencies.%s.%s' % (category, name)] = v
+        stats['storage_server.io_queue_depth'] = \
+            sum([sd.io.get_stats()["queue_depth"] for sd in self.sharedirs])
+        cache = self.readv_cache.get_stats()
+        for name in ("hits", "misses", "bytes", "entries"):
+            stats['storage_server.readv_cache.' + name] = cache[name]
+        if cache["hits"] + cache["misses"]:
+            stats['storage_server.readv_cache.hit_rate'] = \
+                float(cache["hits"]) / (cache["hits"] + cache["misses"])
+        for window_name, window in LATENCY_WINDOWS.items():
+            for category,ld in self.get_latencies(window).items():
+                for name,v in ld.items():
+                    stats['storage_server.latencies_%s.%s.%s'
+                          % (window_name, category, name)] = v
+                    # the unsuffixed names, which the munin plugins use,
+                    # cover the longest window
+                    if window_name == "1h":
+                        stats['storage_server.latencies.%s.%s'
+                              % (category, name)] = v
+
+        uploads, allocated = self._get_directory_loads()
+        for i, sd in enumerate(self.sharedirs):
+            stats['storage_server.sharedir_%d.uploads' % i] = uploads.get(sd, 0)
+            stats['storage_server.sharedir_%d.allocated' % i] = allocated.get(sd, 0)
 
         try:
-            disk = fileutil.get_disk_stats(self.sharedir, self.reserved_space)
-            writeable = disk['avail'] > 0
+            disks = [sd.get_disk_stats() for sd in self.sharedirs]
+            writeable = max([disk['avail'] for disk in disks]) > 0
 
             # spacetime predictors should use disk_avail / (d(disk_used)/dt)
-            stats['storage_server.disk_total'] = disk['total']
-            stats['storage_server.disk_used'] = disk['used']
-            stats['storage_server.disk_free_for_root'] = disk['free_for_root']
-            stats['storage_server.disk_free_for_nonroot'] = disk['free_for_nonroot']
-            stats['storage_server.disk_avail'] = disk['avail']
+            for name in ('total', 'used', 'free_for_root', 'free_for_nonroot',
+                         'avail'):
+                stats['storage_server.disk_' + name] = sum([disk[name]
+                                                            for disk in disks])
+                for i, disk in enumerate(disks):
+                    stats['storage_server.sharedir_%d.disk_%s' % (i, name)] = disk[name]
         except AttributeError:
             writeable = True
         except EnvironmentError:
@@ -198,10 +328,15 @@ class StorageServer(service.MultiService, Referenceable):
             writeable = False
 
         stats['storage_server.accepting_immutable_shares'] = int(writeable)
-        s = self.bucket_counter.get_state()
-        bucket_count = s.get("last-complete-bucket-count")
-        if bucket_count:
-            stats['storage_server.total_bucket_count'] = bucket_count
+        counts = self.inventory.get_counts()
+        if counts is not None:
+            stats['storage_server.total_bucket_count'] = counts["buckets"]
+            stats['storage_server.immutable_share_count'] = counts["immutable-shares"]
+            stats['storage_server.immutable_share_bytes'] = counts["immutable-bytes"]
+            stats['storage_server.mutable_share_count'] = counts["mutable-shares"]
+            stats['storage_server.mutable_share_bytes'] = counts["mutable-bytes"]
+            stats['storage_server.total_share_bytes'] = (counts["immutable-bytes"]
+                                                         + counts["mutable-bytes"])
         return stats
 
     def get_available_space(self):
@@ -210,13 +345,58 @@ class StorageServer(service.MultiService, Referenceable):
 
         if self.readonly_storage:
             return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
+        # a share must fit into a single directory
+        spaces = [sd.get_available_space() for sd in self.sharedirs]
+        if None in spaces:
+            return None
+        return max(spaces)
 
     def allocated_size(self):
-        space = 0
-        for bw in self._active_writers:
-            space += bw.allocated_size()
-        return space
+        return sum([sd.allocated for sd in self.sharedirs])
+
+    def _get_directory_loads(self):
+        # returns two dicts mapping each ShareDirectory to the number of
+        # uploads in progress into it, and the space allocated to them
+        uploads = dict([(sd, sd.uploads) for sd in self.sharedirs])
+        allocated = dict([(sd, sd.allocated) for sd in self.sharedirs])
+        return uploads, allocated
+
+    def get_space_usage(self):
+        """Return a dict that describes how my space is used: the share
+        counts and bytes from my ShareInventory (None until it has counted
+        every prefix), the space allocated to uploads in progress, and the
+        disk statistics of each of my directories. None of this walks the
+        share directories or waits for statvfs(2), so it is cheap enough to
+        be polled often, by munin for example."""
+        sharedirs = []
+        disks = []
+        for sd in self.sharedirs:
+            try:
+                disk = sd.get_disk_stats()
+                disks.append(disk)
+            except (AttributeError, EnvironmentError):
+                disk = None
+            sharedirs.append({"path": sd.storedir,
+                              "uploads": sd.uploads,
+                              "allocated": sd.allocated,
+                              "disk": disk,
+                              })
+        total = None
+        if disks and len(disks) == len(sharedirs):
+            total = dict([(name, sum([d[name] for d in disks]))
+                          for name in disks[0]])
+        counts = self.inventory.get_counts()
+        if counts is not None:
+            counts["total-bytes"] = (counts["immutable-bytes"]
+                                     + counts["mutable-bytes"])
+        return {"shares": counts,
+                "allocated": self.allocated_size(),
+                "uploads": sum([sd.uploads for sd in self.sharedirs]),
+                "reserved-space": self.reserved_space,
+                "available": self.get_available_space(),
+                "disk": total,
+                "sharedirs": sharedirs,
+                }
 
     def remote_get_version(self):
         remaining_space = self.get_available_space()
@@ -231,6 +411,7 @@ class StorageServer(service.MultiService, Referenceable):
                       "delete-mutable-shares-with-zero-length-writev": True,
                       "fills-holes-with-zero-bytes": True,
                       "prevents-read-past-end-of-share-data": True,
+                      "maximum-add-leases-batch-size": MAX_LEASES_PER_BATCH,
                       },
                     "application-version": str(allmydata.__full_version__),
                     }
@@ -245,9 +426,6 @@ class StorageServer(service.MultiService, Referenceable):
         # to a particular owner.
         start = time.time()
         self.count("allocate")
-        alreadygot = set()
-        bucketwriters = {} # k: shnum, v: BucketWriter
-        si_dir = storage_index_to_dir(storage_index)
         si_s = si_b2a(storage_index)
 
         log.msg("storage: allocate_buckets %s" % si_s)
@@ -261,29 +439,63 @@ class StorageServer(service.MultiService, Referenceable):
                                renew_secret, cancel_secret,
                                expire_time, self.my_nodeid)
 
-        max_space_per_bucket = allocated_size
-
-        remaining_space = self.get_available_space()
-        limited = remaining_space is not None
-        if limited:
-            # this is a bit conservative, since some of this allocated_size()
-            # has already been written to disk, where it will show up in
-            # get_available_space.
-            remaining_space -= self.allocated_size()
-        # self.readonly_storage causes remaining_space <= 0
-
         # fill alreadygot with all shares that we have, not just the ones
         # they asked about: this will save them a lot of work. Add or update
         # leases for all of them: if they want us to hold shares for this
         # file, they'll want us to hold leases for this file.
+        d = self.get_io(storage_index).run(storage_index,
+                                           self._add_lease_to_immutable_shares,
+                                           storage_index, lease_info)
+        def _allocate(alreadygot):
+            bucketwriters = self._allocate_bucket_writers(storage_index,
+                                                          sharenums,
+                                                          allocated_size,
+                                                          lease_info, canary)
+            self.add_latency("allocate", time.time() - start)
+            return alreadygot, bucketwriters
+        return when_done(d, _allocate)
+
+    def _add_lease_to_immutable_shares(self, storage_index, lease_info):
+        alreadygot = set()
         for (shnum, fn) in self._get_bucket_shares(storage_index):
             alreadygot.add(shnum)
             sf = ShareFile(fn)
+            old_size = os.path.getsize(fn)
             sf.add_or_renew_lease(lease_info)
+            self.note_share_resized(storage_index, "immutable",
+                                    old_size, os.path.getsize(fn))
+        return alreadygot
+
+    def _allocate_bucket_writers(self, storage_index, sharenums,
+                                 allocated_size, lease_info, canary):
+        # this runs in the reactor thread, because BucketWriters must
+        # register with the canary
+        bucketwriters = {} # k: shnum, v: BucketWriter
+        si_dir = storage_index_to_dir(storage_index)
+        max_space_per_bucket = allocated_size
+
+        uploads, allocated = self._get_directory_loads()
+        sd = self.buckets.find(storage_index)
+        bucket_existed = sd is not None and os.path.isdir(sd.get_bucketdir(storage_index))
+        if not bucket_existed:
+            # new buckets go into the least busy directory that has room
+            sd = self.buckets.choose_directory(max_space_per_bucket,
+                                               uploads, allocated)
+        if sd is None or self.readonly_storage:
+            # no directory has room for even one share
+            return bucketwriters
+
+        remaining_space = sd.get_available_space()
+        limited = remaining_space is not None
+        if limited:
+            # this is a bit conservative, since some of this allocated_size()
+            # has already been written to disk, where it will show up in
+            # get_available_space.
+            remaining_space -= allocated.get(sd, 0)
 
         for shnum in sharenums:
-            incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
-            finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
+            incominghome = os.path.join(sd.incomingdir, si_dir, "%d" % shnum)
+            finalhome = os.path.join(sd.sharedir, si_dir, "%d" % shnum)
             if os.path.exists(finalhome):
                 # great! we already have it. easy.
                 pass
@@ -296,22 +508,24 @@ class StorageServer(service.MultiService, Referenceable):
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
                 bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                                  max_space_per_bucket, lease_info, canary,
+                                  self.durability, sd.io)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
-                self._active_writers[bw] = 1
+                self._active_writers[bw] = (storage_index, sd)
+                sd.upload_started(bw)
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
                 # bummer! not enough space to accept this bucket
                 pass
 
-        if bucketwriters:
-            fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
-
-        self.add_latency("allocate", time.time() - start)
-        return alreadygot, bucketwriters
+        if bucketwriters and not bucket_existed:
+            fileutil.make_dirs(sd.get_bucketdir(storage_index))
+            self.inventory.bucket_added(storage_index)
+            self.buckets.bucket_added(storage_index, sd)
+        return bucketwriters
 
     def _iter_share_files(self, storage_index):
         for shnum, filename in self._get_bucket_shares(storage_index):
@@ -337,33 +551,96 @@ class StorageServer(service.MultiService, Referenceable):
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
+        d = self.get_io(storage_index).run(storage_index, self._add_lease,
+                                           storage_index, lease_info)
+        def _done(res):
+            self.add_latency("add-lease", time.time() - start)
+            return None
+        return when_done(d, _done)
+
+    def _add_lease(self, storage_index, lease_info):
         for sf in self._iter_share_files(storage_index):
+            old_size = os.path.getsize(sf.home)
             sf.add_or_renew_lease(lease_info)
-        self.add_latency("add-lease", time.time() - start)
-        return None
+            self.note_share_resized(storage_index, sf.sharetype,
+                                    old_size, os.path.getsize(sf.home))
+
+    def remote_add_leases(self, leases):
+        start = time.time()
+        self.count("add-leases")
+        new_expire_time = time.time() + 31*24*60*60
+        # visit the buckets in the order they are laid out on disk (by
+        # prefix, then storage index), so that neighbouring buckets are read
+        # one after another. Each bucket is still a separate job for the
+        # disk-I/O threads, so that it cannot overlap with a write to it.
+        leases = sorted(leases, key=lambda lease: si_b2a(lease[0]))
+        ds = []
+        for (storage_index, renew_secret, cancel_secret) in leases:
+            lease_info = LeaseInfo(1, renew_secret, cancel_secret,
+                                   new_expire_time, self.my_nodeid)
+            ds.append(defer.maybeDeferred(self.get_io(storage_index).run,
+                                          storage_index, self._add_lease,
+                                          storage_index, lease_info))
+        d = defer.DeferredList(ds, consumeErrors=True)
+        def _done(results):
+            self.add_latency("add-leases", time.time() - start)
+            # one bad bucket does not stop the others from getting their
+            # leases, but the client still hears about it
+            for (success, res) in results:
+                if not success:
+                    return res
+            return None
+        d.addCallback(_done)
+        return d
 
     def remote_renew_lease(self, storage_index, renew_secret):
         start = time.time()
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
+        d = self.get_io(storage_index).run(storage_index, self._renew_lease,
+                                           storage_index, renew_secret,
+                                           new_expire_time)
+        def _done(found_buckets):
+            self.add_latency("renew", time.time() - start)
+            if not found_buckets:
+                raise IndexError("no such lease to renew")
+        return when_done(d, _done)
+
+    def _renew_lease(self, storage_index, renew_secret, new_expire_time):
         found_buckets = False
         for sf in self._iter_share_files(storage_index):
             found_buckets = True
             sf.renew_lease(renew_secret, new_expire_time)
-        self.add_latency("renew", time.time() - start)
-        if not found_buckets:
-            raise IndexError("no such lease to renew")
+        return found_buckets
 
     def bucket_writer_closed(self, bw, consumed_size):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
-        del self._active_writers[bw]
+        (storage_index, sd) = self._active_writers.pop(bw)
+        sd.upload_finished(bw)
+        sd.note_written(consumed_size)
+        if consumed_size:
+            self.inventory.share_added(storage_index, "immutable",
+                                       consumed_size)
+
+    def note_share_resized(self, storage_index, sharetype, old_size, new_size):
+        """A share in this bucket has grown or shrunk in place, for example
+        because a lease was added to or cancelled from it. Keep the
+        inventory and its share directory's count of written bytes exact."""
+        self.inventory.share_resized(storage_index, sharetype,
+                                     old_size, new_size)
+        sd = self.buckets.find(storage_index)
+        if sd is not None:
+            sd.note_written(new_size - old_size)
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
         the integer form of the last component of 'pathname'."""
-        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+        sd = self.buckets.find(storage_index)
+        if sd is None:
+            return
+        storagedir = sd.get_bucketdir(storage_index)
         try:
             for f in os.listdir(storagedir):
                 if NUM_RE.match(f):
@@ -378,11 +655,18 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("get")
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %s" % si_s)
+        io = self.get_io(storage_index)
+        d = io.run(None, self._get_bucket_readers, storage_index, io)
+        def _done(bucketreaders):
+            self.add_latency("get", time.time() - start)
+            return bucketreaders
+        return when_done(d, _done)
+
+    def _get_bucket_readers(self, storage_index, io):
         bucketreaders = {} # k: sharenum, v: BucketReader
         for shnum, filename in self._get_bucket_shares(storage_index):
             bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
-        self.add_latency("get", time.time() - start)
+                                                storage_index, shnum, io)
         return bucketreaders
 
     def get_leases(self, storage_index):
@@ -409,19 +693,39 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("writev")
         si_s = si_b2a(storage_index)
         log.msg("storage: slot_writev %s" % si_s)
-        si_dir = storage_index_to_dir(storage_index)
+        # writes to the same slot are serialized by using the storage index
+        # as the key
+        d = self.get_io(storage_index).run(storage_index, self._slot_writev,
+                                           storage_index, secrets,
+                                           test_and_write_vectors, read_vector)
+        def _done(res):
+            self.add_latency("writev", time.time() - start)
+            return res
+        return when_done(d, _done)
+
+    def _slot_writev(self, storage_index, secrets, test_and_write_vectors,
+                     read_vector):
+        si_s = si_b2a(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
+        sd = self.buckets.find(storage_index)
+        if sd is None:
+            # if we create any shares, they go wherever there is most room.
+            # Mutable shares don't honor reserved_space, so there is always
+            # somewhere to put them.
+            sd = self.buckets.choose_directory(0) or self.sharedirs[0]
         # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
+        bucketdir = sd.get_bucketdir(storage_index)
         shares = {}
-        if os.path.isdir(bucketdir):
+        bucket_existed = os.path.isdir(bucketdir)
+        if bucket_existed:
             for sharenum_s in os.listdir(bucketdir):
                 try:
                     sharenum = int(sharenum_s)
                 except ValueError:
                     continue
                 filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
+                msf = MutableShareFile(filename, self,
+                                       self.mutable_growth_factor)
                 msf.check_write_enabler(write_enabler, si_s)
                 shares[sharenum] = msf
         # write_enabler is good for all existing shares.
@@ -456,12 +760,19 @@ class StorageServer(service.MultiService, Referenceable):
                                expire_time, self.my_nodeid)
 
         if testv_is_good:
+            # whatever happens below, cached reads of these shares are no
+            # longer valid
+            self.readv_cache.invalidate(storage_index)
             # now apply the write vectors
             for sharenum in test_and_write_vectors:
                 (testv, datav, new_length) = test_and_write_vectors[sharenum]
                 if new_length == 0:
                     if sharenum in shares:
+                        old_size = os.path.getsize(shares[sharenum].home)
                         shares[sharenum].unlink()
+                        self.inventory.share_removed(storage_index, "mutable",
+                                                     old_size)
+                        sd.note_written(-old_size)
                 else:
                     if sharenum not in shares:
                         # allocate a new share
@@ -470,19 +781,32 @@ class StorageServer(service.MultiService, Referenceable):
                                                           sharenum,
                                                           allocated_size,
                                                           owner_num=0)
+                        if not bucket_existed:
+                            self.inventory.bucket_added(storage_index)
+                            self.buckets.bucket_added(storage_index, sd)
+                            bucket_existed = True
+                        created_size = os.path.getsize(share.home)
+                        self.inventory.share_added(storage_index, "mutable",
+                                                   created_size)
+                        sd.note_written(created_size)
                         shares[sharenum] = share
+                    old_size = os.path.getsize(shares[sharenum].home)
                     shares[sharenum].writev(datav, new_length)
                     # and update the lease
                     shares[sharenum].add_or_renew_lease(lease_info)
+                    new_size = os.path.getsize(shares[sharenum].home)
+                    self.inventory.share_resized(storage_index, "mutable",
+                                                 old_size, new_size)
+                    sd.note_written(new_size - old_size)
 
             if new_length == 0:
                 # delete empty bucket directories
                 if not os.listdir(bucketdir):
                     os.rmdir(bucketdir)
-
+                    self.inventory.bucket_removed(storage_index)
+                    self.buckets.bucket_removed(storage_index)
 
         # all done
-        self.add_latency("writev", time.time() - start)
         return (testv_is_good, read_data)
 
     def _allocate_slot_share(self, bucketdir, secrets, sharenum,
@@ -492,7 +816,7 @@ class StorageServer(service.MultiService, Referenceable):
         fileutil.make_dirs(bucketdir)
         filename = os.path.join(bucketdir, "%d" % sharenum)
         share = create_mutable_sharefile(filename, my_nodeid, write_enabler,
-                                         self)
+                                         self, self.mutable_growth_factor)
         return share
 
     def remote_slot_readv(self, storage_index, shares, readv):
@@ -501,25 +825,38 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
+        d = self.get_io(storage_index).run(storage_index, self._slot_readv,
+                                           storage_index, shares, readv)
+        def _done(datavs):
+            log.msg("returning shares %s" % (datavs.keys(),),
+                    facility="tahoe.storage", level=log.NOISY, parent=lp)
             self.add_latency("readv", time.time() - start)
+            return datavs
+        return when_done(d, _done)
+
+    def _slot_readv(self, storage_index, shares, readv):
+        datavs = self.readv_cache.get(storage_index, shares, readv)
+        if datavs is not None:
+            return datavs
+        sd = self.buckets.find(storage_index)
+        # shares exist if there is a file for them
+        if sd is None or not os.path.isdir(sd.get_bucketdir(storage_index)):
+            self.readv_cache.add(storage_index, [], readv, {})
             return {}
+        bucketdir = sd.get_bucketdir(storage_index)
         datavs = {}
+        sharenums = []
         for sharenum_s in os.listdir(bucketdir):
             try:
                 sharenum = int(sharenum_s)
             except ValueError:
                 continue
+            sharenums.append(sharenum)
             if sharenum in shares or not shares:
                 filename = os.path.join(bucketdir, sharenum_s)
                 msf = MutableShareFile(filename, self)
                 datavs[sharenum] = msf.readv(readv)
-        log.msg("returning shares %s" % (datavs.keys(),),
-                facility="tahoe.storage", level=log.NOISY, parent=lp)
-        self.add_latency("readv", time.time() - start)
+        self.readv_cache.add(storage_index, sharenums, readv, datavs)
         return datavs
 
     def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
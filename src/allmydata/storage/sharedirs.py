@@ -0,0 +1,227 @@
+
+import os, threading, time, weakref
+from allmydata.storage.common import si_b2a, storage_index_to_dir
+from allmydata.storage.executor import StorageIOExecutor
+from allmydata.util import fileutil, log
+
+class ShareDirectory:
+    """I am one of the directory trees in which a StorageServer keeps
+    shares, usually one per disk. 'storedir' is laid out like the node's own
+    BASEDIR/storage: shares live in storedir/shares/$START/$STORAGEINDEX/,
+    and shares that are still being uploaded live in
+    storedir/shares/incoming/, which is on the same filesystem so that
+    finished shares can be moved into place with a rename.
+
+    I also keep account of my space, so that the StorageServer can decide
+    whether to accept a share without asking the OS or looking at each
+    upload in progress. 'uploads' and 'allocated' are the number of
+    BucketWriters writing new shares into me, and the space promised to
+    them: see upload_started(). My disk statistics come from statvfs(2) at
+    most once every 'disk_stats_interval' seconds, and are adjusted in
+    between by the bytes that the StorageServer tells me it has written
+    (see note_written()). Space freed by deleting shares shows up with the
+    next statvfs(2), so until then I err on the side of having less room.
+
+    'io' is the StorageIOExecutor that does the disk I/O for the buckets in
+    me, so that each disk gets its own threads and a slow disk only holds up
+    the requests for its own shares.
+
+    I may be used from the StorageServer's disk-I/O threads, so 'logger'
+    must be safe to call from them.
+    """
+
+    disk_stats_interval = 60
+
+    def __init__(self, storedir, reserved_space=0, executor=None,
+                 logger=log.msg):
+        self.storedir = storedir
+        self.io = executor or StorageIOExecutor()
+        self._log = logger
+        self.sharedir = os.path.join(storedir, "shares")
+        self.incomingdir = os.path.join(self.sharedir, "incoming")
+        self.reserved_space = reserved_space
+        self.uploads = 0
+        self.allocated = 0
+        self._writers = {} # id(BucketWriter) -> (weakref, allocated size)
+        self._disk_stats = None
+        self._disk_stats_time = None
+        self._written = 0
+        # reentrant, since a BucketWriter may be garbage-collected (and
+        # _forget_upload called) while the lock is held
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return "<ShareDirectory %s>" % (self.sharedir,)
+
+    def get_bucketdir(self, storage_index):
+        return os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+
+    def get_disk_stats(self):
+        """Return a dict like fileutil.get_disk_stats() for my filesystem,
+        which may be up to 'disk_stats_interval' seconds old. Raises the
+        same exceptions."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if (self._disk_stats is None
+                or not 0 <= now - self._disk_stats_time < self.disk_stats_interval):
+                self._disk_stats = fileutil.get_disk_stats(self.sharedir,
+                                                           self.reserved_space)
+                self._disk_stats_time = now
+                self._written = 0
+            disk = self._disk_stats.copy()
+            written = self._written
+        finally:
+            self._lock.release()
+        if written:
+            disk['used'] += written
+            for name in ('free_for_root', 'free_for_nonroot', 'avail'):
+                disk[name] = max(disk[name] - written, 0)
+        return disk
+
+    def get_available_space(self):
+        """Returns available space for share storage in bytes, or None if no
+        API to get this information is available. Like get_disk_stats(),
+        this may be a little out of date."""
+        try:
+            return self.get_disk_stats()['avail']
+        except AttributeError:
+            return None
+        except EnvironmentError:
+            self._log("OS call to get disk statistics failed")
+            return 0
+
+    def note_written(self, delta):
+        """The StorageServer has grown (or, with a negative 'delta', shrunk)
+        the shares in this directory by 'delta' bytes."""
+        self._lock.acquire()
+        try:
+            self._written += delta
+        finally:
+            self._lock.release()
+
+    def upload_started(self, bw):
+        """Count the space allocated to a BucketWriter that is writing a new
+        share into me, until upload_finished() is called or the BucketWriter
+        is thrown away without being closed."""
+        key = id(bw)
+        def _gone(ref):
+            self._forget_upload(key)
+        self._lock.acquire()
+        try:
+            self._writers[key] = (weakref.ref(bw, _gone), bw.allocated_size())
+            self.uploads += 1
+            self.allocated += bw.allocated_size()
+        finally:
+            self._lock.release()
+
+    def upload_finished(self, bw):
+        self._forget_upload(id(bw))
+
+    def _forget_upload(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._writers:
+                (ref, size) = self._writers.pop(key)
+                self.uploads -= 1
+                self.allocated -= size
+        finally:
+            self._lock.release()
+
+class BucketIndex:
+    """I know which of a StorageServer's ShareDirectories holds each bucket.
+    All of the shares for a given storage index are kept in a single
+    directory.
+
+    With only one directory there is nothing to look up. Otherwise I learn
+    the contents of each prefix directory (in all of the ShareDirectories)
+    the first time a storage index with that prefix is looked up, and the
+    StorageServer tells me whenever it creates or removes a bucket after
+    that. This costs about a hundred bytes of memory per bucket.
+
+    New buckets are placed by choose_directory(), which prefers the
+    directory with the fewest uploads in progress, and then the one with
+    the most free space.
+
+    I may be used from the StorageServer's disk-I/O threads, so 'logger'
+    must be safe to call from them.
+    """
+
+    def __init__(self, sharedirs, logger=log.msg):
+        self.sharedirs = sharedirs
+        self._log = logger
+        self._buckets = {} # base32 storage index -> ShareDirectory
+        self._loaded_prefixes = set()
+        self._lock = threading.Lock()
+
+    def _load_prefix(self, prefix):
+        for sd in self.sharedirs:
+            try:
+                buckets = os.listdir(os.path.join(sd.sharedir, prefix))
+            except EnvironmentError:
+                continue
+            for si_s in buckets:
+                if si_s in self._buckets:
+                    self._log(format="bucket %(si)s is in both %(first)s and"
+                              " %(second)s, ignoring the second",
+                              si=si_s, first=self._buckets[si_s].sharedir,
+                              second=sd.sharedir,
+                              facility="tahoe.storage", level=log.WEIRD,
+                              umid="q0v1Vg")
+                    continue
+                self._buckets[si_s] = sd
+        self._loaded_prefixes.add(prefix)
+
+    def find(self, storage_index):
+        """Return the ShareDirectory that holds the bucket for this storage
+        index, or None if there is no such bucket. If I have only one
+        directory, I return it without checking."""
+        if len(self.sharedirs) == 1:
+            return self.sharedirs[0]
+        si_s = si_b2a(storage_index)
+        self._lock.acquire()
+        try:
+            if si_s[:2] not in self._loaded_prefixes:
+                self._load_prefix(si_s[:2])
+            return self._buckets.get(si_s)
+        finally:
+            self._lock.release()
+
+    def bucket_added(self, storage_index, sharedir):
+        if len(self.sharedirs) == 1:
+            return
+        si_s = si_b2a(storage_index)
+        self._lock.acquire()
+        try:
+            if si_s[:2] in self._loaded_prefixes:
+                self._buckets[si_s] = sharedir
+        finally:
+            self._lock.release()
+
+    def bucket_removed(self, storage_index):
+        if len(self.sharedirs) == 1:
+            return
+        self._lock.acquire()
+        try:
+            self._buckets.pop(si_b2a(storage_index), None)
+        finally:
+            self._lock.release()
+
+    def choose_directory(self, size, uploads={}, allocated={}):
+        """Pick a ShareDirectory for a new bucket that will need 'size'
+        bytes. 'uploads' and 'allocated' map ShareDirectories to the number
+        of uploads in progress and the number of bytes allocated to them.
+        Returns None if no directory has room."""
+        candidates = []
+        for i, sd in enumerate(self.sharedirs):
+            space = sd.get_available_space()
+            if space is not None:
+                space -= allocated.get(sd, 0)
+                if space < size:
+                    continue
+            # on platforms that cannot tell us the free space, every
+            # directory looks the same, and only the uploads count
+            candidates.append((uploads.get(sd, 0), -(space or 0), i, sd))
+        if not candidates:
+            return None
+        return min(candidates)[-1]
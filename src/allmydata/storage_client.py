@@ -31,12 +31,14 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 
 import re, time
 from zope.interface import implements
+from twisted.internet import defer
 from foolscap.api import eventually
 from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
 from allmydata.util.rrefutil import add_version_to_remote_reference
 from allmydata.util.hashutil import sha1
+from allmydata.mutable.common import ReadSizeEstimator
 
 # who is responsible for de-duplication?
 #  both?
@@ -72,6 +74,8 @@ class StorageFarmBroker:
         # them for it.
         self.servers = {}
         self.introducer_client = None
+        # learns how much of a mutable share to read in the first query
+        self.read_size_estimator = ReadSizeEstimator()
 
     # these two are used in unit tests
     def test_add_rref(self, serverid, rref, ann):
@@ -318,5 +322,95 @@ class NativeStorageServer:
         # used when the broker wants us to hurry up
         self._reconnector.reset()
 
+class LeaseBatcher:
+    """I add leases to the shares of many files, sending them to each
+    storage server in batches (with one add_leases() message per batch)
+    rather than with one add_lease() message per file. A deep-check with
+    --add-lease uses one of me for the whole traversal, and passes me to
+    each check as its add_lease= argument.
+
+    add_lease() returns a Deferred that fires when that lease has been
+    added, or errbacks with the failure of the message that carried it. A
+    server is sent a batch when it has 'batch_size' leases waiting, and
+    whatever is left is sent by flush(), which must be called once the
+    caller has asked for all of its leases.
+
+    Servers that do not offer add_leases() (older ones, which do not list
+    'maximum-add-leases-batch-size' in their version dictionary) are sent
+    add_lease() right away, as is a batch that holds only one lease.
+    """
+
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        self._pending = {} # IServer -> list of (si, renew, cancel, Deferred)
+        self._in_flight = 0
+        self._flush_waiters = []
+
+    def _get_max_batch(self, rref):
+        v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        return min(self.batch_size,
+                   v1.get("maximum-add-leases-batch-size", 0))
+
+    def add_lease(self, server, storage_index, renew_secret, cancel_secret):
+        rref = server.get_rref()
+        max_batch = self._get_max_batch(rref)
+        if max_batch < 2:
+            return self._send_one(rref, storage_index, renew_secret,
+                                  cancel_secret)
+        d = defer.Deferred()
+        pending = self._pending.setdefault(server, [])
+        pending.append((storage_index, renew_secret, cancel_secret, d))
+        if len(pending) >= max_batch:
+            self._send_batch(server)
+        return d
+
+    def _send_one(self, rref, storage_index, renew_secret, cancel_secret):
+        self._in_flight += 1
+        d = rref.callRemote("add_lease", storage_index,
+                            renew_secret, cancel_secret)
+        d.addBoth(self._sent)
+        return d
+
+    def _send_batch(self, server):
+        pending = self._pending.pop(server)
+        rref = server.get_rref()
+        if len(pending) == 1:
+            (storage_index, renew_secret, cancel_secret, d) = pending[0]
+            d2 = self._send_one(rref, storage_index, renew_secret,
+                                cancel_secret)
+            d2.chainDeferred(d)
+            return
+        self._in_flight += 1
+        leases = [lease[:3] for lease in pending]
+        d2 = rref.callRemote("add_leases", leases)
+        def _fire(res):
+            for (si, renew, cancel, d) in pending:
+                d.callback(None)
+        def _fail(f):
+            for (si, renew, cancel, d) in pending:
+                d.errback(f)
+        d2.addCallbacks(_fire, _fail)
+        d2.addBoth(self._sent)
+
+    def _sent(self, res):
+        self._in_flight -= 1
+        if not self._in_flight:
+            waiters, self._flush_waiters = self._flush_waiters, []
+            for d in waiters:
+                eventually(d.callback, None)
+        return res
+
+    def flush(self):
+        """Send every lease that is still waiting. I return a Deferred that
+        fires (with None, regardless of errors) when all of the messages
+        that I have sent have been answered."""
+        for server in self._pending.keys():
+            self._send_batch(server)
+        if not self._in_flight:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._flush_waiters.append(d)
+        return d
+
 class UnknownServerTypeError(Exception):
     pass
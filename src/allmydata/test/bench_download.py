@@ -0,0 +1,143 @@
+"""
+Measure how much copying the immutable downloader does between the zfec
+decoder and the consumer that receives the ciphertext, and how fast a file
+goes through DownloadNode's decode/hash stage and Segmentation.
+
+No servers are involved: the k primary blocks of each segment are encoded up
+front and handed to DownloadNode.process_blocks() as if a SegmentFetcher had
+just fetched them. zfec hands primary blocks back without copying them, so
+any ciphertext that reaches the consumer in a string which is not one of
+those blocks has been copied by the download pipeline.
+
+Run it with 'make bench-download'. Pass --profile to get a hotshot profile
+of a whole-file read of the larger file in bench_download.prof.
+"""
+
+import hotshot.stats, os, sys, time
+
+from allmydata import uri
+from allmydata.codec import CRSEncoder, CRSDecoder
+from allmydata.hashtree import HashTree
+from allmydata.util import hashutil, mathutil
+from allmydata.immutable.downloader.node import DownloadNode
+from allmydata.immutable.downloader.status import DownloadStatus
+from foolscap.eventual import _theSimpleQueue
+
+K, N = 3, 10
+SEGSIZE = 128*1024
+MiB = 1024*1024
+REPS = 5 # report the fastest of this many reads
+
+class FakeSegmentFetcher:
+    def __init__(self, segnum):
+        self.segnum = segnum
+    def stop(self):
+        pass
+
+class BenchNode(DownloadNode):
+    # a DownloadNode which already holds the primary blocks of every
+    # segment, and "fetches" a segment by passing them to process_blocks()
+    def __init__(self, data):
+        si = "\x00"*16
+        v = uri.CHKFileVerifierURI(si, "\x00"*32, K, N, len(data))
+        DownloadNode.__init__(self, v, None, None, None, None,
+                              DownloadStatus(si, len(data)))
+        segsize = mathutil.next_multiple(min(SEGSIZE, len(data)), K)
+        self.blocks = []
+        leaves = []
+        for segnum in range(mathutil.div_ceil(len(data), segsize)):
+            segment = data[segnum*segsize:(segnum+1)*segsize]
+            leaves.append(hashutil.crypttext_segment_hash(segment))
+            segment += "\x00" * (mathutil.pad_size(len(segment), K))
+            blocksize = len(segment) / K
+            enc = CRSEncoder()
+            enc.set_params(len(segment), K, N)
+            inshares = [segment[i*blocksize:(i+1)*blocksize]
+                        for i in range(K)]
+            (shares, shareids) = enc.encode(inshares, range(K)).result
+            self.blocks.append(dict(zip(shareids, shares)))
+        t = HashTree(leaves)
+        self._parse_and_store_UEB({"segment_size": segsize,
+                                   "crypttext_root_hash": t[0],
+                                   "share_root_hash": "\x00"*32})
+        self.ciphertext_hash_tree.set_hashes(dict(enumerate(t)))
+
+    def _parse_and_store_UEB(self, d):
+        # the real one also takes UEB fields we don't need here
+        self.segment_size = d["segment_size"]
+        r = self._calculate_sizes(self.segment_size)
+        self.tail_segment_size = r["tail_segment_size"]
+        self.tail_segment_padded = r["tail_segment_padded"]
+        self.num_segments = r["num_segments"]
+        self.block_size = r["block_size"]
+        self.tail_block_size = r["tail_block_size"]
+        self._codec = CRSDecoder()
+        self._codec.set_params(self.segment_size, K, N)
+        self.ciphertext_hash_tree_leaves = self.num_segments
+        self.ciphertext_hash_tree.__init__(self.num_segments)
+        self.ciphertext_hash_tree.set_hashes({0: d["crypttext_root_hash"]})
+
+    def _start_new_segment(self):
+        if self._active_segment is None and self._segment_requests:
+            segnum = self._segment_requests[0][0]
+            self._active_segment = FakeSegmentFetcher(segnum)
+            self.process_blocks(segnum, dict(self.blocks[segnum]))
+
+class CountingConsumer:
+    def __init__(self, blocks):
+        self.block_ids = set()
+        for b in blocks:
+            self.block_ids.update([id(block) for block in b.values()])
+        self.bytes_written = 0
+        self.bytes_copied = 0
+    def registerProducer(self, p, streaming):
+        pass
+    def unregisterProducer(self):
+        pass
+    def write(self, data):
+        self.bytes_written += len(data)
+        if id(data) not in self.block_ids:
+            self.bytes_copied += len(data)
+
+def read(node, offset, size):
+    c = CountingConsumer(node.blocks)
+    d = node.read(c, offset, size)
+    # nothing here needs the reactor: drain the eventual-send queue by hand
+    while _theSimpleQueue._events:
+        _theSimpleQueue._turn()
+    assert d.called
+    d.addErrback(lambda f: sys.exit(f.getTraceback()))
+    return c
+
+def bench(filesize, profile=False):
+    node = BenchNode(os.urandom(filesize))
+    print "%d MiB file, %d-of-%d, %d KiB segments" % (filesize/MiB, K, N,
+                                                      SEGSIZE/1024)
+    for (name, offset, size) in [("whole file", 0, None),
+                                 ("unaligned range", 1000, filesize/2)]:
+        if profile:
+            p = hotshot.Profile("bench_download.prof")
+            c = p.runcall(read, node, offset, size)
+            p.close()
+            break
+        elapsed = None
+        for i in range(REPS):
+            start = time.time()
+            c = read(node, offset, size)
+            elapsed = min(elapsed or 1e9, time.time() - start)
+        print ("  %-16s %.2f bytes copied per byte served, %6.1f MB/s"
+               % (name+":", float(c.bytes_copied) / c.bytes_written,
+                  c.bytes_written / elapsed / 1e6))
+
+def print_profile():
+    s = hotshot.stats.load("bench_download.prof")
+    s.strip_dirs()
+    s.sort_stats("time")
+    s.print_stats(32)
+
+if __name__ == "__main__":
+    profile = "--profile" in sys.argv
+    bench(1*MiB)
+    bench(64*MiB, profile)
+    if profile:
+        print_profile()
@@ -0,0 +1,72 @@
+"""
+Measure how the segment size of an MDMF file affects the cost of creating
+it, reading it back whole, and making a small in-place modification.
+
+The shares are kept in memory by test_mutable's FakeStorage, so this times
+the encoding, hashing, signing and decoding done by the mutable-file code,
+not the network. Alongside each update the number of share bytes written
+to the servers is reported: update() has to rewrite every segment that the
+new data touches, so this grows with the segment size.
+
+Run it with 'make bench-mutable'.
+"""
+
+import os, sys, time
+
+from allmydata.interfaces import MDMF_VERSION
+from allmydata.mutable.publish import MutableData, choose_segment_size
+from allmydata.test.test_mutable import FakeStorage, make_nodemaker
+from foolscap.eventual import _theSimpleQueue
+
+KiB = 1024
+MiB = 1024*KiB
+UPDATE_SIZE = 4*KiB
+
+class CountingStorage(FakeStorage):
+    def __init__(self):
+        FakeStorage.__init__(self)
+        self.bytes_written = 0
+    def write(self, peerid, storage_index, shnum, offset, data):
+        self.bytes_written += len(data)
+        return FakeStorage.write(self, peerid, storage_index, shnum, offset,
+                                 data)
+
+def run(d):
+    # nothing here needs the reactor: drain the eventual-send queue by hand
+    while _theSimpleQueue._events:
+        _theSimpleQueue._turn()
+    assert d.called
+    results = []
+    d.addCallbacks(results.append, lambda f: sys.exit(f.getTraceback()))
+    return results[0]
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    res = run(f(*args, **kwargs))
+    return res, time.time() - start
+
+def bench(filesize, segment_size):
+    s = CountingStorage()
+    nm = make_nodemaker(s)
+    data = os.urandom(filesize)
+    n, create_time = timed(nm.create_mutable_file, MutableData(data),
+                           version=MDMF_VERSION, segment_size=segment_size)
+    res, read_time = timed(n.download_best_version)
+    assert res == data
+    v = run(n.get_best_mutable_version())
+    s.bytes_written = 0
+    _, update_time = timed(v.update, MutableData("x"*UPDATE_SIZE),
+                           filesize/2)
+    name = "%dKiB:" % ((segment_size or choose_segment_size(filesize)) / KiB)
+    if segment_size is None:
+        name = "auto " + name
+    print ("  %-13s create %6.1f MB/s, read %6.1f MB/s,"
+           " %d KiB update %6.3fs (%d KiB written)"
+           % (name, filesize / create_time / 1e6, filesize / read_time / 1e6,
+              UPDATE_SIZE / KiB, update_time, s.bytes_written / KiB))
+
+if __name__ == "__main__":
+    for filesize in [1*MiB, 16*MiB]:
+        print "%d MiB file, 3-of-10" % (filesize / MiB)
+        for segment_size in [32*KiB, 128*KiB, 512*KiB, 1*MiB, None]:
+            bench(filesize, segment_size)
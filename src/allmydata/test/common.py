@@ -11,7 +11,7 @@ from allmydata.introducer.server import IntroducerNode
 from allmydata.interfaces import IMutableFileNode, IImmutableFileNode,\
                                  NotEnoughSharesError, ICheckable, \
                                  IMutableUploadable, SDMF_VERSION, \
-                                 MDMF_VERSION
+                                 MDMF_VERSION, DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.check_results import CheckResults, CheckAndRepairResults, \
      DeepCheckResults, DeepCheckAndRepairResults
 from allmydata.storage_client import StubServer
@@ -119,6 +119,8 @@ class FakeCHKFileNode:
         return len(data)
     def get_current_size(self):
         return defer.succeed(self.get_size())
+    def get_segment_size(self):
+        return defer.succeed(DEFAULT_MAX_SEGMENT_SIZE)
 
     def read(self, consumer, offset=0, size=None):
         # we don't bother to call registerProducer/unregisterProducer,
@@ -267,6 +269,8 @@ class FakeMutableFileNode:
         return self.get_size_of_best_version()
     def get_size_of_best_version(self):
         return defer.succeed(len(self.all_contents[self.storage_index]))
+    def get_segment_size(self):
+        return defer.succeed(DEFAULT_MAX_SEGMENT_SIZE)
 
     def get_storage_index(self):
         return self.storage_index
@@ -274,6 +278,15 @@ class FakeMutableFileNode:
     def get_servermap(self, mode):
         return defer.succeed(None)
 
+    # like get_best_readable_version, these are really part of
+    # IMutableFileVersion. We don't keep a sequence number, so the root hash
+    # is derived from the contents.
+    def get_sequence_number(self):
+        return 1
+    def get_root_hash(self):
+        return hashutil.tagged_hash("fake-root-hash",
+                                    self.all_contents[self.storage_index])
+
     def get_version(self):
         assert self.storage_index in self.file_types
         return self.file_types[self.storage_index]
@@ -332,6 +345,9 @@ class FakeMutableFileNode:
     def download_best_version(self):
         return defer.succeed(self._download_best_version())
 
+    # I am also my own best readable version (IMutableFileVersion)
+    download_to_data = download_best_version
+
 
     def _download_best_version(self, ignored=None):
         if isinstance(self.my_uri, uri.LiteralFileURI):
@@ -354,7 +370,8 @@ class FakeMutableFileNode:
         assert not self.is_readonly()
         old_contents = self.all_contents[self.storage_index]
         new_data = modifier(old_contents, None, True)
-        self.all_contents[self.storage_index] = new_data
+        if new_data is not None: # None means no change, as in the real one
+            self.all_contents[self.storage_index] = new_data
         return None
 
     # As actually implemented, MutableFilenode and MutableFileVersion
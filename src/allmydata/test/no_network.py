@@ -27,6 +27,7 @@ from allmydata.util import fileutil, idlib, hashutil
 from allmydata.util.hashutil import sha1
 from allmydata.test.common_web import HTTPClientGETFactory
 from allmydata.interfaces import IStorageBroker, IServer
+from allmydata.mutable.common import ReadSizeEstimator
 from allmydata.test.common import TEST_RSA_KEY_SIZE
 
 
@@ -163,6 +164,8 @@ class NoNetworkServer:
 
 class NoNetworkStorageBroker:
     implements(IStorageBroker)
+    def __init__(self):
+        self.read_size_estimator = ReadSizeEstimator()
     def get_servers_for_psi(self, peer_selection_index):
         def _permuted(server):
             seed = server.get_permutation_seed()
@@ -2,7 +2,7 @@
 import os.path
 from twisted.trial import unittest
 from cStringIO import StringIO
-import urllib, re
+import urllib, re, struct
 import simplejson
 
 from mock import patch
@@ -13,6 +13,8 @@ from allmydata.immutable import upload
 from allmydata.interfaces import MDMF_VERSION, SDMF_VERSION
 from allmydata.mutable.publish import MutableData
 from allmydata.dirnode import normalize
+from allmydata.storage.inventory import ShareInventory, empty_counts, \
+     NUM_PREFIXES
 from allmydata.scripts.common_http import socket_error
 import allmydata.scripts.common_http
 from pycryptopp.publickey import ed25519
@@ -453,6 +455,68 @@ class CLI(CLITestMixin, unittest.TestCase):
         self.failUnless("mqfblse6m5a6dh45isu2cg7oji" in err,
                         "didn't see 'mqfblse6m5a6dh45isu2cg7oji' in '%s'" % err)
 
+    def _migrate_shares(self, *args):
+        o = debug.MigrateSharesOptions()
+        o.stdout,o.stderr = StringIO(), StringIO()
+        o.parseOptions(list(args))
+        rc = debug.migrate_shares(o)
+        return rc, o.stdout.getvalue(), o.stderr.getvalue()
+
+    def test_migrate_shares(self):
+        basedir = "cli/test_migrate_shares"
+        source = os.path.join(basedir, "old", "storage")
+        dest = os.path.join(basedir, "new", "storage")
+        for si_s in ["mqfblse6m5a6dh45isu2cg7oji", "mqaaaaaaaaaaaaaaaaaaaaaaaa",
+                     "7xaaaaaaaaaaaaaaaaaaaaaaaa"]:
+            bucketdir = os.path.join(source, "shares", si_s[:2], si_s)
+            fileutil.make_dirs(bucketdir)
+            fileutil.write(os.path.join(bucketdir, "3"), "share " + si_s)
+        fileutil.make_dirs(os.path.join(source, "shares", "incoming", "ab"))
+        # this one is already there
+        bucketdir = os.path.join(dest, "shares", "7x",
+                                 "7xaaaaaaaaaaaaaaaaaaaaaaaa")
+        fileutil.make_dirs(bucketdir)
+        fileutil.write(os.path.join(bucketdir, "5"), "")
+        # the destination server has counted all of its shares
+        statefile = os.path.join(dest, "share_inventory.state")
+        inventory = ShareInventory(statefile)
+        prefixes = [base32.b2a(struct.pack(">H", i << (16-10)))[:2]
+                    for i in range(NUM_PREFIXES)]
+        for prefix in prefixes:
+            inventory.set_prefix_counts(prefix, empty_counts())
+        inventory.save_state()
+
+        rc, out, err = self._migrate_shares("--dry-run", source, dest)
+        self.failUnlessReallyEqual(rc, 1)
+        self.failUnlessIn("would move 2 buckets", out)
+        self.failIf(os.path.exists(os.path.join(dest, "shares", "mq")))
+
+        rc, out, err = self._migrate_shares(source, dest)
+        self.failUnlessReallyEqual(rc, 1)
+        self.failUnlessIn("moved 2 buckets", out)
+        self.failUnlessIn("1 buckets were already present", out)
+        self.failUnlessIn("7xaaaaaaaaaaaaaaaaaaaaaaaa", err)
+        self.failUnlessReallyEqual(
+            fileutil.read(os.path.join(dest, "shares", "mq",
+                                       "mqfblse6m5a6dh45isu2cg7oji", "3")),
+            "share mqfblse6m5a6dh45isu2cg7oji")
+        self.failIf(os.path.exists(os.path.join(source, "shares", "mq",
+                                                "mqfblse6m5a6dh45isu2cg7oji")))
+        self.failIf(os.path.exists(os.path.join(dest, "shares", "incoming")))
+        self.failUnless(os.path.exists(os.path.join(source, "shares", "7x",
+                                                    "7xaaaaaaaaaaaaaaaaaaaaaaaa",
+                                                    "3")))
+        # its counts leave out the moved shares, so they are no longer used
+        self.failUnlessIn("share counts for 1 prefixes will be recomputed",
+                          out)
+        inventory = ShareInventory(statefile)
+        self.failUnlessReallyEqual(inventory.get_counts(), None)
+        counted = inventory.get_state()["counted-prefixes"]
+        self.failIfIn("mq", counted)
+        self.failUnlessIn("7x", counted)
+        self.failUnlessReallyEqual(len(counted),
+                                   NUM_PREFIXES - 1)
+
     def test_alias(self):
         aliases = {"tahoe": "TA",
                    "work": "WA",
@@ -1,11 +1,12 @@
 import os
 from twisted.trial import unittest
 from twisted.application import service
+from twisted.internet import defer
 
 import allmydata
 from allmydata.node import OldConfigError, OldConfigOptionError, MissingConfigEntry
 from allmydata import client
-from allmydata.storage_client import StorageFarmBroker
+from allmydata.storage_client import StorageFarmBroker, LeaseBatcher
 from allmydata.util import base32, fileutil
 from allmydata.interfaces import IFilesystemNode, IFileNode, \
      IImmutableFileNode, IMutableFileNode, IDirectoryNode
@@ -135,6 +136,72 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         c = client.Client(basedir)
         self.failUnlessEqual(c.getServiceNamed("storage").reserved_space, 0)
 
+    def test_durability(self):
+        basedir = "client.Basic.test_durability"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "durability = fdatasync\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("storage").durability,
+                             "fdatasync")
+
+    def test_io_threads(self):
+        basedir = "client.Basic.test_io_threads"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "io_threads = 4\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.sharedirs[0].io.threads, 4)
+
+    def test_mutable_growth(self):
+        basedir = "client.Basic.test_mutable_growth"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "mutable_growth_factor = 1.5\n" + \
+                           "compact_mutable_shares = true\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.mutable_growth_factor, 1.5)
+        self.failUnless(ss.mutable_compactor)
+
+    def test_readv_cache_size(self):
+        basedir = "client.Basic.test_readv_cache_size"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "readv_cache_size = 4MB\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.readv_cache.max_bytes, 4000000)
+
+    def test_extra_dirs(self):
+        basedir = u"client.Basic.test_extra_dirs"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "extra_dirs = disk1, %s\n" % os.path.abspath("client.Basic.test_extra_dirs.disk2"))
+        c = client.Client(basedir)
+        sharedirs = [sd.storedir for sd in c.getServiceNamed("storage").sharedirs]
+        self.failUnlessEqual(sharedirs,
+                             [os.path.join(os.path.abspath(basedir), "storage"),
+                              os.path.join(os.path.abspath(basedir), "disk1"),
+                              os.path.abspath("client.Basic.test_extra_dirs.disk2")])
+        self.failUnless(os.path.isdir(os.path.join(basedir, "disk1", "shares", "incoming")))
+
     def _permute(self, sb, key):
         return [ s.get_longname() for s in sb.get_servers_for_psi(key) ]
 
@@ -190,6 +257,22 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         _check("helper.furl = None", None)
         _check("helper.furl = pb://blah\n", "pb://blah")
 
+    def test_key_pool(self):
+        basedir = "test_client.Basic.test_key_pool"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failUnlessRaises(KeyError, c.getServiceNamed, "key_pool")
+
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG + "[client]\nmutable.key_pool = true\n")
+        c = client.Client(basedir)
+        pool = c.getServiceNamed("key_pool")
+        self.failUnlessIdentical(c._key_generator._pool, pool)
+        self.failUnlessEqual(pool.keysize, 2048)
+        c.set_default_mutable_keysize(522)
+        self.failUnlessEqual(pool.keysize, 522)
+
     @mock.patch('allmydata.util.log.msg')
     @mock.patch('allmydata.frontends.drop_upload.DropUploader')
     def test_create_drop_uploader(self, mock_drop_uploader, mock_log_msg):
@@ -257,6 +340,73 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
                         mock_log_msg.call_args_list)
 
 
+class FakeLeaseRRef:
+    def __init__(self, batch_size):
+        v1 = {}
+        if batch_size:
+            v1["maximum-add-leases-batch-size"] = batch_size
+        self.version = {"http://allmydata.org/tahoe/protocols/storage/v1": v1}
+        self.calls = []
+    def callRemote(self, methname, *args):
+        d = defer.Deferred()
+        self.calls.append((methname, args, d))
+        return d
+
+class FakeLeaseServer:
+    def __init__(self, batch_size):
+        self.rref = FakeLeaseRRef(batch_size)
+    def get_rref(self):
+        return self.rref
+
+class LeaseBatching(unittest.TestCase):
+    def test_batches(self):
+        new = FakeLeaseServer(3)
+        old = FakeLeaseServer(None)
+        b = LeaseBatcher(batch_size=10)
+        added = []
+        for si in ["si0", "si1", "si2", "si3"]:
+            for server in (new, old):
+                d = b.add_lease(server, si, si+"rs", si+"cs")
+                d.addCallback(lambda ign, si=si: added.append(si))
+        # the old server gets one message per storage index, straight away
+        self.failUnlessEqual([call[:2] for call in old.rref.calls],
+                             [("add_lease", (si, si+"rs", si+"cs"))
+                              for si in ["si0", "si1", "si2", "si3"]])
+        # the new one got a full batch, as many as it will take at once
+        self.failUnlessEqual([call[:2] for call in new.rref.calls],
+                             [("add_leases", ([(si, si+"rs", si+"cs")
+                                               for si in ["si0", "si1", "si2"]],))])
+        new.rref.calls[0][2].callback(None)
+        self.failUnlessEqual(added, ["si0", "si1", "si2"])
+
+        flushed = []
+        d = b.flush()
+        d.addCallback(flushed.append)
+        # the last one goes by itself
+        self.failUnlessEqual([call[0] for call in new.rref.calls],
+                             ["add_leases", "add_lease"])
+        new.rref.calls[1][2].callback(None)
+        for (methname, args, d) in old.rref.calls:
+            self.failIf(flushed)
+            d.callback(None)
+        d = flush_but_dont_ignore(None)
+        d.addCallback(lambda ign: self.failUnlessEqual(flushed, [None]))
+        return d
+
+    def test_failure(self):
+        server = FakeLeaseServer(100)
+        b = LeaseBatcher()
+        failures = []
+        for si in ["si0", "si1"]:
+            d = b.add_lease(server, si, "rs", "cs")
+            d.addErrback(failures.append)
+        self.failUnlessEqual(server.rref.calls, [])
+        b.flush()
+        server.rref.calls[0][2].errback(IndexError("oops"))
+        self.failUnlessEqual(len(failures), 2)
+        for f in failures:
+            self.failUnless(f.check(IndexError))
+
 def flush_but_dont_ignore(res):
     d = flushEventualQueue()
     def _done(ignored):
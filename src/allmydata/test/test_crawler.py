@@ -8,7 +8,8 @@ from foolscap.api import eventually, fireEventually
 
 from allmydata.util import fileutil, hashutil, pollmixin
 from allmydata.storage.server import StorageServer, si_b2a
-from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded, \
+     CrawlerHost
 
 from allmydata.test.test_storage import FakeCanary
 from allmydata.test.common_util import StallMixin
@@ -82,6 +83,13 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class PrefixEnumeratingCrawler(ShareCrawler):
+    def __init__(self, *args, **kwargs):
+        ShareCrawler.__init__(self, *args, **kwargs)
+        self.all_buckets = []
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        self.all_buckets.extend(buckets)
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -137,6 +145,38 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         c2.start_current_prefix(time.time())
         self.failUnlessEqual(sorted(sis), sorted(c2.all_buckets))
 
+    def test_multiple_sharedirs(self):
+        self.basedir = "crawler/Basic/multiple_sharedirs"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid,
+                           extra_storedirs=[os.path.join(self.basedir, "d1")])
+        ss.setServiceParent(self.s)
+        # alternate between the two directories
+        placed = []
+        def choose_directory(size, uploads={}, allocated={}):
+            placed.append(size)
+            return ss.sharedirs[len(placed) % 2]
+        self.patch(ss.buckets, "choose_directory", choose_directory)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        seen = []
+        def process_bucket(cycle, prefix, prefixdir, storage_index_b32):
+            seen.append(os.path.join(prefixdir, storage_index_b32))
+        c.process_bucket = process_bucket
+        c.load_state()
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(len(seen), 10)
+        for bucketdir in seen:
+            self.failUnless(os.path.isdir(bucketdir), bucketdir)
+        # the buckets were spread over both directories
+        self.failUnlessEqual(len(set([os.path.dirname(os.path.dirname(b))
+                                      for b in seen])), 2)
+        self.failUnlessEqual(sorted(sis),
+                             sorted([os.path.basename(b) for b in seen]))
+
     def test_service(self):
         self.basedir = "crawler/Basic/service"
         fileutil.make_dirs(self.basedir)
@@ -165,6 +205,230 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_check)
         return d
 
+    def test_io_scheduled(self):
+        self.basedir = "crawler/Basic/io_scheduled"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.io_threads = 2
+        saves = []
+        def save_state():
+            saves.append(c.last_complete_prefix_index)
+            return ShareCrawler.save_state(c)
+        c.save_state = save_state
+        sleeps = []
+        c.yielding = sleeps.append
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        def _check(ignored):
+            self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+            # the state was saved after every prefix
+            self.failUnless(len(saves) >= len(c.prefixes), len(saves))
+            self.failIfEqual(c.get_progress()["io-latency"], None)
+            # a local disk is fast enough that it never had to slow down:
+            # the only sleep is the one between cycles
+            self.failUnlessEqual(sleeps, [c.minimum_cycle_time])
+            self.failIf(c._prefetching)
+            self.failIf(c._prefetched)
+        d.addCallback(_check)
+        return d
+
+    def test_io_backoff(self):
+        self.basedir = "crawler/Basic/io_backoff"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        self.failUnlessEqual(c.get_io_backoff(), 0.0)
+        # the disk is twice as slow as we'd like: spend as long sleeping as
+        # the last prefix took to load
+        c.target_io_latency = 0.010
+        c.io_latency = 0.020
+        c.last_prefix_io_time = 3.0
+        self.failUnlessEqual(c.get_io_backoff(), 3.0)
+        c.io_latency = 0.005
+        self.failUnlessEqual(c.get_io_backoff(), 0.0)
+
+        # when the crawler has to back off, it sleeps after every prefix
+        c.io_threads = 1
+        c.io_latency = None
+        c.target_io_latency = 0.001
+        real_load_prefix = c.load_prefix
+        def load_prefix(prefix):
+            # pretend that the disk is slow
+            (buckets, homes, elapsed, ops) = real_load_prefix(prefix)
+            return (buckets, homes, 0.1, 1)
+        c.load_prefix = load_prefix
+        sleeps = []
+        def yielding(sleep_time):
+            sleeps.append(sleep_time)
+            c.stopService()
+        c.yielding = yielding
+        c.setServiceParent(self.s)
+        d = self.poll(lambda: sleeps)
+        def _check(ignored):
+            self.failUnlessEqual(len(sleeps), 1)
+            self.failUnlessApproximates(sleeps[0], 0.1 * (0.1 / 0.001 - 1),
+                                        0.01)
+            self.failUnlessEqual(c.state["last-complete-prefix"], c.prefixes[0])
+        d.addCallback(_check)
+        return d
+
+    def test_combined(self):
+        self.basedir = "crawler/Basic/combined"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+
+        host = CrawlerHost(ss, os.path.join(self.basedir, "host.state"))
+        host.slow_start = 0
+        host.cpu_slice = 500
+        listed = []
+        real_list_buckets = host._list_buckets
+        def _list_buckets(prefix):
+            listed.append(prefix)
+            return real_list_buckets(prefix)
+        host._list_buckets = _list_buckets
+        c1 = BucketEnumeratingCrawler(ss, os.path.join(self.basedir, "c1"))
+        c2 = PrefixEnumeratingCrawler(ss, os.path.join(self.basedir, "c2"))
+        host.add_consumer(c1, "c1")
+        host.add_consumer(c2, "c2")
+        host.setServiceParent(self.s)
+        # the consumers don't run on their own
+        self.failIf(c1.timer)
+        self.failIf(c2.timer)
+
+        d = c1.finished_d
+        def _check(ignored):
+            self.failUnlessEqual(sorted(sis), sorted(c1.all_buckets))
+            self.failUnlessEqual(sorted(sis), sorted(c2.all_buckets))
+            # each prefix was listed once, for both consumers
+            self.failUnlessEqual(sorted(listed), host.prefixes)
+            for c in (c1, c2):
+                s = c.get_state()
+                self.failUnlessEqual(s["last-cycle-finished"], 0)
+                self.failUnlessEqual(s["current-cycle"], None)
+                self.failUnlessEqual(c.get_progress()["cycle-in-progress"],
+                                     False)
+            progress = host.get_consumer_progress()
+            self.failUnlessEqual(sorted(progress.keys()), ["c1", "c2"])
+            # and the state of each consumer was saved in its own file
+            c3 = BucketEnumeratingCrawler(ss, os.path.join(self.basedir, "c1"))
+            self.failUnlessEqual(c3.state["last-cycle-finished"], 0)
+        d.addCallback(_check)
+        return d
+
+    def test_combined_schedule(self):
+        self.basedir = "crawler/Basic/combined_schedule"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+
+        host = CrawlerHost(ss, os.path.join(self.basedir, "host.state"))
+        host.slow_start = 0
+        host.cpu_slice = 500
+        # 'due' has never run, so it joins the first cycle
+        due = BucketEnumeratingCrawler(ss, os.path.join(self.basedir, "due"))
+        # 'recent' started a cycle a minute ago, and is not due for an hour
+        recent = BucketEnumeratingCrawler(ss,
+                                          os.path.join(self.basedir, "recent"))
+        recent.minimum_cycle_time = 60*60
+        recent.state["last-cycle-finished"] = 0
+        recent.state["current-cycle-start-time"] = time.time() - 60
+        # 'halfway' was interrupted in the middle of a cycle
+        halfway = BucketEnumeratingCrawler(ss,
+                                           os.path.join(self.basedir, "halfway"))
+        halfway.state["current-cycle"] = 0
+        halfway.last_complete_prefix_index = 511
+        for name, c in [("due", due), ("recent", recent),
+                        ("halfway", halfway)]:
+            host.add_consumer(c, name)
+        sleeps = []
+        host.yielding = sleeps.append
+        host.setServiceParent(self.s)
+
+        d = due.finished_d
+        def _check(ignored):
+            self.failUnlessEqual(sorted(sis), sorted(due.all_buckets))
+            self.failUnlessEqual(recent.all_buckets, [])
+            self.failUnlessEqual(recent.state["last-cycle-finished"], 0)
+            middle = host.prefixes[511]
+            self.failUnlessEqual(sorted([si for si in sis if si[:2] > middle]),
+                                 sorted(halfway.all_buckets))
+            self.failUnlessEqual(halfway.state["last-cycle-finished"], 0)
+            # the host sleeps until the next consumer is due, which is 'due'
+            # (whose minimum_cycle_time is 300s)
+            self.failUnlessEqual(len(sleeps), 1)
+            self.failUnless(250 < sleeps[0] <= 300, sleeps)
+            p = recent.get_progress()
+            self.failUnlessEqual(p["cycle-in-progress"], False)
+            self.failUnless(p["remaining-wait-time"] > 55*60, p)
+        d.addCallback(_check)
+        return d
+
+    def test_combined_catch_up(self):
+        self.basedir = "crawler/Basic/combined_catch_up"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+
+        host = CrawlerHost(ss, os.path.join(self.basedir, "host.state"))
+        host.slow_start = 0
+        host.cpu_slice = 500
+        # the host was interrupted further along than its consumer
+        host.state["current-cycle"] = 0
+        host.last_complete_prefix_index = 700
+        behind = BucketEnumeratingCrawler(ss,
+                                          os.path.join(self.basedir, "behind"))
+        behind.state["current-cycle"] = 0
+        behind.last_complete_prefix_index = 511
+        host.add_consumer(behind, "behind")
+        saved = []
+        real_save_state = behind.save_state
+        def _save_state():
+            saved.append("behind")
+            real_save_state()
+        behind.save_state = _save_state
+        real_host_save_state = host.save_state
+        def _host_save_state():
+            real_host_save_state()
+            saved.append("host")
+        host.save_state = _host_save_state
+        host.setServiceParent(self.s)
+
+        d = behind.finished_d
+        def _check(ignored):
+            # the prefixes between the consumer and the host were not
+            # skipped: they were done in the host's next cycle
+            self.failUnlessEqual(host.state["last-cycle-finished"], 1)
+            middle = host.prefixes[511]
+            self.failUnlessEqual(sorted([si for si in sis if si[:2] > middle]),
+                                 sorted(behind.all_buckets))
+            self.failUnlessEqual(behind.state["last-cycle-finished"], 0)
+            # and the consumer's state is always saved before the host's
+            self.failUnless(saved)
+            self.failUnlessEqual(saved[:2], ["behind", "host"])
+        d.addCallback(_check)
+        return d
+
     def test_paced(self):
         self.basedir = "crawler/Basic/paced"
         fileutil.make_dirs(self.basedir)
@@ -4,16 +4,18 @@ from zope.interface import implements
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.internet.interfaces import IConsumer
+from twisted.python import failure
 from allmydata import uri, dirnode
 from allmydata.client import Client
 from allmydata.immutable import upload
 from allmydata.interfaces import IImmutableFileNode, IMutableFileNode, \
      ExistingChildError, NoSuchChildError, MustNotBeUnknownRWError, \
      MustBeDeepImmutableError, MustBeReadonlyError, \
-     IDeepCheckResults, IDeepCheckAndRepairResults, \
+     IDeepCheckResults, IDeepCheckAndRepairResults, IDirectoryNode, \
      MDMF_VERSION, SDMF_VERSION
 from allmydata.mutable.filenode import MutableFileNode
-from allmydata.mutable.common import UncoordinatedWriteError
+from allmydata.mutable.common import UncoordinatedWriteError, \
+     NotWriteableError
 from allmydata.util import hashutil, base32
 from allmydata.util.netstring import split_netstring
 from allmydata.monitor import Monitor
@@ -1373,6 +1375,26 @@ class Dirnode(GridTestMixin, unittest.TestCase,
         self.set_up_grid()
         return self._do_initial_children_test(mdmf=True)
 
+    def test_list_version(self):
+        self.basedir = "dirnode/Dirnode/test_list_version"
+        self.set_up_grid()
+        c = self.g.clients[0]
+        nm = c.nodemaker
+        kids = {u"kid": (nm.create_from_cap(make_mutable_file_uri()), {})}
+        d = c.create_dirnode(kids)
+        def _created(n):
+            self.rootnode = n
+            return n.get_best_readable_version()
+        d.addCallback(_created)
+        def _got_version(version):
+            self.failUnlessReallyEqual(version.get_sequence_number(), 1)
+            self.failUnlessReallyEqual(len(version.get_root_hash()), 32)
+            return self.rootnode.list(version)
+        d.addCallback(_got_version)
+        d.addCallback(lambda children:
+                      self.failUnlessReallyEqual(children.keys(), [u"kid"]))
+        return d
+
 class MinimalFakeMutableFile:
     def get_writekey(self):
         return "writekey"
@@ -1917,3 +1939,104 @@ class Adder(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
 
         d.addCallback(_test_adder)
         return d
+
+class Batcher(GridTestMixin, unittest.TestCase):
+
+    def _create_tree(self, c):
+        self.filenode1 = c.nodemaker.create_from_cap(make_chk_file_uri(1234))
+        self.filenode2 = c.nodemaker.create_from_cap(make_chk_file_uri(5678))
+        d = c.create_dirnode()
+        def _created(dn):
+            self.root = dn
+            d2 = dn.set_nodes({u"file1": (self.filenode1, {"color": "red"}),
+                               u"file2": (self.filenode1, None)})
+            d2.addCallback(lambda ign: dn.create_subdirectory(u"dir1"))
+            d2.addCallback(lambda ign: dn)
+            return d2
+        d.addCallback(_created)
+        return d
+
+    def test_apply_batch(self):
+        self.basedir = "dirnode/Batcher/test_apply_batch"
+        self.set_up_grid()
+        c = self.g.clients[0]
+        d = self._create_tree(c)
+        def _apply(root):
+            self.modifies = 0
+            real_modify = root._node.modify
+            def _modify(*args, **kwargs):
+                self.modifies += 1
+                return real_modify(*args, **kwargs)
+            root._node.modify = _modify
+            return root.apply_batch([
+                ("set", u"new", self.filenode2, {"size": "big"}, True),
+                ("set", u"dir1", self.filenode2, None, False),
+                ("delete", u"missing", True),
+                ("delete", u"file2", True),
+                ("rename", u"file1", u"renamed", True),
+                ("rename", u"new", u"dir1", "only-files"),
+                ("set-metadata", u"renamed", {"shape": "round"}),
+                ])
+        d.addCallback(_apply)
+        def _applied(results):
+            self.failUnlessEqual(self.modifies, 1)
+            self.failUnlessEqual(len(results), 7)
+            self.failUnlessEqual([r for r in results if r is None],
+                                 [None] * 4)
+            self.failUnless(isinstance(results[1], ExistingChildError))
+            self.failUnless(isinstance(results[2], NoSuchChildError))
+            self.failUnless(isinstance(results[5], ExistingChildError))
+            return self.root.list()
+        d.addCallback(_applied)
+        def _check(children):
+            self.failUnlessEqual(sorted(children.keys()),
+                                 [u"dir1", u"new", u"renamed"])
+            self.failUnless(IDirectoryNode.providedBy(children[u"dir1"][0]))
+            self.failUnlessEqual(children[u"new"][0].get_uri(),
+                                 self.filenode2.get_uri())
+            self.failUnlessEqual(children[u"new"][1]["size"], "big")
+            self.failUnlessEqual(children[u"renamed"][0].get_uri(),
+                                 self.filenode1.get_uri())
+            # set-metadata replaced the metadata that came with the rename
+            self.failIf("color" in children[u"renamed"][1])
+            self.failUnlessEqual(children[u"renamed"][1]["shape"], "round")
+            self.failUnless("linkmotime" in children[u"renamed"][1]["tahoe"])
+            ro = self.root.get_readonly_uri()
+            return c.create_node_from_uri(ro).apply_batch([])
+        d.addCallback(_check)
+        def _readonly(res):
+            self.failUnless(isinstance(res, failure.Failure))
+            res.trap(NotWriteableError)
+        d.addBoth(_readonly)
+        return d
+
+    def test_retry(self):
+        # if our first attempt lands but we see an UncoordinatedWriteError,
+        # the retry must not report the changes it finds already made as
+        # failures.
+        self.basedir = "dirnode/Batcher/test_retry"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        d = self._create_tree(c0)
+        def _do_batch(root):
+            nm = UCWEingNodeMaker(c0.storage_broker, c0._secret_holder,
+                                  c0.get_history(), c0.getServiceNamed("uploader"),
+                                  c0.terminator,
+                                  c0.get_encoding_parameters(),
+                                  c0.mutable_file_default,
+                                  c0._key_generator)
+            n = nm.create_from_cap(root.get_uri())
+            n._node.please_ucwe_after_next_upload = True
+            return n.apply_batch([
+                ("set", u"new", self.filenode2, None, False),
+                ("delete", u"file2", True),
+                ("rename", u"file1", u"renamed", False),
+                ])
+        d.addCallback(_do_batch)
+        d.addCallback(lambda results:
+                      self.failUnlessEqual(results, [None, None, None]))
+        d.addCallback(lambda ign: self.root.list())
+        d.addCallback(lambda children:
+                      self.failUnlessEqual(sorted(children.keys()),
+                                           [u"dir1", u"new", u"renamed"]))
+        return d
@@ -19,6 +19,7 @@ from allmydata.immutable.downloader.common import BadSegmentNumberError, \
      BadCiphertextHashError, COMPLETE, OVERDUE, DEAD
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.immutable.downloader.fetcher import SegmentFetcher
+from allmydata.immutable.downloader.segmentation import select_pieces
 from allmydata.codec import CRSDecoder
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
 
@@ -623,6 +624,25 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(_got_segment)
         return d
 
+    def test_download_segment_pieces(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.load_shares()
+        n = self.c0.create_node_from_uri(immutable_uri)
+        cn = n._cnode
+        cn._maybe_create_download_node()
+        # the DownloadNode hands out the decoded blocks without joining them.
+        # This 3-of-10 file has a single 312-byte padded segment, of which
+        # the last two bytes are trimmed off.
+        (d,c) = cn._node.get_segment(0)
+        def _got_segment((offset,pieces,decodetime)):
+            self.failUnlessEqual(offset, 0)
+            self.failUnlessEqual([len(piece) for piece in pieces],
+                                 [104, 104, 102])
+        d.addCallback(_got_segment)
+        return d
+
     def test_download_segment_cancel(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
@@ -1619,3 +1639,23 @@ class Selection(unittest.TestCase):
                                                       2: "block-2"}) )
         d.addCallback(_check4)
         return d
+
+class Pieces(unittest.TestCase):
+    def test_select_pieces(self):
+        pieces = ["abc", "defg", "hi"]
+        data = "".join(pieces)
+        for start in range(len(data)+1):
+            for length in range(len(data)-start+1):
+                selected = select_pieces(pieces, start, length)
+                self.failUnlessEqual("".join(selected),
+                                     data[start:start+length])
+                self.failIf("" in selected, (start, length, selected))
+
+    def test_no_copy(self):
+        pieces = ["abc", "defg", "hi"]
+        selected = select_pieces(pieces, 1, 7)
+        self.failUnlessEqual(selected, ["bc", "defg", "h"])
+        self.failUnlessIdentical(selected[1], pieces[1])
+        selected = select_pieces(pieces, 0, 9)
+        for (s, p) in zip(selected, pieces):
+            self.failUnlessIdentical(s, p)
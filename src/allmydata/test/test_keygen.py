@@ -1,12 +1,13 @@
 
-import os
+import os, time
 from twisted.trial import unittest
 from twisted.application import service
 
 from foolscap.api import Tub, fireEventually, flushEventualQueue
 
-from allmydata import key_generator
-from allmydata.util import pollmixin
+from allmydata import key_generator, keypool
+from allmydata.client import KeyGenerator
+from allmydata.util import pollmixin, fileutil
 from allmydata.test.common import TEST_RSA_KEY_SIZE
 from pycryptopp.publickey import rsa
 
@@ -98,3 +99,122 @@ class KeyGenService(unittest.TestCase, pollmixin.PollMixin):
         d.addCallback(lambda junk: self.poll(keypool_full))
 
         return d
+
+class KeyPool(unittest.TestCase, pollmixin.PollMixin):
+    def setUp(self):
+        self.parent = service.MultiService()
+        self.parent.startService()
+        self.basedir = self.mktemp()
+        fileutil.make_dirs(self.basedir)
+        self.poolfile = os.path.join(self.basedir, "key_pool")
+        self.secret = "\x00" * 32
+        self.patch(keypool.KeyPool, "MIN_POOL_SIZE", 2)
+
+    def tearDown(self):
+        return self.parent.stopService()
+
+    def make_pool(self, secret=None):
+        pool = keypool.KeyPool(self.poolfile, secret or self.secret,
+                               TEST_RSA_KEY_SIZE)
+        pool.setServiceParent(self.parent)
+        return pool
+
+    def test_refill(self):
+        pool = self.make_pool()
+        d = self.poll(lambda: pool.get_pool_size() == 2)
+        def _full(ign):
+            self.failUnlessEqual(pool.get_target_size(), 2)
+            key = pool.get_key(TEST_RSA_KEY_SIZE)
+            s = rsa.create_signing_key_from_string(key)
+            junk = os.urandom(42)
+            self.failUnless(s.get_verifying_key().verify(junk, s.sign(junk)))
+            # there are none of other sizes
+            self.failUnlessEqual(pool.get_key(TEST_RSA_KEY_SIZE*2), None)
+            # three keys were asked for recently, so three are made
+            pool.get_key(TEST_RSA_KEY_SIZE)
+            self.failUnlessEqual(pool.get_target_size(), 3)
+            return self.poll(lambda: pool.get_pool_size() == 3)
+        d.addCallback(_full)
+        def _refilled(ign):
+            # demand is forgotten after a while
+            self.patch(keypool.KeyPool, "DEMAND_PERIOD", -1)
+            self.failUnlessEqual(pool.get_target_size(), 2)
+        d.addCallback(_refilled)
+        return d
+
+    def test_persistence(self):
+        pool = self.make_pool()
+        d = self.poll(lambda: pool.get_pool_size() == 2)
+        def _full(ign):
+            self.key = pool.get_key(TEST_RSA_KEY_SIZE)
+            self.remaining = pool._keys[:]
+            self.failIfIn(self.key, open(self.poolfile, "rb").read())
+            return pool.disownServiceParent()
+        d.addCallback(_full)
+        def _stopped(ign):
+            # a key that was handed out is never handed out again
+            pool2 = keypool.KeyPool(self.poolfile, self.secret,
+                                    TEST_RSA_KEY_SIZE)
+            pool2._load()
+            self.failUnlessEqual(pool2._keys, self.remaining)
+            self.failIfIn(self.key, pool2._keys)
+            # the pool can't be read without the secret
+            pool3 = keypool.KeyPool(self.poolfile, "\x01" * 32,
+                                    TEST_RSA_KEY_SIZE)
+            pool3._load()
+            self.failUnlessEqual(pool3._keys, [])
+            # and keys of the wrong size are not used
+            pool4 = keypool.KeyPool(self.poolfile, self.secret,
+                                    TEST_RSA_KEY_SIZE*2)
+            pool4._load()
+            self.failUnlessEqual(pool4._keys, [])
+        d.addCallback(_stopped)
+        return d
+
+    def test_key_generator(self):
+        pool = self.make_pool()
+        kg = KeyGenerator()
+        kg.set_key_pool(pool)
+        self.failUnlessEqual(pool.keysize, 2048)
+        kg.set_default_keysize(TEST_RSA_KEY_SIZE)
+        d = self.poll(lambda: pool.get_pool_size() == 2)
+        d.addCallback(lambda ign: kg.generate())
+        def _generated((verifier, signer)):
+            self.failUnlessEqual(pool.get_pool_size(), 1)
+            junk = os.urandom(42)
+            self.failUnless(verifier.verify(junk, signer.sign(junk)))
+        d.addCallback(_generated)
+        return d
+
+    def test_key_generator_empty_pool(self):
+        pool = self.make_pool()
+        kg = KeyGenerator()
+        kg.set_key_pool(pool)
+        kg.set_default_keysize(TEST_RSA_KEY_SIZE)
+        # the worker has only just been started, so this has to wait for it
+        self.failUnlessEqual(pool.get_pool_size(), 0)
+        d = kg.generate()
+        def _generated((verifier, signer)):
+            junk = os.urandom(42)
+            self.failUnless(verifier.verify(junk, signer.sign(junk)))
+            # the key went straight to the caller, and the pool still refills
+            return self.poll(lambda: pool.get_pool_size() == 2)
+        d.addCallback(_generated)
+        return d
+
+    def test_key_generator_no_worker(self):
+        pool = keypool.KeyPool(self.poolfile, self.secret, TEST_RSA_KEY_SIZE)
+        # pretend the last worker failed, so none will be started for a while
+        pool._last_worker_failure = time.time()
+        pool.setServiceParent(self.parent)
+        kg = KeyGenerator()
+        kg.set_key_pool(pool)
+        kg.set_default_keysize(TEST_RSA_KEY_SIZE)
+        self.failIf(pool._worker)
+        d = kg.generate()
+        def _generated((verifier, signer)):
+            self.failUnlessEqual(pool.get_pool_size(), 0)
+            junk = os.urandom(42)
+            self.failUnless(verifier.verify(junk, signer.sign(junk)))
+        d.addCallback(_generated)
+        return d
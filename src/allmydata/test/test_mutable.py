@@ -18,19 +18,22 @@ from foolscap.api import eventually, fireEventually
 from foolscap.logging import log
 from allmydata.storage_client import StorageFarmBroker
 from allmydata.storage.common import storage_index_to_dir
+from allmydata.storage.server import StorageServer
 from allmydata.scripts import debug
 
 from allmydata.mutable.filenode import MutableFileNode, BackoffAgent
 from allmydata.mutable.common import \
      MODE_CHECK, MODE_ANYTHING, MODE_WRITE, MODE_READ, \
      NeedMoreDataError, UnrecoverableFileError, UncoordinatedWriteError, \
-     NotEnoughServersError, CorruptShareError
+     NotEnoughServersError, CorruptShareError, SignatureCache
+from allmydata.mutable import publish, retrieve, servermap
 from allmydata.mutable.retrieve import Retrieve
 from allmydata.mutable.publish import Publish, MutableFileHandle, \
                                       MutableData, \
                                       DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.mutable.servermap import ServerMap, ServermapUpdater
-from allmydata.mutable.layout import unpack_header, MDMFSlotReadProxy
+from allmydata.mutable.layout import unpack_header, MDMFSlotReadProxy, \
+     SlotWriteCoalescer
 from allmydata.mutable.repairer import MustForceRepairError
 
 import allmydata.test.common_util as testutil
@@ -284,6 +287,64 @@ class Filenode(unittest.TestCase, testutil.ShouldFailMixin):
         d.addCallback(_created)
         return d
 
+    def _get_segment_size(self, n):
+        d = n.get_servermap(MODE_READ)
+        d.addCallback(lambda smap: smap.best_recoverable_version()[3])
+        return d
+
+    def test_create_mdmf_with_segment_size(self):
+        contents = "segment size " * 10000 # five 30000-byte segments
+        d = self.nodemaker.create_mutable_file(MutableData(contents),
+                                               version=MDMF_VERSION,
+                                               segment_size=30000)
+        def _created(n):
+            self.n = n
+            return self._get_segment_size(n)
+        d.addCallback(_created)
+        d.addCallback(self.failUnlessEqual, 30000)
+        d.addCallback(lambda ign: self.n.download_best_version())
+        d.addCallback(self.failUnlessEqual, contents)
+        # the file keeps its segment size when it is overwritten (from a
+        # node that knows nothing of how it was created) or updated
+        d.addCallback(lambda ign:
+                      self.nodemaker.create_from_cap(self.n.get_uri()))
+        def _overwrite(n):
+            self.n = n
+            return n.overwrite(MutableData(contents * 2))
+        d.addCallback(_overwrite)
+        d.addCallback(lambda ign: self._get_segment_size(self.n))
+        d.addCallback(self.failUnlessEqual, 30000)
+        d.addCallback(lambda ign: self.n.get_best_mutable_version())
+        d.addCallback(lambda mv: mv.update(MutableData("new data"), 45000))
+        d.addCallback(lambda ign: self.n.download_best_version())
+        d.addCallback(self.failUnlessEqual,
+                      contents[:45000] + "new data" + (contents * 2)[45008:])
+        d.addCallback(lambda ign: self._get_segment_size(self.n))
+        d.addCallback(self.failUnlessEqual, 30000)
+        return d
+
+    def test_choose_segment_size(self):
+        MiB = 1024*1024
+        for (datalength, segment_size) in [(0, 128*1024),
+                                           (128*MiB, 128*1024),
+                                           (128*MiB + 1, 256*1024),
+                                           (512*MiB, 512*1024),
+                                           (1024*MiB, 1024*1024),
+                                           (64*1024*MiB, 1024*1024)]:
+            self.failUnlessEqual(publish.choose_segment_size(datalength),
+                                 segment_size, datalength)
+
+    def test_create_mdmf_adaptive_segment_size(self):
+        self.patch(publish, "ADAPTIVE_SEGMENT_COUNT", 2)
+        contents = "adaptive " * 70000 # 630000 bytes
+        d = self.nodemaker.create_mutable_file(MutableData(contents),
+                                               version=MDMF_VERSION)
+        d.addCallback(self._get_segment_size)
+        # 512 KiB, rounded up to a multiple of k=3
+        d.addCallback(self.failUnlessEqual,
+                      mathutil.next_multiple(512*1024, 3))
+        return d
+
     def test_single_share(self):
         # Make sure that we tolerate publishing a single share.
         self.nodemaker.default_encoding_parameters['k'] = 1
@@ -1103,6 +1164,116 @@ class Servermap(unittest.TestCase, PublishMixin):
         d.addCallback(lambda sm: self.failUnlessOneRecoverable(sm, 10))
         return d
 
+    def test_read_size_estimator(self):
+        # the encrypted private key of an SDMF share is at its very end,
+        # beyond the default read size, so the first MODE_WRITE update by a
+        # node without the privkey has to read each share twice. Later ones
+        # have learned how much to read, and need only one query per server.
+        # Only the first share to arrive still needs the privkey, so only it
+        # is counted as having avoided a follow-up read.
+        cap = self._fn.get_cap()
+        servers = self._storage_broker.get_connected_servers()
+        estimator = self._storage_broker.read_size_estimator
+        def _update(ign):
+            self._queries = sum([s.get_rref().queries for s in servers])
+            fn = self._nodemaker._create_mutable(cap)
+            self.failIf(fn.get_privkey())
+            smu = ServermapUpdater(fn, self._storage_broker, Monitor(),
+                                   ServerMap(), MODE_WRITE)
+            d = smu.update()
+            def _updated(sm):
+                self.failUnlessOneRecoverable(sm, 10)
+                self.failUnless(fn.get_privkey())
+                queries = sum([s.get_rref().queries for s in servers])
+                return (queries - self._queries,
+                        smu.get_status().get_follow_up_reads())
+            d.addCallback(_updated)
+            return d
+        d = _update(None)
+        d.addCallback(lambda res: self.failUnlessEqual(res, (20, (10, 0))))
+        d.addCallback(_update)
+        d.addCallback(lambda res: self.failUnlessEqual(res, (10, (0, 1))))
+        d.addCallback(lambda ign:
+            self.failUnlessEqual(estimator.get_stats(),
+                                 {"shares": 20,
+                                  "follow_up_reads": 10,
+                                  "follow_up_reads_avoided": 1}))
+        return d
+
+    def test_read_size_estimator_format(self):
+        # the estimates are kept by the format of the shares themselves,
+        # even when the filenode is wrong about it
+        cap = self._fn.get_cap()
+        estimator = self._storage_broker.read_size_estimator
+        fn = self._nodemaker._create_mutable(cap)
+        fn.get_version = lambda: MDMF_VERSION
+        smu = ServermapUpdater(fn, self._storage_broker, Monitor(),
+                               ServerMap(), MODE_WRITE)
+        d = smu.update()
+        def _updated(sm):
+            self.failUnlessEqual(sm.get_share_format(), SDMF_VERSION)
+            self.failUnless(estimator._needed)
+            self.failUnlessEqual(set([fmt for (fmt, need_pubkey, need_privkey)
+                                      in estimator._needed]),
+                                 set([SDMF_VERSION]))
+            # an update that has not seen a share yet uses what was learned
+            # about any format, and one that has uses only its own format
+            needed = estimator.get_read_size((SDMF_VERSION, True, True), 1000)
+            self.failUnless(needed > 1000, needed)
+            self.failUnlessEqual(estimator.get_read_size((None, True, True),
+                                                         1000), needed)
+            self.failUnlessEqual(estimator.get_read_size((MDMF_VERSION,
+                                                          True, True), 1000),
+                                 1000)
+        d.addCallback(_updated)
+        return d
+
+
+    def test_signature_cache(self):
+        # every share of a version has the same signature, and once it has
+        # been verified, later updates by other nodes don't verify it again.
+        cache = SignatureCache()
+        self.patch(servermap, "signature_cache", cache)
+        cap = self._fn.get_cap()
+        def _update(ign, mode=MODE_READ):
+            return self.make_servermap(mode,
+                                       self._nodemaker._create_mutable(cap))
+        d = _update(None)
+        d.addCallback(lambda sm: self.failUnlessOneRecoverable(sm, 6))
+        d.addCallback(lambda ign:
+            self.failUnlessEqual(cache.get_stats(), {"hits": 0, "misses": 1}))
+        d.addCallback(_update)
+        d.addCallback(lambda ign:
+            self.failUnlessEqual(cache.get_stats(), {"hits": 1, "misses": 1}))
+        # a share with a bad signature is still caught
+        d.addCallback(corrupt, self._storage, "signature", [0])
+        d.addCallback(_update, MODE_CHECK)
+        d.addCallback(lambda sm: self.failUnlessOneRecoverable(sm, 9))
+        return d
+
+    def test_signature_cache_size(self):
+        class FakePubkey:
+            verifies = 0
+            def verify(self, prefix, signature):
+                self.verifies += 1
+                return signature == "good"
+        pubkey = FakePubkey()
+        cache = SignatureCache()
+        cache.MAX_ENTRIES = 2
+        self.failIf(cache.verify(pubkey, "fp", "prefix1", "bad"))
+        self.failIf(cache.verify(pubkey, "fp", "prefix1", "bad"))
+        self.failUnlessEqual(pubkey.verifies, 2)
+        for prefix in ["prefix1", "prefix2", "prefix1", "prefix3"]:
+            self.failUnless(cache.verify(pubkey, "fp", prefix, "good"))
+        self.failUnlessEqual(pubkey.verifies, 5)
+        # prefix2 was the least recently used, so it was forgotten
+        self.failUnless(cache.verify(pubkey, "fp", "prefix1", "good"))
+        self.failUnlessEqual(pubkey.verifies, 5)
+        self.failUnless(cache.verify(pubkey, "fp", "prefix2", "good"))
+        self.failUnlessEqual(pubkey.verifies, 6)
+        # and a different key has to be checked separately
+        self.failUnless(cache.verify(pubkey, "fp2", "prefix2", "good"))
+        self.failUnlessEqual(pubkey.verifies, 7)
 
     def test_mark_bad(self):
         d = defer.succeed(None)
@@ -3697,6 +3868,92 @@ class Update(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
         d0.addCallback(_run)
         return d0
 
+    def _count_reads(self):
+        self.reads = 0
+        original = StorageServer.remote_slot_readv
+        def _slot_readv(ss, storage_index, shares, readv):
+            self.reads += 1
+            return original(ss, storage_index, shares, readv)
+        self.patch(StorageServer, "remote_slot_readv", _slot_readv)
+
+    def _update_and_count_reads(self, node, offset, new_data):
+        d = node.get_best_mutable_version()
+        def _update(mv):
+            self.reads = 0
+            return mv.update(MutableData(new_data), offset)
+        d.addCallback(_update)
+        d.addCallback(lambda ign: self.reads)
+        return d
+
+    def test_update_uses_last_publish(self):
+        # right after we publish a version, we know everything that an
+        # in-place update of it needs, so it doesn't have to read anything
+        self._count_reads()
+        segsize = mathutil.next_multiple(DEFAULT_MAX_SEGMENT_SIZE, 3)
+        expected = [self.data]
+        def _replace(offset, new_data):
+            old = expected[0]
+            expected[0] = (old[:offset] + new_data +
+                           old[offset+len(new_data):])
+            return self._update_and_count_reads(self.n, offset, new_data)
+        d = self.nm.create_mutable_file(MutableData(self.data),
+                                        version=MDMF_VERSION)
+        def _created(n):
+            self.n = n
+            # whole segments
+            return _replace(2*segsize, "a" * segsize)
+        d.addCallback(_created)
+        d.addCallback(lambda reads: self.failUnlessEqual(reads, 0))
+        # part of the segment that we just wrote
+        d.addCallback(lambda ign: _replace(2*segsize + 10, "b" * 100))
+        d.addCallback(lambda reads: self.failUnlessEqual(reads, 0))
+        # part of a segment that we don't have
+        d.addCallback(lambda ign: _replace(10, "c" * 100))
+        d.addCallback(lambda reads: self.failIfEqual(reads, 0))
+        d.addCallback(lambda ign: self.n.download_best_version())
+        d.addCallback(lambda data: self.failUnlessEqual(data, expected[0]))
+        return d
+
+    def test_update_without_last_publish(self):
+        self._count_reads()
+        d = self.nm.create_mutable_file(MutableData(self.data),
+                                        version=MDMF_VERSION)
+        def _created(n):
+            self.n = n
+            # as though the file had been written by someone else
+            n._update_cache = None
+            return self._update_and_count_reads(n, 0, "replaced")
+        d.addCallback(_created)
+        d.addCallback(lambda reads: self.failIfEqual(reads, 0))
+        d.addCallback(lambda ign: self.n.download_best_version())
+        d.addCallback(lambda data:
+                      self.failUnlessEqual(data,
+                                           "replaced" + self.data[8:]))
+        return d
+
+    def test_update_after_uncoordinated_write(self):
+        d = self.nm.create_mutable_file(MutableData(self.data),
+                                        version=MDMF_VERSION)
+        def _created(n):
+            self.n = n
+            return n.get_best_mutable_version()
+        d.addCallback(_created)
+        def _got_version(mv):
+            self.mv = mv
+            # another node for the same file (as another client would have)
+            # changes it after we've looked at it
+            n2 = self.nm._create_mutable(self.n.get_cap())
+            return n2.overwrite(MutableData("other data"))
+        d.addCallback(_got_version)
+        # our update must not clobber it without noticing
+        d.addCallback(lambda ign:
+                      self.shouldFail(UncoordinatedWriteError,
+                                      "update_after_uncoordinated_write",
+                                      None,
+                                      self.mv.update, MutableData("x"), 0))
+        return d
+
+
 class Interoperability(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
     sdmf_old_shares = {}
     sdmf_old_shares[0] = "VGFob2UgbXV0YWJsZSBjb250YWluZXIgdjEKdQlEA47ESLbTdKdpLJXCpBxd5OH239tl5hvAiz1dvGdE5rIOpf8cbfxbPcwNF+Y5dM92uBVbmV6KAAAAAAAAB/wAAAAAAAAJ0AAAAAFOWSw7jSx7WXzaMpdleJYXwYsRCV82jNA5oex9m2YhXSnb2POh+vvC1LE1NAfRc9GOb2zQG84Xdsx1Jub2brEeKkyt0sRIttN0p2kslcKkHF3k4fbf22XmAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABamJprL6ecrsOoFKdrXUmWveLq8nzEGDOjFnyK9detI3noX3uyK2MwSnFdAfyN0tuAwoAAAAAAAAAFQAAAAAAAAAVAAABjwAAAo8AAAMXAAADNwAAAAAAAAM+AAAAAAAAB/wwggEgMA0GCSqGSIb3DQEBAQUAA4IBDQAwggEIAoIBAQC1IkainlJF12IBXBQdpRK1zXB7a26vuEYqRmQM09YjC6sQjCs0F2ICk8n9m/2Kw4l16eIEboB2Au9pODCE+u/dEAakEFh4qidTMn61rbGUbsLK8xzuWNW22ezzz9/nPia0HDrulXt51/FYtfnnAuD1RJGXJv/8tDllE9FL/18TzlH4WuB6Fp8FTgv7QdbZAfWJHDGFIpVCJr1XxOCsSZNFJIqGwZnD2lsChiWw5OJDbKd8otqN1hIbfHyMyfMOJ/BzRzvZXaUt4Dv5nf93EmQDWClxShRwpuX/NkZ5B2K9OFonFTbOCexm/MjMAdCBqebKKaiHFkiknUCn9eJQpZ5bAgERgV50VKj+AVTDfgTpqfO2vfo4wrufi6ZBb8QV7hllhUFBjYogQ9C96dnS7skv0s+cqFuUjwMILr5/rsbEmEMGvl0T0ytyAbtlXuowEFVj/YORNknM4yjY72YUtEPTlMpk0Cis7aIgTvu5qWMPER26PMApZuRqiwRsGIkaJIvOVOTHHjFYe3/YzdMkc7OZtqRMfQLtwVl2/zKQQV8b/a9vaT6q3mRLRd4P3esaAFe/+7sR/t+9tmB+a8kxtKM6kmaVQJMbXJZ4aoHGfeLX0m35Rcvu2Bmph7QfSDjk/eaE3q55zYSoGWShmlhlw4Kwg84sMuhmcVhLvo0LovR8bKmbdgACtTh7+7gs/l5w1lOkgbF6w7rkXLNslK7L2KYF4SPFLUcABOOLy8EETxh7h7/z9d62EiPu9CNpRrCOLxUhn+JUS+DuAAhgcAb/adrQFrhlrRNoRpvjDuxmFebA4F0qCyqWssm61AAQ/EX4eC/1+hGOQ/h4EiKUkqxdsfzdcPlDvd11SGWZ0VHsUclZChTzuBAU2zLTXm+cG8IFhO50ly6Ey/DB44NtMKVaVzO0nU8DE0Wua7Lx6Bnad5n91qmHAnwSEJE5YIhQM634omd6cq9Wk4seJCUIn+ucoknrpxp0IR9QMxpKSMRHRUg2K8ZegnY3YqFunRZKCfsq9ufQEKgjZN12AFqi551KPBdn4/3V5HK6xTv0P4robSsE/BvuIfByvRf/W7ZrDx+CFC4EEcsBOACOZCrkhhqd5TkYKbe9RA+vs56+9N5qZGurkxcoKviiyEncxvTuShD65DK/6x6kMDMgQv/EdZDI3x9GtHTnRBYXwDGnPJ19w+q2zC3e2XarbxTGYQIPEC5mYx0gAA0sbjf018NGfwBhl6SB54iGsa8uLvR3jHv6OSRJgwxL6j7P0Ts4Hv2EtO12P0Lv21pwi3JC1O/WviSrKCvrQD5lMHL9Uym3hwFi2zu0mqwZvxOAbGy7kfOPXkLYKOHTZLthzKj3PsdjeceWBfYIvPGKYcd6wDr36d1aXSYS4IWeApTS2AQ2lu0DUcgSefAvsA8NkgOklvJY1cjTMSg6j6cxQo48Bvl8RAWGLbr4h2S/8KwDGxwLsSv0Gop/gnFc3GzCsmL0EkEyHHWkCA8YRXCghfW80KLDV495ff7yF5oiwK56GniqowZ3RG9Jxp5MXoJQgsLV1VMQFMAmsY69yz8eoxRH3wl9L0dMyndLulhWWzNwPMQ2I0yAWdzA/pksVmwTJTFenB3MHCiWc5rEwJ3yofe6NZZnZQrYyL9r1TNnVwfTwRUiykPiLSk4x9Mi6DX7RamDAxc8u3gDVfjPsTOTagBOEGUWlGAL54KE/E6sgCQ5DEAt12chk8AxbjBFLPgV+/idrzS0lZHOL+IVBI9D0i3Bq1yZcSIqcjZB0M3IbxbPm4gLAYOWEiTUN2ecsEHHg9nt6rhgffVoqSbCCFPbpC0xf7WOC3+BQORIZECOCC7cUAciXq3xn+GuxpFE40RWRJeKAK7bBQ21X89ABIXlQFkFddZ9kRvlZ2Pnl0oeF+2pjnZu0Yc2czNfZEQF2P7BKIdLrgMgxG89snxAY8qAYTCKyQw6xTG87wkjDcpy1wzsZLP3WsOuO7cAm7b27xU0jRKq8Cw4d1hDoyRG+RdS53F8RFJzVMaNNYgxU2tfRwUvXpTRXiOheeRVvh25+YGVnjakUXjx/dSDnOw4ETHGHD+7styDkeSfc3BdSZxswzc6OehgMI+xsCxeeRym15QUm9hxvg8X7Bfz/0WulgFwgzrm11TVynZYOmvyHpiZKoqQyQyKahIrfhwuchCr7lMsZ4a+umIkNkKxCLZnI+T7jd+eGFMgKItjz3kTTxRl3IhaJG3LbPmwRUJynMxQKdMi4Uf0qy0U7+i8hIJ9m50QXc+3tw2bwDSbx22XYJ9Wf14gxx5G5SPTb1JVCbhe4fxNt91xIxCow2zk62tzbYfRe6dfmDmgYHkv2PIEtMJZK8iKLDjFfu2ZUxsKT2A5g1q17og6o9MeXeuFS3mzJXJYFQZd+3UzlFR9qwkFkby9mg5y4XSeMvRLOHPt/H/r5SpEqBE6a9MadZYt61FBV152CUEzd43ihXtrAa0XH9HdsiySBcWI1SpM3mv9rRP0DiLjMUzHw/K1D8TE2f07zW4t/9kvE11tFj/NpICixQAAAAA="
@@ -3765,3 +4022,255 @@ class DifferentEncoding(unittest.TestCase):
             return "new contents"
         d.addCallback(lambda n: n.modify(modifier))
         return d
+
+class PipelinedPublish(GridTestMixin, unittest.TestCase):
+    def setUp(self):
+        GridTestMixin.setUp(self)
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c = self.g.clients[0]
+        self.nm = self.c.nodemaker
+        # seven segments, sent two at a time (the segment size is rounded
+        # up to a multiple of k, so leave some room for that)
+        self.data = "pipelined publish " * 50000
+        self.patch(publish, "PUBLISH_WINDOW_SIZE",
+                   2*DEFAULT_MAX_SEGMENT_SIZE + 100)
+        self.writes = []
+        original = StorageServer.remote_slot_testv_and_readv_and_writev
+        def _count_writes(ss, storage_index, secrets, tw_vectors, read_vector):
+            self.writes.extend(tw_vectors.keys())
+            return original(ss, storage_index, secrets, tw_vectors,
+                            read_vector)
+        self.patch(StorageServer, "remote_slot_testv_and_readv_and_writev",
+                   _count_writes)
+
+    def test_new_shares_are_sent_a_window_at_a_time(self):
+        d = self.nm.create_mutable_file(MutableData(self.data),
+                                        version=MDMF_VERSION)
+        def _created(n):
+            self.n = n
+            # three windows of two segments each, then the last segment
+            # along with everything else
+            self.failUnlessEqual(sorted(self.writes),
+                                 sorted(range(10) * 4))
+            ps = list(self.c.get_history().list_all_publish_statuses())[-1]
+            self.failUnlessIn("send_blocks", ps.timings)
+            self.failUnlessIn("wait_for_blocks", ps.timings)
+            return n.download_best_version()
+        d.addCallback(_created)
+        d.addCallback(lambda data: self.failUnlessEqual(data, self.data))
+        return d
+
+    def test_existing_shares_are_written_at_once(self):
+        d = self.nm.create_mutable_file(MutableData("small"),
+                                        version=MDMF_VERSION)
+        def _created(n):
+            self.n = n
+            del self.writes[:]
+            return n.overwrite(MutableData(self.data))
+        d.addCallback(_created)
+        def _overwritten(ign):
+            # the old version must stay readable until the new one replaces
+            # it, so each share is written in a single operation
+            self.failUnlessEqual(sorted(self.writes), range(10))
+            return self.n.download_best_version()
+        d.addCallback(_overwritten)
+        d.addCallback(lambda data: self.failUnlessEqual(data, self.data))
+        return d
+
+class WindowWatchingConsumer(MemoryConsumer):
+    # remembers which segments had been asked for by the time of each write,
+    # and pauses the producer after the first one
+    def __init__(self, requested):
+        MemoryConsumer.__init__(self)
+        self.requested = requested
+        self.requested_at_write = []
+        self.paused = None
+    def write(self, data):
+        self.requested_at_write.append(sorted(self.requested))
+        if self.paused is None:
+            self.producer.pauseProducing()
+            self.paused = fireEventually()
+            self.paused.addCallback(fireEventually)
+            self.paused.addCallback(self._unpause)
+        return MemoryConsumer.write(self, data)
+    def _unpause(self, ign):
+        # nothing more was asked for while we were paused
+        self.requested_at_unpause = sorted(self.requested)
+        self.producer.resumeProducing()
+
+class PipelinedRetrieve(GridTestMixin, unittest.TestCase):
+    def setUp(self):
+        GridTestMixin.setUp(self)
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.nm = self.g.clients[0].nodemaker
+        # eight segments, fetched up to three at a time
+        self.data = "pipelined retrieve " * 50000
+        self.patch(retrieve, "RETRIEVE_WINDOW_SIZE",
+                   3*DEFAULT_MAX_SEGMENT_SIZE + 100)
+
+    def _watch_reads(self):
+        self.requested = []
+        self.hash_fetches = []
+        original_get_block = MDMFSlotReadProxy.get_block_and_salt
+        def _get_block_and_salt(reader, segnum):
+            self.requested.append(segnum)
+            return original_get_block(reader, segnum)
+        self.patch(MDMFSlotReadProxy, "get_block_and_salt",
+                   _get_block_and_salt)
+        original_get_hashes = MDMFSlotReadProxy.get_blockhashes
+        def _get_blockhashes(reader, needed=None, force_remote=False):
+            if needed:
+                self.hash_fetches.append(reader.shnum)
+            return original_get_hashes(reader, needed, force_remote)
+        self.patch(MDMFSlotReadProxy, "get_blockhashes", _get_blockhashes)
+
+    def test_segments_in_flight(self):
+        d = self.nm.create_mutable_file(MutableData(self.data),
+                                        version=MDMF_VERSION)
+        d.addCallback(lambda n: n.get_best_readable_version())
+        def _read(version):
+            self._watch_reads()
+            self.c = WindowWatchingConsumer(self.requested)
+            return version.read(self.c)
+        d.addCallback(_read)
+        def _check(ign):
+            self.failUnlessEqual("".join(self.c.chunks), self.data)
+            # k=3 blocks of the first three segments were asked for before
+            # the first one was delivered, and nothing else until we
+            # resumed
+            self.failUnlessEqual(self.c.requested_at_write[0],
+                                 sorted(range(3) * 3))
+            self.failUnlessEqual(self.c.requested_at_unpause,
+                                 sorted(range(3) * 3))
+            self.failUnlessEqual(self.c.requested_at_write[1],
+                                 sorted(range(4) * 3))
+            self.failUnlessEqual(sorted(self.requested), sorted(range(8) * 3))
+            # the segments in flight shared one fetch of each block hash tree
+            self.failUnlessEqual(sorted(self.hash_fetches),
+                                 sorted(set(self.hash_fetches)))
+        d.addCallback(_check)
+        return d
+
+    def test_partial_read(self):
+        d = self.nm.create_mutable_file(MutableData(self.data),
+                                        version=MDMF_VERSION)
+        d.addCallback(lambda n: n.get_best_readable_version())
+        def _read(version):
+            self._watch_reads()
+            self.c = MemoryConsumer()
+            return version.read(self.c, 2*DEFAULT_MAX_SEGMENT_SIZE + 10,
+                                DEFAULT_MAX_SEGMENT_SIZE)
+        d.addCallback(_read)
+        def _check(ign):
+            start = 2*DEFAULT_MAX_SEGMENT_SIZE + 10
+            self.failUnlessEqual("".join(self.c.chunks),
+                                 self.data[start:start +
+                                           DEFAULT_MAX_SEGMENT_SIZE])
+            # we never fetch beyond the range that was asked for
+            self.failUnlessEqual(sorted(set(self.requested)), [2, 3])
+        d.addCallback(_check)
+        return d
+
+    def test_bad_block_in_window(self):
+        d = self.nm.create_mutable_file(MutableData(self.data),
+                                        version=MDMF_VERSION)
+        d.addCallback(lambda n: n.get_best_readable_version())
+        def _read(version):
+            self._watch_reads()
+            # share 0 is one of the first ones used. Give it a bad block for
+            # a segment that is fetched while earlier ones are in flight.
+            get_block_and_salt = MDMFSlotReadProxy.get_block_and_salt
+            def _corrupt_block(reader, segnum):
+                d = get_block_and_salt(reader, segnum)
+                if reader.shnum == 0 and segnum == 2:
+                    d.addCallback(lambda (block, salt):
+                                  ("x" + block[1:], salt))
+                return d
+            self.patch(MDMFSlotReadProxy, "get_block_and_salt",
+                       _corrupt_block)
+            self.c = MemoryConsumer()
+            return version.read(self.c)
+        d.addCallback(_read)
+        def _check(ign):
+            self.failUnlessEqual("".join(self.c.chunks), self.data)
+            # only the block of segment 2 that was bad was fetched again,
+            # from a replacement for share 0: the other two had validated
+            self.failUnlessEqual(self.requested.count(2), 4)
+        d.addCallback(_check)
+        return d
+
+class RecordingRref:
+    def __init__(self):
+        self.calls = []
+    def callRemote(self, methname, *args):
+        self.calls.append((methname, args))
+        return defer.succeed(len(self.calls))
+
+class WriteCoalescing(GridTestMixin, unittest.TestCase):
+    def test_coalescer(self):
+        rref = RecordingRref()
+        c = SlotWriteCoalescer(rref)
+        readv = [(0, 41)]
+        ds = [c.callRemote("slot_testv_and_readv_and_writev", "si", "secrets",
+                           {0: ([], [(0, "a")], None)}, readv),
+              c.callRemote("slot_testv_and_readv_and_writev", "si", "secrets",
+                           {1: ([], [(0, "b")], None)}, readv),
+              # a second write to share 0 must not overtake the first
+              c.callRemote("slot_testv_and_readv_and_writev", "si", "secrets",
+                           {0: ([], [(1, "c")], None)}, readv),
+              # and a different read vector can't share a call
+              c.callRemote("slot_testv_and_readv_and_writev", "si", "secrets",
+                           {2: ([], [(0, "d")], None)}, [(0, 1)]),
+              ]
+        # other methods are not held back
+        c.callRemote("slot_readv", "si", [], [(0, 1)])
+        self.failUnlessEqual(rref.calls, [("slot_readv",
+                                           ("si", [], [(0, 1)]))])
+        d = gatherResults(ds)
+        def _check(answers):
+            self.failUnlessEqual(answers, [2, 2, 3, 4])
+            self.failUnlessEqual([args[2] for (methname, args)
+                                  in rref.calls[1:]],
+                                 [{0: ([], [(0, "a")], None),
+                                   1: ([], [(0, "b")], None)},
+                                  {0: ([], [(1, "c")], None)},
+                                  {2: ([], [(0, "d")], None)}])
+        d.addCallback(_check)
+        return d
+
+    def test_one_write_per_server(self):
+        self.basedir = "mutable/WriteCoalescing/one_write_per_server"
+        self.set_up_grid(num_servers=3)
+        nm = self.g.clients[0].nodemaker
+        self.patch(publish, "PUBLISH_WINDOW_SIZE",
+                   2*DEFAULT_MAX_SEGMENT_SIZE + 100)
+        self.writes = []
+        original = StorageServer.remote_slot_testv_and_readv_and_writev
+        def _count_writes(ss, storage_index, secrets, tw_vectors, read_vector):
+            self.writes.append((ss, sorted(tw_vectors.keys())))
+            return original(ss, storage_index, secrets, tw_vectors,
+                            read_vector)
+        self.patch(StorageServer, "remote_slot_testv_and_readv_and_writev",
+                   _count_writes)
+        data = "coalesced writes " * 50000 # seven segments
+        d = nm.create_mutable_file(MutableData(data), version=MDMF_VERSION)
+        def _created(n):
+            # ten shares on three servers: each server gets one call per
+            # window of blocks, plus one to finish, covering all its shares
+            servers = set([ss for (ss, shnums) in self.writes])
+            self.failUnlessEqual(len(servers), 3)
+            self.failUnlessEqual(len(self.writes), 3*4)
+            shnums = sum([shnums for (ss, shnums) in self.writes], [])
+            self.failUnlessEqual(sorted(shnums), sorted(range(10) * 4))
+            del self.writes[:]
+            self.n = n
+            return n.overwrite(MutableData(data + "more"))
+        d.addCallback(_created)
+        def _overwritten(ign):
+            self.failUnlessEqual(len(self.writes), 3)
+            return self.n.download_best_version()
+        d.addCallback(_overwritten)
+        d.addCallback(lambda res: self.failUnlessEqual(res, data + "more"))
+        return d
@@ -5,6 +5,7 @@ import mock
 from twisted.trial import unittest
 
 from twisted.internet import defer
+from twisted.python import threadable
 from twisted.application import service
 from foolscap.api import fireEventually
 import itertools
@@ -12,12 +13,16 @@ from allmydata import interfaces
 from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format
 from allmydata.storage.server import StorageServer
 from allmydata.storage.mutable import MutableShareFile
-from allmydata.storage.immutable import BucketWriter, BucketReader
+from allmydata.storage import immutable
+from allmydata.storage.immutable import BucketWriter, BucketReader, ShareFile
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
-     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
+     si_b2a
 from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.readcache import ReadvCache
 from allmydata.storage.crawler import BucketCountingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.inventory import empty_counts
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
 from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
@@ -106,6 +111,60 @@ class Bucket(unittest.TestCase):
         self.failUnlessEqual(br.remote_read(25, 25), "b"*25)
         self.failUnlessEqual(br.remote_read(50, 7), "c"*7)
 
+    def test_write_coalescing(self):
+        incoming, final = self.make_workdir("test_write_coalescing")
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary())
+        bw.write_buffer_size = 60
+        sf = ShareFile(incoming)
+        # adjacent writes are held back until the buffer fills
+        bw.remote_write(0, "a"*25)
+        bw.remote_write(25, "b"*25)
+        self.failUnlessEqual(sf.read_share_data(0, 50), "\x00"*50)
+        bw.remote_write(50, "c"*25)
+        self.failUnlessEqual(sf.read_share_data(0, 75),
+                             "a"*25 + "b"*25 + "c"*25)
+        # a write somewhere else pushes out what is buffered
+        bw.remote_write(75, "d"*10)
+        bw.remote_write(150, "e"*10)
+        self.failUnlessEqual(sf.read_share_data(75, 10), "d"*10)
+        self.failUnlessEqual(sf.read_share_data(150, 10), "\x00"*10)
+        # writes that are too large are refused right away
+        self.failUnlessRaises(DataTooLargeError, bw.remote_write, 190, "f"*20)
+        bw.remote_close()
+        br = BucketReader(self, bw.finalhome)
+        self.failUnlessEqual(br.remote_read(0, 85),
+                             "a"*25 + "b"*25 + "c"*25 + "d"*10)
+        self.failUnlessEqual(br.remote_read(150, 10), "e"*10)
+
+    def _count_syncs(self, name, durability, sizes):
+        incoming, final = self.make_workdir(name)
+        syncs = []
+        self.patch(os, "fsync", lambda fd: syncs.append("fsync"))
+        self.patch(immutable, "_fdatasync",
+                   lambda fd: syncs.append("fdatasync"))
+        bw = BucketWriter(self, incoming, final, 1000, self.make_lease(),
+                          FakeCanary(), durability)
+        bw.write_buffer_size = 100
+        bw.sync_batch_size = 300
+        offset = 0
+        for size in sizes:
+            bw.remote_write(offset, "a"*size)
+            offset += size
+        bw.remote_close()
+        return syncs
+
+    def test_durability(self):
+        sizes = [100] * 7
+        self.failUnlessEqual(self._count_syncs("test_durability_none",
+                                               "none", sizes), [])
+        self.failUnlessEqual(self._count_syncs("test_durability_fsync",
+                                               "fsync", sizes), ["fsync"])
+        # one batch after 300 bytes, another after 600, then one at close
+        self.failUnlessEqual(self._count_syncs("test_durability_fdatasync",
+                                               "fdatasync", sizes),
+                             ["fdatasync"] * 3)
+
     def test_read_past_end_of_share_data(self):
         # test vector for immutable files (hard-coded contents of an immutable share
         # file):
@@ -516,7 +575,10 @@ class Server(unittest.TestCase):
             }
 
         ss = self.create("test_reserved_space", reserved_space=reserved_space)
-        # 15k available, 10k reserved, leaves 5k for shares
+        # 15k available, 10k reserved, leaves 5k for shares. The server
+        # normally reuses its disk stats for a while: ask the (mock) OS
+        # every time instead.
+        ss.sharedirs[0].disk_stats_interval = 0
 
         # a newly created and filled share incurs this much overhead, beyond
         # the size we request.
@@ -573,6 +635,57 @@ class Server(unittest.TestCase):
         ss.disownServiceParent()
         del ss
 
+    @mock.patch('allmydata.util.fileutil.get_disk_stats')
+    def test_space_accounting(self, mock_get_disk_stats):
+        mock_get_disk_stats.return_value = {
+            'total': 20000,
+            'used': 5000,
+            'free_for_root': 15000,
+            'free_for_nonroot': 15000,
+            'avail': 15000,
+            }
+        ss = self.create("test_space_accounting")
+        sd = ss.sharedirs[0]
+        self.failUnlessEqual(ss.get_available_space(), 15000)
+        calls = mock_get_disk_stats.call_count
+
+        already,writers = self.allocate(ss, "vid1", [0,1,2], 1000,
+                                        FakeCanary(True))
+        self.failUnlessEqual(ss.allocated_size(), 3000)
+        self.failUnlessEqual((sd.uploads, sd.allocated), (3, 3000))
+        # admission checks reuse the disk stats instead of asking the OS
+        self.failUnlessEqual(mock_get_disk_stats.call_count, calls)
+
+        # closing a share releases its allocation, and the bytes it wrote
+        # are taken off the cached disk stats
+        writers[0].remote_write(0, "a"*25)
+        writers[0].remote_close()
+        consumed = os.path.getsize(writers[0].finalhome)
+        self.failUnlessEqual((sd.uploads, sd.allocated), (2, 2000))
+        disk = sd.get_disk_stats()
+        self.failUnlessEqual(disk['used'], 5000 + consumed)
+        self.failUnlessEqual(disk['avail'], 15000 - consumed)
+        self.failUnlessEqual(ss.get_available_space(), 15000 - consumed)
+        self.failUnlessEqual(mock_get_disk_stats.call_count, calls)
+
+        # abandoned writers release their allocations too
+        del already, writers
+        self.failUnlessEqual(ss.allocated_size(), 0)
+        self.failUnlessEqual((sd.uploads, sd.allocated), (0, 0))
+
+        # once the stats are old enough, the OS is asked again
+        sd.disk_stats_interval = 0
+        self.failUnlessEqual(ss.get_available_space(), 15000)
+        self.failUnlessEqual(mock_get_disk_stats.call_count, calls+1)
+
+        usage = ss.get_space_usage()
+        self.failUnlessEqual(usage["allocated"], 0)
+        self.failUnlessEqual(usage["available"], 15000)
+        self.failUnlessEqual(usage["disk"]["total"], 20000)
+        self.failUnlessEqual(len(usage["sharedirs"]), 1)
+        # the inventory has not counted every prefix yet
+        self.failUnlessEqual(usage["shares"], None)
+
     def test_seek(self):
         basedir = self.workdir("test_seek_behavior")
         fileutil.make_dirs(basedir)
@@ -687,6 +800,53 @@ class Server(unittest.TestCase):
         leases = list(ss.get_leases("si3"))
         self.failUnlessEqual(len(leases), 2)
 
+    def test_add_leases(self):
+        ss = self.create("test_add_leases")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('maximum-add-leases-batch-size'), sv1)
+
+        def secrets():
+            return (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                    hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+        for si in ["si0", "si1", "si2"]:
+            rs,cs = secrets()
+            already,writers = ss.remote_allocate_buckets(si, rs, cs, range(3),
+                                                         100, FakeCanary())
+            for wb in writers.values():
+                wb.remote_close()
+        # and a mutable slot
+        mutable_rs,cs = secrets()
+        answer = ss.remote_slot_testv_and_readv_and_writev("si3",
+                                                           ("we1", mutable_rs, cs),
+                                                           {0: ([], [(0, "data")], None)},
+                                                           [])
+        self.failUnlessEqual(answer, (True, {}))
+
+        batch = []
+        for si in ["si3", "si0", "si9", "si2", "si1", "si0"]:
+            rs,cs = secrets()
+            batch.append((si, rs, cs))
+        d = ss.remote_add_leases(batch)
+        def _check(res):
+            self.failUnlessEqual(res, None)
+            for si in ["si0", "si1", "si2"]:
+                leases = list(ss.get_leases(si))
+                expected = [rs for (si2, rs, cs) in batch if si2 == si]
+                self.failUnlessEqual(len(leases), 1+len(expected))
+                renew_secrets = set([l.renew_secret for l in leases])
+                for rs in expected:
+                    self.failUnlessIn(rs, renew_secrets)
+            # the storage index with no shares was ignored
+            self.failUnlessEqual(list(ss.get_leases("si9")), [])
+            msf = MutableShareFile(os.path.join(ss.sharedir,
+                                                storage_index_to_dir("si3"),
+                                                "0"))
+            renew_secrets = [l.renew_secret for l in msf.get_leases()]
+            self.failUnlessEqual(renew_secrets, [mutable_rs, batch[0][1]])
+        d.addCallback(_check)
+        return d
+
     def test_readonly(self):
         workdir = self.workdir("test_readonly")
         ss = StorageServer(workdir, "\x00" * 20, readonly_storage=True)
@@ -1358,6 +1518,201 @@ class MutableServer(unittest.TestCase):
         self.failUnless(os.path.exists(prefixdir), prefixdir)
         self.failIf(os.path.exists(bucketdir), bucketdir)
 
+    def _append_with_extra_leases(self, ss, appends):
+        # write a share that has leases in the extra-lease block, then
+        # append to it one piece at a time. Returns the share file and the
+        # list of extra-lease offsets seen after each write.
+        self.allocate(ss, "si1", "we1", self._lease_secret.next(), set([0]), 0)
+        for i in range(5):
+            ss.remote_add_lease("si1", self.renew_secret("extra%d" % i),
+                                self.cancel_secret("extra%d" % i))
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        msf = MutableShareFile(fn)
+        offsets = []
+        for i in range(appends):
+            data = chr(ord("a") + i % 26) * 1000
+            answer = writev("si1", secrets, {0: ([], [(i*1000, data)], None)},
+                            [])
+            self.failUnlessEqual(answer, (True, {0: []}))
+            f = open(fn, "rb")
+            offsets.append(msf._read_extra_lease_offset(f))
+            f.close()
+        return msf, offsets
+
+    def test_container_growth(self):
+        ss = StorageServer(self.workdir("test_container_growth"), "\x00" * 20,
+                           mutable_growth_factor=2.0)
+        ss.setServiceParent(self.sparent)
+        msf, offsets = self._append_with_extra_leases(ss, 50)
+        # the container doubled each time it grew: 1000, 2000, .. 64000
+        self.failUnlessEqual(len(set(offsets)), 7)
+        self.failUnlessEqual(len(list(msf.get_leases())), 7)
+        expected = "".join([chr(ord("a") + i % 26) * 1000 for i in range(50)])
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0, 60000)]),
+                             {0: [expected]})
+
+        # without a growth factor, the leases move on every append
+        ss = StorageServer(self.workdir("test_container_growth_default"),
+                           "\x00" * 20)
+        msf, offsets = self._append_with_extra_leases(ss, 10)
+        self.failUnlessEqual(len(set(offsets)), 10)
+
+        self.failUnlessRaises(ValueError, StorageServer,
+                              self.workdir("test_container_growth_bad"),
+                              "\x00" * 20, mutable_growth_factor=0.5)
+
+    def test_compact(self):
+        ss = StorageServer(self.workdir("test_compact"), "\x00" * 20,
+                           mutable_growth_factor=2.0)
+        ss.setServiceParent(self.sparent)
+        msf, offsets = self._append_with_extra_leases(ss, 20)
+        leases = sorted([l.renew_secret for l in msf.get_leases()])
+        old_size = os.path.getsize(msf.home)
+        # not worth it
+        self.failUnlessEqual(msf.compact(min_slack=100000), 0)
+        freed = msf.compact()
+        self.failUnlessEqual(freed, 32000 - 20000)
+        self.failUnlessEqual(os.path.getsize(msf.home), old_size - freed)
+        self.failUnlessEqual(sorted([l.renew_secret
+                                     for l in msf.get_leases()]), leases)
+        expected = "".join([chr(ord("a") + i % 26) * 1000 for i in range(20)])
+        self.failUnlessEqual(msf.readv([(0, 30000)]), [expected])
+        self.failUnlessEqual(msf.compact(), 0)
+
+        # the share can grow again afterwards
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        answer = writev("si1", secrets, {0: ([], [(20000, "z"*10)], None)}, [])
+        self.failUnlessEqual(answer, (True, {0: []}))
+        self.failUnlessEqual(msf.readv([(19999, 11)]), ["t" + "z"*10])
+        self.failUnlessEqual(sorted([l.renew_secret
+                                     for l in msf.get_leases()]), leases)
+
+        # shrinking the data leaves room that compaction gives back
+        answer = writev("si1", secrets, {0: ([], [], 5000)}, [])
+        self.failUnlessEqual(msf.compact(), 40000 - 5000)
+        self.failUnlessEqual(msf.readv([(0, 30000)]), [expected[:5000]])
+        self.failUnlessEqual(sorted([l.renew_secret
+                                     for l in msf.get_leases()]), leases)
+
+    def test_readv_cache(self):
+        ss = StorageServer(self.workdir("test_readv_cache"), "\x00" * 20,
+                           readv_cache_size=100000)
+        ss.setServiceParent(self.sparent)
+        self.allocate(ss, "si1", "we1", self._lease_secret.next(),
+                      set([0,1]), 100)
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        readv = ss.remote_slot_readv
+        answer = writev("si1", secrets, {0: ([], [(0, "a"*100)], None),
+                                         1: ([], [(0, "b"*100)], None)}, [])
+        self.failUnlessEqual(answer[0], True)
+        def stats():
+            s = ss.get_stats()
+            return (s["storage_server.readv_cache.hits"],
+                    s["storage_server.readv_cache.misses"])
+
+        self.failUnlessEqual(readv("si1", [], [(0, 10)]),
+                             {0: ["a"*10], 1: ["b"*10]})
+        self.failUnlessEqual(stats(), (0, 1))
+        # change the share behind the server's back: the next identical
+        # read is answered from memory, so it doesn't notice
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        f = open(fn, "rb+")
+        f.seek(MutableShareFile.DATA_OFFSET)
+        f.write("c"*10)
+        f.close()
+        self.failUnlessEqual(readv("si1", [], [(0, 10)]),
+                             {0: ["a"*10], 1: ["b"*10]})
+        self.failUnlessEqual(readv("si1", [1], [(0, 10)]), {1: ["b"*10]})
+        self.failUnlessEqual(stats(), (2, 1))
+        self.failUnlessEqual(ss.get_stats()["storage_server.readv_cache.hit_rate"],
+                             2.0/3)
+        # a range that hasn't been read yet comes from disk
+        self.failUnlessEqual(readv("si1", [0], [(5, 10)]), {0: ["c"*5 + "a"*5]})
+        self.failUnlessEqual(stats(), (2, 2))
+
+        # a write forgets everything about the storage index
+        answer = writev("si1", secrets, {1: ([], [(0, "d"*10)], None)}, [])
+        self.failUnlessEqual(answer[0], True)
+        self.failUnlessEqual(readv("si1", [], [(0, 10)]),
+                             {0: ["c"*10], 1: ["d"*10]})
+        self.failUnlessEqual(stats(), (2, 3))
+        # and so does deleting a share
+        writev("si1", secrets, {1: ([], [], 0)}, [])
+        self.failUnlessEqual(readv("si1", [], [(0, 10)]), {0: ["c"*10]})
+
+        # storage indexes with no shares are remembered too
+        self.failUnlessEqual(readv("si2", [], [(0, 10)]), {})
+        self.failUnlessEqual(readv("si2", [], [(0, 10)]), {})
+        self.failUnlessEqual(stats(), (3, 5))
+        self.allocate(ss, "si2", "we1", self._lease_secret.next(), set([0]), 0)
+        self.failUnlessEqual(readv("si2", [], [(0, 10)]), {0: [""]})
+
+    def test_readv_cache_disabled(self):
+        ss = self.create("test_readv_cache_disabled")
+        self.allocate(ss, "si1", "we1", self._lease_secret.next(), set([0]), 0)
+        ss.remote_slot_readv("si1", [], [(0, 10)])
+        ss.remote_slot_readv("si1", [], [(0, 10)])
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.readv_cache.hits"], 0)
+        self.failUnlessEqual(stats["storage_server.readv_cache.misses"], 0)
+        self.failIfIn("storage_server.readv_cache.hit_rate", stats)
+
+
+class ReadCache(unittest.TestCase):
+    def test_eviction(self):
+        c = ReadvCache(10000)
+        overhead = c.ENTRY_OVERHEAD + c.RANGE_OVERHEAD
+        for i in range(20):
+            c.add("si%d" % i, [0], [(0, 700)], {0: ["x"*700]})
+            self.failUnless(c.get_stats()["bytes"] <= 10000)
+        # the most recent entries survived
+        self.failUnlessEqual(c.get("si19", [], [(0, 700)]), {0: ["x"*700]})
+        self.failUnlessEqual(c.get("si0", [], [(0, 700)]), None)
+        self.failUnlessEqual(c.get_stats()["bytes"],
+                             c.get_stats()["entries"] * (overhead + 700))
+
+        # a recently used entry is kept in preference to newer ones
+        c = ReadvCache(10000)
+        c.add("si0", [0], [(0, 700)], {0: ["x"*700]})
+        for i in range(1, 20):
+            c.get("si0", [], [(0, 700)])
+            c.add("si%d" % i, [0], [(0, 700)], {0: ["x"*700]})
+        self.failUnlessEqual(c.get("si0", [], [(0, 700)]), {0: ["x"*700]})
+
+        # an entry that would take more than an eighth is not kept
+        c.add("big", [0], [(0, 2000)], {0: ["x"*2000]})
+        self.failUnlessEqual(c.get("big", [], [(0, 2000)]), None)
+
+    def test_shares_changed(self):
+        c = ReadvCache(10000)
+        c.add("si1", [0, 1], [(0, 5)], {0: ["aaaaa"]})
+        # share 1 was not read, so nothing can be answered for it
+        self.failUnlessEqual(c.get("si1", [0], [(0, 5)]), {0: ["aaaaa"]})
+        self.failUnlessEqual(c.get("si1", [], [(0, 5)]), None)
+        self.failUnlessEqual(c.get("si1", [2], [(0, 5)]), {})
+        # a different set of shares replaces what was known
+        c.add("si1", [1], [(0, 5)], {1: ["bbbbb"]})
+        self.failUnlessEqual(c.get("si1", [], [(0, 5)]), {1: ["bbbbb"]})
+        c.invalidate("si1")
+        self.failUnlessEqual(c.get("si1", [], [(0, 5)]), None)
+        self.failUnlessEqual(c.get_stats()["bytes"], 0)
+
+        # with no room, nothing is cached
+        c = ReadvCache(0)
+        c.add("si1", [0], [(0, 5)], {0: ["aaaaa"]})
+        self.failUnlessEqual(c.get("si1", [], [(0, 5)]), None)
+        self.failUnlessEqual(c.get_stats()["misses"], 0)
+
 
 class MDMFProxies(unittest.TestCase, ShouldFailMixin):
     def setUp(self):
@@ -2796,6 +3151,11 @@ class Stats(unittest.TestCase):
         ss.setServiceParent(self.sparent)
         return ss
 
+    def failUnlessClose(self, value, expected, output):
+        # percentiles are estimated to within a few percent
+        self.failUnless(abs(value - expected) <= 0.04*expected + 1,
+                        (value, expected, output))
+
     def test_latencies(self):
         ss = self.create("test_latencies")
         for i in range(10000):
@@ -2811,48 +3171,49 @@ class Stats(unittest.TestCase):
         output = ss.get_latencies()
 
         self.failUnlessEqual(sorted(output.keys()),
-                             sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
-        self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
-        self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
+                             sorted(["allocate", "renew", "cancel", "write",
+                                     "write-none", "get"]))
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnlessClose(output["allocate"]["mean"], 4999.5, output)
+        self.failUnlessClose(output["allocate"]["01_0_percentile"], 100, output)
+        self.failUnlessClose(output["allocate"]["10_0_percentile"], 1000, output)
+        self.failUnlessClose(output["allocate"]["50_0_percentile"], 5000, output)
+        self.failUnlessClose(output["allocate"]["90_0_percentile"], 9000, output)
+        self.failUnlessClose(output["allocate"]["95_0_percentile"], 9500, output)
+        self.failUnlessClose(output["allocate"]["99_0_percentile"], 9900, output)
+        self.failUnlessClose(output["allocate"]["99_9_percentile"], 9990, output)
+
+        self.failUnlessEqual(output["renew"]["samplesize"], 1000)
+        self.failUnlessClose(output["renew"]["mean"], 500, output)
+        self.failUnlessClose(output["renew"]["01_0_percentile"], 10, output)
+        self.failUnlessClose(output["renew"]["10_0_percentile"], 100, output)
+        self.failUnlessClose(output["renew"]["50_0_percentile"], 500, output)
+        self.failUnlessClose(output["renew"]["90_0_percentile"], 900, output)
+        self.failUnlessClose(output["renew"]["95_0_percentile"], 950, output)
+        self.failUnlessClose(output["renew"]["99_0_percentile"], 990, output)
+        self.failUnlessClose(output["renew"]["99_9_percentile"], 999, output)
+
+        self.failUnlessEqual(output["write"]["samplesize"], 20)
+        self.failUnlessClose(output["write"]["mean"], 9, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["write"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["write"]["90_0_percentile"] - 18) < 1, output)
-        self.failUnless(abs(output["write"]["95_0_percentile"] - 19) < 1, output)
+        self.failUnlessClose(output["write"]["10_0_percentile"], 2, output)
+        self.failUnlessClose(output["write"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["write"]["90_0_percentile"], 18, output)
+        self.failUnlessClose(output["write"]["95_0_percentile"], 19, output)
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
-        self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
+        self.failUnlessEqual(output["cancel"]["samplesize"], 10)
+        self.failUnlessClose(output["cancel"]["mean"], 9, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["cancel"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["cancel"]["90_0_percentile"] - 18) < 1, output)
+        self.failUnlessClose(output["cancel"]["10_0_percentile"], 2, output)
+        self.failUnlessClose(output["cancel"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["cancel"]["90_0_percentile"], 18, output)
         self.failUnless(output["cancel"]["95_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(output["get"]["samplesize"], 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -2862,6 +3223,387 @@ class Stats(unittest.TestCase):
         self.failUnless(output["get"]["99_0_percentile"] is None, output)
         self.failUnless(output["get"]["99_9_percentile"] is None, output)
 
+    def test_durability_latencies(self):
+        ss = StorageServer(self.workdir("test_durability_latencies"),
+                           "\x00" * 20, durability="fsync")
+        ss.add_latency("write", 1.0)
+        ss.add_latency("close", 2.0)
+        ss.add_latency("read", 3.0)
+        output = ss.get_latencies()
+        self.failUnlessEqual(sorted(output.keys()),
+                             ["close", "close-fsync", "read",
+                              "write", "write-fsync"])
+        self.failUnlessEqual(output["write-fsync"]["samplesize"], 1)
+        self.failUnlessEqual(output["close-fsync"]["samplesize"], 1)
+        self.failIfIn("write-none", ss.latencies)
+        self.failUnlessRaises(ValueError, StorageServer,
+                              self.workdir("test_durability_bad"),
+                              "\x00" * 20, durability="sometimes")
+
+    def test_latency_windows(self):
+        ss = self.create("test_latency_windows")
+        now = time.time()
+        self.patch(time, "time", lambda: now)
+        ss.add_latency("readv", 1.0)
+        now += 3*60
+        ss.add_latency("readv", 2.0)
+        ss.add_latency("readv", 3.0)
+        self.failUnlessEqual(ss.get_latencies(60)["readv"]["samplesize"], 2)
+        self.failUnlessEqual(ss.get_latencies(3600)["readv"]["samplesize"], 3)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.latencies.readv.samplesize"], 3)
+        self.failUnlessEqual(stats["storage_server.latencies_1m.readv.samplesize"], 2)
+        self.failUnlessEqual(stats["storage_server.latencies_5m.readv.samplesize"], 3)
+        self.failUnlessEqual(stats["storage_server.latencies_1h.readv.mean"], 2.0)
+        # the unsuffixed names cover the last hour
+        now += 10*60
+        stats = ss.get_stats()
+        self.failIfIn("storage_server.latencies_5m.readv.samplesize", stats)
+        self.failUnlessEqual(stats["storage_server.latencies.readv.samplesize"], 3)
+        self.failUnlessEqual(ss.get_latencies()["readv"]["samplesize"], 3)
+        now += 2*60*60
+        self.failIfIn("readv", ss.get_latencies(3600))
+
+class IOThreads(unittest.TestCase, ShouldFailMixin):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "IOThreads", name)
+        return basedir
+
+    def create(self, name):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, "\x00" * 20, io_threads=2)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        rs, cs = hashutil.tagged_hash("blah", "1"), hashutil.tagged_hash("blah", "2")
+        canary = FakeCanary()
+        d = ss.remote_allocate_buckets("si1", rs, cs, set([0, 1]), 100, canary)
+        def _allocated((already, writers)):
+            self.failUnlessEqual(already, set())
+            self.failUnlessEqual(set(writers.keys()), set([0, 1]))
+            dl = []
+            for shnum, bw in writers.items():
+                # these are queued up without waiting for each other
+                bw.remote_write(0, "a"*25)
+                bw.remote_write(25, "b"*25)
+                bw.remote_write(75, "d"*25) # not adjacent: flushes
+                dl.append(defer.maybeDeferred(bw.remote_close))
+            return defer.DeferredList(dl, fireOnOneErrback=True)
+        d.addCallback(_allocated)
+        d.addCallback(lambda ign: self.failUnlessEqual(ss.allocated_size(), 0))
+        d.addCallback(lambda ign: ss.remote_get_buckets("si1"))
+        def _got(readers):
+            self.failUnlessEqual(set(readers.keys()), set([0, 1]))
+            return readers[1].remote_read(0, 100)
+        d.addCallback(_got)
+        d.addCallback(lambda data:
+                      self.failUnlessEqual(data, "a"*25 + "b"*25 + "\x00"*25
+                                           + "d"*25))
+        # a second allocation sees the shares, and renews their leases
+        d.addCallback(lambda ign:
+                      ss.remote_allocate_buckets("si1", rs, cs, set([0, 1, 2]),
+                                                 100, canary))
+        def _allocated_again((already, writers)):
+            self.failUnlessEqual(already, set([0, 1]))
+            self.failUnlessEqual(writers.keys(), [2])
+            return writers[2].remote_abort()
+        d.addCallback(_allocated_again)
+        d.addCallback(lambda ign: ss.remote_renew_lease("si1", rs))
+        d.addCallback(lambda ign:
+                      self.shouldFail(IndexError, "renew", None,
+                                      ss.remote_renew_lease, "si2", rs))
+        return d
+
+    def test_mutable_writes_are_ordered(self):
+        ss = self.create("test_mutable_writes_are_ordered")
+        secrets = (hashutil.tagged_hash("we", "1"),
+                   hashutil.tagged_hash("renew", "1"),
+                   hashutil.tagged_hash("cancel", "1"))
+        data = "".join([chr(ord("a") + i) for i in range(20)])
+        dl = []
+        for i in range(len(data)):
+            # each write only succeeds if all of the ones before it have
+            # been applied
+            testv = [(0, i, "eq", data[:i])]
+            datav = [(i, data[i])]
+            d = ss.remote_slot_testv_and_readv_and_writev("si1", secrets,
+                                                          {0: (testv, datav,
+                                                               None)},
+                                                          [])
+            dl.append(d)
+        self.failUnless(ss.get_stats()["storage_server.io_queue_depth"] > 0)
+        d = defer.gatherResults(dl)
+        def _written(results):
+            self.failUnlessEqual([wrote for (wrote, readv) in results],
+                                 [True] * len(data))
+            self.failIf(ss.is_io_busy("si1"))
+            self.failUnlessEqual(ss.get_stats()["storage_server.io_queue_depth"],
+                                 0)
+            self.failUnlessEqual(ss.get_latencies()["io-wait"]["samplesize"],
+                                 len(data))
+            return ss.remote_slot_readv("si1", [], [(0, 100)])
+        d.addCallback(_written)
+        d.addCallback(lambda datavs:
+                      self.failUnlessEqual(datavs, {0: [data]}))
+        return d
+
+    def test_incoming_dirs_removed_in_reactor(self):
+        # new shares' incoming/ directories are made in the reactor thread,
+        # so they must only ever be removed there too
+        ss = self.create("test_incoming_dirs_removed_in_reactor")
+        rs, cs = hashutil.tagged_hash("blah", "1"), hashutil.tagged_hash("blah", "2")
+        canary = FakeCanary()
+        d = ss.remote_allocate_buckets("si1", rs, cs, set([0, 1]), 100, canary)
+        removals = []
+        def _allocated((already, writers)):
+            dl = []
+            for bw in writers.values():
+                def _remove_incoming_dirs(bw=bw,
+                                          orig=bw._remove_incoming_dirs):
+                    removals.append(threadable.isInIOThread())
+                    orig()
+                bw._remove_incoming_dirs = _remove_incoming_dirs
+                bw.remote_write(0, "a"*100)
+            dl.append(defer.maybeDeferred(writers[0].remote_close))
+            dl.append(defer.maybeDeferred(writers[1].remote_abort))
+            return defer.DeferredList(dl, fireOnOneErrback=True)
+        d.addCallback(_allocated)
+        def _closed(ign):
+            self.failUnlessEqual(removals, [True, True])
+            incomingdir = ss.sharedirs[0].incomingdir
+            self.failUnlessEqual(os.listdir(incomingdir), [])
+        d.addCallback(_closed)
+        return d
+
+    def test_write_reports_both_flushes(self):
+        ss = self.create("test_write_reports_both_flushes")
+        rs, cs = hashutil.tagged_hash("blah", "1"), hashutil.tagged_hash("blah", "2")
+        d = ss.remote_allocate_buckets("si1", rs, cs, set([0]), 200,
+                                       FakeCanary())
+        def _allocated((already, writers)):
+            bw = self.bw = writers[0]
+            bw.write_buffer_size = 50
+            flushes = []
+            def _flush(offset, data, orig=bw._flush):
+                flushes.append(offset)
+                if len(flushes) == 1:
+                    raise IOError("disk error in the first flush")
+                orig(offset, data)
+            bw._flush = _flush
+            bw.remote_write(0, "a"*25)
+            # this write is not adjacent, and fills the buffer: the failure
+            # of the first of its two flushes must reach the client
+            return self.shouldFail(IOError, "write", "first flush",
+                                   bw.remote_write, 100, "b"*50)
+        d.addCallback(_allocated)
+        d.addCallback(lambda ign: self.bw.remote_abort())
+        return d
+
+    def test_close_failure(self):
+        ss = self.create("test_close_failure")
+        rs, cs = hashutil.tagged_hash("blah", "1"), hashutil.tagged_hash("blah", "2")
+        d = ss.remote_allocate_buckets("si1", rs, cs, set([0]), 100,
+                                       FakeCanary())
+        def _allocated((already, writers)):
+            bw = self.bw = writers[0]
+            def _sync():
+                raise IOError("disk error in sync")
+            bw._sync = _sync
+            bw.remote_write(0, "a"*100)
+            self.failUnlessEqual(ss.allocated_size(), 100)
+            return self.shouldFail(IOError, "close", "disk error",
+                                   bw.remote_close)
+        d.addCallback(_allocated)
+        def _failed(ign):
+            # the share is given up, and so is the space allocated to it
+            self.failUnlessEqual(self.bw._f, None)
+            self.failIf(os.path.exists(self.bw.incominghome))
+            self.failUnlessEqual(os.listdir(ss.sharedirs[0].incomingdir), [])
+            self.failUnlessEqual(ss.allocated_size(), 0)
+        d.addCallback(_failed)
+        return d
+
+class MultipleDirectories(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "MultipleDirectories", name)
+        return basedir
+
+    def create(self, name, **kwargs):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, "\x00" * 20,
+                           extra_storedirs=[os.path.join(workdir, "disk1"),
+                                            os.path.join(workdir, "disk2")],
+                           **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def allocate(self, ss, storage_index, sharenums):
+        rs = hashutil.tagged_hash("blah", storage_index + "r")
+        cs = hashutil.tagged_hash("blah", storage_index + "c")
+        return ss.remote_allocate_buckets(storage_index, rs, cs, sharenums,
+                                          100, FakeCanary())
+
+    def where(self, ss, storage_index):
+        for i, sd in enumerate(ss.sharedirs):
+            if os.path.isdir(sd.get_bucketdir(storage_index)):
+                return i
+        return None
+
+    def test_placement(self):
+        ss = self.create("test_placement")
+        self.failUnlessEqual(len(ss.sharedirs), 3)
+        # all three directories are on the same disk, so only the number of
+        # uploads in progress decides where new buckets go
+        already, writers1 = self.allocate(ss, "si1", set([0, 1]))
+        self.failUnlessEqual(self.where(ss, "si1"), 0)
+        already, writers2 = self.allocate(ss, "si2", set([0]))
+        self.failUnlessEqual(self.where(ss, "si2"), 1)
+        already, writers3 = self.allocate(ss, "si3", set([0]))
+        self.failUnlessEqual(self.where(ss, "si3"), 2)
+        # more shares for an existing bucket go into the same directory
+        already, writers1b = self.allocate(ss, "si1", set([2]))
+        self.failUnlessEqual(writers1b.keys(), [2])
+        self.failUnless(writers1b[2].incominghome.startswith(ss.sharedirs[0].incomingdir))
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.sharedir_0.uploads"], 3)
+        self.failUnlessEqual(stats["storage_server.sharedir_1.uploads"], 1)
+        self.failUnlessEqual(stats["storage_server.sharedir_1.allocated"], 100)
+        if "storage_server.disk_total" in stats:
+            self.failUnlessEqual(stats["storage_server.disk_total"],
+                                 3*stats["storage_server.sharedir_2.disk_total"])
+
+        for writers in (writers1, writers2, writers3, writers1b):
+            for bw in writers.values():
+                bw.remote_write(0, "a"*100)
+                bw.remote_close()
+        self.failUnlessEqual(ss.get_stats()["storage_server.sharedir_0.uploads"], 0)
+        self.failUnlessEqual(sorted(ss.remote_get_buckets("si1").keys()),
+                             [0, 1, 2])
+        self.failUnlessEqual(ss.remote_get_buckets("si3")[0].remote_read(0, 100),
+                             "a"*100)
+        self.failUnlessEqual(ss.remote_get_buckets("si4"), {})
+
+        # mutable shares are placed too
+        secrets = (hashutil.tagged_hash("we", "1"),
+                   hashutil.tagged_hash("renew", "1"),
+                   hashutil.tagged_hash("cancel", "1"))
+        wrote, readv = ss.remote_slot_testv_and_readv_and_writev(
+            "si5", secrets, {0: ([], [(0, "mutable")], None)}, [])
+        self.failUnless(wrote)
+        self.failIfEqual(self.where(ss, "si5"), None)
+        self.failUnlessEqual(ss.remote_slot_readv("si5", [], [(0, 7)]),
+                             {0: ["mutable"]})
+        self.failUnless(ss.have_shares())
+
+    def test_lookup_after_restart(self):
+        ss = self.create("test_lookup_after_restart")
+        already, writers2 = self.allocate(ss, "si1", set([0]))
+        already, writers = self.allocate(ss, "si2", set([0, 1]))
+        self.failUnlessEqual(self.where(ss, "si2"), 1)
+        for bw in writers.values() + writers2.values():
+            bw.remote_write(0, "b"*100)
+            bw.remote_close()
+        d = ss.disownServiceParent()
+        def _restart(ign):
+            ss2 = self.create("test_lookup_after_restart")
+            self.failUnlessEqual(sorted(ss2.remote_get_buckets("si2").keys()),
+                                 [0, 1])
+            already, writers = self.allocate(ss2, "si2", set([0, 1, 2]))
+            self.failUnlessEqual(already, set([0, 1]))
+            self.failUnless(writers[2].incominghome.startswith(ss2.sharedirs[1].incomingdir))
+            self.failUnlessRaises(IndexError, ss2.remote_renew_lease, "si3",
+                                  hashutil.tagged_hash("blah", "si3r"))
+        d.addCallback(_restart)
+        return d
+
+    def test_full_directory(self):
+        ss = self.create("test_full_directory")
+        def get_disk_stats(whichdir, reserved_space):
+            # the first directory is full
+            if whichdir == ss.sharedirs[0].sharedir:
+                return {'avail': 0}
+            return {'avail': 1000}
+        self.patch(fileutil, "get_disk_stats", get_disk_stats)
+        all_writers = [] # keep the BucketWriters alive
+        already, writers = self.allocate(ss, "si1", set([0, 1]))
+        all_writers.append(writers)
+        self.failUnlessEqual(self.where(ss, "si1"), 1)
+        self.failUnlessEqual(ss.get_available_space(), 1000)
+        # there is only room for eighteen more of these
+        for i in range(18):
+            already, writers = self.allocate(ss, "si%d" % (i+2), set([0]))
+            self.failUnlessEqual(len(writers), 1)
+            self.failIfEqual(self.where(ss, "si%d" % (i+2)), 0)
+            all_writers.append(writers)
+        already, writers = self.allocate(ss, "si20", set([0]))
+        self.failUnlessEqual(writers, {})
+
+    def test_io_per_directory(self):
+        ss = self.create("test_io_per_directory", io_threads=2)
+        executors = [sd.io for sd in ss.sharedirs]
+        self.failUnlessEqual(len(set(executors)), 3)
+        self.failUnlessEqual([io.threads for io in executors], [2, 2, 2])
+        # the directories' lookups log through the server, which is safe to
+        # do from their threads
+        self.failUnlessEqual(ss.buckets._log, ss.log)
+        self.failUnlessEqual(ss.sharedirs[1]._log, ss.log)
+        canary = FakeCanary()
+        rs, cs = hashutil.tagged_hash("blah", "r"), hashutil.tagged_hash("blah", "c")
+        d = ss.remote_allocate_buckets("si1", rs, cs, set([0]), 100, canary)
+        d.addCallback(lambda ign:
+                      ss.remote_allocate_buckets("si2", rs, cs, set([0]), 100,
+                                                 canary))
+        def _allocated((already, writers)):
+            self.failUnlessEqual(self.where(ss, "si2"), 1)
+            bw = writers[0]
+            # the share is written by the threads of its own directory
+            self.failUnlessIdentical(bw._io, executors[1])
+            bw.remote_write(0, "a"*100)
+            return bw.remote_close()
+        d.addCallback(_allocated)
+        d.addCallback(lambda ign: self.failUnlessIdentical(ss.get_io("si2"),
+                                                           executors[1]))
+        d.addCallback(lambda ign: ss.remote_get_buckets("si2"))
+        def _got(readers):
+            self.failUnlessIdentical(readers[0]._io, executors[1])
+            return readers[0].remote_read(0, 100)
+        d.addCallback(_got)
+        d.addCallback(lambda data: self.failUnlessEqual(data, "a"*100))
+        # a bucket that does not exist yet is looked after by the first
+        # directory, and stays there for as long as it has work queued
+        secrets = (hashutil.tagged_hash("we", "1"),
+                   hashutil.tagged_hash("renew", "1"),
+                   hashutil.tagged_hash("cancel", "1"))
+        def _write_mutable(ign):
+            self.failUnlessIdentical(ss.get_io("si5"), executors[0])
+            d1 = ss.remote_slot_testv_and_readv_and_writev(
+                "si5", secrets, {0: ([], [(0, "mutable")], None)}, [])
+            self.failUnlessIdentical(ss.get_io("si5"), executors[0])
+            self.failUnless(ss.is_io_busy("si5"))
+            d2 = ss.remote_slot_readv("si5", [], [(0, 7)])
+            return defer.gatherResults([d1, d2])
+        d.addCallback(_write_mutable)
+        d.addCallback(lambda (writev, readv):
+                      self.failUnlessEqual(readv, {0: ["mutable"]}))
+        return d
+
 def remove_tags(s):
     s = re.sub(r'<[^>]*>', ' ', s)
     s = re.sub(r'\s+', ' ', s)
@@ -2909,6 +3651,7 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
         self.failUnlessIn("Accepting new shares: Yes", s)
         self.failUnlessIn("Reserved space: - 0 B (0)", s)
         self.failUnlessIn("Total buckets: Not computed yet", s)
+        self.failUnlessIn("Total shares: Not computed yet", s)
         self.failUnlessIn("Next crawl in", s)
 
         # give the bucket-counting-crawler one tick to get started. The
@@ -2941,7 +3684,8 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
             html = w.renderSynchronously()
             s = remove_tags(html)
             self.failUnlessIn("Total buckets: 0 (the number of", s)
-            self.failUnless("Next crawl in 59 minutes" in s or "Next crawl in 60 minutes" in s, s)
+            self.failUnlessIn("Total shares: 0 immutable (0 B), 0 mutable (0 B)", s)
+            self.failUnless("Next crawl in 23 hours" in s or "Next crawl in 24 hours" in s, s)
         d.addCallback(_check2)
         return d
 
@@ -3025,6 +3769,83 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
         ss.setServiceParent(self.s)
         return d
 
+    def test_share_inventory(self):
+        basedir = "storage/BucketCounter/share_inventory"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.bucket_counter.slow_start = 0
+        ss.bucket_counter.cpu_slice = 100.0
+        self.failIfIn("storage_server.total_bucket_count", ss.get_stats())
+        ss.setServiceParent(self.s)
+
+        def _stats():
+            stats = ss.get_stats()
+            return (stats["storage_server.total_bucket_count"],
+                    stats["storage_server.immutable_share_count"],
+                    stats["storage_server.immutable_share_bytes"],
+                    stats["storage_server.mutable_share_count"],
+                    stats["storage_server.mutable_share_bytes"],
+                    stats["storage_server.total_share_bytes"])
+        def _size(si, shnum):
+            return os.path.getsize(os.path.join(ss.sharedir,
+                                                storage_index_to_dir(si),
+                                                str(shnum)))
+
+        # nothing is reported until the crawler has counted every prefix
+        d = self.poll(lambda: ss.inventory.get_counts() is not None)
+        def _check(ignored):
+            self.failUnlessEqual(_stats(), (0, 0, 0, 0, 0, 0))
+
+            # the counts follow uploads without waiting for the crawler
+            canary = FakeCanary()
+            a,w = ss.remote_allocate_buckets("\x00" * 16,
+                                             hashutil.tagged_hash("renew", "0"),
+                                             hashutil.tagged_hash("cancel", "0"),
+                                             [0, 1], 100, canary)
+            self.failUnlessEqual(_stats()[0], 1)
+            for shnum in w:
+                w[shnum].remote_write(0, "a" * 100)
+                w[shnum].remote_close()
+            imm_bytes = _size("\x00" * 16, 0) + _size("\x00" * 16, 1)
+            self.failUnlessEqual(_stats(), (1, 2, imm_bytes, 0, 0, imm_bytes))
+
+            writev = ss.remote_slot_testv_and_readv_and_writev
+            secrets = (hashutil.tagged_hash("write-enabler", "2"),
+                       hashutil.tagged_hash("renew", "2"),
+                       hashutil.tagged_hash("cancel", "2"))
+            writev("\x02" * 16, secrets, {0: ([], [(0, "b" * 100)], None)}, [])
+            mut_bytes = _size("\x02" * 16, 0)
+            self.failUnlessEqual(_stats(), (2, 2, imm_bytes, 1, mut_bytes,
+                                            imm_bytes + mut_bytes))
+            writev("\x02" * 16, secrets, {0: ([], [(100, "b" * 900)], None)}, [])
+            self.failUnless(_size("\x02" * 16, 0) > mut_bytes)
+            mut_bytes = _size("\x02" * 16, 0)
+            self.failUnlessEqual(_stats()[4], mut_bytes)
+            writev("\x02" * 16, secrets, {0: ([], [], 0)}, [])
+            self.failUnlessEqual(_stats(), (1, 2, imm_bytes, 0, 0, imm_bytes))
+            self.failUnlessEqual(ss.inventory.get_state()["corrections"], 0)
+
+            # the crawler corrects counts that have drifted from the disk
+            prefix = si_b2a("\x00" * 16)[:2]
+            ss.inventory.bucket_added("\x00" * 16)
+            self.failUnlessEqual(_stats()[0], 2)
+            prefixdir = os.path.join(ss.sharedir, prefix)
+            counts = ss.bucket_counter.count_shares(prefixdir,
+                                                    os.listdir(prefixdir))
+            ss.inventory.set_prefix_counts(prefix, counts)
+            self.failUnlessEqual(_stats(), (1, 2, imm_bytes, 0, 0, imm_bytes))
+            self.failUnlessEqual(ss.inventory.get_state()["corrections"], 1)
+
+            # and the counts survive a restart
+            expected = ss.inventory.get_counts()
+            return ss.disownServiceParent().addCallback(lambda ign: expected)
+        d.addCallback(_check)
+        def _restarted(expected):
+            ss2 = StorageServer(basedir, "\x00" * 20)
+            self.failUnlessEqual(ss2.inventory.get_counts(), expected)
+        d.addCallback(_restarted)
+        return d
+
 class InstrumentedLeaseCheckingCrawler(LeaseCheckingCrawler):
     stop_after_first_bucket = False
     def process_bucket(self, *args, **kwargs):
@@ -3428,6 +4249,73 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addCallback(_check_html)
         return d
 
+    def test_share_inventory_follows_leases(self):
+        basedir = "storage/LeaseCrawler/share_inventory_follows_leases"
+        fileutil.make_dirs(basedir)
+        now = time.time()
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="cutoff-date",
+                           expiration_cutoff_date=int(now - 2000))
+        ss.bucket_counter.slow_start = 0
+        ss.bucket_counter.cpu_slice = 100.0
+        lc = ss.lease_checker
+        ss.setServiceParent(self.s)
+
+        def _count_shares():
+            counts = empty_counts()
+            for prefix in lc.prefixes:
+                prefixdir = os.path.join(ss.sharedir, prefix)
+                if not os.path.isdir(prefixdir):
+                    continue
+                prefix_counts = ss.bucket_counter.count_shares(
+                    prefixdir, os.listdir(prefixdir))
+                for name in counts:
+                    counts[name] += prefix_counts[name]
+            return counts
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+
+        d = self.poll(lambda: ss.inventory.get_counts() is not None)
+        def _counted(ignored):
+            # make_shares() adds leases to existing shares of both kinds
+            self.make_shares(ss)
+            [immutable_si_0, immutable_si_1,
+             mutable_si_2, mutable_si_3] = self.sis
+            ss.remote_add_leases([(immutable_si_0,
+                                   hashutil.tagged_hash("renew", "extra"),
+                                   hashutil.tagged_hash("cancel", "extra"))])
+            ss.remote_allocate_buckets(immutable_si_0,
+                                       hashutil.tagged_hash("renew", "again"),
+                                       hashutil.tagged_hash("cancel", "again"),
+                                       [0], 1000, FakeCanary())
+            self.failUnlessEqual(
+                len(list(_get_sharefile(immutable_si_0).get_leases())), 3)
+            self.failUnlessEqual(ss.inventory.get_counts(), _count_shares())
+
+            # expire the first lease of each share, which shrinks some
+            # shares and removes others
+            expire_time = now - 3000 + 31*24*60*60
+            for si, rs in zip(self.sis, [self.renew_secrets[i]
+                                         for i in (0, 1, 3, 4)]):
+                self.backdate_lease(_get_sharefile(si), rs, expire_time)
+            sizes = [os.path.getsize(_get_sharefile(si).home)
+                     for si in (immutable_si_0, immutable_si_1)]
+            lc.started_cycle(0)
+            for si in self.sis:
+                si_s = si_b2a(si)
+                lc.process_bucket(0, si_s[:2],
+                                  os.path.join(ss.sharedir, si_s[:2]), si_s)
+            self.failUnlessEqual(len(list(ss._iter_share_files(mutable_si_2))),
+                                 0)
+            self.failUnless(os.path.getsize(_get_sharefile(immutable_si_0).home)
+                            < sizes[0])
+            self.failUnless(os.path.getsize(_get_sharefile(immutable_si_1).home)
+                            < sizes[1])
+            self.failUnlessEqual(ss.inventory.get_counts(), _count_shares())
+        d.addCallback(_counted)
+        return d
+
     def test_expire_cutoff_date(self):
         basedir = "storage/LeaseCrawler/expire_cutoff_date"
         fileutil.make_dirs(basedir)
@@ -3953,10 +4841,94 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addBoth(_cleanup)
         return d
 
+    def test_status_combined_crawler(self):
+        basedir = "storage/WebStatus/status_combined_crawler"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, combined_crawler=True,
+                           crawler_io_threads=2)
+        host = ss.crawler_host
+        self.failUnlessEqual(host.get_consumers(),
+                             [ss.bucket_counter, ss.lease_checker])
+        self.failUnlessEqual(host.io_threads, 2)
+        self.failUnlessEqual(ss.lease_checker.io_threads, 0)
+        ss.setServiceParent(self.s)
+        w = StorageStatus(ss)
+        d = self.render1(w)
+        def _check_html(html):
+            s = remove_tags(html)
+            self.failUnlessIn("Combined Crawler", s)
+            self.failUnlessIn("bucket_counter: Next crawl in", s)
+            self.failUnlessIn("lease_checker: Next crawl in", s)
+        d.addCallback(_check_html)
+        d.addCallback(lambda ign: self.render_json(w))
+        def _check_json(json):
+            data = simplejson.loads(json)
+            self.failUnlessEqual(sorted(data["crawler-host-consumers"]),
+                                 ["bucket_counter", "lease_checker"])
+            self.failUnlessIn("crawler-host-progress", data)
+        d.addCallback(_check_json)
+        return d
+
     def render_json(self, page):
         d = self.render1(page, args={"t": ["json"]})
         return d
 
+class MutableCompactor(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def test_compactor(self):
+        basedir = "storage/MutableCompactor/compactor"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, mutable_growth_factor=2.0,
+                           compact_mutable_shares=True)
+        mc = ss.mutable_compactor
+        mc.slow_start = 0
+        mc.cpu_slice = 500
+        mc.min_slack = 0
+
+        secrets = (hashutil.tagged_hash("we_blah", "we"),
+                   hashutil.tagged_hash("renew_blah", "renew"),
+                   hashutil.tagged_hash("cancel_blah", "cancel"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        for si in ("si1", "si2"):
+            for i in range(3):
+                writev(si, secrets, {0: ([], [(i*1000, "a"*1000)], None)}, [])
+        # si1 has 1000 bytes to spare, si2 was truncated to leave 3500
+        writev("si2", secrets, {0: ([], [], 500)}, [])
+        fn1 = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        fn2 = os.path.join(ss.sharedir, storage_index_to_dir("si2"), "0")
+        size1 = os.path.getsize(fn1)
+        size2 = os.path.getsize(fn2)
+        # si1 is still being written to, so it keeps its room to grow
+        mc.idle_time = 60
+        old = time.time() - 120
+        os.utime(fn2, (old, old))
+
+        ss.setServiceParent(self.s)
+        d = self.poll(lambda: mc.get_state()["last-cycle"] is not None)
+        def _check(ignored):
+            self.failUnlessEqual(mc.get_state()["last-cycle"],
+                                 {"compacted-shares": 1, "freed-bytes": 3500})
+            self.failUnlessEqual(os.path.getsize(fn1), size1)
+            self.failUnlessEqual(os.path.getsize(fn2), size2 - 3500)
+            self.failUnlessEqual(ss.remote_slot_readv("si2", [0], [(0, 1000)]),
+                                 {0: ["a"*500]})
+            self.failUnlessEqual(len(list(MutableShareFile(fn2).get_leases())),
+                                 1)
+            # the inventory was told (both buckets have the same prefix)
+            si2_b32 = base32.b2a("si2")
+            counts = ss.inventory.get_state()["prefixes"][si2_b32[:2]]
+            self.failUnlessEqual(counts["mutable-bytes"],
+                                 os.path.getsize(fn1) + os.path.getsize(fn2))
+        d.addCallback(_check)
+        return d
+
+
 class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
 
     def setUp(self):
@@ -3965,6 +4937,53 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
     def tearDown(self):
         return self.s.stopService()
 
+    def test_latencies_json(self):
+        basedir = "storage/WebStatus/latencies_json"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.setServiceParent(self.s)
+        for i in range(10):
+            ss.add_latency("get", 0.01 * i)
+        w = StorageStatus(ss)
+        d = self.render1(w, args={"t": ["latencies"]})
+        def _check(json):
+            data = simplejson.loads(json)
+            self.failUnlessEqual(sorted(data.keys()), ["1h", "1m", "5m"])
+            self.failUnlessEqual(data["1m"].keys(), ["get"])
+            self.failUnlessEqual(data["1m"]["get"]["samplesize"], 10)
+            self.failUnlessEqual(data["1m"]["get"]["99_9_percentile"], None)
+        d.addCallback(_check)
+        return d
+
+    def test_space_json(self):
+        basedir = "storage/WebStatus/space_json"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, reserved_space=1000)
+        ss.setServiceParent(self.s)
+        w = StorageStatus(ss)
+        d = self.render1(w, args={"t": ["space"]})
+        def _check(json):
+            data = simplejson.loads(json)
+            self.failUnlessEqual(data["shares"], None)
+            self.failUnlessEqual(data["allocated"], 0)
+            self.failUnlessEqual(data["uploads"], 0)
+            self.failUnlessEqual(data["reserved-space"], 1000)
+            self.failUnlessEqual(data["available"], ss.get_available_space())
+            self.failUnlessEqual([sd["path"] for sd in data["sharedirs"]],
+                                 [basedir])
+            # pretend the bucket counter has finished its first pass
+            for prefix in ss.bucket_counter.prefixes:
+                ss.inventory.set_prefix_counts(prefix, empty_counts())
+            ss.inventory.share_added("si1", "mutable", 500)
+            return self.render1(w, args={"t": ["space"]})
+        d.addCallback(_check)
+        def _check_counted(json):
+            data = simplejson.loads(json)
+            self.failUnlessEqual(data["shares"]["mutable-shares"], 1)
+            self.failUnlessEqual(data["shares"]["total-bytes"], 500)
+        d.addCallback(_check_counted)
+        return d
+
     def test_no_server(self):
         w = StorageStatus(None)
         html = w.renderSynchronously()
@@ -3997,6 +5016,34 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addCallback(_check_json)
         return d
 
+    def test_status_combined_crawler(self):
+        basedir = "storage/WebStatus/status_combined_crawler"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, combined_crawler=True,
+                           crawler_io_threads=2)
+        host = ss.crawler_host
+        self.failUnlessEqual(host.get_consumers(),
+                             [ss.bucket_counter, ss.lease_checker])
+        self.failUnlessEqual(host.io_threads, 2)
+        self.failUnlessEqual(ss.lease_checker.io_threads, 0)
+        ss.setServiceParent(self.s)
+        w = StorageStatus(ss)
+        d = self.render1(w)
+        def _check_html(html):
+            s = remove_tags(html)
+            self.failUnlessIn("Combined Crawler", s)
+            self.failUnlessIn("bucket_counter: Next crawl in", s)
+            self.failUnlessIn("lease_checker: Next crawl in", s)
+        d.addCallback(_check_html)
+        d.addCallback(lambda ign: self.render_json(w))
+        def _check_json(json):
+            data = simplejson.loads(json)
+            self.failUnlessEqual(sorted(data["crawler-host-consumers"]),
+                                 ["bucket_counter", "lease_checker"])
+            self.failUnlessIn("crawler-host-progress", data)
+        d.addCallback(_check_json)
+        return d
+
     def render_json(self, page):
         d = self.render1(page, args={"t": ["json"]})
         return d
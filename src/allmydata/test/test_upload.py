@@ -88,6 +88,86 @@ class Uploadable(unittest.TestCase):
         d.addCallback(lambda res: u.close())
         return d
 
+class FakeProducer:
+    def __init__(self):
+        self.paused = False
+    def pauseProducing(self):
+        self.paused = True
+    def resumeProducing(self):
+        self.paused = False
+
+class StreamingUploadable(unittest.TestCase):
+    def shouldEqual(self, data, expected):
+        self.failUnless(isinstance(data, list))
+        self.failUnlessEqual("".join(data), expected)
+
+    def test_read_as_written(self):
+        u = upload.StreamingData(41)
+        reads = []
+        u.read(10).addCallback(reads.append)
+        u.write("a"*5)
+        self.failIf(reads)
+        u.write("b"*15)
+        self.failUnlessEqual(len(reads), 1)
+        self.shouldEqual(reads[0], "a"*5 + "b"*5)
+        u.write("c"*21)
+        u.finish()
+        d = u.read(80)
+        d.addCallback(self.shouldEqual, "b"*10 + "c"*21)
+        d.addCallback(lambda ign: u.get_size())
+        d.addCallback(self.failUnlessEqual, 41)
+        return d
+
+    def test_random_key(self):
+        u = upload.StreamingData(41)
+        d = u.get_encryption_key()
+        def _got_key(key):
+            self.failUnlessEqual(len(key), 16)
+            self.failIfEqual(key, upload.StreamingData(41)._key)
+        d.addCallback(_got_key)
+        return d
+
+    def test_backpressure(self):
+        p = FakeProducer()
+        u = upload.StreamingData(3*MiB, p)
+        u.max_buffered = 100
+        u.write("a"*101)
+        self.failUnless(p.paused)
+        reads = []
+        u.read(10).addCallback(reads.append)
+        self.failUnless(p.paused)
+        u.read(50).addCallback(reads.append)
+        self.failIf(p.paused)
+        u.write("b"*200)
+        self.failUnless(p.paused)
+        # a read that needs more than is buffered must not leave the
+        # producer paused, or we would wait forever
+        u.read(250).addCallback(reads.append)
+        self.failIf(p.paused)
+        u.write("c"*20)
+        self.failUnlessEqual(len(reads), 3)
+        self.shouldEqual(reads[2], "a"*41 + "b"*200 + "c"*9)
+
+    def test_fail(self):
+        u = upload.StreamingData(41)
+        d = u.read(10)
+        u.fail(Failure(ServerError("connection lost")))
+        d.addCallbacks(lambda res: self.fail("should have failed"),
+                       lambda f: f.trap(ServerError))
+        return d
+
+    def test_discard(self):
+        p = FakeProducer()
+        u = upload.StreamingData(3*MiB, p)
+        u.max_buffered = 100
+        u.write("a"*101)
+        self.failUnless(p.paused)
+        u.discard()
+        self.failIf(p.paused)
+        u.write("b"*500)
+        self.failIf(p.paused)
+        self.failUnlessEqual(u._buffered, 0)
+
 class ServerError(Exception):
     pass
 
@@ -332,6 +412,17 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(self._check_large, SIZE_LARGE)
         return d
 
+    def test_streaming_large(self):
+        data = self.get_data(SIZE_LARGE)
+        u = upload.StreamingData(len(data))
+        d = self.u.upload(u)
+        for i in range(0, len(data), 100):
+            u.write(data[i:i+100])
+        u.finish()
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        return d
+
     def test_filehandle_zero(self):
         data = self.get_data(SIZE_ZERO)
         d = upload_filehandle(self.u, StringIO(data))
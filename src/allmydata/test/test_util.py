@@ -1,7 +1,7 @@
 
 def foo(): pass # keep the line number constant
 
-import os, time, sys
+import os, time, sys, math
 from StringIO import StringIO
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
@@ -12,7 +12,7 @@ from pycryptopp.hash.sha256 import SHA256 as _hash
 from allmydata.util import base32, idlib, humanreadable, mathutil, hashutil
 from allmydata.util import assertutil, fileutil, deferredutil, abbreviate
 from allmydata.util import limiter, time_format, pollmixin, cachedir
-from allmydata.util import statistics, dictutil, pipeline
+from allmydata.util import statistics, dictutil, pipeline, latency
 from allmydata.util import log as tahoe_log
 from allmydata.util.spans import Spans, overlap, DataSpans
 
@@ -311,6 +311,59 @@ class Statistics(unittest.TestCase):
         self.failUnlessEqual(f(plist, .5, 3), .02734375)
 
 
+class Latency(unittest.TestCase):
+    def test_percentiles(self):
+        h = latency.LatencyHistogram()
+        self.failUnlessEqual(h.get_percentile(0.5), None)
+        samples = [0.0001 * 1.01**i for i in range(1000)]
+        for value in reversed(samples):
+            h.add(value)
+        self.failUnlessEqual(h.count, 1000)
+        self.failUnlessAlmostEqual(h.total, sum(samples))
+        for fraction in (0.01, 0.1, 0.5, 0.9, 0.99, 0.999):
+            expected = samples[int(fraction*1000)]
+            got = h.get_percentile(fraction)
+            self.failUnless(abs(got - expected) <= expected / 32,
+                            (fraction, got, expected))
+        self.failUnlessEqual(h.get_percentile(0.0), samples[0])
+        self.failUnlessEqual(h.get_percentile(1.0), samples[-1])
+
+    def test_bounded(self):
+        h = latency.LatencyHistogram()
+        for i in range(-5, 100):
+            h.add(10.0**(i/4.0 - 10))
+        h.add(0)
+        h.add(10**20)
+        self.failUnlessEqual(h.count, 107)
+        maximum = (math.log(h.MAX_VALUE/h.MIN_VALUE, 2) + 1) * h.SUB_BUCKETS
+        self.failUnless(len(h.buckets) <= maximum, len(h.buckets))
+        self.failUnlessEqual(h.get_percentile(0.0), 0)
+        self.failUnlessEqual(h.get_percentile(1.0), 10**20)
+
+    def test_merge(self):
+        a = latency.LatencyHistogram()
+        b = latency.LatencyHistogram()
+        for i in range(100):
+            a.add(1.0 + i)
+            b.add(101.0 + i)
+        a.merge(b)
+        self.failUnlessEqual((a.count, a.min, a.max), (200, 1.0, 200.0))
+        self.failUnless(abs(a.get_percentile(0.5) - 101) < 101/32.0)
+
+    def test_windows(self):
+        w = latency.WindowedLatencyHistogram()
+        start = 1000000 * 60
+        for minute in range(120):
+            w.add(float(minute), now=start + minute*60)
+        now = start + 119*60 + 30
+        self.failUnlessEqual(w.get_histogram(60, now).count, 2)
+        self.failUnlessEqual(w.get_histogram(5*60, now).count, 6)
+        h = w.get_histogram(60*60, now)
+        self.failUnlessEqual((h.count, h.min, h.max), (61, 59.0, 119.0))
+        # old minutes are thrown away
+        self.failUnlessEqual(len(w.slots), 61)
+        self.failUnlessEqual(w.get_histogram(60*60, now + 2*60*60).count, 0)
+
 class Asserts(unittest.TestCase):
     def should_assert(self, func, *args, **kwargs):
         try:
@@ -22,10 +22,11 @@ from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.dirnode import DirectoryNode
 from allmydata.nodemaker import NodeMaker
 from allmydata.unknown import UnknownNode
-from allmydata.web import status, common
+from allmydata.web import status, common, directory, filenode, coalesce
+from allmydata.web.common import immutable_etag
 from allmydata.scripts.debug import CorruptShareOptions, corrupt_share
 from allmydata.util import fileutil, base32, hashutil
-from allmydata.util.consumer import download_to_data
+from allmydata.util.consumer import download_to_data, MemoryConsumer
 from allmydata.util.netstring import split_netstring
 from allmydata.util.encodingutil import to_str
 from allmydata.test.common import FakeCHKFileNode, FakeMutableFileNode, \
@@ -73,7 +74,8 @@ class FakeNodeMaker(NodeMaker):
                                    self.encoding_params, None,
                                    self.all_contents).init_from_cap(cap)
     def create_mutable_file(self, contents="", keysize=None,
-                            version=SDMF_VERSION):
+                            version=SDMF_VERSION, segment_size=None):
+        self.last_segment_size = segment_size
         n = FakeMutableFileNode(None, None, self.encoding_params, None,
                                 self.all_contents)
         return n.create(contents, version=version)
@@ -108,6 +110,23 @@ class FakeUploader(service.Service):
         return (self.helper_furl, self.helper_connected)
 
 
+def parse_byteranges(body, content_type):
+    # split a multipart/byteranges response body into a list of
+    # (content-type, content-range, data) tuples
+    assert content_type.startswith("multipart/byteranges; boundary="), \
+           content_type
+    boundary = content_type.split("boundary=", 1)[1]
+    assert body.endswith("--%s--\r\n" % boundary), body
+    body = body[:-len("--%s--\r\n" % boundary)]
+    parts = []
+    for part in body.split("--%s\r\n" % boundary)[1:]:
+        (header, data) = part.split("\r\n\r\n", 1)
+        assert data.endswith("\r\n")
+        fields = dict([line.split(": ", 1) for line in header.split("\r\n")])
+        parts.append( (fields["Content-Type"], fields["Content-Range"],
+                       data[:-2]) )
+    return parts
+
 def build_one_ds():
     ds = DownloadStatus("storage_index", 1234)
     now = time.time()
@@ -221,6 +240,7 @@ class FakeStorageServer(service.MultiService):
         self.nickname = nickname
         self.bucket_counter = FakeBucketCounter()
         self.lease_checker = FakeLeaseChecker()
+        self.crawler_host = None
     def get_stats(self):
         return {"storage_server.accepting_immutable_shares": False}
 
@@ -866,6 +886,117 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_got)
         return d
 
+    def test_GET_FILEURL_multirange(self):
+        headers = {"range": "bytes=12-14,1-3,-2"}
+        length  = len(self.BAR_CONTENTS)
+        d = self.GET(self.public_url + "/foo/bar.txt", headers=headers,
+                     return_response=True)
+        def _got((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failIf(headers.has_key("content-range"))
+            self.failUnlessReallyEqual(int(headers["content-length"][0]),
+                                       len(res))
+            parts = parse_byteranges(res, headers["content-type"][0])
+            # parts are returned in file order
+            self.failUnlessReallyEqual(parts,
+              [("text/plain", "bytes 1-3/%d" % length,
+                self.BAR_CONTENTS[1:4]),
+               ("text/plain", "bytes 12-14/%d" % length,
+                self.BAR_CONTENTS[12:15]),
+               ("text/plain", "bytes %d-%d/%d" % (length-2, length-1, length),
+                self.BAR_CONTENTS[-2:])])
+        d.addCallback(_got)
+        return d
+
+    def test_GET_FILEURL_multirange_encoding(self):
+        # the parts hold gzipped bytes, but the multipart/byteranges body
+        # that carries them is not itself gzipped
+        d = self._foo_node.set_uri(u"bar.txt.gz", self._bar_txt_uri,
+                                   self._bar_txt_uri)
+        d.addCallback(lambda ign:
+                      self.GET(self.public_url + "/foo/bar.txt.gz",
+                               headers={"range": "bytes=1-3,10-12"},
+                               return_response=True))
+        def _got_multi((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failIf(headers.has_key("content-encoding"))
+            parts = parse_byteranges(res, headers["content-type"][0])
+            self.failUnlessReallyEqual([data for (ctype, crange, data)
+                                        in parts],
+                                       [self.BAR_CONTENTS[1:4],
+                                        self.BAR_CONTENTS[10:13]])
+        d.addCallback(_got_multi)
+        d.addCallback(lambda ign:
+                      self.GET(self.public_url + "/foo/bar.txt.gz",
+                               headers={"range": "bytes=1-3"},
+                               return_response=True))
+        def _got_single((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failUnlessReallyEqual(headers["content-encoding"], ["gzip"])
+            self.failUnlessReallyEqual(res, self.BAR_CONTENTS[1:4])
+        d.addCallback(_got_single)
+        return d
+
+    def test_GET_FILEURL_multirange_merged(self):
+        # overlapping and adjacent ranges are merged, and unsatisfiable ones
+        # are dropped, which leaves a single range here
+        headers = {"range": "bytes=5-8,1-5,9-10,100-200"}
+        d = self.GET(self.public_url + "/foo/bar.txt", headers=headers,
+                     return_response=True)
+        def _got((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failUnlessReallyEqual(headers["content-range"][0],
+                                       "bytes 1-10/%d" % len(self.BAR_CONTENTS))
+            self.failUnlessReallyEqual(res, self.BAR_CONTENTS[1:11])
+        d.addCallback(_got)
+        return d
+
+    def test_GET_FILEURL_multirange_overrun(self):
+        headers = {"range": "bytes=100-200,300-400"}
+        d = self.shouldFail2(error.Error, "test_GET_FILEURL_multirange_overrun",
+                             "416 Requested Range not satisfiable",
+                             "First beyond end of file",
+                             self.GET, self.public_url + "/foo/bar.txt",
+                             headers=headers)
+        return d
+
+    def test_HEAD_FILEURL_multirange(self):
+        headers = {"range": "bytes=1-3,10-12"}
+        d = self.HEAD(self.public_url + "/foo/bar.txt", headers=headers,
+                     return_response=True)
+        def _got((res, status, headers)):
+            self.failUnlessReallyEqual(res, "")
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failUnless(headers["content-type"][0].startswith(
+                "multipart/byteranges; boundary="), headers["content-type"])
+            self.failIf(headers.has_key("content-range"))
+            # (header + data + CRLF) for each part, then a trailer
+            boundary = headers["content-type"][0].split("boundary=")[1]
+            expected = len("--%s--\r\n" % boundary)
+            for r in ("1-3", "10-12"):
+                expected += len("--%s\r\nContent-Type: text/plain\r\n"
+                                "Content-Range: bytes %s/%d\r\n\r\n"
+                                % (boundary, r, len(self.BAR_CONTENTS)))
+                expected += 3 + 2
+            self.failUnlessReallyEqual(int(headers["content-length"][0]),
+                                       expected)
+        d.addCallback(_got)
+        return d
+
+    def test_GET_FILEURL_multirange_mutable(self):
+        headers = {"range": "bytes=0-1,5-6"}
+        d = self.GET(self.public_url + "/foo/quux.txt", headers=headers,
+                     return_response=True)
+        def _got((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            parts = parse_byteranges(res, headers["content-type"][0])
+            self.failUnlessReallyEqual([data for (ctype, crange, data)
+                                        in parts],
+                                       [self.QUUX_CONTENTS[0:2],
+                                        self.QUUX_CONTENTS[5:7]])
+        d.addCallback(_got)
+        return d
+
     def test_HEAD_FILEURL(self):
         d = self.HEAD(self.public_url + "/foo/bar.txt", return_response=True)
         def _got((res, status, headers)):
@@ -1053,6 +1184,10 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
             def _just_the_etag(result):
                 data, response, headers = result
                 etag = headers['etag'][0]
+                # strong ETags are quoted strings
+                self.failUnless(etag.startswith('"') and etag.endswith('"'),
+                                etag)
+                etag = etag[1:-1]
                 if uri.startswith('URI:DIR'):
                     self.failUnless(etag.startswith('DIR:'), etag)
                 return etag
@@ -1116,6 +1251,95 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
 
         return d
 
+    def _get_etag_and_cache_control(self, url, **kwargs):
+        d = self.GET(url, return_response=True, **kwargs)
+        d.addCallback(lambda (data, code, headers):
+                      (headers["etag"][0], headers["cache-control"][0]))
+        return d
+
+    def _GET_conditional(self, url, etag, method="GET"):
+        if method == "HEAD":
+            d = self.HEAD(url, return_response=True,
+                          headers={"If-None-Match": etag})
+        else:
+            d = self.GET(url, return_response=True,
+                         headers={"If-None-Match": etag})
+        d.addCallback(lambda (data, code, headers): (int(code), data))
+        return d
+
+    def test_GET_etags_immutable_cache_control(self):
+        url = "/uri/%s" % self._bar_txt_uri
+        d = self._get_etag_and_cache_control(url)
+        def _check((etag, cache_control)):
+            self.failUnlessReallyEqual(cache_control,
+                                       common.IMMUTABLE_CACHE_CONTROL)
+            n = self.s.create_node_from_uri(self._bar_txt_uri)
+            self.failUnlessReallyEqual(etag, '"%s-"' % immutable_etag(n))
+            self.etag = etag
+        d.addCallback(_check)
+        # weak tags and lists of tags are accepted too
+        d.addCallback(lambda ign: self._GET_conditional(url,
+                                              'W/%s, "other"' % self.etag))
+        d.addCallback(self.failUnlessReallyEqual, (http.NOT_MODIFIED, ""))
+        d.addCallback(lambda ign: self._GET_conditional(url, "*"))
+        d.addCallback(self.failUnlessReallyEqual, (http.NOT_MODIFIED, ""))
+        d.addCallback(lambda ign: self._GET_conditional(url, '"other"'))
+        d.addCallback(self.failUnlessReallyEqual,
+                      (http.OK, self.BAR_CONTENTS))
+        d.addCallback(lambda ign: self._GET_conditional(url, self.etag,
+                                                        method="HEAD"))
+        d.addCallback(self.failUnlessReallyEqual, (http.NOT_MODIFIED, ""))
+        return d
+
+    def test_GET_etags_mutable(self):
+        url = self.public_url + "/foo/quux.txt"
+        d = self._get_etag_and_cache_control(url)
+        def _check((etag, cache_control)):
+            self.failUnlessReallyEqual(cache_control,
+                                       common.MUTABLE_CACHE_CONTROL)
+            self.etag = etag
+        d.addCallback(_check)
+        d.addCallback(lambda ign: self._GET_conditional(url, self.etag))
+        d.addCallback(self.failUnlessReallyEqual, (http.NOT_MODIFIED, ""))
+        d.addCallback(lambda ign: self._GET_conditional(url, self.etag,
+                                                        method="HEAD"))
+        d.addCallback(self.failUnlessReallyEqual, (http.NOT_MODIFIED, ""))
+        # a new version gets a new ETag
+        d.addCallback(lambda ign: self.PUT(url, "new contents"))
+        d.addCallback(lambda ign: self._GET_conditional(url, self.etag))
+        d.addCallback(self.failUnlessReallyEqual, (http.OK, "new contents"))
+        d.addCallback(lambda ign: self._get_etag_and_cache_control(url))
+        d.addCallback(lambda (etag, cache_control):
+                      self.failIfEqual(etag, self.etag))
+        return d
+
+    def test_GET_etags_mutable_directory(self):
+        url = self.public_url + "/foo/"
+        d = defer.succeed(None)
+        for t in ("", "json"):
+            d.addCallback(lambda ign, t=t:
+                          self._get_etag_and_cache_control(url + "?t=" + t))
+            def _check((etag, cache_control), t=t):
+                self.failUnless(etag.startswith('"DIR:'), etag)
+                self.failUnless(etag.endswith('-%s"' % t), etag)
+                self.failUnlessReallyEqual(cache_control,
+                                           common.MUTABLE_CACHE_CONTROL)
+                self.etag = etag
+            d.addCallback(_check)
+            d.addCallback(lambda ign, t=t:
+                          self._GET_conditional(url + "?t=" + t, self.etag))
+            d.addCallback(self.failUnlessReallyEqual, (http.NOT_MODIFIED, ""))
+        # changing the directory changes its ETag
+        d.addCallback(lambda ign: self.PUT(self.public_url + "/foo/new.txt",
+                                           "new file"))
+        d.addCallback(lambda ign: self._GET_conditional(url + "?t=json",
+                                                        self.etag))
+        def _changed((code, data)):
+            self.failUnlessReallyEqual(code, http.OK)
+            self.failUnlessIn("new.txt", data)
+        d.addCallback(_changed)
+        return d
+
     # TODO: version of this with a Unicode filename
     def test_GET_FILEURL_save(self):
         d = self.GET(self.public_url + "/foo/bar.txt?filename=bar.txt&save=true",
@@ -1605,6 +1829,88 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_got_json)
         return d
 
+    def test_GET_DIRURL_json_pages(self):
+        allnames = [self._htmlname_unicode, u"bar.txt", u"baz.txt",
+                    u"blockingfile", u"empty", u"n\u00fc.txt", u"quux.txt",
+                    u"sub"]
+        url = self.public_url + "/foo?t=json"
+        d = defer.succeed(None)
+        for (args, expected) in [("&limit=3", allnames[:3]),
+                                 ("&offset=2&limit=3", allnames[2:5]),
+                                 ("&offset=6", allnames[6:]),
+                                 ("&offset=20", []),
+                                 ("&limit=0", []),
+                                 ("&after-name=bar.txt", allnames[2:]),
+                                 ("&after-name=bb&limit=2", allnames[3:5]),
+                                 ("&after-name=n%C3%BC.txt&offset=1",
+                                  allnames[7:]),
+                                 # the same name, not in NFC
+                                 ("&after-name=nu%CC%88.txt&offset=1",
+                                  allnames[7:]),
+                                 ]:
+            d.addCallback(lambda ign, args=args: self.GET(url + args))
+            def _check(res, args=args, expected=expected):
+                data = simplejson.loads(res)
+                self.failUnlessEqual(data[0], "dirnode")
+                self.failUnlessReallyEqual(to_str(data[1]["rw_uri"]),
+                                           self._foo_uri)
+                self.failUnlessEqual(sorted(data[1]["children"].keys()),
+                                     expected, args)
+            d.addCallback(_check)
+        for args in ["&offset=-1", "&limit=many"]:
+            d.addCallback(lambda ign, args=args:
+                          self.shouldHTTPError("test_GET_DIRURL_json_pages",
+                                               400, "Bad Request",
+                                               "offset= and limit=",
+                                               self.GET, url + args))
+        d.addCallback(lambda ign:
+                      self.shouldHTTPError("test_GET_DIRURL_json_pages",
+                                           400, "Bad Request",
+                                           "after-name= must be UTF-8",
+                                           self.GET, url + "&after-name=%FF"))
+        # each page has its own ETag
+        d.addCallback(lambda ign: self._get_etag_and_cache_control(url))
+        d.addCallback(lambda (etag, cache_control):
+                      self._get_etag_and_cache_control(url + "&limit=3"))
+        d.addCallback(lambda (etag, cache_control):
+                      self._GET_conditional(url + "&limit=4", etag))
+        d.addCallback(lambda (code, data):
+                      self.failUnlessReallyEqual(code, http.OK))
+        return d
+
+    def test_GET_DIRURL_large(self):
+        # listings with more children than get rendered in one turn
+        count = 2*directory.JSON_CHILDREN_PER_TURN + 17
+        bar = self.s.create_node_from_uri(self._bar_txt_uri)
+        names = [u"file-%04d" % i for i in range(count)]
+        kids = dict([(name, (bar, {})) for name in names])
+        d = self.s.create_dirnode(kids)
+        def _created(dn):
+            self._large_url = "/uri/" + urllib.quote(dn.get_uri())
+        d.addCallback(_created)
+        d.addCallback(lambda ign: self.GET(self._large_url + "?t=json"))
+        def _check_json(res):
+            data = simplejson.loads(res)
+            children = data[1]["children"]
+            self.failUnlessEqual(sorted(children.keys()), names)
+            for name in names:
+                self.failUnlessEqual(children[name][0], "filenode")
+                self.failUnlessReallyEqual(to_str(children[name][1]["ro_uri"]),
+                                           self._bar_txt_uri)
+        d.addCallback(_check_json)
+        d.addCallback(lambda ign: self.GET(self._large_url + "?t=json"
+                                           "&after-name=file-0150&limit=100"))
+        def _check_page(res):
+            children = simplejson.loads(res)[1]["children"]
+            self.failUnlessEqual(sorted(children.keys()), names[151:])
+        d.addCallback(_check_page)
+        d.addCallback(lambda ign: self.GET(self._large_url + "/"))
+        def _check_html(res):
+            rows = re.findall(r'<td><a href="[^"]*">(file-\d+)</a></td>', res)
+            self.failUnlessEqual(rows, [str(name) for name in names])
+        d.addCallback(_check_html)
+        return d
+
 
     def test_POST_DIRURL_manifest_no_ophandle(self):
         d = self.shouldFail2(error.Error,
@@ -3300,6 +3606,80 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
     def test_POST_set_children_with_hyphen(self):
         return self.test_POST_set_children(command_name="set-children")
 
+    def test_POST_batch(self):
+        contents, n, newuri = self.makefile(9)
+        ops = [{"op": "set", "name": "new.txt", "rw_uri": newuri,
+                "metadata": {"color": "blue"}},
+               {"op": "set", "name": "sub", "rw_uri": newuri,
+                "replace": False},
+               {"op": "rename", "from_name": "bar.txt",
+                "to_name": "renamed.txt"},
+               {"op": "unlink", "name": "missing"},
+               {"op": "set-metadata", "name": "renamed.txt",
+                "metadata": {"color": "red"}},
+               ]
+        d = self.POST2(self.public_url + "/foo?t=batch", simplejson.dumps(ops))
+        def _check(res):
+            results = simplejson.loads(res)
+            self.failUnlessReallyEqual([r["status"] for r in results],
+                                       ["ok", "error", "ok", "error", "ok"])
+            self.failUnlessIn("ExistingChildError", results[1]["error"])
+            self.failUnlessIn("NoSuchChildError", results[3]["error"])
+        d.addCallback(_check)
+        d.addCallback(lambda ign:
+                      self.failUnlessChildContentsAre(self._foo_node,
+                                                      u"new.txt", contents))
+        d.addCallback(lambda ign:
+                      self.failIfNodeHasChild(self._foo_node, u"bar.txt"))
+        d.addCallback(lambda ign:
+                      self.failUnlessNodeHasChild(self._foo_node, u"sub"))
+        d.addCallback(lambda ign:
+                      self._foo_node.get_metadata_for(u"new.txt"))
+        d.addCallback(lambda md: self.failUnlessReallyEqual(md["color"], "blue"))
+        d.addCallback(lambda ign:
+                      self._foo_node.get_metadata_for(u"renamed.txt"))
+        d.addCallback(lambda md: self.failUnlessReallyEqual(md["color"], "red"))
+        d.addCallback(lambda ign: self.GET(self.public_url + "/foo/renamed.txt"))
+        d.addCallback(self.failUnlessIsBarDotTxt)
+        return d
+
+    def test_POST_batch_non_ascii_error(self):
+        contents, n, newuri = self.makefile(9)
+        name = u"\u00e9t\u00e9.txt"
+        ops = [{"op": "set", "name": name, "rw_uri": newuri},
+               {"op": "set", "name": name, "rw_uri": newuri,
+                "replace": False},
+               {"op": "unlink", "name": u"\u263a"},
+               ]
+        d = self.POST2(self.public_url + "/foo?t=batch", simplejson.dumps(ops))
+        def _check(res):
+            results = simplejson.loads(res)
+            self.failUnlessReallyEqual([r["status"] for r in results],
+                                       ["ok", "error", "error"])
+            self.failUnlessIn(u"ExistingChildError", results[1]["error"])
+            self.failUnlessIn(name, results[1]["error"])
+            self.failUnlessIn(u"NoSuchChildError", results[2]["error"])
+            # NoSuchChildError describes itself with its repr()
+            self.failUnlessIn(u"\\u263a", results[2]["error"])
+        d.addCallback(_check)
+        return d
+
+    def test_POST_batch_bad(self):
+        url = self.public_url + "/foo?t=batch"
+        d = self.shouldFail2(error.Error, "not json", "400 Bad Request",
+                             "requires a JSON list of operations",
+                             self.POST2, url, "not json")
+        d.addCallback(lambda ign:
+            self.shouldFail2(error.Error, "unknown op", "400 Bad Request",
+                             "unknown operation",
+                             self.POST2, url,
+                             simplejson.dumps([{"op": "unlink", "name": "bar.txt"},
+                                               {"op": "frob"}])))
+        # nothing was applied
+        d.addCallback(lambda ign:
+                      self.failUnlessNodeHasChild(self._foo_node, u"bar.txt"))
+        return d
+
     def test_POST_link_uri(self):
         contents, n, newuri = self.makefile(8)
         d = self.POST(self.public_url + "/foo", t="uri", name="new.txt", uri=newuri)
@@ -3390,6 +3770,19 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(self.failUnlessIsBarJSON)
         return d
 
+    def test_POST_rename_file_keeps_metadata(self):
+        d = self._foo_node.set_metadata_for(u"bar.txt", {"color": "blue"})
+        d.addCallback(lambda ign:
+                      self.POST(self.public_url + "/foo", t="rename",
+                                from_name="bar.txt", to_name="wibble.txt"))
+        d.addCallback(lambda ign:
+                      self._foo_node.get_metadata_for(u"wibble.txt"))
+        def _check(md):
+            self.failUnlessReallyEqual(md["color"], "blue")
+            self.failUnlessIn("linkmotime", md["tahoe"])
+        d.addCallback(_check)
+        return d
+
     def test_POST_rename_file_redundant(self):
         d = self.POST(self.public_url + "/foo", t="rename",
                       from_name="bar.txt", to_name='bar.txt')
@@ -3816,6 +4209,33 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_got_json)
         return d
 
+    def test_PUT_NEWFILEURL_mdmf_segment_size(self):
+        d = self.PUT(self.public_url + "/foo/mdmf.txt?format=mdmf"
+                     "&segment-size=65536", self.NEWFILE_CONTENTS)
+        d.addCallback(lambda ign:
+                      self.failUnlessReallyEqual(self.s.nodemaker.last_segment_size,
+                                                 65536))
+        d.addCallback(lambda ign: self.PUT("/uri?format=mdmf&segment-size=4096",
+                                           self.NEWFILE_CONTENTS))
+        d.addCallback(lambda ign:
+                      self.failUnlessReallyEqual(self.s.nodemaker.last_segment_size,
+                                                 4096))
+        d.addCallback(lambda ign: self.PUT("/uri?format=mdmf",
+                                           self.NEWFILE_CONTENTS))
+        d.addCallback(lambda ign:
+                      self.failUnlessReallyEqual(self.s.nodemaker.last_segment_size,
+                                                 None))
+        for bad in ["big", "0", "%d" % (1024*1024*1024)]:
+            d.addCallback(lambda ign, bad=bad:
+                          self.shouldHTTPError("PUT_NEWFILEURL_mdmf_segment_size",
+                                               400, "Bad Request",
+                                               "segment-size= must be",
+                                               self.PUT, self.public_url +
+                                               "/foo/new.txt?format=mdmf"
+                                               "&segment-size=" + bad,
+                                               self.NEWFILE_CONTENTS))
+        return d
+
     def test_PUT_NEWFILEURL_bad_format(self):
         new_contents = self.NEWFILE_CONTENTS * 300000
         return self.shouldHTTPError("PUT_NEWFILEURL_bad_format",
@@ -3922,6 +4342,34 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_check3)
         return d
 
+    def test_PUT_NEWFILE_URI_streaming(self):
+        # big enough to make the request pause its transport
+        file_contents = "streamed\n" * 300000
+        d = self.PUT("/uri?streaming=true", file_contents)
+        def _check(uri):
+            self.failUnlessIn(uri, self.get_all_contents())
+            self.failUnlessReallyEqual(self.get_all_contents()[uri],
+                                       file_contents)
+        d.addCallback(_check)
+        return d
+
+    def test_PUT_NEWFILEURL_streaming(self):
+        d = self.PUT(self.public_url + "/foo/new.txt?streaming=true",
+                     self.NEWFILE_CONTENTS)
+        d.addCallback(self.failUnlessURIMatchesROChild, self._foo_node, u"new.txt")
+        d.addCallback(lambda res:
+                      self.failUnlessChildContentsAre(self._foo_node, u"new.txt",
+                                                      self.NEWFILE_CONTENTS))
+        return d
+
+    def test_PUT_NEWFILE_URI_streaming_mutable(self):
+        d = self.shouldFail2(error.Error, "test_PUT_NEWFILE_URI_streaming_mutable",
+                             "400 Bad Request",
+                             "streaming=true can only be used to upload immutable files",
+                             self.PUT, "/uri?streaming=true&format=mdmf",
+                             self.NEWFILE_CONTENTS)
+        return d
+
     def test_PUT_mkdir(self):
         d = self.PUT("/uri?t=mkdir", "")
         def _check(uri):
@@ -4265,6 +4713,57 @@ class IntroducerWeb(unittest.TestCase):
         return factory.deferred
 
 
+class FakeBatchDirnode:
+    def __init__(self):
+        self.batches = []
+    def get_uri(self):
+        return "URI:DIR2:fake"
+    def apply_batch(self, ops):
+        d = defer.Deferred()
+        self.batches.append((ops, d))
+        return d
+
+class Coalescer(unittest.TestCase):
+    def test_coalesce(self):
+        c = coalesce.DirectoryMutationCoalescer()
+        dn = FakeBatchDirnode()
+        results = {}
+        def _apply(op):
+            d = c.apply(dn, op)
+            d.addBoth(lambda res: results.__setitem__(op, res))
+        # changes made in the same turn go in the same batch
+        _apply(("delete", u"a"))
+        _apply(("delete", u"b"))
+        d = fireEventually()
+        def _sent_first(ign):
+            self.failUnlessEqual(len(dn.batches), 1)
+            self.failUnlessEqual(dn.batches[0][0],
+                                 [("delete", u"a"), ("delete", u"b")])
+            # and those made while it is being applied wait for it to finish
+            _apply(("delete", u"c"))
+            _apply(("delete", u"d"))
+            return fireEventually()
+        d.addCallback(_sent_first)
+        def _waiting(ign):
+            self.failUnlessEqual(len(dn.batches), 1)
+            dn.batches[0][1].callback([None, interfaces.NoSuchChildError(u"b")])
+            self.failUnlessEqual(results[("delete", u"a")], None)
+            results[("delete", u"b")].trap(interfaces.NoSuchChildError)
+            return fireEventually()
+        d.addCallback(_waiting)
+        def _sent_second(ign):
+            self.failUnlessEqual(len(dn.batches), 2)
+            self.failUnlessEqual(dn.batches[1][0],
+                                 [("delete", u"c"), ("delete", u"d")])
+            # if the whole batch fails, so does every change in it
+            dn.batches[1][1].errback(ValueError("boom"))
+            results[("delete", u"c")].trap(ValueError)
+            results[("delete", u"d")].trap(ValueError)
+            self.failUnlessEqual(c.get_stats(),
+                                 {"batches": 2, "operations": 4})
+        d.addCallback(_sent_second)
+        return d
+
 class Util(ShouldFailMixin, testutil.ReallyEqualMixin, unittest.TestCase):
     def test_load_file(self):
         # This will raise an exception unless a well-formed XML file is found under that name.
@@ -4278,6 +4777,82 @@ class Util(ShouldFailMixin, testutil.ReallyEqualMixin, unittest.TestCase):
         self.shouldFail(AssertionError, "test_parse_replace_arg", "",
                         common.parse_replace_arg, "only_fles")
 
+    def test_merge_ranges(self):
+        merge_ranges = filenode.merge_ranges
+        self.failUnlessReallyEqual(merge_ranges([]), [])
+        self.failUnlessReallyEqual(merge_ranges([(5,9), (0,2)]),
+                                   [(0,2), (5,9)])
+        self.failUnlessReallyEqual(merge_ranges([(5,9), (0,4)]), [(0,9)])
+        self.failUnlessReallyEqual(merge_ranges([(0,9), (2,3), (8,12)]),
+                                   [(0,12)])
+
+    def test_byteranges_consumer(self):
+        data = "".join([chr(i) for i in range(100)])
+        parts = [(12, 20, "<a>"), (25, 25, "<b>"), (30, 59, "<c>")]
+        expected = ("<a>" + data[12:21] + "\r\n" + "<b>" + data[25] + "\r\n"
+                    + "<c>" + data[30:60] + "\r\n")
+        # the consumer must produce the same output no matter how the data
+        # is chunked
+        for chunksize in (1, 3, 7, 48):
+            req = MemoryConsumer()
+            c = filenode.ByteRangesConsumer(req, 10, parts)
+            for start in range(10, 60, chunksize):
+                c.write(data[start:min(start+chunksize, 60)])
+            self.failUnlessReallyEqual("".join(req.chunks), expected)
+        # data that falls within a single part is passed through uncopied
+        req = MemoryConsumer()
+        c = filenode.ByteRangesConsumer(req, 30, parts[2:])
+        chunk = data[31:40]
+        c.write(data[30:31])
+        c.write(chunk)
+        self.failUnlessIdentical(req.chunks[-1], chunk)
+
+    def test_directory_json_streamer(self):
+        class PausingRequest(MemoryConsumer):
+            def __init__(self):
+                MemoryConsumer.__init__(self)
+                self.finished = defer.Deferred()
+            def setHeader(self, name, value):
+                pass
+            def notifyFinish(self):
+                return self.finished
+            def write(self, data):
+                MemoryConsumer.write(self, data)
+                if len(self.chunks) == 3:
+                    # the transport's buffer is full
+                    self.producer.pauseProducing()
+        self.patch(directory, "JSON_CHILDREN_PER_TURN", 2)
+        self.patch(directory, "json_child", lambda node, metadata: metadata)
+        names = [u"a", u"b", u"c", u"d", u"e"]
+        children = dict([(name, (None, {"n": i}))
+                         for (i, name) in enumerate(names)])
+        req = PausingRequest()
+        streamer = directory.DirectoryJSONStreamer(req, children, names[1:],
+                                                   {"mutable": True})
+        d = streamer.start()
+        d2 = fireEventually()
+        d2.addCallback(fireEventually)
+        def _paused(ign):
+            # the header and the first two children, and nothing more
+            # while we are paused
+            self.failUnlessEqual(len(req.chunks), 3)
+            self.failIf(req.done)
+            req.producer.resumeProducing()
+            return d
+        d2.addCallback(_paused)
+        def _done(res):
+            self.failUnlessEqual(res, "")
+            self.failUnless(req.done)
+            data = simplejson.loads("".join(req.chunks))
+            self.failUnlessEqual(data, ["dirnode",
+                                        {"mutable": True,
+                                         "children": {"b": {"n": 1},
+                                                      "c": {"n": 2},
+                                                      "d": {"n": 3},
+                                                      "e": {"n": 4}}}])
+        d2.addCallback(_done)
+        return d2
+
     def test_abbreviate_time(self):
         self.failUnlessReallyEqual(common.abbreviate_time(None), "")
         self.failUnlessReallyEqual(common.abbreviate_time(1.234), "1.23s")
@@ -5665,6 +6240,128 @@ class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMi
                                                        self.GET, self.child_url))
         return d
 
+    def test_PUT_streaming(self):
+        self.basedir = "web/Grid/PUT_streaming"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        # more than StreamingData.max_buffered, so the upload will have to
+        # pause and resume the HTTP connection
+        DATA = "streamed data\n" * 200000
+        d = self.PUT("uri?streaming=true", postdata=DATA)
+        def _uploaded(filecap):
+            n = c0.create_node_from_uri(filecap.strip())
+            self.failIf(n.is_mutable())
+            return download_to_data(n)
+        d.addCallback(_uploaded)
+        d.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA))
+        return d
+
+    def test_GET_multirange_mdmf_segment_size(self):
+        self.basedir = "web/Grid/GET_multirange_mdmf_segment_size"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        # 4KiB segments: these ranges are all well within
+        # DEFAULT_MAX_SEGMENT_SIZE of each other, but only the first two
+        # are less than a segment apart
+        DATA = "".join(["%09d\n" % i for i in range(5000)])
+        ranges = [(10, 19), (4100, 4109), (20000, 20009), (30000, 30099)]
+        headers = {"range": "bytes=" + ",".join(["%d-%d" % r
+                                                 for r in ranges])}
+        d = c0.create_mutable_file(publish.MutableData(DATA),
+                                   version=MDMF_VERSION, segment_size=4096)
+        def _created(n):
+            h = c0.get_history()
+            self.retrieves = len(list(h.list_all_retrieve_statuses()))
+            return self.GET("uri/%s" % urllib.quote(n.get_uri()),
+                            headers=headers, return_response=True)
+        d.addCallback(_created)
+        def _got((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            parts = parse_byteranges(res, headers["content-type"][0])
+            self.failUnlessReallyEqual([data for (ctype, crange, data)
+                                        in parts],
+                                       [DATA[first:last+1]
+                                        for (first, last) in ranges])
+            # one read() for the first two ranges, one for each of the rest
+            h = c0.get_history()
+            retrieves = len(list(h.list_all_retrieve_statuses()))
+            self.failUnlessReallyEqual(retrieves - self.retrieves, 3)
+        d.addCallback(_got)
+        return d
+
+    def test_GET_multirange(self):
+        self.basedir = "web/Grid/GET_multirange"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        # four 128KiB segments, with ranges in the first, second and last
+        DATA = "".join(["%09d\n" % i for i in range(50000)])
+        ranges = [(10, 19), (1000, 1999), (130000, 130009),
+                  (len(DATA)-10, len(DATA)-1)]
+        headers = {"range": "bytes=" + ",".join(["%d-%d" % r
+                                                 for r in ranges])}
+        d = c0.upload(upload.Data(DATA, convergence=""))
+        def _uploaded(ur):
+            self.si = uri.from_string(ur.get_uri()).get_storage_index()
+            return self.GET("uri/%s" % ur.get_uri(), headers=headers,
+                            return_response=True)
+        d.addCallback(_uploaded)
+        def _got((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failUnlessReallyEqual(int(headers["content-length"][0]),
+                                       len(res))
+            parts = parse_byteranges(res, headers["content-type"][0])
+            self.failUnlessReallyEqual(
+                parts,
+                [("text/plain", "bytes %d-%d/%d" % (first, last, len(DATA)),
+                  DATA[first:last+1]) for (first, last) in ranges])
+            [ds] = [ds for ds
+                    in c0.get_history().list_all_download_statuses()
+                    if ds.get_storage_index() == self.si]
+            # the first three ranges were fetched with a single read, and no
+            # segment was downloaded twice
+            self.failUnlessReallyEqual(len(ds.read_events), 2)
+            segnums = [ev["segment_number"] for ev in ds.segment_events]
+            self.failUnlessReallyEqual(sorted(set(segnums)), segnums)
+        d.addCallback(_got)
+        return d
+
+    def test_GET_etags_mutable(self):
+        self.basedir = "web/Grid/GET_etags_mutable"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        d = c0.create_mutable_file(publish.MutableData("mutable data"))
+        def _created(n):
+            self.url = "uri/%s" % urllib.quote(n.get_uri())
+            return self.GET(self.url, return_response=True)
+        d.addCallback(_created)
+        def _got((data, code, headers)):
+            self.failUnlessReallyEqual(data, "mutable data")
+            self.etag = headers["etag"][0]
+            h = c0.get_history()
+            self.retrieves = len(list(h.list_all_retrieve_statuses()))
+            return self.GET(self.url, return_response=True,
+                            headers={"If-None-Match": self.etag})
+        d.addCallback(_got)
+        def _not_modified((data, code, headers)):
+            self.failUnlessReallyEqual(int(code), http.NOT_MODIFIED)
+            self.failUnlessReallyEqual(data, "")
+            # the servermap told us that nothing changed, so no data was
+            # retrieved
+            h = c0.get_history()
+            self.failUnlessReallyEqual(
+                len(list(h.list_all_retrieve_statuses())), self.retrieves)
+        d.addCallback(_not_modified)
+        d.addCallback(lambda ign: self.PUT(self.url, postdata="new data"))
+        d.addCallback(lambda ign:
+                      self.GET(self.url, return_response=True,
+                               headers={"If-None-Match": self.etag}))
+        def _modified((data, code, headers)):
+            self.failUnlessReallyEqual(int(code), http.OK)
+            self.failUnlessReallyEqual(data, "new data")
+            self.failIfEqual(headers["etag"][0], self.etag)
+        d.addCallback(_modified)
+        return d
+
 
 class CompletelyUnhandledError(Exception):
     pass
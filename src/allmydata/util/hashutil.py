@@ -209,3 +209,13 @@ def constant_time_compare(a, b):
 BACKUPDB_DIRHASH_TAG = "allmydata_backupdb_dirhash_v1"
 def backupdb_dirhash(contents):
     return tagged_hash(BACKUPDB_DIRHASH_TAG, contents)
+
+KEY_POOL_SECRET_TAG = "allmydata_key_pool_secret_v1"
+KEY_POOL_KEY_TAG = "allmydata_key_pool_secret_and_salt_to_key_v1"
+KEY_POOL_CHECK_TAG = "allmydata_key_pool_check_v1"
+def my_key_pool_secret_hash(my_secret):
+    return tagged_hash(my_secret, KEY_POOL_SECRET_TAG)
+def key_pool_key_hash(key_pool_secret, salt):
+    return tagged_pair_hash(KEY_POOL_KEY_TAG, key_pool_secret, salt, KEYLEN)
+def key_pool_check_hash(key, contents):
+    return tagged_pair_hash(KEY_POOL_CHECK_TAG, key, contents)
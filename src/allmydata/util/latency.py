@@ -0,0 +1,119 @@
+
+import math, time
+
+class LatencyHistogram:
+    """I summarize a stream of latency measurements (in seconds) in a fixed
+    amount of memory, well enough to answer percentile questions.
+
+    Each measurement is counted in a bucket: every power of two is split
+    into SUB_BUCKETS equal-width buckets, so a percentile is reported to
+    within about 1/(2*SUB_BUCKETS) (3%) of the true value. Measurements
+    below MIN_VALUE or above MAX_VALUE are counted in the lowest or highest
+    bucket, which bounds the number of buckets. The count, sum, minimum and
+    maximum are kept exactly.
+    """
+    SUB_BUCKETS = 16
+    MIN_VALUE = 2.0**-20 # about a microsecond
+    MAX_VALUE = 2.0**16 # about eighteen hours
+
+    def __init__(self):
+        self.buckets = {} # index -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        value = min(max(value, self.MIN_VALUE), self.MAX_VALUE)
+        mantissa, exponent = math.frexp(value) # 0.5 <= mantissa < 1
+        sub = int((mantissa - 0.5) * 2 * self.SUB_BUCKETS)
+        return exponent * self.SUB_BUCKETS + min(sub, self.SUB_BUCKETS-1)
+
+    def _value(self, index):
+        # the middle of the bucket
+        exponent, sub = divmod(index, self.SUB_BUCKETS)
+        mantissa = 0.5 + (sub + 0.5) / (2.0 * self.SUB_BUCKETS)
+        return math.ldexp(mantissa, exponent)
+
+    def add(self, value):
+        i = self._index(value)
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, c in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + c
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def get_percentile(self, fraction):
+        """Return (approximately) the value below which 'fraction' of the
+        measurements fall, or None if there are no measurements. This is
+        the value that sorted(samples)[int(fraction*count)] would give."""
+        return self.get_percentiles([fraction])[fraction]
+
+    def get_percentiles(self, fractions):
+        """Return a dict mapping each of 'fractions' to what
+        get_percentile() would return for it, in a single pass."""
+        if not self.count:
+            return dict([(f, None) for f in fractions])
+        ranks = sorted([(min(int(f * self.count), self.count - 1), f)
+                        for f in fractions])
+        results = {}
+        seen = 0
+        indices = sorted(self.buckets)
+        for rank, f in ranks:
+            # the extremes are known exactly
+            if rank == 0:
+                results[f] = self.min
+                continue
+            if rank == self.count - 1:
+                results[f] = self.max
+                continue
+            while seen + self.buckets[indices[0]] <= rank:
+                seen += self.buckets[indices.pop(0)]
+            results[f] = min(max(self._value(indices[0]), self.min), self.max)
+        return results
+
+class WindowedLatencyHistogram:
+    """I keep one LatencyHistogram for each minute of the last hour, so that
+    percentiles can be reported for recent windows of time. A window of N
+    minutes covers the current (partial) minute and the N before it."""
+    SLOT = 60
+    MAX_WINDOW = 60*60
+
+    def __init__(self):
+        self.slots = {} # minute number -> LatencyHistogram
+
+    def add(self, value, now=None):
+        if now is None:
+            now = time.time()
+        slot = int(now // self.SLOT)
+        if slot not in self.slots:
+            oldest = slot - self.MAX_WINDOW // self.SLOT
+            for old in [s for s in self.slots if s < oldest]:
+                del self.slots[old]
+            self.slots[slot] = LatencyHistogram()
+        self.slots[slot].add(value)
+
+    def get_histogram(self, window, now=None):
+        """Return a LatencyHistogram of the measurements made in the last
+        'window' seconds."""
+        if now is None:
+            now = time.time()
+        slot = int(now // self.SLOT)
+        oldest = slot - window // self.SLOT
+        h = LatencyHistogram()
+        for s, sh in self.slots.items():
+            if oldest <= s <= slot:
+                h.merge(sh)
+        return h
@@ -0,0 +1,83 @@
+
+import weakref
+
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+from foolscap.api import eventually
+
+from allmydata.util import log
+
+class DirectoryMutationCoalescer:
+    """I merge small changes to the same directory (adding a child by cap,
+    unlinking one, renaming one) that arrive close together into a single
+    DirectoryNode.apply_batch() call, so that a client which adds a thousand
+    entries one request at a time does not cause a thousand
+    read-modify-publish cycles.
+
+    A batch is sent 'window' seconds after its first change arrives (or on
+    the next turn of the event loop, if 'window' is zero). While a batch for
+    a directory is being applied, further changes to that directory are
+    held back and sent together when it finishes. Each change is answered
+    with its own result, just as if it had been applied alone."""
+
+    def __init__(self, window=0):
+        self._window = window
+        self._pending = {} # dirnode uri -> (dirnode, [(op, Deferred)])
+        self._busy = set() # dirnode uris with a batch in flight
+        self._stats = {"batches": 0, "operations": 0}
+
+    def apply(self, dirnode, op):
+        """Apply one Batcher operation to 'dirnode', together with any other
+        changes to the same directory. I return a Deferred that fires with
+        None, or errbacks with the reason this operation failed."""
+        key = dirnode.get_uri()
+        d = defer.Deferred()
+        if key not in self._pending:
+            self._pending[key] = (dirnode, [])
+            if key not in self._busy:
+                self._schedule(key)
+        self._pending[key][1].append((op, d))
+        return d
+
+    def get_stats(self):
+        return self._stats.copy()
+
+    def _schedule(self, key):
+        if self._window:
+            reactor.callLater(self._window, self._flush, key)
+        else:
+            eventually(self._flush, key)
+
+    def _flush(self, key):
+        dirnode, waiting = self._pending.pop(key)
+        self._busy.add(key)
+        self._stats["batches"] += 1
+        self._stats["operations"] += len(waiting)
+        log.msg(format="applying %(count)d coalesced changes to a directory",
+                count=len(waiting), level=log.NOISY, umid="nb3Fpw")
+        d = dirnode.apply_batch([op for (op, wd) in waiting])
+        def _done(res):
+            self._busy.discard(key)
+            if key in self._pending:
+                self._schedule(key)
+            for i, (op, wd) in enumerate(waiting):
+                if isinstance(res, Failure):
+                    wd.errback(res)
+                elif res[i] is None:
+                    wd.callback(None)
+                else:
+                    wd.errback(Failure(res[i]))
+        d.addBoth(_done)
+        d.addErrback(log.err, umid="OjbB0w")
+
+_coalescers = weakref.WeakKeyDictionary()
+
+def set_mutation_coalescer(client, coalescer):
+    _coalescers[client] = coalescer
+
+def get_mutation_coalescer(client):
+    """Return the DirectoryMutationCoalescer used by the web frontend of
+    'client', creating one with no extra delay if it has none yet."""
+    if client not in _coalescers:
+        _coalescers[client] = DirectoryMutationCoalescer()
+    return _coalescers[client]
@@ -12,7 +12,9 @@ from allmydata.interfaces import ExistingChildError, NoSuchChildError, \
      EmptyPathnameComponentError, MustBeDeepImmutableError, \
      MustBeReadonlyError, MustNotBeUnknownRWError, SDMF_VERSION, MDMF_VERSION
 from allmydata.mutable.common import UnrecoverableFileError
-from allmydata.util import abbreviate
+from allmydata.mutable.publish import MAX_SEGMENT_SIZE
+from allmydata.immutable.upload import FileHandle, StreamingData
+from allmydata.util import abbreviate, base32, hashutil
 from allmydata.util.encodingutil import to_str, quote_output
 
 
@@ -63,6 +65,21 @@ def get_mutable_type(file_format): # accepts result of get_format()
         #      do_immutable()
         return None
 
+def get_segment_size(req):
+    """Return the segment size asked for with segment-size= when creating an
+    MDMF file, or None to let the node choose one."""
+    arg = get_arg(req, "segment-size", None)
+    if not arg:
+        return None
+    try:
+        segment_size = int(arg)
+    except ValueError:
+        raise WebError("segment-size= must be an integer", http.BAD_REQUEST)
+    if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+        raise WebError("segment-size= must be between 1 and %d" %
+                       MAX_SEGMENT_SIZE, http.BAD_REQUEST)
+    return segment_size
+
 
 def parse_offset_arg(offset):
     # XXX: This will raise a ValueError when invoked on something that
@@ -76,6 +93,67 @@ def parse_offset_arg(offset):
     return offset
 
 
+def get_immutable_uploadable(req, convergence):
+    # the body of a "PUT ?streaming=true" is uploaded while it is still
+    # arriving: see webish.MyRequest.gotLength
+    if isinstance(req.content, StreamingData):
+        return req.content
+    return FileHandle(req.content, convergence)
+
+def reject_streaming_upload(req):
+    if isinstance(req.content, StreamingData):
+        raise WebError("streaming=true can only be used to upload immutable "
+                       "files", http.BAD_REQUEST)
+
+# immutable resources never change, so caches may keep them for a year.
+# Mutable ones may be stored, but must be revalidated (with If-None-Match)
+# before each use.
+IMMUTABLE_CACHE_CONTROL = "max-age=31536000"
+MUTABLE_CACHE_CONTROL = "no-cache"
+
+def immutable_etag(node):
+    """Return the basis of a strong ETag for an immutable file or directory.
+    This is derived from the verifycap, which pins down the exact contents
+    (LIT caps have no verifycap, but contain the contents themselves)."""
+    verifycap = node.get_verify_cap()
+    if verifycap:
+        capstring = verifycap.to_string()
+    else:
+        capstring = node.get_readonly_uri()
+    h = hashutil.tagged_hash("allmydata_webapi_etag_v1", capstring, 16)
+    return base32.b2a(h)
+
+def mutable_etag(node, version):
+    """Return the basis of a strong ETag for one version of a mutable file
+    or directory, derived from its sequence number and root hash."""
+    v = "%s:%d:%s" % (node.get_storage_index(),
+                      version.get_sequence_number(), version.get_root_hash())
+    h = hashutil.tagged_hash("allmydata_webapi_etag_v1", v, 16)
+    return base32.b2a(h)
+
+def set_etag(req, etag, mutable):
+    """Send 'etag' as a strong ETag, along with a Cache-Control header that
+    suits the mutability of the resource. If the request carries an
+    If-None-Match header that matches, I set a 304 (Not Modified) response
+    code and return True: the caller should then send no body."""
+    tag = '"%s"' % etag
+    req.setHeader("etag", tag)
+    if mutable:
+        req.setHeader("cache-control", MUTABLE_CACHE_CONTROL)
+    else:
+        req.setHeader("cache-control", IMMUTABLE_CACHE_CONTROL)
+    tags = req.getHeader("if-none-match")
+    if not tags:
+        return False
+    # If-None-Match uses the weak comparison function, so W/ is ignored
+    tags = [t.strip() for t in tags.split(",")]
+    tags = [t[2:] if t.startswith("W/") else t for t in tags]
+    if tag in tags or "*" in tags:
+        req.setResponseCode(http.NOT_MODIFIED)
+        return True
+    return False
+
+
 def get_root(ctx_or_req):
     req = IRequest(ctx_or_req)
     # the addSlash=True gives us one extra (empty) segment
@@ -1,4 +1,5 @@
 
+import bisect
 import simplejson
 import urllib
 
@@ -10,28 +11,30 @@ from twisted.web import http
 from nevow import url, rend, inevow, tags as T
 from nevow.inevow import IRequest
 
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, eventually
 
-from allmydata.util import base32, time_format
+from allmydata.util import base32, hashutil, time_format
 from allmydata.uri import from_string_dirnode
 from allmydata.interfaces import IDirectoryNode, IFileNode, IFilesystemNode, \
      IImmutableFileNode, IMutableFileNode, ExistingChildError, \
      NoSuchChildError, EmptyPathnameComponentError, SDMF_VERSION, MDMF_VERSION
 from allmydata.blacklist import ProhibitedNode
 from allmydata.monitor import Monitor, OperationCancelledError
+from allmydata.storage_client import LeaseBatcher
 from allmydata import dirnode
 from allmydata.web.common import text_plain, WebError, \
      IOpHandleTable, NeedOperationHandleError, \
      boolean_of_arg, get_arg, get_root, parse_replace_arg, \
      should_create_intermediate_directories, \
      getxmlfile, RenderMixin, humanize_failure, convert_children_json, \
-     get_format, get_mutable_type
+     get_format, get_mutable_type, set_etag, immutable_etag, mutable_etag
 from allmydata.web.filenode import ReplaceMeMixin, \
      FileNodeHandler, PlaceHolderNodeHandler
 from allmydata.web.check_results import CheckResultsRenderer, \
      CheckAndRepairResultsRenderer, DeepCheckResultsRenderer, \
      DeepCheckAndRepairResultsRenderer, LiteralCheckResultsRenderer
 from allmydata.web.info import MoreInfo
+from allmydata.web.coalesce import get_mutation_coalescer
 from allmydata.web.operations import ReloadMixin
 from allmydata.web.check_results import json_check_results, \
      json_check_and_repair_results
@@ -145,7 +148,8 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
 
     def render_DELETE(self, ctx):
         assert self.parentnode and self.name
-        d = self.parentnode.delete(self.name)
+        d = get_mutation_coalescer(self.client).apply(self.parentnode,
+                                                     ("delete", self.name))
         d.addCallback(lambda res: self.node.get_uri())
         return d
 
@@ -157,19 +161,35 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         # t=info contains variable ophandles, t=rename-form contains the name
         # of the child being renamed. Neither is allowed an ETag.
         FIXED_OUTPUT_TYPES =  ["", "json", "uri", "readonly-uri"]
+        etag_t = t
+        if t == "json":
+            # each page of a paginated listing gets its own ETag
+            page = get_listing_page(req)
+            if page != (0, None, None):
+                etag_t += "-" + listing_page_etag(page)
         if not self.node.is_mutable() and t in FIXED_OUTPUT_TYPES:
-            si = self.node.get_storage_index()
-            if si and req.setETag('DIR:%s-%s' % (base32.b2a(si), t or "")):
+            if set_etag(req, "DIR:%s-%s" % (immutable_etag(self.node), etag_t),
+                        mutable=False):
                 return ""
 
-        if not t:
-            # render the directory as HTML, using the docFactory and Nevow's
-            # whole templating thing.
-            return DirectoryAsHTML(self.node,
-                                   self.client.mutable_file_default)
+        if self.node.is_mutable() and t in ("", "json"):
+            # find the current version first, so that a client which already
+            # has it can be answered without fetching the directory contents
+            d = self.node.get_best_readable_version()
+            def _got_version(version):
+                if set_etag(req, "DIR:%s-%s" % (mutable_etag(self.node,
+                                                             version), etag_t),
+                            mutable=True):
+                    return ""
+                return self._render_listing(ctx, t, version)
+            def _no_version(f):
+                # let the listing report the problem, as it always has
+                return self._render_listing(ctx, t)
+            d.addCallbacks(_got_version, _no_version)
+            return d
 
-        if t == "json":
-            return DirectoryJSONMetadata(ctx, self.node)
+        if t in ("", "json"):
+            return self._render_listing(ctx, t)
         if t == "info":
             return MoreInfo(self.node)
         if t == "uri":
@@ -181,6 +201,15 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
 
         raise WebError("GET directory: bad t=%s" % t)
 
+    def _render_listing(self, ctx, t, version=None):
+        if not t:
+            # render the directory as HTML, using the docFactory and Nevow's
+            # whole templating thing.
+            return DirectoryAsHTML(self.node,
+                                   self.client.mutable_file_default, version)
+        assert t == "json"
+        return DirectoryJSONMetadata(ctx, self.node, version)
+
     def render_PUT(self, ctx):
         req = IRequest(ctx)
         t = get_arg(req, "t", "").strip()
@@ -237,6 +266,8 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
             d = self._POST_stream_manifest(ctx)
         elif t == "set_children" or t == "set-children":
             d = self._POST_set_children(req)
+        elif t == "batch":
+            d = self._POST_batch(req)
         else:
             raise WebError("POST to a directory with bad t=%s" % t)
 
@@ -350,7 +381,10 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         # know whether it is a read cap. Passing a read cap as the writecap
         # argument will work (it ends up calling NodeMaker.create_from_cap,
         # which derives a readcap if necessary and possible).
-        d = self.node.set_uri(name, childcap, None, overwrite=replace)
+        childnode = self.client.create_node_from_uri(childcap, None, name=name)
+        childnode.raise_error()
+        d = get_mutation_coalescer(self.client).apply(self.node,
+            ("set", name, childnode, None, replace))
         d.addCallback(lambda res: childcap)
         return d
 
@@ -368,7 +402,8 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
             name = ''
         charset = get_arg(req, "_charset", "utf-8")
         name = name.decode(charset)
-        d = self.node.delete(name)
+        d = get_mutation_coalescer(self.client).apply(self.node,
+                                                     ("delete", name))
         d.addCallback(lambda res: "thing unlinked")
         return d
 
@@ -396,7 +431,8 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
             raise WebError("to_name= may not contain a slash", http.BAD_REQUEST)
 
         replace = boolean_of_arg(get_arg(req, "replace", "true"))
-        d = self.node.move_child_to(from_name, self.node, to_name, replace)
+        d = get_mutation_coalescer(self.client).apply(self.node,
+            ("rename", from_name, to_name, replace))
         d.addCallback(lambda res: "thing renamed")
         return d
 
@@ -587,11 +623,92 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         # TODO: results
         return d
 
+    def _POST_batch(self, req):
+        req.content.seek(0)
+        body = req.content.read()
+        try:
+            operations = simplejson.loads(body)
+        except ValueError, le:
+            raise WebError("t=batch requires a JSON list of operations: %s"
+                           % (le,), http.BAD_REQUEST)
+        if not isinstance(operations, list):
+            raise WebError("t=batch requires a JSON list of operations",
+                           http.BAD_REQUEST)
+        ops = [self._parse_batch_operation(o) for o in operations]
+        d = self.node.apply_batch(ops)
+        def _done(results):
+            req.setHeader("content-type", "text/plain")
+            out = []
+            for res in results:
+                if res is None:
+                    out.append({"status": "ok"})
+                else:
+                    out.append({"status": "error",
+                                "error": describe_batch_error(res)})
+            return simplejson.dumps(out, indent=1) + "\n"
+        d.addCallback(_done)
+        return d
+
+    def _parse_batch_operation(self, o):
+        def _name(key):
+            name = o.get(key)
+            if not isinstance(name, basestring):
+                raise WebError("t=batch: %s operation requires %s"
+                               % (op, key), http.BAD_REQUEST)
+            return unicode(name) # simplejson-2.0.1 returns str *or* unicode
+        def _replace():
+            replace = o.get("replace", True)
+            if replace not in (True, False, "only-files"):
+                raise WebError("t=batch: bad replace= value %r" % (replace,),
+                               http.BAD_REQUEST)
+            return replace
+        if not isinstance(o, dict):
+            raise WebError("t=batch: each operation must be a JSON object",
+                           http.BAD_REQUEST)
+        op = o.get("op")
+        if op == "set":
+            writecap = o.get("rw_uri")
+            if writecap is not None:
+                writecap = str(writecap)
+            readcap = o.get("ro_uri")
+            if readcap is not None:
+                readcap = str(readcap)
+            name = _name("name")
+            child = self.client.create_node_from_uri(writecap, readcap,
+                                                     name=name)
+            return ("set", name, child, o.get("metadata"), _replace())
+        if op in ("delete", "unlink"):
+            return ("delete", _name("name"), True)
+        if op == "rename":
+            to_name = _name("to_name")
+            if "/" in to_name:
+                raise WebError("to_name= may not contain a slash",
+                               http.BAD_REQUEST)
+            return ("rename", _name("from_name"), to_name, _replace())
+        if op == "set-metadata":
+            metadata = o.get("metadata")
+            if not isinstance(metadata, dict):
+                raise WebError("t=batch: set-metadata operation requires "
+                               "metadata", http.BAD_REQUEST)
+            return ("set-metadata", _name("name"), metadata)
+        raise WebError("t=batch: unknown operation %r" % (op,),
+                       http.BAD_REQUEST)
+
+def describe_batch_error(e):
+    # exception messages may be unicode or UTF-8 bytes (quote_output()
+    # returns the latter), so neither unicode(e) nor str(e) is safe alone
+    try:
+        msg = unicode(e)
+    except UnicodeError:
+        msg = str(e).decode("utf-8", "replace")
+    return u"%s: %s" % (e.__class__.__name__, msg)
+
 def abbreviated_dirnode(dirnode):
     u = from_string_dirnode(dirnode.get_uri())
     return u.abbrev_si()
 
 SPACE = u"\u00A0"*2
+HTML_ROWS_PER_TURN = 100
 
 class DirectoryAsHTML(rend.Page):
     # The remainder of this class is to render the directory into
@@ -599,9 +716,10 @@ class DirectoryAsHTML(rend.Page):
     docFactory = getxmlfile("directory.xhtml")
     addSlash = True
 
-    def __init__(self, node, default_mutable_format):
+    def __init__(self, node, default_mutable_format, version=None):
         rend.Page.__init__(self)
         self.node = node
+        self.version = version
 
         assert default_mutable_format in (MDMF_VERSION, SDMF_VERSION)
         self.default_mutable_format = default_mutable_format
@@ -609,25 +727,9 @@ class DirectoryAsHTML(rend.Page):
     def beforeRender(self, ctx):
         # attempt to get the dirnode's children, stashing them (or the
         # failure that results) for later use
-        d = self.node.list()
+        d = self.node.list(self.version)
         def _good(children):
-            # Deferreds don't optimize out tail recursion, and the way
-            # Nevow's flattener handles Deferreds doesn't take this into
-            # account. As a result, large lists of Deferreds that fire in the
-            # same turn (i.e. the output of defer.succeed) will cause a stack
-            # overflow. To work around this, we insert a turn break after
-            # every 100 items, using foolscap's fireEventually(). This gives
-            # the stack a chance to be popped. It would also work to put
-            # every item in its own turn, but that'd be a lot more
-            # inefficient. This addresses ticket #237, for which I was never
-            # able to create a failing unit test.
-            output = []
-            for i,item in enumerate(sorted(children.items())):
-                if i % 100 == 0:
-                    output.append(fireEventually(item))
-                else:
-                    output.append(item)
-            self.dirnode_children = output
+            self.dirnode_children = sorted(children.items())
             return ctx
         def _bad(f):
             text, code = humanize_failure(f)
@@ -685,6 +787,29 @@ class DirectoryAsHTML(rend.Page):
     def data_children(self, ctx, data):
         return self.dirnode_children
 
+    def render_children(self, ctx, data):
+        # This is Nevow's 'sequence' renderer, except that the rows are
+        # produced lazily, as the page is flattened and written out, rather
+        # than all being cloned up front. For a large directory this lets the
+        # first rows reach the browser before the last ones have been built.
+        tag = ctx.tag
+        headers = tag.allPatterns("header")
+        if not data:
+            empty = tag.allPatterns("empty")
+            return tag.clear()[headers, empty]
+        pattern = tag.patternGenerator("item")
+        def _rows():
+            for i,item in enumerate(data):
+                if i and i % HTML_ROWS_PER_TURN == 0:
+                    # Nevow's flattener recurses for each item it is given,
+                    # so a long listing would overflow the stack (ticket
+                    # #237). Breaking the output into separate turns with
+                    # foolscap's fireEventually() pops the stack, and lets
+                    # the reactor do other work in between.
+                    yield fireEventually("")
+                yield pattern(data=item)
+        return tag.clear()[headers, _rows()]
+
     def render_row(self, ctx, data):
         name, (target, metadata) = data
         name = name.encode("utf-8")
@@ -884,48 +1009,165 @@ class DirectoryAsHTML(rend.Page):
         return get_arg(req, "results", "")
 
 
-def DirectoryJSONMetadata(ctx, dirnode):
-    d = dirnode.list()
-    def _got(children):
-        kids = {}
-        for name, (childnode, metadata) in children.iteritems():
-            assert IFilesystemNode.providedBy(childnode), childnode
-            rw_uri = childnode.get_write_uri()
-            ro_uri = childnode.get_readonly_uri()
-            if IFileNode.providedBy(childnode):
-                kiddata = ("filenode", {'size': childnode.get_size(),
-                                        'mutable': childnode.is_mutable(),
-                                        })
-                if childnode.is_mutable():
-                    mutable_type = childnode.get_version()
-                    assert mutable_type in (SDMF_VERSION, MDMF_VERSION)
-                    if mutable_type == MDMF_VERSION:
-                        file_format = "MDMF"
-                    else:
-                        file_format = "SDMF"
-                else:
-                    file_format = "CHK"
-                kiddata[1]['format'] = file_format
-
-            elif IDirectoryNode.providedBy(childnode):
-                kiddata = ("dirnode", {'mutable': childnode.is_mutable()})
+JSON_CHILDREN_PER_TURN = 100
+
+def get_listing_page(req):
+    """Parse the offset=, limit= and after-name= arguments of a t=json
+    directory listing, returning an (offset, limit, after_name) tuple."""
+    try:
+        offset = int(get_arg(req, "offset", 0))
+        limit = get_arg(req, "limit", None)
+        if limit is not None:
+            limit = int(limit)
+    except ValueError:
+        raise WebError("offset= and limit= must be integers")
+    if offset < 0 or (limit is not None and limit < 0):
+        raise WebError("offset= and limit= must not be negative")
+    after_name = get_arg(req, "after-name", None)
+    if after_name is not None:
+        try:
+            after_name = after_name.decode("utf-8")
+        except UnicodeDecodeError:
+            raise WebError("after-name= must be UTF-8", http.BAD_REQUEST)
+        # child names are kept in NFC, so compare against that
+        after_name = dirnode.normalize(after_name)
+    return (offset, limit, after_name)
+
+def listing_page_etag(page):
+    h = hashutil.tagged_hash("allmydata_webapi_listing_page_v1", repr(page), 8)
+    return base32.b2a(h)
+
+def select_listing_page(names, (offset, limit, after_name)):
+    """Given a sorted list of child names, return the ones on the requested
+    page: those that sort after 'after_name', less the first 'offset' of
+    them, and at most 'limit' in all."""
+    if after_name is not None:
+        names = names[bisect.bisect_right(names, after_name):]
+    names = names[offset:]
+    if limit is not None:
+        names = names[:limit]
+    return names
+
+def json_child(childnode, metadata):
+    assert IFilesystemNode.providedBy(childnode), childnode
+    rw_uri = childnode.get_write_uri()
+    ro_uri = childnode.get_readonly_uri()
+    if IFileNode.providedBy(childnode):
+        kiddata = ("filenode", {'size': childnode.get_size(),
+                                'mutable': childnode.is_mutable(),
+                                })
+        if childnode.is_mutable():
+            mutable_type = childnode.get_version()
+            assert mutable_type in (SDMF_VERSION, MDMF_VERSION)
+            if mutable_type == MDMF_VERSION:
+                file_format = "MDMF"
             else:
-                kiddata = ("unknown", {})
+                file_format = "SDMF"
+        else:
+            file_format = "CHK"
+        kiddata[1]['format'] = file_format
+
+    elif IDirectoryNode.providedBy(childnode):
+        kiddata = ("dirnode", {'mutable': childnode.is_mutable()})
+    else:
+        kiddata = ("unknown", {})
 
-            kiddata[1]["metadata"] = metadata
-            if rw_uri:
-                kiddata[1]["rw_uri"] = rw_uri
-            if ro_uri:
-                kiddata[1]["ro_uri"] = ro_uri
-            verifycap = childnode.get_verify_cap()
-            if verifycap:
-                kiddata[1]['verify_uri'] = verifycap.to_string()
+    kiddata[1]["metadata"] = metadata
+    if rw_uri:
+        kiddata[1]["rw_uri"] = rw_uri
+    if ro_uri:
+        kiddata[1]["ro_uri"] = ro_uri
+    verifycap = childnode.get_verify_cap()
+    if verifycap:
+        kiddata[1]['verify_uri'] = verifycap.to_string()
+    return kiddata
+
+class DirectoryJSONStreamer:
+    """I write a t=json directory listing to the request as it is produced,
+    instead of building it into one big string. I am registered with the
+    request as a push producer, so when the client cannot keep up I stop
+    between children until I am resumed, rather than piling the rest of
+    the listing up in the transport's buffer. At most
+    JSON_CHILDREN_PER_TURN children are written in each reactor turn, so
+    listing a huge directory does not stall other requests either."""
+    implements(IPushProducer)
 
-            kids[name] = kiddata
+    def __init__(self, req, children, names, contents):
+        self._req = req
+        self._children = children # name -> (childnode, metadata)
+        self._names = names # the names to list, in order
+        self._contents = contents # the rest of the dirnode's JSON
+        self._next = 0 # index into self._names
+        self._paused = False
+        self._scheduled = False
+        self._finished = False
+        self._done = defer.Deferred()
+
+    def start(self):
+        """Start writing. I return a Deferred that fires when the whole
+        listing has been written, or the client has gone away."""
+        self._req.notifyFinish().addBoth(lambda ign: self.stopProducing())
+        self._req.setHeader("content-type", "text/plain")
+        self._req.registerProducer(self, True)
+        self._req.write('[\n "dirnode",\n {\n  "children": {')
+        self._schedule()
+        return self._done
 
+    def pauseProducing(self):
+        self._paused = True
+    def resumeProducing(self):
+        self._paused = False
+        self._schedule()
+    def stopProducing(self):
+        # the client went away: don't bother with the rest
+        self._finish()
+
+    def _schedule(self):
+        if self._paused or self._scheduled or self._finished:
+            return
+        self._scheduled = True
+        eventually(self._write_children)
+
+    def _write_children(self):
+        self._scheduled = False
+        end = min(self._next + JSON_CHILDREN_PER_TURN, len(self._names))
+        while self._next < end and not self._paused and not self._finished:
+            i = self._next
+            name = self._names[i]
+            childnode, metadata = self._children[name]
+            self._next += 1
+            self._req.write("%s\n   %s: %s" %
+                            (i and "," or "",
+                             simplejson.dumps(name),
+                             simplejson.dumps(json_child(childnode,
+                                                         metadata))))
+        if self._finished:
+            return
+        if self._next < len(self._names):
+            # resumeProducing() takes over if we have been paused
+            self._schedule()
+            return
+        rest = simplejson.dumps(self._contents, indent=1)[1:-1].strip()
+        rest = rest.replace("\n", "\n ")
+        self._req.write("\n  },\n  %s\n }\n]\n" % rest)
+        self._finish()
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self._req.unregisterProducer()
+        eventually(self._done.callback, "")
+
+def DirectoryJSONMetadata(ctx, dirnode, version=None):
+    req = IRequest(ctx)
+    page = get_listing_page(req)
+    d = dirnode.list(version)
+    def _got(children):
+        names = select_listing_page(sorted(children.keys()), page)
+        contents = {}
         drw_uri = dirnode.get_write_uri()
         dro_uri = dirnode.get_readonly_uri()
-        contents = { 'children': kids }
         if dro_uri:
             contents['ro_uri'] = dro_uri
         if drw_uri:
@@ -934,11 +1176,8 @@ def DirectoryJSONMetadata(ctx, dirnode):
         if verifycap:
             contents['verify_uri'] = verifycap.to_string()
         contents['mutable'] = dirnode.is_mutable()
-        data = ("dirnode", contents)
-        json = simplejson.dumps(data, indent=1) + "\n"
-        return json
+        return DirectoryJSONStreamer(req, children, names, contents).start()
     d.addCallback(_got)
-    d.addCallback(text_plain, ctx)
     return d
 
 
@@ -1171,6 +1410,9 @@ class DeepCheckStreamer(dirnode.DeepStats):
         self.req = IRequest(ctx)
         self.verify = verify
         self.repair = repair
+        if add_lease:
+            # send the leases for many files in each message
+            add_lease = LeaseBatcher()
         self.add_lease = add_lease
 
     def setMonitor(self, monitor):
@@ -1232,6 +1474,13 @@ class DeepCheckStreamer(dirnode.DeepStats):
         self.req.write(j+"\n")
 
     def finish(self):
+        d = defer.succeed(None)
+        if self.add_lease:
+            d.addCallback(lambda ign: self.add_lease.flush())
+        d.addCallback(lambda ign: self.write_stats())
+        return d
+
+    def write_stats(self):
         stats = dirnode.DeepStats.get_results(self)
         d = {"type": "stats",
              "stats": stats,
@@ -1,12 +1,16 @@
 
+import os
 import simplejson
 
+from zope.interface import implements
 from twisted.web import http, static
 from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
 from nevow import url, rend
 from nevow.inevow import IRequest
 
-from allmydata.interfaces import ExistingChildError, SDMF_VERSION, MDMF_VERSION
+from allmydata.interfaces import ExistingChildError, SDMF_VERSION, \
+     MDMF_VERSION
 from allmydata.monitor import Monitor
 from allmydata.immutable.upload import FileHandle
 from allmydata.mutable.publish import MutableFileHandle
@@ -18,10 +22,13 @@ from allmydata.blacklist import FileProhibited, ProhibitedNode
 from allmydata.web.common import text_plain, WebError, RenderMixin, \
      boolean_of_arg, get_arg, should_create_intermediate_directories, \
      MyExceptionHandler, parse_replace_arg, parse_offset_arg, \
-     get_format, get_mutable_type
+     get_format, get_mutable_type, get_segment_size, \
+     get_immutable_uploadable, reject_streaming_upload, set_etag, \
+     immutable_etag, mutable_etag
 from allmydata.web.check_results import CheckResultsRenderer, \
      CheckAndRepairResultsRenderer, LiteralCheckResultsRenderer
 from allmydata.web.info import MoreInfo
+from allmydata.web.coalesce import get_mutation_coalescer
 
 class ReplaceMeMixin:
     def replace_me_with_a_child(self, req, client, replace):
@@ -29,8 +36,10 @@ class ReplaceMeMixin:
         file_format = get_format(req, "CHK")
         mutable_type = get_mutable_type(file_format)
         if mutable_type is not None:
+            reject_streaming_upload(req)
             data = MutableFileHandle(req.content)
-            d = client.create_mutable_file(data, version=mutable_type)
+            d = client.create_mutable_file(data, version=mutable_type,
+                                           segment_size=get_segment_size(req))
             def _uploaded(newnode):
                 d2 = self.parentnode.set_node(self.name, newnode,
                                               overwrite=replace)
@@ -39,7 +48,7 @@ class ReplaceMeMixin:
             d.addCallback(_uploaded)
         else:
             assert file_format == "CHK"
-            uploadable = FileHandle(req.content, convergence=client.convergence)
+            uploadable = get_immutable_uploadable(req, client.convergence)
             d = self.parentnode.add_file(self.name, uploadable,
                                          overwrite=replace)
         def _done(filenode):
@@ -60,7 +69,9 @@ class ReplaceMeMixin:
         req.content.seek(0)
         childcap = req.content.read()
         childnode = client.create_node_from_uri(childcap, None, name=self.name)
-        d = self.parentnode.set_node(self.name, childnode, overwrite=replace)
+        childnode.raise_error()
+        d = get_mutation_coalescer(client).apply(self.parentnode,
+            ("set", self.name, childnode, None, replace))
         d.addCallback(lambda res: childnode.get_uri())
         return d
 
@@ -72,7 +83,8 @@ class ReplaceMeMixin:
         if file_format in ("SDMF", "MDMF"):
             mutable_type = get_mutable_type(file_format)
             uploadable = MutableFileHandle(contents.file)
-            d = client.create_mutable_file(uploadable, version=mutable_type)
+            d = client.create_mutable_file(uploadable, version=mutable_type,
+                                           segment_size=get_segment_size(req))
             def _uploaded(newnode):
                 d2 = self.parentnode.set_node(self.name, newnode,
                                               overwrite=replace)
@@ -163,8 +175,8 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         if not self.node.is_mutable() and t in FIXED_OUTPUT_TYPES:
             # if the client already has the ETag then we can
             # short-circuit the whole process.
-            si = self.node.get_storage_index()
-            if si and req.setETag('%s-%s' % (base32.b2a(si), t or "")):
+            if set_etag(req, "%s-%s" % (immutable_etag(self.node), t),
+                        mutable=False):
                 return ""
 
         if not t:
@@ -181,9 +193,7 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
             # properly. So we assume that at least the browser will agree
             # with itself, and echo back the same bytes that we were given.
             filename = get_arg(req, "filename", self.name) or "unknown"
-            d = self.node.get_best_readable_version()
-            d.addCallback(lambda dn: FileDownloader(dn, filename))
-            return d
+            return self._get_downloader(req, filename)
         if t == "json":
             # We do this to make sure that fields like size and
             # mutable-type (which depend on the file on the grid and not
@@ -217,9 +227,25 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         t = get_arg(req, "t", "").strip()
         if t:
             raise WebError("HEAD file: bad t=%s" % t)
+        if not self.node.is_mutable():
+            if set_etag(req, "%s-" % immutable_etag(self.node),
+                        mutable=False):
+                return ""
         filename = get_arg(req, "filename", self.name) or "unknown"
+        return self._get_downloader(req, filename)
+
+    def _get_downloader(self, req, filename):
         d = self.node.get_best_readable_version()
-        d.addCallback(lambda dn: FileDownloader(dn, filename))
+        def _got_version(version):
+            if self.node.is_mutable():
+                # the servermap update which found this version has told us
+                # its seqnum and roothash, so we can tell a client that
+                # already has it before we fetch any data
+                if set_etag(req, "%s-" % mutable_etag(self.node, version),
+                            mutable=True):
+                    return ""
+            return FileDownloader(version, filename)
+        d.addCallback(_got_version)
         return d
 
     def render_PUT(self, ctx):
@@ -311,11 +337,13 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
 
     def render_DELETE(self, ctx):
         assert self.parentnode and self.name
-        d = self.parentnode.delete(self.name)
+        d = get_mutation_coalescer(self.client).apply(self.parentnode,
+                                                     ("delete", self.name))
         d.addCallback(lambda res: self.node.get_uri())
         return d
 
     def replace_my_contents(self, req):
+        reject_streaming_upload(req)
         req.content.seek(0)
         new_contents = MutableFileHandle(req.content)
         d = self.node.overwrite(new_contents)
@@ -324,6 +352,7 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
 
 
     def update_my_contents(self, req, offset):
+        reject_streaming_upload(req)
         req.content.seek(0)
         added_contents = MutableFileHandle(req.content)
 
@@ -346,6 +375,53 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         return d
 
 
+def merge_ranges(ranges):
+    """Given a list of (first,last) inclusive byte ranges, return a sorted
+    list in which overlapping and adjacent ranges have been merged."""
+    merged = []
+    for (first, last) in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append( (first, last) )
+    return merged
+
+class ByteRangesConsumer:
+    """I am the consumer for a single read() that covers one or more parts
+    of a multipart/byteranges response. I write each part's header and data
+    to the request as the data arrives, and discard any bytes that fall
+    between the parts."""
+    implements(IConsumer)
+
+    def __init__(self, req, offset, parts):
+        self._req = req
+        self._offset = offset # file offset of the next byte we will receive
+        self._parts = list(parts) # (first, last, header), sorted
+
+    def registerProducer(self, producer, streaming):
+        self._req.registerProducer(producer, streaming)
+    def unregisterProducer(self):
+        self._req.unregisterProducer()
+
+    def write(self, data):
+        start = self._offset
+        end = start + len(data)
+        self._offset = end
+        while self._parts:
+            (first, last, header) = self._parts[0]
+            if first >= end:
+                break
+            if first >= start:
+                self._req.write(header)
+            # when this chunk lies entirely within the part, the slice is
+            # the original string rather than a copy
+            self._req.write(data[max(first, start)-start:
+                                 min(last+1, end)-start])
+            if last+1 > end:
+                break
+            self._req.write("\r\n")
+            self._parts.pop(0)
+
 class FileDownloader(rend.Page):
     def __init__(self, filenode, filename):
         rend.Page.__init__(self)
@@ -400,6 +476,35 @@ class FileDownloader(rend.Page):
         except ValueError:
             return None
 
+    def _read_parts(self, req, parts, finished):
+        # Parts that are less than a segment apart are fetched with a
+        # single read(), so that each segment is downloaded (at most) once.
+        # Each read() uses the same filenode, and therefore the same
+        # DownloadNode and its share/hash state. The segment size is the
+        # file's own: MDMF files may choose theirs.
+        d = self.filenode.get_segment_size()
+        def _got_segment_size(segsize):
+            spans = []
+            for part in parts:
+                if spans and part[0] - spans[-1][-1][1] <= segsize:
+                    spans[-1].append(part)
+                else:
+                    spans.append([part])
+            d2 = defer.succeed(None)
+            for span in spans:
+                d2.addCallback(self._read_span, req, span, finished)
+            return d2
+        d.addCallback(_got_segment_size)
+        return d
+
+    def _read_span(self, ign, req, span, finished):
+        if finished:
+            # the client went away, don't start another read
+            return
+        first, last = span[0][0], span[-1][1]
+        c = ByteRangesConsumer(req, first, span)
+        return self.filenode.read(c, first, last-first+1)
+
     def renderHTTP(self, ctx):
         req = IRequest(ctx)
         gte = static.getTypeAndEncoding
@@ -408,8 +513,6 @@ class FileDownloader(rend.Page):
                               static.File.contentEncodings,
                               defaultType="text/plain")
         req.setHeader("content-type", ctype)
-        if encoding:
-            req.setHeader("content-encoding", encoding)
 
         if boolean_of_arg(get_arg(req, "save", "False")):
             # tell the browser to save the file rather display it we don't
@@ -428,29 +531,53 @@ class FileDownloader(rend.Page):
         # TODO: for mutable files, use the roothash. For LIT, hash the data.
         # or maybe just use the URI for CHK and LIT.
         rangeheader = req.getHeader('range')
+        parts = None
         if rangeheader:
             ranges = self.parse_range_header(rangeheader)
 
             # ranges = None means the header didn't parse, so ignore
-            # the header as if it didn't exist.  If is more than one
-            # range, then just return the first for now, until we can
-            # generate multipart/byteranges.
+            # the header as if it didn't exist.
             if ranges is not None:
-                first, last = ranges[0]
-
-                if first >= filesize:
+                # ranges which start beyond the end of the file are
+                # unsatisfiable, and are dropped. The rest are clipped to
+                # the file, and overlapping or adjacent ones are merged.
+                ranges = merge_ranges([(max(0, r[0]), min(filesize-1, r[1]))
+                                       for r in ranges
+                                       if r[0] < filesize])
+                if not ranges:
                     raise WebError('First beyond end of file',
                                    http.REQUESTED_RANGE_NOT_SATISFIABLE)
-                else:
-                    first = max(0, first)
-                    last = min(filesize-1, last)
-
-                    req.setResponseCode(http.PARTIAL_CONTENT)
+                req.setResponseCode(http.PARTIAL_CONTENT)
+                if len(ranges) == 1:
+                    first, last = ranges[0]
                     req.setHeader('content-range',"bytes %s-%s/%s" %
                                   (str(first), str(last),
                                    str(filesize)))
                     contentsize = last - first + 1
                     size = contentsize
+                else:
+                    boundary = base32.b2a(os.urandom(16))
+                    parts = []
+                    for (first, last) in ranges:
+                        header = ("--%s\r\n"
+                                  "Content-Type: %s\r\n"
+                                  "Content-Range: bytes %d-%d/%d\r\n"
+                                  "\r\n" % (boundary, ctype,
+                                             first, last, filesize))
+                        parts.append( (first, last, header) )
+                    trailer = "--%s--\r\n" % boundary
+                    # each part is followed by a CRLF
+                    contentsize = len(trailer)
+                    for (first, last, header) in parts:
+                        contentsize += len(header) + (last-first+1) + 2
+                    req.setHeader("content-type",
+                                  "multipart/byteranges; boundary=%s"
+                                  % boundary)
+
+        if encoding and parts is None:
+            # the encoding would apply to the whole multipart/byteranges
+            # body, but only the file's bytes inside its parts are encoded
+            req.setHeader("content-encoding", encoding)
 
         req.setHeader("content-length", str(contentsize))
         if req.method == "HEAD":
@@ -461,7 +588,11 @@ class FileDownloader(rend.Page):
             finished.append(True)
         req.notifyFinish().addBoth(_request_finished)
 
-        d = self.filenode.read(req, first, size)
+        if parts is None:
+            d = self.filenode.read(req, first, size)
+        else:
+            d = self._read_parts(req, parts, finished)
+            d.addCallback(lambda ign: finished or req.write(trailer))
 
         def _finished(ign):
             if not finished:
@@ -851,6 +851,11 @@ class PublishStatusPage(rend.Page, RateAndTimeMixin):
     def data_rate_encode(self, ctx, data):
         return self._get_rate(data, "encode")
 
+    def data_time_send_blocks(self, ctx, data):
+        return self.publish_status.timings.get("send_blocks")
+    def data_time_wait_for_blocks(self, ctx, data):
+        return self.publish_status.timings.get("wait_for_blocks")
+
     def data_time_pack(self, ctx, data):
         return self.publish_status.timings.get("pack")
     def data_rate_pack(self, ctx, data):
@@ -931,6 +936,10 @@ class MapupdateStatusPage(rend.Page, RateAndTimeMixin):
         else:
             return ""
 
+    def render_follow_up_reads(self, ctx, data):
+        follow_up, avoided = data.get_follow_up_reads()
+        return "%d (%d avoided by reading more up front)" % (follow_up, avoided)
+
     def data_time_total(self, ctx, data):
         return self.update_status.timings.get("total")
 
@@ -4,6 +4,7 @@ from nevow import rend, tags as T, inevow
 from allmydata.web.common import getxmlfile, abbreviate_time, get_arg
 from allmydata.util.abbreviate import abbreviate_space
 from allmydata.util import time_format, idlib
+from allmydata.storage.server import LATENCY_WINDOWS
 
 def remove_prefix(s, prefix):
     if not s.startswith(prefix):
@@ -24,6 +25,10 @@ class StorageStatus(rend.Page):
         t = get_arg(req, "t")
         if t == "json":
             return self.render_JSON(req)
+        if t == "latencies":
+            return self.render_latencies_JSON(req)
+        if t == "space":
+            return self.render_space_JSON(req)
         return rend.Page.renderHTTP(self, ctx)
 
     def render_JSON(self, req):
@@ -33,6 +38,21 @@ class StorageStatus(rend.Page):
              "lease-checker": self.storage.lease_checker.get_state(),
              "lease-checker-progress": self.storage.lease_checker.get_progress(),
              }
+        host = self.storage.crawler_host
+        if host:
+            d["crawler-host-progress"] = host.get_progress()
+            d["crawler-host-consumers"] = host.get_consumer_progress()
+        return simplejson.dumps(d, indent=1) + "\n"
+
+    def render_latencies_JSON(self, req):
+        req.setHeader("content-type", "text/plain")
+        d = dict([(window_name, self.storage.get_latencies(window))
+                  for (window_name, window) in LATENCY_WINDOWS.items()])
+        return simplejson.dumps(d, indent=1) + "\n"
+
+    def render_space_JSON(self, req):
+        req.setHeader("content-type", "text/plain")
+        d = self.storage.get_space_usage()
         return simplejson.dumps(d, indent=1) + "\n"
 
     def data_nickname(self, ctx, storage):
@@ -93,12 +113,22 @@ class StorageStatus(rend.Page):
         return d
 
     def data_last_complete_bucket_count(self, ctx, data):
-        s = self.storage.bucket_counter.get_state()
-        count = s.get("last-complete-bucket-count")
+        stats = self.storage.get_stats()
+        count = stats.get("storage_server.total_bucket_count")
         if count is None:
             return "Not computed yet"
         return count
 
+    def render_share_counts(self, ctx, storage):
+        stats = self.storage.get_stats()
+        if "storage_server.total_share_bytes" not in stats:
+            return ctx.tag["Not computed yet"]
+        return ctx.tag["%d immutable (%s), %d mutable (%s)" %
+                       (stats["storage_server.immutable_share_count"],
+                        abbreviate_space(stats["storage_server.immutable_share_bytes"]),
+                        stats["storage_server.mutable_share_count"],
+                        abbreviate_space(stats["storage_server.mutable_share_bytes"]))]
+
     def render_count_crawler_status(self, ctx, storage):
         p = self.storage.bucket_counter.get_progress()
         return ctx.tag[self.format_crawler_progress(p)]
@@ -128,6 +158,19 @@ class StorageStatus(rend.Page):
             return ["Next crawl in %s" % abbreviate_time(soon),
                     cycletime_s]
 
+    def render_crawler_host(self, ctx, storage):
+        host = self.storage.crawler_host
+        if not host:
+            return ""
+        consumers = T.ul()
+        for name, p in sorted(host.get_consumer_progress().items()):
+            consumers[T.li[name, ": ", self.format_crawler_progress(p)]]
+        return ctx.tag[T.h2["Combined Crawler"],
+                       T.p["One walk of the shares is shared by these ",
+                           "crawlers: ",
+                           self.format_crawler_progress(host.get_progress())],
+                       consumers]
+
     def render_lease_expiration_enabled(self, ctx, data):
         lc = self.storage.lease_checker
         if lc.expiration_enabled:
@@ -6,12 +6,13 @@ from nevow import rend, url, tags as T
 from allmydata.immutable.upload import FileHandle
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.web.common import getxmlfile, get_arg, boolean_of_arg, \
-     convert_children_json, WebError, get_format, get_mutable_type
+     convert_children_json, WebError, get_format, get_mutable_type, \
+     get_segment_size, get_immutable_uploadable, reject_streaming_upload
 from allmydata.web import status
 
 def PUTUnlinkedCHK(req, client):
     # "PUT /uri", to create an unlinked file.
-    uploadable = FileHandle(req.content, client.convergence)
+    uploadable = get_immutable_uploadable(req, client.convergence)
     d = client.upload(uploadable)
     d.addCallback(lambda results: results.get_uri())
     # that fires with the URI of the new file
@@ -19,9 +20,11 @@ def PUTUnlinkedCHK(req, client):
 
 def PUTUnlinkedSSK(req, client, version):
     # SDMF: files are small, and we can only upload data
+    reject_streaming_upload(req)
     req.content.seek(0)
     data = MutableFileHandle(req.content)
-    d = client.create_mutable_file(data, version=version)
+    d = client.create_mutable_file(data, version=version,
+                                   segment_size=get_segment_size(req))
     d.addCallback(lambda n: n.get_uri())
     return d
 
@@ -92,7 +95,8 @@ def POSTUnlinkedSSK(req, client, version):
     # SDMF: files are small, and we can only upload data
     contents = req.fields["file"].file
     data = MutableFileHandle(contents)
-    d = client.create_mutable_file(data, version=version)
+    d = client.create_mutable_file(data, version=version,
+                                   segment_size=get_segment_size(req))
     d.addCallback(lambda n: n.get_uri())
     return d
 
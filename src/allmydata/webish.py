@@ -1,12 +1,15 @@
 import re, time
 from twisted.application import service, strports, internet
 from twisted.web import http
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from nevow import appserver, inevow, static
 from allmydata.util import log, fileutil
+from allmydata.immutable import upload
 
 from allmydata.web import introweb, root
 from allmydata.web.common import IOpHandleTable, MyExceptionHandler
+from allmydata.web.coalesce import DirectoryMutationCoalescer, \
+     set_mutation_coalescer
 
 # we must override twisted.web.http.Request.requestReceived with a version
 # that doesn't use cgi.parse_multipart() . Since we actually use Nevow, we
@@ -19,13 +22,60 @@ parse_qs = http.parse_qs
 class MyRequest(appserver.NevowRequest):
     fields = None
     _tahoe_request_had_error = None
+    _streaming_body = None
+    _body_complete = False
+    _finish_when_body_complete = None
+
+    def gotLength(self, length):
+        """Called by channel when it knows the length of the request body.
+
+        PUTs with a streaming=true query argument are processed right away,
+        so the upload can consume the body as it arrives instead of waiting
+        for the whole thing to be spooled to a temporary file.
+        """
+        if length is not None and self._wants_streaming_upload():
+            self.content = upload.StreamingData(length,
+                                                self.channel.transport)
+            self._streaming_body = self.content
+            self._parseRequestLine(self.channel._command, self.channel._path,
+                                   self.channel._version)
+            # let the channel finish dealing with the headers (and send any
+            # "100 Continue") before we start producing a response
+            reactor.callLater(0, self._startProcessing)
+            return
+        appserver.NevowRequest.gotLength(self, length)
+
+    def _wants_streaming_upload(self):
+        if getattr(self.channel, "_command", None) != "PUT":
+            return False
+        x = self.channel._path.split('?', 1)
+        if len(x) == 1:
+            return False
+        args = parse_qs(x[1], 1)
+        if args.get("t", [""])[0].strip():
+            # t=uri and friends read the body as a whole
+            return False
+        streaming = args.get("streaming", ["false"])[0]
+        return streaming.lower() in ("true", "t", "1", "on")
 
     def requestReceived(self, command, path, version):
         """Called by channel when all data has been received.
 
         This method is not intended for users.
         """
+        if self._streaming_body:
+            # we were already processed by gotLength
+            self._body_complete = True
+            self._streaming_body.finish()
+            if self._finish_when_body_complete:
+                (success,) = self._finish_when_body_complete
+                appserver.NevowRequest.finishRequest(self, success)
+            return
         self.content.seek(0,0)
+        self._parseRequestLine(command, path, version)
+        self._startProcessing()
+
+    def _parseRequestLine(self, command, path, version):
         self.args = {}
         self.stack = []
 
@@ -77,9 +127,26 @@ class MyRequest(appserver.NevowRequest):
 ##                      self.channel.transport.loseConnection()
 ##                      return
 ##                  raise
+
+    def _startProcessing(self):
         self.processing_started_timestamp = time.time()
         self.process()
 
+    def finishRequest(self, success):
+        if self._streaming_body and not self._body_complete:
+            # The channel is still delivering our request body, and cannot
+            # move on to the next request (or close cleanly) until it has all
+            # arrived. Throw away the rest of it and finish afterwards.
+            self._streaming_body.discard()
+            self._finish_when_body_complete = (success,)
+            return
+        appserver.NevowRequest.finishRequest(self, success)
+
+    def connectionLost(self, reason):
+        if self._streaming_body and not self._body_complete:
+            self._streaming_body.fail(reason)
+        appserver.NevowRequest.connectionLost(self, reason)
+
     def _logger(self):
         # we build up a log string that hides most of the cap, to preserve
         # user privacy. We retain the query args so we can identify things
@@ -129,7 +196,7 @@ class WebishServer(service.MultiService):
     name = "webish"
 
     def __init__(self, client, webport, nodeurl_path=None, staticdir=None,
-                 clock=None):
+                 clock=None, mutation_window=0):
         service.MultiService.__init__(self)
         # the 'data' argument to all render() methods default to the Client
         # the 'clock' argument to root.Root is, if set, a
@@ -138,6 +205,9 @@ class WebishServer(service.MultiService):
         # time in a deterministic manner.
         self.root = root.Root(client, clock)
         self.buildServer(webport, nodeurl_path, staticdir)
+        # small changes to the same directory are merged into batches
+        set_mutation_coalescer(client,
+                               DirectoryMutationCoalescer(mutation_window))
         if self.root.child_operations:
             self.site.remember(self.root.child_operations, IOpHandleTable)
             self.root.child_operations.setServiceParent(self)